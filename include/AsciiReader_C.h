@@ -0,0 +1,19 @@
+/* Copyright (c) 2003-2019 by Mike Jarvis
+ *
+ * TreeCorr is free software: redistribution and use in source and binary forms,
+ * with or without modification, are permitted provided that the following
+ * conditions are met:
+ *
+ * 1. Redistributions of source code must retain the above copyright notice, this
+ *    list of conditions, and the disclaimer given in the accompanying LICENSE
+ *    file.
+ * 2. Redistributions in binary form must reproduce the above copyright notice,
+ *    this list of conditions, and the disclaimer given in the documentation
+ *    and/or other materials provided with the distribution.
+ */
+
+extern long CountAsciiRows(const char* file_name, const char* comment_marker, int delimiter,
+                           long* ncols);
+extern long ReadAsciiColumns(const char* file_name, const char* comment_marker, int delimiter,
+                             long start, long end, long* cols, int ncols, double** out,
+                             long* err_row);
@@ -17,6 +17,7 @@
 
 #include <vector>
 #include <string>
+#include <map>
 
 #include "Cell.h"
 #include "Field.h"
@@ -33,13 +34,60 @@ class BinnedCorr2
 
 public:
 
+    // When the fields have patches, the results for each pair of patches are accumulated
+    // separately as well as into the total.  They are keyed by the patch numbers.
+    typedef std::map<std::pair<long,long>, BinnedCorr2<D1,D2,B>*> PatchMap;
+
+    // Each thread accumulates its results into its own BinnedCorr2 (and its own PatchMap),
+    // so the threads never need to wait for each other while processing.  The thread's
+    // BinnedCorr2 is only made the first time the thread needs it, so threads that don't
+    // have anything to add to the total (e.g. because they only work on pairs of patches,
+    // which have their own copies) don't use the memory.  At the end, reduce adds them all
+    // into the parent.
+    // When _min_task_pairs > 0, the sub-pairs of any pair of cells with more than this many
+    // pairs of objects are processed in separate OpenMP tasks, so idle threads can help with
+    // the large top-level pairs.  The tasks use the copies of whichever thread runs them.
+    struct ThreadData
+    {
+        ThreadData(BinnedCorr2<D1,D2,B>& _parent, int nthreads) :
+            parent(_parent), corrs(nthreads, 0), patch_results(nthreads),
+            npatch_copies(nthreads, 0) {}
+        ~ThreadData();
+
+        // Get the BinnedCorr2 of the current thread for the patch pair (p1,p2).
+        // (p1 < 0 if there are no patches.)
+        BinnedCorr2<D1,D2,B>& getCorr(long p1, long p2);
+
+        // Add the results of all the threads into parent.  This must be called by every
+        // thread in the parallel region.  Each thread adds up a different range of bins,
+        // so they can all work at the same time.
+        void reduce();
+
+        // The total memory used by the threads' copies of the data vector, in bytes.
+        // This includes the copies made for each pair of patches.
+        long getMemory() const;
+
+        BinnedCorr2<D1,D2,B>& parent;
+        std::vector<BinnedCorr2<D1,D2,B>*> corrs;
+        std::vector<PatchMap> patch_results;
+        // The number of patch pairs in patch_results that had any pairs, counted in reduce
+        // before they are merged into the parent.
+        std::vector<long> npatch_copies;
+    };
+
     BinnedCorr2(double minsep, double maxsep, int nbins, double binsize, double b,
                 double minrpar, double maxrpar, double xp, double yp, double zp,
+                double min_task_pairs, int bucket_size,
                 double* xi0, double* xi1, double* xi2, double* xi3,
                 double* meanr, double* meanlogr, double* weight, double* npairs);
-    BinnedCorr2(const BinnedCorr2& rhs, bool copy_data=true);
+    // If lazy, the data vector isn't allocated until the first pair is added to it.
+    // (This is used for the patch pairs, many of which may not end up having any pairs.)
+    BinnedCorr2(const BinnedCorr2& rhs, bool copy_data=true, bool lazy=false);
     ~BinnedCorr2();
 
+    // Whether the data vector has been allocated.
+    bool hasData() const { return _npairs != 0; }
+
     void clear();  // Set all data to 0.
 
     template <int C, int M>
@@ -58,13 +106,59 @@ public:
     void process11(const Cell<D1,C>& c1, const Cell<D2,C>& c2, const MetricHelper<M>& m,
                    bool do_reverse);
 
+    // In task mode, these process the given pair in a new task if it is large enough.
+    // Otherwise (and normally), they just call process2 or process11.
+    template <int C, int M>
+    void subProcess2(const Cell<D1,C>& c12, const MetricHelper<M>& m);
+
+    template <int C, int M>
+    void subProcess11(const Cell<D1,C>& c1, const Cell<D2,C>& c2, const MetricHelper<M>& m,
+                      bool do_reverse);
+
+    // When both cells have at most _bucket_size objects and need to be split, these process
+    // all pairs of their leaves in a simple loop rather than recursing down to the leaves.
+    template <int C, int M>
+    void processBucket2(const Cell<D1,C>& c12, const MetricHelper<M>& m);
+
+    template <int C, int M>
+    void processBucket11(const Cell<D1,C>& c1, const Cell<D2,C>& c2, const MetricHelper<M>& m,
+                         bool do_reverse);
+
+    // p1, p2 are the positions to use for the binning.  Normally these are just the positions
+    // of c1 and c2, but for TwoD binning with the Periodic metric, p2 is the periodic image of
+    // c2 that is nearest to c1.
     template <int C>
-    void directProcess11(const Cell<D1,C>& c1, const Cell<D2,C>& c2, const double dsq,
+    void directProcess11(const Cell<D1,C>& c1, const Cell<D2,C>& c2,
+                         const Position<C>& p1, const Position<C>& p2, const double dsq,
                          bool do_reverse, int k=-1, double r=0., double logr=0.);
 
     // Note: op= only copies _data.  Not all the params.
     void operator=(const BinnedCorr2<D1,D2,B>& rhs);
     void operator+=(const BinnedCorr2<D1,D2,B>& rhs);
+    // Add just the bins i1 <= i < i2.
+    void add(const BinnedCorr2<D1,D2,B>& rhs, int i1, int i2);
+
+    // Get the BinnedCorr2 in patch_results for the patch pair (p1,p2), making it if necessary.
+    // Its data vector is only allocated once a pair is added to it.
+    BinnedCorr2<D1,D2,B>& getPatchCorr(PatchMap& patch_results, long p1, long p2) const;
+    // Add the results in patch_results to _patch_results.  (Not to the total; that is done
+    // by ThreadData::reduce.)  This takes ownership of the BinnedCorr2 objects in
+    // patch_results.  The ones that never had any pairs added to them are dropped.
+    void mergePatchResults(PatchMap& patch_results);
+
+    // Copy the results for each patch pair into the given arrays, which have one row of
+    // nbins values for each patch pair.  Then clear _patch_results.
+    long getNPatchPairs() const { return long(_patch_results.size()); }
+    void takePatchResults(long* p1, long* p2, double* xi0, double* xi1, double* xi2,
+                          double* xi3, double* meanr, double* meanlogr, double* weight,
+                          double* npairs);
+
+    // The memory used by one copy of the data vector, in bytes.
+    long getMemory() const
+    { return (XiData<D1,D2>::narrays + 4) * long(_nbins) * sizeof(double); }
+    // The memory used by the threads' copies of the data vector in the last call to process,
+    // including the copies for each pair of patches.
+    long getThreadMemory() const { return _thread_memory; }
 
     // Sample a random subset of pairs in a given range
     template <int C, int M>
@@ -81,6 +175,8 @@ public:
 
 protected:
 
+    void newData();  // Allocate the data vector and set it to 0.
+
     double _minsep;
     double _maxsep;
     int _nbins;
@@ -88,6 +184,8 @@ protected:
     double _b;
     double _minrpar, _maxrpar;
     double _xp, _yp, _zp;
+    double _min_task_pairs;
+    long _bucket_size;
     double _logminsep;
     double _halfminsep;
     double _minsepsq;
@@ -110,19 +208,27 @@ protected:
     double* _meanlogr;
     double* _weight;
     double* _npairs;
+
+    PatchMap _patch_results;
+    long _thread_memory;
+
+    // These are only set while processing in task mode.
+    ThreadData* _task_data;
+    long _task_p1, _task_p2;  // The patch pair that this BinnedCorr2 accumulates.
 };
 
 template <int D1, int D2>
 struct XiData // This works for NK, KK
 {
     XiData(double* xi0, double*, double*, double*) : xi(xi0) {}
+    enum { narrays = 1 };
 
     void new_data(int n) { xi = new double[n]; }
     void delete_data(int n) { delete [] xi; xi = 0; }
     void copy(const XiData<D1,D2>& rhs,int n)
     { for (int i=0; i<n; ++i) xi[i] = rhs.xi[i]; }
-    void add(const XiData<D1,D2>& rhs,int n)
-    { for (int i=0; i<n; ++i) xi[i] += rhs.xi[i]; }
+    void add(const XiData<D1,D2>& rhs, int i1, int i2)
+    { for (int i=i1; i<i2; ++i) xi[i] += rhs.xi[i]; }
     void clear(int n)
     { for (int i=0; i<n; ++i) xi[i] = 0.; }
     void write(std::ostream& os) const // Just used for debugging.  Print the first value.
@@ -139,6 +245,7 @@ template <int D1>
 struct XiData<D1, GData> // This works for NG, KG
 {
     XiData(double* xi0, double* xi1, double*, double*) : xi(xi0), xi_im(xi1) {}
+    enum { narrays = 2 };
 
     void new_data(int n)
     {
@@ -155,10 +262,10 @@ struct XiData<D1, GData> // This works for NG, KG
         for (int i=0; i<n; ++i) xi[i] = rhs.xi[i];
         for (int i=0; i<n; ++i) xi_im[i] = rhs.xi_im[i];
     }
-    void add(const XiData<D1,GData>& rhs,int n)
+    void add(const XiData<D1,GData>& rhs, int i1, int i2)
     {
-        for (int i=0; i<n; ++i) xi[i] += rhs.xi[i];
-        for (int i=0; i<n; ++i) xi_im[i] += rhs.xi_im[i];
+        for (int i=i1; i<i2; ++i) xi[i] += rhs.xi[i];
+        for (int i=i1; i<i2; ++i) xi_im[i] += rhs.xi_im[i];
     }
     void clear(int n)
     {
@@ -177,6 +284,7 @@ struct XiData<GData, GData>
 {
     XiData(double* xi0, double* xi1, double* xi2, double* xi3) :
         xip(xi0), xip_im(xi1), xim(xi2), xim_im(xi3) {}
+    enum { narrays = 4 };
 
     void new_data(int n)
     {
@@ -199,12 +307,12 @@ struct XiData<GData, GData>
         for (int i=0; i<n; ++i) xim[i] = rhs.xim[i];
         for (int i=0; i<n; ++i) xim_im[i] = rhs.xim_im[i];
     }
-    void add(const XiData<GData,GData>& rhs,int n)
+    void add(const XiData<GData,GData>& rhs, int i1, int i2)
     {
-        for (int i=0; i<n; ++i) xip[i] += rhs.xip[i];
-        for (int i=0; i<n; ++i) xip_im[i] += rhs.xip_im[i];
-        for (int i=0; i<n; ++i) xim[i] += rhs.xim[i];
-        for (int i=0; i<n; ++i) xim_im[i] += rhs.xim_im[i];
+        for (int i=i1; i<i2; ++i) xip[i] += rhs.xip[i];
+        for (int i=i1; i<i2; ++i) xip_im[i] += rhs.xip_im[i];
+        for (int i=i1; i<i2; ++i) xim[i] += rhs.xim[i];
+        for (int i=i1; i<i2; ++i) xim_im[i] += rhs.xim_im[i];
     }
     void clear(int n)
     {
@@ -226,10 +334,11 @@ template <>
 struct XiData<NData, NData>
 {
     XiData(double* , double* , double* , double* ) {}
+    enum { narrays = 0 };
     void new_data(int n) {}
     void delete_data(int n) {}
     void copy(const XiData<NData,NData>& rhs,int n) {}
-    void add(const XiData<NData,NData>& rhs,int n) {}
+    void add(const XiData<NData,NData>& rhs, int i1, int i2) {}
     void clear(int n) {}
     void write(std::ostream& os) const {}
 };
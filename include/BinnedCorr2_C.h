@@ -15,11 +15,21 @@
 extern void* BuildCorr2(int d1, int d2, int bin_type,
                         double minsep, double maxsep, int nbins, double binsize, double b,
                         double minrpar, double maxrpar, double xp, double yp, double zp,
+                        double min_task_pairs, int bucket_size,
                         double* xip, double* xip_im, double* xim, double* xim_im,
                         double* meanr, double* meanlogr, double* weight, double* npairs);
 
 extern void DestroyCorr2(void* corr, int d1, int d2, int bin_type);
 
+extern long GetCorr2NPatchPairs(void* corr, int d1, int d2, int bin_type);
+
+extern long GetCorr2ThreadMemory(void* corr, int d1, int d2, int bin_type);
+
+extern void TakeCorr2PatchResults(void* corr, int d1, int d2, int bin_type, long* p1, long* p2,
+                                  double* xi0, double* xi1, double* xi2, double* xi3,
+                                  double* meanr, double* meanlogr, double* weight,
+                                  double* npairs);
+
 extern void ProcessAuto2(void* corr, void* field, int dots,
                          int d, int coord, int bin_type, int metric);
 
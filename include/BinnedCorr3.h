@@ -45,6 +45,29 @@ public:
     BinnedCorr3(const BinnedCorr3& rhs, bool copy_data=true);
     ~BinnedCorr3();
 
+    // Each thread accumulates its results into its own BinnedCorr3, which is only made the
+    // first time the thread needs it.  At the end, reduce adds them all into the parent.
+    // See the equivalent struct in BinnedCorr2 for more details.
+    struct ThreadData
+    {
+        ThreadData(BinnedCorr3<DC1,DC2,DC3,B>& _parent, int nthreads) :
+            parent(_parent), corrs(nthreads, 0) {}
+        ~ThreadData();
+
+        // Get the BinnedCorr3 of the current thread.
+        BinnedCorr3<DC1,DC2,DC3,B>& getCorr();
+
+        // Add the results of all the threads into parent.  This must be called by every
+        // thread in the parallel region.  Each thread adds up a different range of bins.
+        void reduce();
+
+        // The total memory used by the threads' copies of the data vector, in bytes.
+        long getMemory() const;
+
+        BinnedCorr3<DC1,DC2,DC3,B>& parent;
+        std::vector<BinnedCorr3<DC1,DC2,DC3,B>*> corrs;
+    };
+
     void clear();  // Set all data to 0.
 
     template <int C, int M>
@@ -73,6 +96,14 @@ public:
     // Note: op= only copies _data.  Not all the params.
     void operator=(const BinnedCorr3<DC1,DC2,DC3,B>& rhs);
     void operator+=(const BinnedCorr3<DC1,DC2,DC3,B>& rhs);
+    // Add just the bins i1 <= i < i2.
+    void add(const BinnedCorr3<DC1,DC2,DC3,B>& rhs, int i1, int i2);
+
+    // The memory used by one copy of the data vector, in bytes.
+    long getMemory() const
+    { return (ZetaData<DC1,DC2,DC3>::narrays + 10) * long(_ntot) * sizeof(double); }
+    // The memory used by the threads' copies of the data vector in the last call to process.
+    long getThreadMemory() const { return _thread_memory; }
 
 protected:
 
@@ -130,6 +161,8 @@ protected:
     double* _meanv;
     double* _weight;
     double* _ntri;
+
+    long _thread_memory;
 };
 
 template <int DC1, int DC2, int DC3>
@@ -137,13 +170,14 @@ struct ZetaData // This works for NNK, NKK, KKK
 {
     ZetaData(double* zeta0, double*, double*, double*, double*, double*, double*, double*) :
         zeta(zeta0) {}
+    enum { narrays = 1 };
 
     void new_data(int n) { zeta = new double[n]; }
     void delete_data() { delete [] zeta; zeta = 0; }
     void copy(const ZetaData<DC1,DC2,DC3>& rhs, int n)
     { for (int i=0; i<n; ++i) zeta[i] = rhs.zeta[i]; }
-    void add(const ZetaData<DC1,DC2,DC3>& rhs, int n)
-    { for (int i=0; i<n; ++i) zeta[i] += rhs.zeta[i]; }
+    void add(const ZetaData<DC1,DC2,DC3>& rhs, int i1, int i2)
+    { for (int i=i1; i<i2; ++i) zeta[i] += rhs.zeta[i]; }
     void clear(int n)
     { for (int i=0; i<n; ++i) zeta[i] = 0.; }
     void write(std::ostream& os) const // Just used for debugging.  Print the first value.
@@ -163,6 +197,7 @@ struct ZetaData<DC1, DC2, GData> // This works for NNG, NKG, KKG
 {
     ZetaData(double* z0, double* z1, double*, double*, double*, double*, double*, double*) :
         zeta(z0), zeta_im(z1) {}
+    enum { narrays = 2 };
 
     void new_data(int n)
     {
@@ -179,10 +214,10 @@ struct ZetaData<DC1, DC2, GData> // This works for NNG, NKG, KKG
         for (int i=0; i<n; ++i) zeta[i] = rhs.zeta[i];
         for (int i=0; i<n; ++i) zeta_im[i] = rhs.zeta_im[i];
     }
-    void add(const ZetaData<DC1,DC2,GData>& rhs, int n)
+    void add(const ZetaData<DC1,DC2,GData>& rhs, int i1, int i2)
     {
-        for (int i=0; i<n; ++i) zeta[i] += rhs.zeta[i];
-        for (int i=0; i<n; ++i) zeta_im[i] += rhs.zeta_im[i];
+        for (int i=i1; i<i2; ++i) zeta[i] += rhs.zeta[i];
+        for (int i=i1; i<i2; ++i) zeta_im[i] += rhs.zeta_im[i];
     }
     void clear(int n)
     {
@@ -203,6 +238,7 @@ struct ZetaData<DC1, GData, GData> // This works for NGG, KGG
 {
     ZetaData(double* z0, double* z1, double* z2, double* z3, double*, double*, double*, double*) :
         zetap(z0), zetap_im(z1), zetam(z2), zetam_im(z3) {}
+    enum { narrays = 4 };
 
     void new_data(int n)
     {
@@ -225,12 +261,12 @@ struct ZetaData<DC1, GData, GData> // This works for NGG, KGG
         for (int i=0; i<n; ++i) zetam[i] = rhs.zetam[i];
         for (int i=0; i<n; ++i) zetam_im[i] = rhs.zetam_im[i];
     }
-    void add(const ZetaData<DC1,GData,GData>& rhs, int n)
+    void add(const ZetaData<DC1,GData,GData>& rhs, int i1, int i2)
     {
-        for (int i=0; i<n; ++i) zetap[i] += rhs.zetap[i];
-        for (int i=0; i<n; ++i) zetap_im[i] += rhs.zetap_im[i];
-        for (int i=0; i<n; ++i) zetam[i] += rhs.zetam[i];
-        for (int i=0; i<n; ++i) zetam_im[i] += rhs.zetam_im[i];
+        for (int i=i1; i<i2; ++i) zetap[i] += rhs.zetap[i];
+        for (int i=i1; i<i2; ++i) zetap_im[i] += rhs.zetap_im[i];
+        for (int i=i1; i<i2; ++i) zetam[i] += rhs.zetam[i];
+        for (int i=i1; i<i2; ++i) zetam_im[i] += rhs.zetam_im[i];
     }
     void clear(int n)
     {
@@ -258,6 +294,7 @@ struct ZetaData<GData, GData, GData>
              double* z4, double* z5, double* z6, double* z7) :
         gam0r(z0), gam0i(z1), gam1r(z2), gam1i(z3),
         gam2r(z4), gam2i(z5), gam3r(z6), gam3i(z7) {}
+    enum { narrays = 8 };
 
     void new_data(int n)
     {
@@ -292,16 +329,16 @@ struct ZetaData<GData, GData, GData>
         for (int i=0; i<n; ++i) gam3r[i] = rhs.gam3r[i];
         for (int i=0; i<n; ++i) gam3i[i] = rhs.gam3i[i];
     }
-    void add(const ZetaData<GData,GData,GData>& rhs, int n)
+    void add(const ZetaData<GData,GData,GData>& rhs, int i1, int i2)
     {
-        for (int i=0; i<n; ++i) gam0r[i] += rhs.gam0r[i];
-        for (int i=0; i<n; ++i) gam0i[i] += rhs.gam0i[i];
-        for (int i=0; i<n; ++i) gam1r[i] += rhs.gam1r[i];
-        for (int i=0; i<n; ++i) gam1i[i] += rhs.gam1i[i];
-        for (int i=0; i<n; ++i) gam2r[i] += rhs.gam2r[i];
-        for (int i=0; i<n; ++i) gam2i[i] += rhs.gam2i[i];
-        for (int i=0; i<n; ++i) gam3r[i] += rhs.gam3r[i];
-        for (int i=0; i<n; ++i) gam3i[i] += rhs.gam3i[i];
+        for (int i=i1; i<i2; ++i) gam0r[i] += rhs.gam0r[i];
+        for (int i=i1; i<i2; ++i) gam0i[i] += rhs.gam0i[i];
+        for (int i=i1; i<i2; ++i) gam1r[i] += rhs.gam1r[i];
+        for (int i=i1; i<i2; ++i) gam1i[i] += rhs.gam1i[i];
+        for (int i=i1; i<i2; ++i) gam2r[i] += rhs.gam2r[i];
+        for (int i=i1; i<i2; ++i) gam2i[i] += rhs.gam2i[i];
+        for (int i=i1; i<i2; ++i) gam3r[i] += rhs.gam3r[i];
+        for (int i=i1; i<i2; ++i) gam3i[i] += rhs.gam3i[i];
     }
     void clear(int n)
     {
@@ -336,10 +373,11 @@ template <>
 struct ZetaData<NData, NData, NData>
 {
     ZetaData(double* , double* , double* , double*, double*, double*, double*, double * ) {}
+    enum { narrays = 0 };
     void new_data(int n) {}
     void delete_data() {}
     void copy(const ZetaData<NData,NData,NData>& rhs, int n) {}
-    void add(const ZetaData<NData,NData,NData>& rhs, int n) {}
+    void add(const ZetaData<NData,NData,NData>& rhs, int i1, int i2) {}
     void clear(int n) {}
     void write(std::ostream& os) const {}
     void write_full(std::ostream& os, int n) const {}
@@ -25,6 +25,8 @@ extern void* BuildCorr3(int d1, int d2, int d3, int bin_type,
 
 extern void DestroyCorr3(void* corr, int d1, int d2, int d3, int bin_type);
 
+extern long GetCorr3ThreadMemory(void* corr, int d1, int d2, int d3, int bin_type);
+
 extern void ProcessAuto3(void* corr, void* field, int dots,
                          int d, int coord, int bin_type, int metric);
 
@@ -53,9 +53,15 @@ struct WPosLeafInfo : public LeafInfo
 };
 
 // When we decide we're at a leaf, but we have >1 index to include, we use this instead.
+// The indices point into a single array owned by the Field, which holds the indices of
+// all the leaves in depth-first order.
+// The location is stored as a byte offset from this struct rather than as a pointer, so the
+// Cells are still valid when the tree is written to a file and memory mapped back in.
 struct ListLeafInfo
 {
-    std::vector<long>* indices;
+    long offset;
+    const long* indices() const
+    { return reinterpret_cast<const long*>(reinterpret_cast<const char*>(this) + offset); }
 };
 
 
@@ -70,7 +76,7 @@ template <int C>
 class CellData<NData,C>
 {
 public:
-    CellData() {}
+    CellData() : _w(0.), _n(0) {}
 
     CellData(const Position<C>& pos, double w) :
         _pos(pos), _w(w), _n(w != 0.) {}
@@ -79,12 +85,12 @@ public:
     CellData(const Position<C2>& pos, double w) :
         _pos(pos), _w(w), _n(w != 0.) {}
 
-    CellData(const std::vector<std::pair<CellData<NData,C>*,WPosLeafInfo> >& vdata,
+    CellData(const std::vector<std::pair<CellData<NData,C>,WPosLeafInfo> >& vdata,
              size_t start, size_t end);
 
     // This doesn't do anything, but is provided for consistency with the other
     // kinds of CellData.
-    void finishAverages(const std::vector<std::pair<CellData<NData,C>*,WPosLeafInfo> >&,
+    void finishAverages(const std::vector<std::pair<CellData<NData,C>,WPosLeafInfo> >&,
                         size_t , size_t ) {}
 
     const Position<C>& getPos() const { return _pos; }
@@ -106,7 +112,7 @@ template <int C>
 class CellData<KData,C>
 {
 public:
-    CellData() {}
+    CellData() : _wk(0.), _w(0.), _n(0) {}
 
     CellData(const Position<C>& pos, double k, double w) :
         _pos(pos), _wk(w*k), _w(w), _n(w != 0.)
@@ -117,12 +123,12 @@ public:
         _pos(pos), _wk(w*k), _w(w), _n(w != 0.)
     {}
 
-    CellData(const std::vector<std::pair<CellData<KData,C>*,WPosLeafInfo> >& vdata,
+    CellData(const std::vector<std::pair<CellData<KData,C>,WPosLeafInfo> >& vdata,
              size_t start, size_t end);
 
     // The above constructor just computes the mean pos, since sometimes that's all we
     // need.  So this function will finish the rest of the construction when desired.
-    void finishAverages(const std::vector<std::pair<CellData<KData,C>*,WPosLeafInfo> >&,
+    void finishAverages(const std::vector<std::pair<CellData<KData,C>,WPosLeafInfo> >&,
                         size_t start, size_t end);
 
     const Position<C>& getPos() const { return _pos; }
@@ -146,7 +152,7 @@ template <int C>
 class CellData<GData,C>
 {
 public:
-    CellData() {}
+    CellData() : _wg(0.), _w(0.), _n(0) {}
 
     CellData(const Position<C>& pos, const std::complex<double>& g, double w) :
         _pos(pos), _wg(w*g), _w(w), _n(w != 0.)
@@ -157,12 +163,12 @@ public:
         _pos(pos), _wg(w*g), _w(w), _n(w != 0.)
     {}
 
-    CellData(const std::vector<std::pair<CellData<GData,C>*,WPosLeafInfo> >& vdata,
+    CellData(const std::vector<std::pair<CellData<GData,C>,WPosLeafInfo> >& vdata,
              size_t start, size_t end);
 
     // The above constructor just computes the mean pos, since sometimes that's all we
     // need.  So this function will finish the rest of the construction when desired.
-    void finishAverages(const std::vector<std::pair<CellData<GData,C>*,WPosLeafInfo> >&,
+    void finishAverages(const std::vector<std::pair<CellData<GData,C>,WPosLeafInfo> >&,
                         size_t start, size_t end);
 
     const Position<C>& getPos() const { return _pos; }
@@ -195,47 +201,68 @@ public:
     // size from the centroid.
     // The structure also keeps track of some averages and sums about
     // the galaxies which are used in the correlation function calculations.
-
-    Cell(CellData<D,C>* data, const LeafInfo& info) :
-        _size(0.), _sizesq(0.), _data(data), _left(0), _info(info) {}
-
-    Cell(std::vector<std::pair<CellData<D,C>*,WPosLeafInfo> >& vdata,
-         double minsizesq, SplitMethod sm, bool brute, size_t start, size_t end);
-
-    Cell(CellData<D,C>* ave, double sizesq,
-         std::vector<std::pair<CellData<D,C>*,WPosLeafInfo> >& vdata,
-         double minsizesq, SplitMethod sm, bool brute, size_t start, size_t end);
-
-    void finishInit(std::vector<std::pair<CellData<D,C>*,WPosLeafInfo> >& vdata,
-                    double minsizesq, SplitMethod sm, bool brute, size_t start, size_t end);
-
-    ~Cell()
-    {
-        Assert(_data);
-        if (_left) {
-            Assert(_right);
-            delete _left;
-            delete _right;
-        } else if (_data->getN() > 1) {
-            delete _listinfo.indices;
-        } // if !left and N==1, then _info, which doesn't need anything to be deleted.
-        delete (_data);
-    }
-
-    const CellData<D,C>& getData() const { return *_data; }
-    const Position<C>& getPos() const { return _data->getPos(); }
-    double getW() const { return _data->getW(); }
-    long getN() const { return _data->getN(); }
+    //
+    // Cells are not allocated individually.  A tree of Cells is stored in a single
+    // contiguous array in depth-first order, so the left child of a Cell is always the
+    // next element in the array, and the right child is _right elements further along.
+    // Leaves have _right == 0.
+
+    Cell() : _size(0.), _sizesq(0.), _data(), _right(0), _info() {}
+
+    Cell(const CellData<D,C>& data, const LeafInfo& info) :
+        _size(0.), _sizesq(0.), _data(data), _right(0), _info(info) {}
+
+    // Build the tree for the data in vdata[start:end], appending the Cells in depth-first
+    // order to the end of cells.  The indices for any leaves with N > 1 are written
+    // into indices[start:end].
+    static void BuildTree(
+        std::vector<Cell<D,C> >& cells, const CellData<D,C>& ave, double sizesq,
+        std::vector<std::pair<CellData<D,C>,WPosLeafInfo> >& vdata, long* indices,
+        double minsizesq, SplitMethod sm, bool brute, size_t start, size_t end);
+
+    static void BuildTree(
+        std::vector<Cell<D,C> >& cells,
+        std::vector<std::pair<CellData<D,C>,WPosLeafInfo> >& vdata, long* indices,
+        double minsizesq, SplitMethod sm, bool brute, size_t start, size_t end);
+
+    const CellData<D,C>& getData() const { return _data; }
+    const Position<C>& getPos() const { return _data.getPos(); }
+    double getW() const { return _data.getW(); }
+    long getN() const { return _data.getN(); }
 
     double getSize() const { return _size; }
     double getSizeSq() const { return _sizesq; }
     // For PairCells, getAllSize is different from getSize.
     double getAllSize() const { return _size; }
 
-    const Cell<D,C>* getLeft() const { return _left; }
-    const Cell<D,C>* getRight() const { return _left ? _right : 0; }
-    const LeafInfo& getInfo() const { Assert(!_left && getN()==1); return _info; }
-    const ListLeafInfo& getListInfo() const { Assert(!_left && getN()!=1); return _listinfo; }
+    const Cell<D,C>* getLeft() const { return _right ? this+1 : 0; }
+    const Cell<D,C>* getRight() const { return _right ? this+_right : 0; }
+    const LeafInfo& getInfo() const { Assert(!_right && getN()==1); return _info; }
+    const ListLeafInfo& getListInfo() const { Assert(!_right && getN()!=1); return _listinfo; }
+    bool isListLeaf() const { return !_right && getN()!=1; }
+    // The Cells below this one are stored right after it, so the whole subtree is the
+    // range [this, getEnd()).  The last Cell in the range is found by following the right
+    // children down to a leaf.
+    const Cell<D,C>* getEnd() const
+    {
+        const Cell<D,C>* c = this;
+        while (c->_right) c += c->_right;
+        return c+1;
+    }
+
+    // BuildTree leaves the _listinfo of each leaf holding its start position in the indices
+    // array, since the Cells are moved after being built.  This sets the final offsets once
+    // the Cells are in place.
+    void finishListInfo(const long* indices)
+    { if (isListLeaf()) setListIndices(indices + _listinfo.offset); }
+    void setListIndices(const long* indices)
+    {
+        _listinfo.offset = long(reinterpret_cast<const char*>(indices) -
+                                reinterpret_cast<const char*>(&_listinfo));
+    }
+    // Move the location of the list of indices by shift bytes relative to this Cell.
+    void shiftListInfo(long shift)
+    { if (isListLeaf()) _listinfo.offset += shift; }
 
     // These are mostly used for debugging purposes.
     long countLeaves() const;
@@ -251,23 +278,22 @@ protected:
     float _size;
     float _sizesq;
 
-    CellData<D,C>* _data;
-    Cell<D,C>* _left;
+    CellData<D,C> _data;
+    long _right;                // Offset to the right child.  0 for leaves.
     union {
-        Cell<D,C>* _right;      // Use this when _left != 0
-        LeafInfo _info;         // Use this when _left == 0 and N == 1
-        ListLeafInfo _listinfo; // Use this when _left == 0 and N > 1
+        LeafInfo _info;         // Use this when _right == 0 and N == 1
+        ListLeafInfo _listinfo; // Use this when _right == 0 and N > 1
     };
 };
 
 template <int D, int C>
 double CalculateSizeSq(
-    const Position<C>& cen, const std::vector<std::pair<CellData<D,C>*,WPosLeafInfo> >& vdata,
+    const Position<C>& cen, const std::vector<std::pair<CellData<D,C>,WPosLeafInfo> >& vdata,
     size_t start, size_t end);
 
 template <int D, int C>
 size_t SplitData(
-    std::vector<std::pair<CellData<D,C>*,WPosLeafInfo> >& vdata, SplitMethod sm,
+    std::vector<std::pair<CellData<D,C>,WPosLeafInfo> >& vdata, SplitMethod sm,
     size_t start, size_t end, const Position<C>& meanpos);
 
 template <int D, int C>
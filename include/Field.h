@@ -17,6 +17,9 @@
 
 #include "Cell.h"
 
+// The number of target locations in each block for Field::getNearMany.
+const long NEAR_BLOCK_SIZE = 64;
+
 // Most of the functionality for building Cells and doing the correlation functions is the
 // same regardless of which kind of Cell we have (N, K, G) or which kind of positions we
 // are using (Flat, ThreeD, Sphere), or what metric we use for the distances between points
@@ -39,25 +42,101 @@ template <int D, int C>
 class Field
 {
 public:
-    Field(double* x, double* y, double* z, double* g1, double* g2, double* k,
-          double* w, double* wpos, long nobj,
+    // T may be double or float.  With float inputs, each value is converted to double
+    // as the tree is built, so the tree is always in double precision.
+    template <typename T>
+    Field(T* x, T* y, T* z, T* g1, T* g2, T* k,
+          T* w, T* wpos, long nobj, long* patch,
           double minsize, double maxsize,
           int sm_int, bool brute, int mintop, int maxtop);
     ~Field();
 
+    // Write the tree to a file, which can be memory mapped by Load.
+    // Returns the number of bytes written, or -1 if there was an error.
+    long save(const char* file_name) const;
+
+    // Write the same thing to a buffer in memory, which must have getSaveSize() bytes.
+    void saveBuffer(char* buffer) const;
+    long getSaveSize() const;
+
+    // Make a Field from a file written by save.  The Cells and indices are used directly
+    // from a read-only memory map of the file, so processes that load the same file share
+    // a single copy of the tree.  Returns 0 if the file cannot be used.
+    static Field<D,C>* Load(const char* file_name);
+
+    // Make a Field from a buffer written by saveBuffer (e.g. in shared memory).  As for Load,
+    // the buffer is used directly, so it needs to persist as long as the Field does.
+    static Field<D,C>* LoadBuffer(const char* data, long size);
+
     long getNObj() const { return _nobj; }
     long getNTopLevel() const { return long(_cells.size()); }
     const std::vector<Cell<D,C>*>& getCells() const { return _cells; }
+    // The patch number of each top-level cell, or an empty vector if there are no patches.
+    const std::vector<long>& getPatches() const { return _patches; }
     long countNear(double x, double y, double z, double sep) const;
     void getNear(double x, double y, double z, double sep, long* indices, int n) const;
 
+    // Append the indices of the points within sep of (x,y,z) to the end of indices.
+    // If catx, caty are given (and catz if C != Flat), then these are the positions of the
+    // original objects, which are used to make the result exact when minsize > 0.
+    void getNear(double x, double y, double z, double sep,
+                 const double* catx, const double* caty, const double* catz,
+                 std::vector<long>& indices) const;
+
+    // Versions of the above for many target locations at once, done in parallel.
+    // getNearMany stores the indices for each block of NEAR_BLOCK_SIZE targets in
+    // consecutive elements of blocks, each sorted by index within each target.
+    void countNearMany(const double* x, const double* y, const double* z, const double* sep,
+                       long n, const double* catx, const double* caty, const double* catz,
+                       long* counts) const;
+    void getNearMany(const double* x, const double* y, const double* z, const double* sep,
+                     long n, const double* catx, const double* caty, const double* catz,
+                     long* counts, std::vector<std::vector<long> >& blocks) const;
+
+    // Find the k nearest points to each of n target locations, done in parallel.
+    // The indices and squared distances are written to indices and distsq, which each have
+    // n*k elements, sorted by distance for each target.  If there are fewer than k points
+    // in the field, the remaining indices are -1 and distsq are infinity.
+    // As above, catx, caty, catz are used to get exact distances when minsize > 0.
+    void getKNN(const double* x, const double* y, const double* z, long n, int k,
+                const double* catx, const double* caty, const double* catz,
+                long* indices, double* distsq) const;
+
+    // The total number of bytes used to store the tree.
+    long getMemory() const;
+
 private:
 
+    // Used by LoadBuffer.
+    Field() : _map(0), _map_size(0) {}
+
+    template <class Writer>
+    bool write(Writer& writer) const;
+
     long _nobj;
     double _minsize;
     double _maxsize;
     SplitMethod _sm;
+    bool _brute;
+    int _mintop;
+    int _maxtop;
+
+    // All the Cells are stored in _nodes, with each top-level tree stored contiguously
+    // in depth-first order.  _cells has pointers to the top-level Cells within _nodes.
+    // The indices of all the leaves are stored in _indices, also in depth-first order.
+    std::vector<Cell<D,C> > _nodes;
+    std::vector<long> _indices;
     std::vector<Cell<D,C>*> _cells;
+    std::vector<long> _patches;
+
+    // For a Field made by Load, _nodes and _indices are empty, and the Cells and indices
+    // are in the memory mapped file instead.  These point to whichever is being used.
+    const Cell<D,C>* _node_data;
+    long _nnodes;
+    const long* _index_data;
+    long _nindices;
+    void* _map;
+    size_t _map_size;
 };
 
 // A SimpleField just stores the celldata.  It doesn't go on to build up the Cells.
@@ -66,14 +145,16 @@ template <int D, int C>
 class SimpleField
 {
 public:
-    SimpleField(double* x, double* y, double* z, double* g1, double* g2, double* k,
-                double* w, double* wpos, long nobj);
+    template <typename T>
+    SimpleField(T* x, T* y, T* z, T* g1, T* g2, T* k,
+                T* w, T* wpos, long nobj);
     ~SimpleField();
 
     long getNObj() const { return long(_cells.size()); }
     const std::vector<Cell<D,C>*>& getCells() const { return _cells; }
 
 private:
+    std::vector<Cell<D,C> > _nodes;
     std::vector<Cell<D,C>*> _cells;
 };
 
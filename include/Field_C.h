@@ -13,29 +13,61 @@
  */
 
 extern void* BuildGField(double* x, double* y, double* z, double* g1, double* g2,
-                         double* w, double* wpos, long nobj,
+                         double* w, double* wpos, long nobj, long* patch,
                          double minsize, double maxsize,
                          int sm_int, int brute, int mintop, int maxtop, int coords);
 
 extern void* BuildKField(double* x, double* y, double* z, double* k,
-                         double* w, double* wpos, long nobj,
+                         double* w, double* wpos, long nobj, long* patch,
                          double minsize, double maxsize,
                          int sm_int, int brute, int mintop, int maxtop, int coords);
 
 extern void* BuildNField(double* x, double* y, double* z,
-                         double* w, double* wpos, long nobj,
+                         double* w, double* wpos, long nobj, long* patch,
                          double minsize, double maxsize,
                          int sm_int, int brute, int mintop, int maxtop, int coords);
 
+extern void* BuildGFieldFloat(float* x, float* y, float* z, float* g1, float* g2,
+                              float* w, float* wpos, long nobj, long* patch,
+                              double minsize, double maxsize,
+                              int sm_int, int brute, int mintop, int maxtop, int coords);
+
+extern void* BuildKFieldFloat(float* x, float* y, float* z, float* k,
+                              float* w, float* wpos, long nobj, long* patch,
+                              double minsize, double maxsize,
+                              int sm_int, int brute, int mintop, int maxtop, int coords);
+
+extern void* BuildNFieldFloat(float* x, float* y, float* z,
+                              float* w, float* wpos, long nobj, long* patch,
+                              double minsize, double maxsize,
+                              int sm_int, int brute, int mintop, int maxtop, int coords);
+
 extern void DestroyGField(void* field, int coords);
 extern void DestroyKField(void* field, int coords);
 extern void DestroyNField(void* field, int coords);
 
+extern long FieldSave(void* field, int d, int coords, const char* file_name);
+extern void* FieldLoad(const char* file_name, int d, int coords);
+extern long FieldGetSaveSize(void* field, int d, int coords);
+extern void FieldSaveBuffer(void* field, int d, int coords, char* buffer);
+extern void* FieldLoadBuffer(char* buffer, long size, int d, int coords);
+
 extern long FieldGetNTopLevel(void* field, int d, int coords);
+extern long FieldGetMemory(void* field, int d, int coords);
 extern long FieldCountNear(void* field, double x, double y, double z, double sep,
                            int d, int coords);
 extern void FieldGetNear(void* field, double x, double y, double z, double sep,
                          int d, int coords, long* indices, int n);
+extern void FieldCountNearMany(void* field, double* x, double* y, double* z, double* sep, long n,
+                               double* catx, double* caty, double* catz,
+                               int d, int coords, long* counts);
+extern void* FieldGetNearMany(void* field, double* x, double* y, double* z, double* sep, long n,
+                              double* catx, double* caty, double* catz,
+                              int d, int coords, long* counts);
+extern void FieldFillNearMany(void* near, long* indices);
+extern void FieldGetKNN(void* field, double* x, double* y, double* z, long n, int k,
+                        double* catx, double* caty, double* catz, int d, int coords,
+                        long* indices, double* distsq);
 
 extern void* BuildGSimpleField(double* x, double* y, double* z, double* g1, double* g2,
                                double* w, double* wpos, long nobj, int coords);
@@ -46,6 +78,15 @@ extern void* BuildKSimpleField(double* x, double* y, double* z, double* k,
 extern void* BuildNSimpleField(double* x, double* y, double* z,
                                double* w, double* wpos, long nobj, int coords);
 
+extern void* BuildGSimpleFieldFloat(float* x, float* y, float* z, float* g1, float* g2,
+                                    float* w, float* wpos, long nobj, int coords);
+
+extern void* BuildKSimpleFieldFloat(float* x, float* y, float* z, float* k,
+                                    float* w, float* wpos, long nobj, int coords);
+
+extern void* BuildNSimpleFieldFloat(float* x, float* y, float* z,
+                                    float* w, float* wpos, long nobj, int coords);
+
 extern void DestroyGSimpleField(void* field, int coords);
 extern void DestroyKSimpleField(void* field, int coords);
 extern void DestroyNSimpleField(void* field, int coords);
@@ -0,0 +1,26 @@
+/* Copyright (c) 2003-2019 by Mike Jarvis
+ *
+ * TreeCorr is free software: redistribution and use in source and binary forms,
+ * with or without modification, are permitted provided that the following
+ * conditions are met:
+ *
+ * 1. Redistributions of source code must retain the above copyright notice, this
+ *    list of conditions, and the disclaimer given in the accompanying LICENSE
+ *    file.
+ * 2. Redistributions in binary form must reproduce the above copyright notice,
+ *    this list of conditions, and the disclaimer given in the documentation
+ *    and/or other materials provided with the distribution.
+ */
+
+extern void GenerateFlat(double* x, double* y, double* z, long n,
+                         double xmin, double xmax, double ymin, double ymax,
+                         double zmin, double zmax, long seed, long stream);
+extern void GenerateRADec(double* ra, double* dec, long n,
+                          double ramin, double ramax, double decmin, double decmax,
+                          long seed, long stream);
+extern void GenerateCap(double* ra, double* dec, long n,
+                        double ra0, double dec0, double radius, long seed, long stream);
+extern void ApplyPixelMask(double* x, double* y, long n, long* mask, long nx, long ny,
+                           double xmin, double xmax, double ymin, double ymax, long* keep);
+extern void ApplyPolygonMask(double* x, double* y, long n, double* px, double* py,
+                             long* pstart, long npoly, long* keep);
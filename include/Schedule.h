@@ -0,0 +1,300 @@
+/* Copyright (c) 2003-2019 by Mike Jarvis
+ *
+ * TreeCorr is free software: redistribution and use in source and binary forms,
+ * with or without modification, are permitted provided that the following
+ * conditions are met:
+ *
+ * 1. Redistributions of source code must retain the above copyright notice, this
+ *    list of conditions, and the disclaimer given in the accompanying LICENSE
+ *    file.
+ * 2. Redistributions in binary form must reproduce the above copyright notice,
+ *    this list of conditions, and the disclaimer given in the documentation
+ *    and/or other materials provided with the distribution.
+ */
+
+#ifndef TreeCorr_Schedule_H
+#define TreeCorr_Schedule_H
+
+// The OpenMP parallelization happens over pairs of top-level cells.  The amount of work
+// for each pair can vary by orders of magnitude, depending on the number of objects in the
+// cells and how close they are to each other.  So rather than loop over them in order, we
+// make a list of all the pairs with an estimate of how long each one will take, and then
+// process the most expensive ones first.  This way, the last jobs to be handed out are
+// the quick ones, so the threads all finish at about the same time.
+
+#include <vector>
+#include <map>
+#include <algorithm>
+#include <cmath>
+#include "Cell.h"
+#include "Metric.h"
+
+#ifdef _OPENMP
+#include "omp.h"
+#endif
+
+struct CellPairJob
+{
+    CellPairJob(long _i, long _j, double _cost) : i(_i), j(_j), cost(_cost) {}
+
+    // Sort the most expensive jobs first.  Ties are kept in the order of i,j, so the order
+    // doesn't depend on the sorting algorithm.
+    bool operator<(const CellPairJob& rhs) const
+    {
+        if (cost != rhs.cost) return cost > rhs.cost;
+        else if (i != rhs.i) return i < rhs.i;
+        else return j < rhs.j;
+    }
+
+    long i, j;  // The indices of the two top-level cells.
+    double cost;
+};
+
+// Estimate the time to process the pair of cells c1, c2 (in arbitrary units).
+// The work is roughly proportional to the number of pairs of objects closer than maxsep.
+// We estimate this as N1 N2 times the fraction of the larger cell that is within maxsep of
+// any given point.  If the cells are too far apart to have any pairs in range, the only
+// cost is rejecting them, which is negligible, so return 0.
+// If same is true, then c1 and c2 are the same cell, so only count each pair once.
+template <int D1, int D2, int C, int M>
+inline double EstimatePairCost(const Cell<D1,C>& c1, const Cell<D2,C>& c2,
+                               const MetricHelper<M>& metric, double maxsep, bool same)
+{
+    if (c1.getW() == 0. || c2.getW() == 0.) return 0.;
+    double s1 = c1.getSize();  // May be modified by DistSq function.
+    double s2 = c2.getSize();  // "
+    const double rsq = metric.DistSq(c1.getPos(), c2.getPos(), s1, s2);
+    if (rsq > SQR(maxsep + s1 + s2)) return 0.;
+    double npairs = double(c1.getN()) * double(c2.getN());
+    if (same) npairs *= 0.5;
+    const double smax = std::max(s1, s2);
+    if (smax > maxsep) npairs *= SQR(maxsep / smax);
+    return 1. + npairs;
+}
+
+// The pairs of top-level cells that are too far apart to have any pairs in range are
+// rejected right away by process11, but with up to 1024 top-level cells in each field,
+// even making the list of all the pairs can take a noticeable amount of time.  So we put
+// the cells of the second field into a coarse grid, and for each cell of the first field,
+// only look at the ones in the nearby grid cells.
+
+inline void GetXYZ(const Position<Flat>& p, double& x, double& y, double& z)
+{ x = p.getX(); y = p.getY(); z = 0.; }
+
+inline void GetXYZ(const Position<ThreeD>& p, double& x, double& y, double& z)
+{ x = p.getX(); y = p.getY(); z = p.getZ(); }
+
+template <int D, int C>
+class CellGrid
+{
+public:
+    typedef std::pair<long, std::pair<long,long> > Key;
+
+    // Put the cells into a grid of cubes (squares for Flat) of side width.
+    CellGrid(const std::vector<Cell<D,C>*>& cells, double width) : _width(width)
+    {
+        for (long j=0;j<long(cells.size());++j) {
+            double x,y,z;
+            GetXYZ(cells[j]->getPos(), x, y, z);
+            _grid[Key(index(x), std::make_pair(index(y), index(z)))].push_back(j);
+        }
+    }
+
+    // Add the indices of the cells within a distance dist of pos to near.
+    // This will also include some cells that are farther away than that.
+    void getNear(const Position<C>& pos, double dist, std::vector<long>& near) const
+    {
+        double x,y,z;
+        GetXYZ(pos, x, y, z);
+        const long ix1 = index(x-dist), ix2 = index(x+dist);
+        const long iy1 = index(y-dist), iy2 = index(y+dist);
+        const long iz1 = C == Flat ? 0 : index(z-dist), iz2 = C == Flat ? 0 : index(z+dist);
+        const double nbox = (ix2-ix1+1.) * (iy2-iy1+1.) * (iz2-iz1+1.);
+        if (nbox > _grid.size()) {
+            // Then it's faster to just check all the grid cells that have anything in them.
+            for (typename Grid::const_iterator it=_grid.begin(); it!=_grid.end(); ++it) {
+                const Key& key = it->first;
+                if (key.first >= ix1 && key.first <= ix2 &&
+                    key.second.first >= iy1 && key.second.first <= iy2 &&
+                    key.second.second >= iz1 && key.second.second <= iz2) {
+                    near.insert(near.end(), it->second.begin(), it->second.end());
+                }
+            }
+        } else {
+            for (long ix=ix1; ix<=ix2; ++ix) {
+                for (long iy=iy1; iy<=iy2; ++iy) {
+                    for (long iz=iz1; iz<=iz2; ++iz) {
+                        typename Grid::const_iterator it =
+                            _grid.find(Key(ix, std::make_pair(iy, iz)));
+                        if (it != _grid.end())
+                            near.insert(near.end(), it->second.begin(), it->second.end());
+                    }
+                }
+            }
+        }
+    }
+
+private:
+    typedef std::map<Key, std::vector<long> > Grid;
+
+    long index(double x) const { return long(std::floor(x / _width)); }
+
+    double _width;
+    Grid _grid;
+};
+
+// Find the cells in cells2 that might have pairs closer than maxsep with each cell in cells1.
+// On output, near[i] has the indices j for cells1[i] in increasing order.
+// This is only done for the Euclidean metric, where the distance between two cells is the
+// same as the distance between their positions in the grid.  For these, the pairs in near
+// are exactly the ones that process11 doesn't reject right away.  For the other metrics,
+// or if the search distance is as large as the whole second field (which includes the
+// brute force case, where the cells have infinite size), near[i] just has all the cells
+// in cells2.
+template <int D1, int D2, int C, int M>
+inline void FindNearCells(const std::vector<Cell<D1,C>*>& cells1,
+                          const std::vector<Cell<D2,C>*>& cells2,
+                          const MetricHelper<M>& metric, double maxsep,
+                          std::vector<std::vector<long> >& near)
+{
+    const long n1 = long(cells1.size());
+    const long n2 = long(cells2.size());
+    near.resize(n1);
+
+    double smax1 = 0.;
+    for (long i=0;i<n1;++i) smax1 = std::max(smax1, cells1[i]->getSize());
+    double smax2 = 0.;
+    double extent = 0.;
+    if (n2 > 0) {
+        double xmin, ymin, zmin;
+        GetXYZ(cells2[0]->getPos(), xmin, ymin, zmin);
+        double xmax = xmin, ymax = ymin, zmax = zmin;
+        for (long j=0;j<n2;++j) {
+            smax2 = std::max(smax2, cells2[j]->getSize());
+            double x,y,z;
+            GetXYZ(cells2[j]->getPos(), x, y, z);
+            xmin = std::min(xmin, x); xmax = std::max(xmax, x);
+            ymin = std::min(ymin, y); ymax = std::max(ymax, y);
+            zmin = std::min(zmin, z); zmax = std::max(zmax, z);
+        }
+        extent = std::max(xmax-xmin, std::max(ymax-ymin, zmax-zmin));
+    }
+
+    if (M != Euclidean || maxsep + smax1 + smax2 >= extent) {
+        for (long i=0;i<n1;++i) {
+            near[i].resize(n2);
+            for (long j=0;j<n2;++j) near[i][j] = j;
+        }
+        return;
+    }
+
+    CellGrid<D2,C> grid(cells2, maxsep + 2.*smax2);
+    for (long i=0;i<n1;++i) {
+        const Cell<D1,C>& c1 = *cells1[i];
+        std::vector<long>& near1 = near[i];
+        near1.clear();
+        grid.getNear(c1.getPos(), maxsep + c1.getSize() + smax2, near1);
+        // Only keep the ones that might actually have pairs in range.
+        long n=0;
+        for (size_t k=0;k<near1.size();++k) {
+            if (EstimatePairCost(c1, *cells2[near1[k]], metric, maxsep, false) > 0.)
+                near1[n++] = near1[k];
+        }
+        near1.resize(n);
+        std::sort(near1.begin(), near1.end());
+    }
+}
+
+// Make the list of jobs for an auto-correlation.  This includes i == j, for the pairs
+// within a single top-level cell, and i < j for the pairs between two different ones.
+// The latter are taken from near, as made by FindNearCells.
+template <int D, int C, int M>
+inline void BuildAutoJobs(const std::vector<Cell<D,C>*>& cells,
+                          const std::vector<std::vector<long> >& near,
+                          const MetricHelper<M>& metric, double maxsep,
+                          std::vector<CellPairJob>& jobs)
+{
+    const long n = long(cells.size());
+    for (long i=0;i<n;++i) {
+        const Cell<D,C>& c1 = *cells[i];
+        jobs.push_back(CellPairJob(i, i, EstimatePairCost(c1, c1, metric, maxsep, true)));
+        std::vector<long>::const_iterator it = std::upper_bound(near[i].begin(), near[i].end(), i);
+        for (; it!=near[i].end(); ++it) {
+            const Cell<D,C>& c2 = *cells[*it];
+            jobs.push_back(CellPairJob(i, *it, EstimatePairCost(c1, c2, metric, maxsep, false)));
+        }
+    }
+}
+
+template <int D, int C, int M>
+inline void BuildAutoJobs(const std::vector<Cell<D,C>*>& cells, const MetricHelper<M>& metric,
+                          double maxsep, std::vector<CellPairJob>& jobs)
+{
+    std::vector<std::vector<long> > near;
+    FindNearCells(cells, cells, metric, maxsep, near);
+    BuildAutoJobs(cells, near, metric, maxsep, jobs);
+}
+
+// Make the list of jobs for a cross-correlation.  This includes all the pairs in near.
+template <int D1, int D2, int C, int M>
+inline void BuildCrossJobs(const std::vector<Cell<D1,C>*>& cells1,
+                           const std::vector<Cell<D2,C>*>& cells2,
+                           const std::vector<std::vector<long> >& near,
+                           const MetricHelper<M>& metric, double maxsep,
+                           std::vector<CellPairJob>& jobs)
+{
+    const long n1 = long(cells1.size());
+    for (long i=0;i<n1;++i) {
+        const Cell<D1,C>& c1 = *cells1[i];
+        for (size_t k=0;k<near[i].size();++k) {
+            const long j = near[i][k];
+            const Cell<D2,C>& c2 = *cells2[j];
+            jobs.push_back(CellPairJob(i, j, EstimatePairCost(c1, c2, metric, maxsep, false)));
+        }
+    }
+}
+
+template <int D1, int D2, int C, int M>
+inline void BuildCrossJobs(const std::vector<Cell<D1,C>*>& cells1,
+                           const std::vector<Cell<D2,C>*>& cells2,
+                           const MetricHelper<M>& metric, double maxsep,
+                           std::vector<CellPairJob>& jobs)
+{
+    std::vector<std::vector<long> > near;
+    FindNearCells(cells1, cells2, metric, maxsep, near);
+    BuildCrossJobs(cells1, cells2, near, metric, maxsep, jobs);
+}
+
+inline bool HasCost(const CellPairJob& job)
+{ return job.cost > 0.; }
+
+// Put the most expensive jobs first.  The jobs with zero cost are often most of the list,
+// so just move them to the end without sorting them.
+// Returns the number of jobs with nonzero cost.
+inline long SortJobs(std::vector<CellPairJob>& jobs)
+{
+    std::vector<CellPairJob>::iterator end = std::partition(jobs.begin(), jobs.end(), HasCost);
+#ifdef _OPENMP
+    // With only one thread, the order doesn't matter, so don't bother sorting.
+    if (omp_get_max_threads() > 1) std::sort(jobs.begin(), end);
+#endif
+    return end - jobs.begin();
+}
+
+// Sort the jobs as above, and group them into the blocks that are handed out to the threads.
+// The jobs with zero cost are handed out block_size at a time, since they aren't worth
+// handing out individually.  Every other job is its own block.
+// On output, blocks has the index of the first job in each block, followed by jobs.size().
+inline void ScheduleJobs(std::vector<CellPairJob>& jobs, std::vector<long>& blocks,
+                         long block_size=256)
+{
+    const long nslow = SortJobs(jobs);
+    const long njobs = jobs.size();
+    blocks.clear();
+    blocks.reserve(nslow + (njobs-nslow)/block_size + 2);
+    for (long k=0;k<nslow;++k) blocks.push_back(k);
+    for (long k=nslow;k<njobs;k+=block_size) blocks.push_back(k);
+    blocks.push_back(njobs);
+}
+
+#endif
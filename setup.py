@@ -581,7 +581,7 @@ dist = setup(name="TreeCorr",
 #print('Installing headers to ',cmd.install_dir)
 #cmd.run()
 
-# Check if pandas and fitsio are installed.
+# Check if the optional dependencies are installed.
 try:
     import pandas
 except ImportError:
@@ -603,6 +603,26 @@ NOTE: While not a required dependency, if you plan to use TreeCorr to read FITS
             pip install fitsio
 """)
 
+try:
+    import h5py
+except ImportError:
+    print("""
+NOTE: While not a required dependency, if you plan to use TreeCorr to read HDF5
+      catalogs, then h5py will be required.
+      To install h5py, simply type
+            pip install h5py
+""")
+
+try:
+    import pyarrow
+except ImportError:
+    print("""
+NOTE: While not a required dependency, if you plan to use TreeCorr to read Parquet
+      catalogs, then pyarrow will be required.
+      To install pyarrow, simply type
+            pip install pyarrow
+""")
+
 # Check that the path includes the directory where the scripts are installed.
 real_env_path = [os.path.realpath(d) for d in os.environ['PATH'].split(':')]
 if (hasattr(dist,'script_install_dir') and
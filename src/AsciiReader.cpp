@@ -0,0 +1,306 @@
+/* Copyright (c) 2003-2019 by Mike Jarvis
+ *
+ * TreeCorr is free software: redistribution and use in source and binary forms,
+ * with or without modification, are permitted provided that the following
+ * conditions are met:
+ *
+ * 1. Redistributions of source code must retain the above copyright notice, this
+ *    list of conditions, and the disclaimer given in the accompanying LICENSE
+ *    file.
+ * 2. Redistributions in binary form must reproduce the above copyright notice,
+ *    this list of conditions, and the disclaimer given in the documentation
+ *    and/or other materials provided with the distribution.
+ */
+
+
+#include <cstdlib>
+#include <cstring>
+#include <string>
+#include <vector>
+#include <limits>
+#include <fcntl.h>
+#include <unistd.h>
+#include <sys/mman.h>
+#include <sys/stat.h>
+#include "dbg.h"
+
+#ifdef _OPENMP
+#include "omp.h"
+#endif
+
+extern "C" {
+#include "AsciiReader_C.h"
+}
+
+// The file is split into chunks of roughly this many bytes, each starting at the beginning
+// of a line.  The chunks are counted and parsed in parallel.
+const size_t CHUNK_SIZE = 1 << 20;
+
+// A read-only memory map of a file, which is unmapped when it goes out of scope.
+class MappedFile
+{
+public:
+    MappedFile(const char* file_name) : _data(0), _size(0), _ok(false)
+    {
+        int fd = open(file_name, O_RDONLY);
+        if (fd < 0) return;
+        struct stat st;
+        if (fstat(fd, &st) == 0) {
+            _size = st.st_size;
+            if (_size == 0) {
+                _ok = true;
+            } else {
+                void* p = mmap(0, _size, PROT_READ, MAP_PRIVATE, fd, 0);
+                if (p != MAP_FAILED) {
+                    _data = static_cast<const char*>(p);
+                    _ok = true;
+#ifdef MADV_SEQUENTIAL
+                    madvise(p, _size, MADV_SEQUENTIAL);
+#endif
+                }
+            }
+        }
+        close(fd);
+    }
+
+    ~MappedFile()
+    { if (_data) munmap(const_cast<char*>(_data), _size); }
+
+    bool ok() const { return _ok; }
+    const char* begin() const { return _data; }
+    const char* end() const { return _data + _size; }
+    size_t size() const { return _size; }
+
+private:
+    const char* _data;
+    size_t _size;
+    bool _ok;
+};
+
+inline bool IsSpace(char c)
+{ return c == ' ' || c == '\t' || c == '\r' || c == '\v' || c == '\f'; }
+
+inline const char* EndOfLine(const char* p, const char* end)
+{
+    const char* eol = static_cast<const char*>(std::memchr(p, '\n', end-p));
+    return eol ? eol : end;
+}
+
+// Return the end of the data part of the line [p,eol), i.e. without any comment or trailing
+// whitespace.  If the line has no data, this returns p.
+inline const char* DataEnd(const char* p, const char* eol, const char* comment, size_t ncomment)
+{
+    if (ncomment > 0) {
+        for (const char* c=p; c + ncomment <= eol; ++c) {
+            if (*c == comment[0] && std::strncmp(c, comment, ncomment) == 0) {
+                eol = c;
+                break;
+            }
+        }
+    }
+    while (eol > p && IsSpace(eol[-1])) --eol;
+    while (p < eol && IsSpace(*p)) ++p;
+    return p < eol ? eol : p;
+}
+
+// Iterate over the fields of a line.  delimiter = 0 means any run of whitespace.
+class FieldIter
+{
+public:
+    FieldIter(const char* p, const char* end, int delimiter) :
+        _p(p), _end(end), _delim(delimiter), _done(false) {}
+
+    // Set [b,e) to the next field, with surrounding whitespace removed.
+    bool next(const char*& b, const char*& e)
+    {
+        if (_done) return false;
+        if (_delim == 0) {
+            while (_p < _end && IsSpace(*_p)) ++_p;
+            if (_p == _end) { _done = true; return false; }
+            b = _p;
+            while (_p < _end && !IsSpace(*_p)) ++_p;
+            e = _p;
+        } else {
+            b = _p;
+            const char* d = static_cast<const char*>(std::memchr(_p, _delim, _end-_p));
+            if (d) {
+                e = d;
+                _p = d+1;
+            } else {
+                e = _end;
+                _done = true;
+            }
+            while (b < e && IsSpace(*b)) ++b;
+            while (e > b && IsSpace(e[-1])) --e;
+        }
+        return true;
+    }
+
+private:
+    const char* _p;
+    const char* _end;
+    int _delim;
+    bool _done;
+};
+
+// Parse [b,e) as a double.  Empty fields are read as NaN.  Returns whether it worked.
+inline bool ParseDouble(const char* b, const char* e, double& val)
+{
+    size_t n = e-b;
+    if (n == 0) {
+        val = std::numeric_limits<double>::quiet_NaN();
+        return true;
+    }
+    // strtod needs a null-terminated string, and the mapped file isn't one.
+    char buf[64];
+    std::string s;
+    const char* str;
+    if (n < sizeof(buf)) {
+        std::memcpy(buf, b, n);
+        buf[n] = '\0';
+        str = buf;
+    } else {
+        s.assign(b, n);
+        str = s.c_str();
+    }
+    char* endptr;
+    val = std::strtod(str, &endptr);
+    return endptr == str + n;
+}
+
+// Split the file into chunks, each of which starts at the beginning of a line.
+// The returned vector has the start of each chunk, plus the end of the file.
+std::vector<const char*> FindChunks(const MappedFile& file)
+{
+    long nchunks = file.size() / CHUNK_SIZE + 1;
+    std::vector<const char*> starts(1, file.begin());
+    for (long i=1; i<nchunks; ++i) {
+        const char* p = file.begin() + i * CHUNK_SIZE;
+        if (p <= starts.back()) continue;
+        p = EndOfLine(p-1, file.end());
+        if (p < file.end()) starts.push_back(p+1);
+    }
+    starts.push_back(file.end());
+    return starts;
+}
+
+// Count the number of data lines in each chunk.
+std::vector<long> CountChunkRows(const std::vector<const char*>& starts,
+                                 const char* comment, size_t ncomment)
+{
+    long nchunks = starts.size()-1;
+    std::vector<long> counts(nchunks, 0);
+#ifdef _OPENMP
+#pragma omp parallel for schedule(dynamic)
+#endif
+    for (long i=0; i<nchunks; ++i) {
+        long n = 0;
+        for (const char* p=starts[i]; p<starts[i+1]; ) {
+            const char* eol = EndOfLine(p, starts[i+1]);
+            if (DataEnd(p, eol, comment, ncomment) != p) ++n;
+            p = eol+1;
+        }
+        counts[i] = n;
+    }
+    return counts;
+}
+
+long CountAsciiRows(const char* file_name, const char* comment_marker, int delimiter,
+                    long* ncols)
+{
+    MappedFile file(file_name);
+    if (!file.ok()) return -1;
+    size_t ncomment = std::strlen(comment_marker);
+
+    // The number of columns is taken from the first line with any data.
+    *ncols = 0;
+    for (const char* p=file.begin(); p<file.end(); ) {
+        const char* eol = EndOfLine(p, file.end());
+        const char* de = DataEnd(p, eol, comment_marker, ncomment);
+        if (de != p) {
+            FieldIter it(p, de, delimiter);
+            const char *b, *e;
+            while (it.next(b,e)) ++*ncols;
+            break;
+        }
+        p = eol+1;
+    }
+
+    std::vector<long> counts = CountChunkRows(FindChunks(file), comment_marker, ncomment);
+    long nrows = 0;
+    for (size_t i=0; i<counts.size(); ++i) nrows += counts[i];
+    return nrows;
+}
+
+long ReadAsciiColumns(const char* file_name, const char* comment_marker, int delimiter,
+                      long start, long end, long* cols, int ncols, double** out,
+                      long* err_row)
+{
+    MappedFile file(file_name);
+    if (!file.ok()) return -1;
+    size_t ncomment = std::strlen(comment_marker);
+
+    // For each column number in the file, which output arrays want it.
+    // (The same column may be used more than once, e.g. for both w and wpos.)
+    long maxcol = 0;
+    for (int j=0; j<ncols; ++j) if (cols[j] > maxcol) maxcol = cols[j];
+    std::vector<std::vector<int> > colmap(maxcol+1);
+    for (int j=0; j<ncols; ++j) colmap[cols[j]].push_back(j);
+
+    // Count the rows in each chunk, so we know where each chunk's rows go in the output.
+    std::vector<const char*> starts = FindChunks(file);
+    std::vector<long> counts = CountChunkRows(starts, comment_marker, ncomment);
+    long nchunks = counts.size();
+    std::vector<long> first(nchunks+1, 0);
+    for (long i=0; i<nchunks; ++i) first[i+1] = first[i] + counts[i];
+    if (end > first[nchunks]) end = first[nchunks];
+    if (end <= start) return 0;
+
+    const double nan = std::numeric_limits<double>::quiet_NaN();
+    long bad_row = -1;
+#ifdef _OPENMP
+#pragma omp parallel for schedule(dynamic)
+#endif
+    for (long i=0; i<nchunks; ++i) {
+        if (first[i+1] <= start || first[i] >= end) continue;
+        long row = first[i];
+        for (const char* p=starts[i]; p<starts[i+1] && row<end; ) {
+            const char* eol = EndOfLine(p, starts[i+1]);
+            const char* de = DataEnd(p, eol, comment_marker, ncomment);
+            if (de != p) {
+                if (row >= start) {
+                    long k = row - start;
+                    FieldIter it(p, de, delimiter);
+                    const char *b, *e;
+                    long col = 1;
+                    for (; col <= maxcol && it.next(b,e); ++col) {
+                        if (colmap[col].empty()) continue;
+                        double val;
+                        if (!ParseDouble(b, e, val)) {
+#ifdef _OPENMP
+#pragma omp critical
+#endif
+                            {
+                                if (bad_row < 0 || row < bad_row) bad_row = row;
+                            }
+                            val = nan;
+                        }
+                        for (size_t j=0; j<colmap[col].size(); ++j) out[colmap[col][j]][k] = val;
+                    }
+                    // Any columns missing from this line are set to NaN.
+                    for (; col <= maxcol; ++col) {
+                        for (size_t j=0; j<colmap[col].size(); ++j) out[colmap[col][j]][k] = nan;
+                    }
+                }
+                ++row;
+            }
+            p = eol+1;
+        }
+    }
+
+    if (bad_row >= 0) {
+        *err_row = bad_row;
+        return -2;
+    }
+    return end - start;
+}
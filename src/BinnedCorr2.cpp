@@ -21,6 +21,7 @@
 #include "Split.h"
 #include "ProjectHelper.h"
 #include "Metric.h"
+#include "Schedule.h"
 #include <vector>
 #include <set>
 #include <map>
@@ -33,16 +34,36 @@
 // for compile-time constexpr in C++14, which we don't require.
 #define MAX(a,b) (a > b ? a : b)
 
+// For most metrics, the separation vector is just p2-p1.  For the Periodic metric, it is
+// p2'-p1, where p2' is the periodic image of p2 nearest to p1.
+template <int M, int C>
+inline const Position<C>& NearestImage(const Position<C>& p1, const Position<C>& p2,
+                                       const MetricHelper<M>& , Position<C>& )
+{ return p2; }
+
+inline const Position<Flat>& NearestImage(const Position<Flat>& p1, const Position<Flat>& p2,
+                                          const MetricHelper<Periodic>& metric,
+                                          Position<Flat>& image)
+{
+    Position<Flat> r = p2-p1;
+    r.wrap(metric.xp, metric.yp);
+    image = p1 + r;
+    return image;
+}
+
 template <int D1, int D2, int B>
 BinnedCorr2<D1,D2,B>::BinnedCorr2(
     double minsep, double maxsep, int nbins, double binsize, double b,
     double minrpar, double maxrpar, double xp, double yp, double zp,
+    double min_task_pairs, int bucket_size,
     double* xi0, double* xi1, double* xi2, double* xi3,
     double* meanr, double* meanlogr, double* weight, double* npairs) :
     _minsep(minsep), _maxsep(maxsep), _nbins(nbins), _binsize(binsize), _b(b),
     _minrpar(minrpar), _maxrpar(maxrpar), _xp(xp), _yp(yp), _zp(zp),
+    _min_task_pairs(min_task_pairs), _bucket_size(bucket_size),
     _coords(-1), _owns_data(false),
-    _xi(xi0,xi1,xi2,xi3), _meanr(meanr), _meanlogr(meanlogr), _weight(weight), _npairs(npairs)
+    _xi(xi0,xi1,xi2,xi3), _meanr(meanr), _meanlogr(meanlogr), _weight(weight), _npairs(npairs),
+    _thread_memory(0), _task_data(0), _task_p1(-1), _task_p2(-1)
 {
     dbg<<"BinnedCorr2 constructor\n";
     // Some helpful variables we can calculate once here.
@@ -59,35 +80,48 @@ BinnedCorr2<D1,D2,B>::BinnedCorr2(
     dbg<<"b = "<<_b<<std::endl;
     dbg<<"minrpar, maxrpar = "<<_minrpar<<"  "<<_maxrpar<<std::endl;
     dbg<<"period = "<<_xp<<"  "<<_yp<<"  "<<_zp<<std::endl;
+    dbg<<"min_task_pairs = "<<_min_task_pairs<<std::endl;
+    dbg<<"bucket_size = "<<_bucket_size<<std::endl;
 }
 
 template <int D1, int D2, int B>
-BinnedCorr2<D1,D2,B>::BinnedCorr2(const BinnedCorr2<D1,D2,B>& rhs, bool copy_data) :
+BinnedCorr2<D1,D2,B>::BinnedCorr2(const BinnedCorr2<D1,D2,B>& rhs, bool copy_data, bool lazy) :
     _minsep(rhs._minsep), _maxsep(rhs._maxsep), _nbins(rhs._nbins),
     _binsize(rhs._binsize), _b(rhs._b),
     _minrpar(rhs._minrpar), _maxrpar(rhs._maxrpar),
-    _xp(rhs._xp), _yp(rhs._yp), _zp(rhs._zp),
+    _xp(rhs._xp), _yp(rhs._yp), _zp(rhs._zp), _min_task_pairs(rhs._min_task_pairs),
+    _bucket_size(rhs._bucket_size),
     _logminsep(rhs._logminsep), _halfminsep(rhs._halfminsep),
     _minsepsq(rhs._minsepsq), _maxsepsq(rhs._maxsepsq), _bsq(rhs._bsq),
     _fullmaxsep(rhs._fullmaxsep), _fullmaxsepsq(rhs._fullmaxsepsq),
     _coords(rhs._coords), _owns_data(true),
-    _xi(0,0,0,0), _weight(0)
+    _xi(0,0,0,0), _meanr(0), _meanlogr(0), _weight(0), _npairs(0), _thread_memory(0),
+    _task_data(rhs._task_data), _task_p1(-1), _task_p2(-1)
 {
     dbg<<"BinnedCorr2 copy constructor\n";
+    if (lazy) return;
+    newData();
+    if (copy_data) *this = rhs;
+}
+
+template <int D1, int D2, int B>
+void BinnedCorr2<D1,D2,B>::newData()
+{
+    Assert(_owns_data);
     _xi.new_data(_nbins);
     _meanr = new double[_nbins];
     _meanlogr = new double[_nbins];
     _weight = new double[_nbins];
     _npairs = new double[_nbins];
-
-    if (copy_data) *this = rhs;
-    else clear();
+    clear();
 }
 
 template <int D1, int D2, int B>
 BinnedCorr2<D1,D2,B>::~BinnedCorr2()
 {
     dbg<<"BinnedCorr2 destructor\n";
+    for (typename PatchMap::iterator it=_patch_results.begin(); it!=_patch_results.end(); ++it)
+        delete it->second;
     if (_owns_data) {
         _xi.delete_data(_nbins);
         delete [] _meanr; _meanr = 0;
@@ -115,11 +149,13 @@ struct ProcessHelper<D,D,B,C,M>
 template <int D1, int D2, int B>
 void BinnedCorr2<D1,D2,B>::clear()
 {
-    _xi.clear(_nbins);
-    for (int i=0; i<_nbins; ++i) _meanr[i] = 0.;
-    for (int i=0; i<_nbins; ++i) _meanlogr[i] = 0.;
-    for (int i=0; i<_nbins; ++i) _weight[i] = 0.;
-    for (int i=0; i<_nbins; ++i) _npairs[i] = 0.;
+    if (hasData()) {
+        _xi.clear(_nbins);
+        for (int i=0; i<_nbins; ++i) _meanr[i] = 0.;
+        for (int i=0; i<_nbins; ++i) _meanlogr[i] = 0.;
+        for (int i=0; i<_nbins; ++i) _weight[i] = 0.;
+        for (int i=0; i<_nbins; ++i) _npairs[i] = 0.;
+    }
     _coords = -1;
 }
 
@@ -134,46 +170,78 @@ void BinnedCorr2<D1,D2,B>::process(const Field<D1,C>& field, bool dots)
     dbg<<"field has "<<n1<<" top level nodes\n";
     Assert(n1 > 0);
 
+    // Make the list of pairs of top-level cells to process, with the slowest ones first.
+    std::vector<CellPairJob> jobs;
+    BuildAutoJobs(field.getCells(), MetricHelper<M>(_minrpar, _maxrpar, _xp, _yp, _zp),
+                  _fullmaxsep, jobs);
+    std::vector<long> blocks;
+    ScheduleJobs(jobs, blocks);
+    const long nblocks = long(blocks.size()) - 1;
+    // Print about one dot per top-level cell.
+    const long dot_every = std::max(nblocks / n1, 1L);
+    dbg<<"processing "<<jobs.size()<<" pairs of top level nodes\n";
+
+    // Each thread accumulates into its own copy of the data vector.  If there are patches,
+    // each thread instead keeps its own results for each pair of patches.  Only the patch
+    // pairs that actually have any pairs in range allocate their data vectors, and only these
+    // are kept in the end.  The auto-correlation pairs are keyed with p1 <= p2.
 #ifdef _OPENMP
+    ThreadData thread_data(*this, omp_get_max_threads());
+    // In task mode, the tasks need to find the results of whichever thread runs them.
+    if (_min_task_pairs > 0.) _task_data = &thread_data;
 #pragma omp parallel
     {
-        // Give each thread their own copy of the data vector to fill in.
-        BinnedCorr2<D1,D2,B> bc2(*this,false);
 #else
-        BinnedCorr2<D1,D2,B>& bc2 = *this;
+    ThreadData thread_data(*this, 1);
 #endif
 
         // Inside the omp parallel, so each thread has its own MetricHelper.
         MetricHelper<M> metric(_minrpar, _maxrpar, _xp, _yp, _zp);
+        const std::vector<long>& patches = field.getPatches();
 
 #ifdef _OPENMP
 #pragma omp for schedule(dynamic)
 #endif
-        for (int i=0;i<n1;++i) {
+        for (long b=0;b<nblocks;++b) {
+            // Only enter the critical section when there is something to print, since
+            // there are a lot of blocks.
+            if (dots && b % dot_every == 0) {
 #ifdef _OPENMP
 #pragma omp critical
 #endif
-            {
+                std::cout<<'.'<<std::flush;
+            }
+            for (long k=blocks[b];k<blocks[b+1];++k) {
+                const long i = jobs[k].i;
+                const long j = jobs[k].j;
 #ifdef _OPENMP
-                xdbg<<omp_get_thread_num()<<" "<<i<<std::endl;
+                xdbg<<omp_get_thread_num()<<" "<<i<<" "<<j<<std::endl;
 #endif
-                if (dots) std::cout<<'.'<<std::flush;
-            }
-            const Cell<D1,C>& c1 = *field.getCells()[i];
-            ProcessHelper<D1,D2,B,C,M>::process2(bc2, c1, metric);
-            for (int j=i+1;j<n1;++j) {
-                const Cell<D1,C>& c2 = *field.getCells()[j];
-                bc2.process11<C,M>(c1, c2, metric, BinTypeHelper<B>::doReverse());
+                const Cell<D1,C>& c1 = *field.getCells()[i];
+                if (i == j) {
+                    BinnedCorr2<D1,D2,B>& bc2i = patches.empty() ?
+                        thread_data.getCorr(-1, -1) :
+                        thread_data.getCorr(patches[i], patches[i]);
+                    ProcessHelper<D1,D2,B,C,M>::process2(bc2i, c1, metric);
+                } else {
+                    const Cell<D1,C>& c2 = *field.getCells()[j];
+                    BinnedCorr2<D1,D2,B>& bc2ij = patches.empty() ?
+                        thread_data.getCorr(-1, -1) :
+                        thread_data.getCorr(std::min(patches[i], patches[j]),
+                                            std::max(patches[i], patches[j]));
+                    bc2ij.process11<C,M>(c1, c2, metric, BinTypeHelper<B>::doReverse());
+                }
             }
         }
+        // Accumulate the results.  (All the tasks are done by now, since they finish
+        // at the implicit barrier at the end of the omp for.)
+        thread_data.reduce();
 #ifdef _OPENMP
-        // Accumulate the results
-#pragma omp critical
-        {
-            *this += bc2;
-        }
     }
+    _task_data = 0;
 #endif
+    _thread_memory = thread_data.getMemory();
+    dbg<<"thread copies used "<<_thread_memory<<" bytes\n";
     if (dots) std::cout<<std::endl;
 }
 
@@ -191,44 +259,62 @@ void BinnedCorr2<D1,D2,B>::process(const Field<D1,C>& field1, const Field<D2,C>&
     Assert(n1 > 0);
     Assert(n2 > 0);
 
+    std::vector<CellPairJob> jobs;
+    BuildCrossJobs(field1.getCells(), field2.getCells(),
+                   MetricHelper<M>(_minrpar, _maxrpar, _xp, _yp, _zp), _fullmaxsep, jobs);
+    std::vector<long> blocks;
+    ScheduleJobs(jobs, blocks);
+    const long nblocks = long(blocks.size()) - 1;
+    const long dot_every = std::max(nblocks / n1, 1L);
+    dbg<<"processing "<<jobs.size()<<" pairs of top level nodes\n";
+
+    // As above, keep track of the results for each pair of patches if both fields
+    // have patches.
 #ifdef _OPENMP
+    ThreadData thread_data(*this, omp_get_max_threads());
+    if (_min_task_pairs > 0.) _task_data = &thread_data;
 #pragma omp parallel
     {
-        // Give each thread their own copy of the data vector to fill in.
-        BinnedCorr2<D1,D2,B> bc2(*this,false);
 #else
-        BinnedCorr2<D1,D2,B>& bc2 = *this;
+    ThreadData thread_data(*this, 1);
 #endif
 
         MetricHelper<M> metric(_minrpar, _maxrpar, _xp, _yp, _zp);
+        const std::vector<long>& patches1 = field1.getPatches();
+        const std::vector<long>& patches2 = field2.getPatches();
+        const bool use_patches = !patches1.empty() && !patches2.empty();
 
 #ifdef _OPENMP
 #pragma omp for schedule(dynamic)
 #endif
-        for (int i=0;i<n1;++i) {
+        for (long b=0;b<nblocks;++b) {
+            if (dots && b % dot_every == 0) {
 #ifdef _OPENMP
 #pragma omp critical
 #endif
-            {
+                std::cout<<'.'<<std::flush;
+            }
+            for (long k=blocks[b];k<blocks[b+1];++k) {
+                const long i = jobs[k].i;
+                const long j = jobs[k].j;
 #ifdef _OPENMP
-                xdbg<<omp_get_thread_num()<<" "<<i<<std::endl;
+                xdbg<<omp_get_thread_num()<<" "<<i<<" "<<j<<std::endl;
 #endif
-                if (dots) std::cout<<'.'<<std::flush;
-            }
-            const Cell<D1,C>& c1 = *field1.getCells()[i];
-            for (int j=0;j<n2;++j) {
+                const Cell<D1,C>& c1 = *field1.getCells()[i];
                 const Cell<D2,C>& c2 = *field2.getCells()[j];
-                bc2.process11<C,M>(c1, c2, metric, false);
+                BinnedCorr2<D1,D2,B>& bc2ij = !use_patches ?
+                    thread_data.getCorr(-1, -1) :
+                    thread_data.getCorr(patches1[i], patches2[j]);
+                bc2ij.process11<C,M>(c1, c2, metric, false);
             }
         }
+        thread_data.reduce();
 #ifdef _OPENMP
-        // Accumulate the results
-#pragma omp critical
-        {
-            *this += bc2;
-        }
     }
+    _task_data = 0;
 #endif
+    _thread_memory = thread_data.getMemory();
+    dbg<<"thread copies used "<<_thread_memory<<" bytes\n";
     if (dots) std::cout<<std::endl;
 }
 
@@ -248,12 +334,11 @@ void BinnedCorr2<D1,D2,B>::processPairwise(
     const long sqrtn = long(sqrt(double(nobj)));
 
 #ifdef _OPENMP
+    ThreadData thread_data(*this, omp_get_max_threads());
 #pragma omp parallel
     {
-        // Give each thread their own copy of the data vector to fill in.
-        BinnedCorr2<D1,D2,B> bc2(*this,false);
 #else
-        BinnedCorr2<D1,D2,B>& bc2 = *this;
+    ThreadData thread_data(*this, 1);
 #endif
 
         MetricHelper<M> metric(_minrpar, _maxrpar, _xp, _yp, _zp);
@@ -277,22 +362,22 @@ void BinnedCorr2<D1,D2,B>::processPairwise(
             const Cell<D1,C>& c1 = *field1.getCells()[i];
             const Cell<D2,C>& c2 = *field2.getCells()[i];
             const Position<C>& p1 = c1.getPos();
-            const Position<C>& p2 = c2.getPos();
+            Position<C> image;
+            const Position<C>& p2 = B == TwoD ? NearestImage(p1, c2.getPos(), metric, image) :
+                c2.getPos();
             double s=0.;
             const double rsq = metric.DistSq(p1, p2, s, s);
             if (BinTypeHelper<B>::isRSqInRange(rsq, p1, p2,
                                                _minsep, _minsepsq, _maxsep, _maxsepsq)) {
-                bc2.template directProcess11(c1,c2,rsq,false);
+                thread_data.getCorr(-1, -1).template directProcess11(c1,c2,p1,p2,rsq,false);
             }
         }
-#ifdef _OPENMP
         // Accumulate the results
-#pragma omp critical
-        {
-            *this += bc2;
-        }
+        thread_data.reduce();
+#ifdef _OPENMP
     }
 #endif
+    _thread_memory = thread_data.getMemory();
     if (dots) std::cout<<std::endl;
 }
 
@@ -302,11 +387,120 @@ void BinnedCorr2<D1,D2,B>::process2(const Cell<D1,C>& c12, const MetricHelper<M>
     if (c12.getW() == 0.) return;
     if (c12.getSize() <= _halfminsep) return;
 
+    if (c12.getN() <= _bucket_size) {
+        processBucket2<C,M>(c12, metric);
+        return;
+    }
+
     Assert(c12.getLeft());
     Assert(c12.getRight());
-    process2<C,M>(*c12.getLeft(), metric);
-    process2<C,M>(*c12.getRight(), metric);
-    process11<C,M>(*c12.getLeft(), *c12.getRight(), metric, BinTypeHelper<B>::doReverse());
+    subProcess2<C,M>(*c12.getLeft(), metric);
+    subProcess2<C,M>(*c12.getRight(), metric);
+    subProcess11<C,M>(*c12.getLeft(), *c12.getRight(), metric, BinTypeHelper<B>::doReverse());
+}
+
+template <int D1, int D2, int B> template <int C, int M>
+void BinnedCorr2<D1,D2,B>::subProcess2(const Cell<D1,C>& c12, const MetricHelper<M>& metric)
+{
+#ifdef _OPENMP
+    if (_task_data && 0.5 * double(c12.getN()) * double(c12.getN()) > _min_task_pairs) {
+        ThreadData* task_data = _task_data;
+        long p1 = _task_p1, p2 = _task_p2;
+        const Cell<D1,C>* pc12 = &c12;
+        // Each task gets its own copy of the metric, which some metrics use for scratch values.
+        MetricHelper<M> m(metric);
+#pragma omp task firstprivate(task_data, p1, p2, pc12, m)
+        task_data->getCorr(p1, p2).template process2<C,M>(*pc12, m);
+        return;
+    }
+#endif
+    process2<C,M>(c12, metric);
+}
+
+template <int D1, int D2, int B> template <int C, int M>
+void BinnedCorr2<D1,D2,B>::subProcess11(const Cell<D1,C>& c1, const Cell<D2,C>& c2,
+                                        const MetricHelper<M>& metric, bool do_reverse)
+{
+#ifdef _OPENMP
+    if (_task_data && double(c1.getN()) * double(c2.getN()) > _min_task_pairs) {
+        ThreadData* task_data = _task_data;
+        long p1 = _task_p1, p2 = _task_p2;
+        const Cell<D1,C>* pc1 = &c1;
+        const Cell<D2,C>* pc2 = &c2;
+        MetricHelper<M> m(metric);
+#pragma omp task firstprivate(task_data, p1, p2, pc1, pc2, m, do_reverse)
+        task_data->getCorr(p1, p2).template process11<C,M>(*pc1, *pc2, m, do_reverse);
+        return;
+    }
+#endif
+    process11<C,M>(c1, c2, metric, do_reverse);
+}
+
+template <int D1, int D2, int B>
+BinnedCorr2<D1,D2,B>::ThreadData::~ThreadData()
+{
+    for (size_t k=0; k<corrs.size(); ++k) delete corrs[k];
+}
+
+template <int D1, int D2, int B>
+BinnedCorr2<D1,D2,B>& BinnedCorr2<D1,D2,B>::ThreadData::getCorr(long p1, long p2)
+{
+#ifdef _OPENMP
+    const int thread = omp_get_thread_num();
+#else
+    const int thread = 0;
+#endif
+    if (p1 >= 0) return parent.getPatchCorr(patch_results[thread], p1, p2);
+#ifdef _OPENMP
+    if (omp_get_num_threads() > 1) {
+        if (!corrs[thread]) corrs[thread] = new BinnedCorr2<D1,D2,B>(parent,false);
+        return *corrs[thread];
+    }
+#endif
+    // With only one thread, just accumulate into the parent directly.
+    return parent;
+}
+
+template <int D1, int D2, int B>
+void BinnedCorr2<D1,D2,B>::ThreadData::reduce()
+{
+#ifdef _OPENMP
+    const int thread = omp_get_thread_num();
+    const int nthreads = omp_get_num_threads();
+#else
+    const int thread = 0;
+    const int nthreads = 1;
+#endif
+    const int nbins = parent._nbins;
+    const int i1 = int(long(nbins) * thread / nthreads);
+    const int i2 = int(long(nbins) * (thread+1) / nthreads);
+    for (size_t k=0; k<corrs.size(); ++k) {
+        if (corrs[k]) parent.add(*corrs[k], i1, i2);
+        for (typename PatchMap::iterator it=patch_results[k].begin();
+             it!=patch_results[k].end(); ++it) {
+            parent.add(*it->second, i1, i2);
+        }
+    }
+    for (typename PatchMap::iterator it=patch_results[thread].begin();
+         it!=patch_results[thread].end(); ++it) {
+        if (it->second->hasData()) ++npatch_copies[thread];
+    }
+#ifdef _OPENMP
+    // Wait until all the threads are done reading the patch results before merging them,
+    // since the merge adds some of them together.
+#pragma omp barrier
+#pragma omp critical
+#endif
+    parent.mergePatchResults(patch_results[thread]);
+}
+
+template <int D1, int D2, int B>
+long BinnedCorr2<D1,D2,B>::ThreadData::getMemory() const
+{
+    long ncopies = 0;
+    for (size_t k=0; k<corrs.size(); ++k) if (corrs[k]) ++ncopies;
+    for (size_t k=0; k<npatch_copies.size(); ++k) ncopies += npatch_copies[k];
+    return ncopies * parent.getMemory();
 }
 
 template <int D1, int D2, int B> template <int C, int M>
@@ -319,7 +513,11 @@ void BinnedCorr2<D1,D2,B>::process11(const Cell<D1,C>& c1, const Cell<D2,C>& c2,
     if (c1.getW() == 0. || c2.getW() == 0.) return;
 
     const Position<C>& p1 = c1.getPos();
-    const Position<C>& p2 = c2.getPos();
+    // The TwoD bins are set by the separation vector, which needs to be wrapped as well
+    // for the Periodic metric.
+    Position<C> image;
+    const Position<C>& p2 = B == TwoD ? NearestImage(p1, c2.getPos(), metric, image) :
+        c2.getPos();
     double s1 = c1.getSize(); // May be modified by DistSq function.
     double s2 = c2.getSize(); // "
     xdbg<<"s1,s2 = "<<s1<<','<<s2<<std::endl;
@@ -356,10 +554,14 @@ void BinnedCorr2<D1,D2,B>::process11(const Cell<D1,C>& c1, const Cell<D2,C>& c2,
     {
         xdbg<<"Drop into single bin.\n";
         if (BinTypeHelper<B>::isRSqInRange(rsq, p1, p2, _minsep, _minsepsq, _maxsep, _maxsepsq)) {
-            directProcess11(c1,c2,rsq,do_reverse,k,r,logr);
+            directProcess11(c1,c2,p1,p2,rsq,do_reverse,k,r,logr);
         }
     } else {
         xdbg<<"Need to split.\n";
+        if (c1.getN() <= _bucket_size && c2.getN() <= _bucket_size) {
+            processBucket11<C,M>(c1, c2, metric, do_reverse);
+            return;
+        }
         bool split1=false, split2=false;
         double bsq_eff = BinTypeHelper<B>::getEffectiveBSq(rsq,_bsq);
         xdbg<<"bsq_eff = "<<bsq_eff<<std::endl;
@@ -373,21 +575,136 @@ void BinnedCorr2<D1,D2,B>::process11(const Cell<D1,C>& c1, const Cell<D2,C>& c2,
             Assert(c1.getRight());
             Assert(c2.getLeft());
             Assert(c2.getRight());
-            process11<C,M>(*c1.getLeft(),*c2.getLeft(),metric,do_reverse);
-            process11<C,M>(*c1.getLeft(),*c2.getRight(),metric,do_reverse);
-            process11<C,M>(*c1.getRight(),*c2.getLeft(),metric,do_reverse);
-            process11<C,M>(*c1.getRight(),*c2.getRight(),metric,do_reverse);
+            subProcess11<C,M>(*c1.getLeft(),*c2.getLeft(),metric,do_reverse);
+            subProcess11<C,M>(*c1.getLeft(),*c2.getRight(),metric,do_reverse);
+            subProcess11<C,M>(*c1.getRight(),*c2.getLeft(),metric,do_reverse);
+            subProcess11<C,M>(*c1.getRight(),*c2.getRight(),metric,do_reverse);
         } else if (split1) {
             Assert(c1.getLeft());
             Assert(c1.getRight());
-            process11<C,M>(*c1.getLeft(),c2,metric,do_reverse);
-            process11<C,M>(*c1.getRight(),c2,metric,do_reverse);
+            subProcess11<C,M>(*c1.getLeft(),c2,metric,do_reverse);
+            subProcess11<C,M>(*c1.getRight(),c2,metric,do_reverse);
         } else {
             Assert(split2);
             Assert(c2.getLeft());
             Assert(c2.getRight());
-            process11<C,M>(c1,*c2.getLeft(),metric,do_reverse);
-            process11<C,M>(c1,*c2.getRight(),metric,do_reverse);
+            subProcess11<C,M>(c1,*c2.getLeft(),metric,do_reverse);
+            subProcess11<C,M>(c1,*c2.getRight(),metric,do_reverse);
+        }
+    }
+}
+
+
+// Collect the leaves below c that have non-zero weight.  The subtree of c is contiguous in
+// the array of Cells, so this is just a linear scan.
+template <int D, int C>
+void GetBucketLeaves(const Cell<D,C>& c, std::vector<const Cell<D,C>*>& leaves)
+{
+    const Cell<D,C>* end = c.getEnd();
+    for (const Cell<D,C>* p = &c; p != end; ++p) {
+        if (!p->getLeft() && p->getW() != 0.) leaves.push_back(p);
+    }
+}
+
+template <int D1, int D2, int B> template <int C, int M>
+void BinnedCorr2<D1,D2,B>::processBucket2(const Cell<D1,C>& c12, const MetricHelper<M>& metric)
+{
+    std::vector<const Cell<D1,C>*> leaves;
+    GetBucketLeaves(c12, leaves);
+    const long n = long(leaves.size());
+    const bool do_reverse = BinTypeHelper<B>::doReverse();
+
+    if (M != Euclidean) {
+        // Other metrics may need to do more work to get the distance or to check rpar,
+        // so just let process11 handle each pair of leaves.
+        for (long i=0; i<n; ++i) {
+            for (long j=i+1; j<n; ++j) {
+                process11<C,M>(*leaves[i], *leaves[j], metric, do_reverse);
+            }
+        }
+        return;
+    }
+
+    std::vector<double> x(n), y(n), z(n), rsq(n), r(n), logr(n);
+    std::vector<long> use(n);
+    for (long i=0; i<n; ++i) GetXYZ(leaves[i]->getPos(), x[i], y[i], z[i]);
+    for (long i=0; i<n; ++i) {
+        const Position<C>& p1 = leaves[i]->getPos();
+        // This loop has no branches, so the compiler can vectorize it.
+        for (long j=i+1; j<n; ++j) {
+            const double dx = x[i]-x[j], dy = y[i]-y[j], dz = z[i]-z[j];
+            rsq[j] = dx*dx + dy*dy + dz*dz;
+        }
+        // Then only do the rest for the pairs that are in range.
+        long nuse = 0;
+        for (long j=i+1; j<n; ++j) {
+            use[nuse] = j;
+            nuse += BinTypeHelper<B>::isRSqInRange(rsq[j], p1, leaves[j]->getPos(), _minsep,
+                                                   _minsepsq, _maxsep, _maxsepsq);
+        }
+        for (long m=0; m<nuse; ++m) {
+            r[m] = sqrt(rsq[use[m]]);
+            logr[m] = log(r[m]);
+        }
+        for (long m=0; m<nuse; ++m) {
+            const long j = use[m];
+            const Position<C>& p2 = leaves[j]->getPos();
+            int k = BinTypeHelper<B>::calculateBinK(p1, p2, r[m], logr[m], _binsize,
+                                                    _minsep, _maxsep, _logminsep);
+            directProcess11(*leaves[i], *leaves[j], p1, p2, rsq[j], do_reverse,
+                            k, r[m], logr[m]);
+        }
+    }
+}
+
+template <int D1, int D2, int B> template <int C, int M>
+void BinnedCorr2<D1,D2,B>::processBucket11(const Cell<D1,C>& c1, const Cell<D2,C>& c2,
+                                           const MetricHelper<M>& metric, bool do_reverse)
+{
+    std::vector<const Cell<D1,C>*> leaves1;
+    std::vector<const Cell<D2,C>*> leaves2;
+    GetBucketLeaves(c1, leaves1);
+    GetBucketLeaves(c2, leaves2);
+    const long n1 = long(leaves1.size());
+    const long n2 = long(leaves2.size());
+
+    if (M != Euclidean) {
+        for (long i=0; i<n1; ++i) {
+            for (long j=0; j<n2; ++j) {
+                process11<C,M>(*leaves1[i], *leaves2[j], metric, do_reverse);
+            }
+        }
+        return;
+    }
+
+    std::vector<double> x2(n2), y2(n2), z2(n2), rsq(n2), r(n2), logr(n2);
+    std::vector<long> use(n2);
+    for (long j=0; j<n2; ++j) GetXYZ(leaves2[j]->getPos(), x2[j], y2[j], z2[j]);
+    for (long i=0; i<n1; ++i) {
+        const Position<C>& p1 = leaves1[i]->getPos();
+        double x1, y1, z1;
+        GetXYZ(p1, x1, y1, z1);
+        for (long j=0; j<n2; ++j) {
+            const double dx = x1-x2[j], dy = y1-y2[j], dz = z1-z2[j];
+            rsq[j] = dx*dx + dy*dy + dz*dz;
+        }
+        long nuse = 0;
+        for (long j=0; j<n2; ++j) {
+            use[nuse] = j;
+            nuse += BinTypeHelper<B>::isRSqInRange(rsq[j], p1, leaves2[j]->getPos(), _minsep,
+                                                   _minsepsq, _maxsep, _maxsepsq);
+        }
+        for (long m=0; m<nuse; ++m) {
+            r[m] = sqrt(rsq[use[m]]);
+            logr[m] = log(r[m]);
+        }
+        for (long m=0; m<nuse; ++m) {
+            const long j = use[m];
+            const Position<C>& p2 = leaves2[j]->getPos();
+            int k = BinTypeHelper<B>::calculateBinK(p1, p2, r[m], logr[m], _binsize,
+                                                    _minsep, _maxsep, _logminsep);
+            directProcess11(*leaves1[i], *leaves2[j], p1, p2, rsq[j], do_reverse,
+                            k, r[m], logr[m]);
         }
     }
 }
@@ -501,8 +818,8 @@ struct DirectHelper<GData,GData>
 
 template <int D1, int D2, int B> template <int C>
 void BinnedCorr2<D1,D2,B>::directProcess11(
-    const Cell<D1,C>& c1, const Cell<D2,C>& c2, const double rsq, bool do_reverse,
-    int k, double r, double logr)
+    const Cell<D1,C>& c1, const Cell<D2,C>& c2, const Position<C>& p1, const Position<C>& p2,
+    const double rsq, bool do_reverse, int k, double r, double logr)
 {
     xdbg<<"DirectProcess11: rsq = "<<rsq<<std::endl;
     XAssert(rsq >= _minsepsq);
@@ -512,8 +829,6 @@ void BinnedCorr2<D1,D2,B>::directProcess11(
     XAssert(c1.getSize()+c2.getSize() < sqrt(rsq)*_b + 0.0001);
 
     XAssert(_binsize != 0.);
-    const Position<C>& p1 = c1.getPos();
-    const Position<C>& p2 = c2.getPos();
     if (k < 0) {
         r = sqrt(rsq);
         logr = log(r);
@@ -530,6 +845,8 @@ void BinnedCorr2<D1,D2,B>::directProcess11(
     Assert(k < _nbins);
     xdbg<<"r,logr,k = "<<r<<','<<logr<<','<<k<<std::endl;
 
+    if (!hasData()) newData();
+
     double nn = double(c1.getN()) * double(c2.getN());
     _npairs[k] += nn;
 
@@ -567,13 +884,81 @@ void BinnedCorr2<D1,D2,B>::operator=(const BinnedCorr2<D1,D2,B>& rhs)
 
 template <int D1, int D2, int B>
 void BinnedCorr2<D1,D2,B>::operator+=(const BinnedCorr2<D1,D2,B>& rhs)
+{
+    add(rhs, 0, _nbins);
+}
+
+template <int D1, int D2, int B>
+void BinnedCorr2<D1,D2,B>::add(const BinnedCorr2<D1,D2,B>& rhs, int i1, int i2)
 {
     Assert(rhs._nbins == _nbins);
-    _xi.add(rhs._xi,_nbins);
-    for (int i=0; i<_nbins; ++i) _meanr[i] += rhs._meanr[i];
-    for (int i=0; i<_nbins; ++i) _meanlogr[i] += rhs._meanlogr[i];
-    for (int i=0; i<_nbins; ++i) _weight[i] += rhs._weight[i];
-    for (int i=0; i<_nbins; ++i) _npairs[i] += rhs._npairs[i];
+    if (!rhs.hasData()) return;
+    Assert(hasData());
+    _xi.add(rhs._xi, i1, i2);
+    for (int i=i1; i<i2; ++i) _meanr[i] += rhs._meanr[i];
+    for (int i=i1; i<i2; ++i) _meanlogr[i] += rhs._meanlogr[i];
+    for (int i=i1; i<i2; ++i) _weight[i] += rhs._weight[i];
+    for (int i=i1; i<i2; ++i) _npairs[i] += rhs._npairs[i];
+}
+
+template <int D1, int D2, int B>
+BinnedCorr2<D1,D2,B>& BinnedCorr2<D1,D2,B>::getPatchCorr(
+    PatchMap& patch_results, long p1, long p2) const
+{
+    std::pair<long,long> key(p1,p2);
+    typename PatchMap::iterator it = patch_results.find(key);
+    if (it == patch_results.end()) {
+        BinnedCorr2<D1,D2,B>* bc2 = new BinnedCorr2<D1,D2,B>(*this,false,true);
+        bc2->_task_p1 = p1;
+        bc2->_task_p2 = p2;
+        it = patch_results.insert(std::make_pair(key, bc2)).first;
+    }
+    return *it->second;
+}
+
+template <int D1, int D2, int B>
+void BinnedCorr2<D1,D2,B>::mergePatchResults(PatchMap& patch_results)
+{
+    for (typename PatchMap::iterator it=patch_results.begin(); it!=patch_results.end(); ++it) {
+        // Any patch pairs whose top-level cells were too far apart to have any pairs in
+        // range never allocated their data.  Don't keep these.
+        if (!it->second->hasData()) {
+            delete it->second;
+            continue;
+        }
+        typename PatchMap::iterator it2 = _patch_results.find(it->first);
+        if (it2 == _patch_results.end()) {
+            _patch_results.insert(*it);
+        } else {
+            *it2->second += *it->second;
+            delete it->second;
+        }
+    }
+    patch_results.clear();
+}
+
+template <int D1, int D2, int B>
+void BinnedCorr2<D1,D2,B>::takePatchResults(
+    long* p1, long* p2, double* xi0, double* xi1, double* xi2, double* xi3,
+    double* meanr, double* meanlogr, double* weight, double* npairs)
+{
+    long k=0;
+    for (typename PatchMap::iterator it=_patch_results.begin(); it!=_patch_results.end();
+         ++it, ++k) {
+        const long offset = k*_nbins;
+        const BinnedCorr2<D1,D2,B>& bc2 = *it->second;
+        p1[k] = it->first.first;
+        p2[k] = it->first.second;
+        XiData<D1,D2> xi(xi0 ? xi0+offset : 0, xi1 ? xi1+offset : 0,
+                         xi2 ? xi2+offset : 0, xi3 ? xi3+offset : 0);
+        xi.copy(bc2._xi, _nbins);
+        for (int i=0; i<_nbins; ++i) meanr[offset+i] = bc2._meanr[i];
+        for (int i=0; i<_nbins; ++i) meanlogr[offset+i] = bc2._meanlogr[i];
+        for (int i=0; i<_nbins; ++i) weight[offset+i] = bc2._weight[i];
+        for (int i=0; i<_nbins; ++i) npairs[offset+i] = bc2._npairs[i];
+        delete it->second;
+    }
+    _patch_results.clear();
 }
 
 template <int D1, int D2, int B> template <int C, int M>
@@ -805,13 +1190,13 @@ void BinnedCorr2<D1,D2,B>::sampleFrom(
             for (int q1=0; q1<nn1; ++q1) {
                 int index1;
                 if (nn1 == 1) index1 = leaf1[p1]->getInfo().index;
-                else index1 = (*leaf1[p1]->getListInfo().indices)[q1];
+                else index1 = leaf1[p1]->getListInfo().indices()[q1];
                 for (size_t p2=0; p2<leaf2.size(); ++p2) {
                     int nn2 = leaf2[p2]->getN();
                     for (int q2=0; q2<nn2; ++q2) {
                         int index2;
                         if (nn2 == 1) index2 = leaf2[p2]->getInfo().index;
-                        else index2 = (*leaf2[p2]->getListInfo().indices)[q2];
+                        else index2 = leaf2[p2]->getListInfo().indices()[q2];
                         i1[k] = index1;
                         i2[k] = index2;
                         sep[k] = r;
@@ -828,13 +1213,13 @@ void BinnedCorr2<D1,D2,B>::sampleFrom(
             for (int q1=0; q1<nn1; ++q1) {
                 int index1;
                 if (nn1 == 1) index1 = leaf1[p1]->getInfo().index;
-                else index1 = (*leaf1[p1]->getListInfo().indices)[q1];
+                else index1 = leaf1[p1]->getListInfo().indices()[q1];
                 for (size_t p2=0; p2<leaf2.size(); ++p2) {
                     int nn2 = leaf2[p2]->getN();
                     for (int q2=0; q2<nn2; ++q2) {
                         int index2;
                         if (nn2 == 1) index2 = leaf2[p2]->getInfo().index;
-                        else index2 = (*leaf2[p2]->getListInfo().indices)[q2];
+                        else index2 = leaf2[p2]->getListInfo().indices()[q2];
                         int j = k;  // j is where in the lists we will place this
                         if (k >= n) {
                             double urd = rand();
@@ -889,7 +1274,7 @@ void BinnedCorr2<D1,D2,B>::sampleFrom(
                 }
                 int index1;
                 if (nn1 == 1) index1 = leaf1[p1]->getInfo().index;
-                else index1 = (*leaf1[p1]->getListInfo().indices)[q1];
+                else index1 = leaf1[p1]->getListInfo().indices()[q1];
                 for (size_t p2=0; p2<leaf2.size(); ++p2) {
                     int nn2 = leaf2[p2]->getN();
                     for (int q2=0; q2<nn2; ++q2,++i) {
@@ -897,7 +1282,7 @@ void BinnedCorr2<D1,D2,B>::sampleFrom(
                             xdbg<<"Use i = "<<i<<std::endl;
                             int index2;
                             if (nn2 == 1) index2 = leaf2[p2]->getInfo().index;
-                            else index2 = (*leaf2[p2]->getListInfo().indices)[q2];
+                            else index2 = leaf2[p2]->getListInfo().indices()[q2];
                             long j = next->second;
                             i1[j] = index1;
                             i2[j] = index2;
@@ -932,24 +1317,25 @@ template <int D1, int D2>
 void* BuildCorr2b(int bin_type,
                   double minsep, double maxsep, int nbins, double binsize, double b,
                   double minrpar, double maxrpar, double xp, double yp, double zp,
+                  double min_task_pairs, int bucket_size,
                   double* xi0, double* xi1, double* xi2, double* xi3,
                   double* meanr, double* meanlogr, double* weight, double* npairs)
 {
     switch(bin_type) {
       case Log:
            return static_cast<void*>(new BinnedCorr2<D1,D2,Log>(
-                   minsep, maxsep, nbins, binsize, b, minrpar, maxrpar, xp, yp, zp,
-                   xi0, xi1, xi2, xi3, meanr, meanlogr, weight, npairs));
+                   minsep, maxsep, nbins, binsize, b, minrpar, maxrpar, xp, yp, zp, min_task_pairs,
+                   bucket_size, xi0, xi1, xi2, xi3, meanr, meanlogr, weight, npairs));
            break;
       case Linear:
            return static_cast<void*>(new BinnedCorr2<D1,D2,Linear>(
-                   minsep, maxsep, nbins, binsize, b, minrpar, maxrpar, xp, yp, zp,
-                   xi0, xi1, xi2, xi3, meanr, meanlogr, weight, npairs));
+                   minsep, maxsep, nbins, binsize, b, minrpar, maxrpar, xp, yp, zp, min_task_pairs,
+                   bucket_size, xi0, xi1, xi2, xi3, meanr, meanlogr, weight, npairs));
            break;
       case TwoD:
            return static_cast<void*>(new BinnedCorr2<D1,D2,TwoD>(
-                   minsep, maxsep, nbins, binsize, b, minrpar, maxrpar, xp, yp, zp,
-                   xi0, xi1, xi2, xi3, meanr, meanlogr, weight, npairs));
+                   minsep, maxsep, nbins, binsize, b, minrpar, maxrpar, xp, yp, zp, min_task_pairs,
+                   bucket_size, xi0, xi1, xi2, xi3, meanr, meanlogr, weight, npairs));
            break;
       default:
            Assert(false);
@@ -961,6 +1347,7 @@ template <int D1>
 void* BuildCorr2a(int d2, int bin_type,
                   double minsep, double maxsep, int nbins, double binsize, double b,
                   double minrpar, double maxrpar, double xp, double yp, double zp,
+                  double min_task_pairs, int bucket_size,
                   double* xi0, double* xi1, double* xi2, double* xi3,
                   double* meanr, double* meanlogr, double* weight, double* npairs)
 {
@@ -973,6 +1360,7 @@ void* BuildCorr2a(int d2, int bin_type,
            return BuildCorr2b<D1,MAX(D1,NData)>(bin_type,
                                                 minsep, maxsep, nbins, binsize, b,
                                                 minrpar, maxrpar, xp, yp, zp,
+                                                min_task_pairs, bucket_size,
                                                 xi0, xi1, xi2, xi3,
                                                 meanr, meanlogr, weight, npairs);
            break;
@@ -980,6 +1368,7 @@ void* BuildCorr2a(int d2, int bin_type,
            return BuildCorr2b<D1,MAX(D1,KData)>(bin_type,
                                                 minsep, maxsep, nbins, binsize, b,
                                                 minrpar, maxrpar, xp, yp, zp,
+                                                min_task_pairs, bucket_size,
                                                 xi0, xi1, xi2, xi3,
                                                 meanr, meanlogr, weight, npairs);
            break;
@@ -987,6 +1376,7 @@ void* BuildCorr2a(int d2, int bin_type,
            return BuildCorr2b<D1,MAX(D1,GData)>(bin_type,
                                                 minsep, maxsep, nbins, binsize, b,
                                                 minrpar, maxrpar, xp, yp, zp,
+                                                min_task_pairs, bucket_size,
                                                 xi0, xi1, xi2, xi3,
                                                 meanr, meanlogr, weight, npairs);
            break;
@@ -1000,6 +1390,7 @@ void* BuildCorr2a(int d2, int bin_type,
 void* BuildCorr2(int d1, int d2, int bin_type,
                  double minsep, double maxsep, int nbins, double binsize, double b,
                  double minrpar, double maxrpar, double xp, double yp, double zp,
+                 double min_task_pairs, int bucket_size,
                  double* xi0, double* xi1, double* xi2, double* xi3,
                  double* meanr, double* meanlogr, double* weight, double* npairs)
 {
@@ -1009,19 +1400,19 @@ void* BuildCorr2(int d1, int d2, int bin_type,
       case NData:
            corr = BuildCorr2a<NData>(d2, bin_type,
                                      minsep, maxsep, nbins, binsize, b,
-                                     minrpar, maxrpar, xp, yp, zp,
+                                     minrpar, maxrpar, xp, yp, zp, min_task_pairs, bucket_size,
                                      xi0, xi1, xi2, xi3, meanr, meanlogr, weight, npairs);
            break;
       case KData:
            corr = BuildCorr2a<KData>(d2, bin_type,
                                      minsep, maxsep, nbins, binsize, b,
-                                     minrpar, maxrpar, xp, yp, zp,
+                                     minrpar, maxrpar, xp, yp, zp, min_task_pairs, bucket_size,
                                      xi0, xi1, xi2, xi3, meanr, meanlogr, weight, npairs);
            break;
       case GData:
            corr = BuildCorr2a<GData>(d2, bin_type,
                                      minsep, maxsep, nbins, binsize, b,
-                                     minrpar, maxrpar, xp, yp, zp,
+                                     minrpar, maxrpar, xp, yp, zp, min_task_pairs, bucket_size,
                                      xi0, xi1, xi2, xi3, meanr, meanlogr, weight, npairs);
            break;
       default:
@@ -1067,6 +1458,168 @@ void DestroyCorr2a(void* corr, int d2, int bin_type)
     }
 }
 
+template <int D1, int D2>
+long GetCorr2NPatchPairsb(void* corr, int bin_type)
+{
+    switch(bin_type) {
+      case Log:
+           return static_cast<BinnedCorr2<D1,D2,Log>*>(corr)->getNPatchPairs();
+      case Linear:
+           return static_cast<BinnedCorr2<D1,D2,Linear>*>(corr)->getNPatchPairs();
+      case TwoD:
+           return static_cast<BinnedCorr2<D1,D2,TwoD>*>(corr)->getNPatchPairs();
+      default:
+           Assert(false);
+    }
+    return 0;  // Can't get here, but saves a compiler warning
+}
+
+template <int D1>
+long GetCorr2NPatchPairsa(void* corr, int d2, int bin_type)
+{
+    switch(d2) {
+      case NData:
+           return GetCorr2NPatchPairsb<D1,MAX(D1,NData)>(corr, bin_type);
+      case KData:
+           return GetCorr2NPatchPairsb<D1,MAX(D1,KData)>(corr, bin_type);
+      case GData:
+           return GetCorr2NPatchPairsb<D1,MAX(D1,GData)>(corr, bin_type);
+      default:
+           Assert(false);
+    }
+    return 0;  // Can't get here, but saves a compiler warning
+}
+
+long GetCorr2NPatchPairs(void* corr, int d1, int d2, int bin_type)
+{
+    switch(d1) {
+      case NData:
+           return GetCorr2NPatchPairsa<NData>(corr, d2, bin_type);
+      case KData:
+           return GetCorr2NPatchPairsa<KData>(corr, d2, bin_type);
+      case GData:
+           return GetCorr2NPatchPairsa<GData>(corr, d2, bin_type);
+      default:
+           Assert(false);
+    }
+    return 0;  // Can't get here, but saves a compiler warning
+}
+
+template <int D1, int D2>
+long GetCorr2ThreadMemoryb(void* corr, int bin_type)
+{
+    switch(bin_type) {
+      case Log:
+           return static_cast<BinnedCorr2<D1,D2,Log>*>(corr)->getThreadMemory();
+      case Linear:
+           return static_cast<BinnedCorr2<D1,D2,Linear>*>(corr)->getThreadMemory();
+      case TwoD:
+           return static_cast<BinnedCorr2<D1,D2,TwoD>*>(corr)->getThreadMemory();
+      default:
+           Assert(false);
+    }
+    return 0;  // Can't get here, but saves a compiler warning
+}
+
+template <int D1>
+long GetCorr2ThreadMemorya(void* corr, int d2, int bin_type)
+{
+    switch(d2) {
+      case NData:
+           return GetCorr2ThreadMemoryb<D1,MAX(D1,NData)>(corr, bin_type);
+      case KData:
+           return GetCorr2ThreadMemoryb<D1,MAX(D1,KData)>(corr, bin_type);
+      case GData:
+           return GetCorr2ThreadMemoryb<D1,MAX(D1,GData)>(corr, bin_type);
+      default:
+           Assert(false);
+    }
+    return 0;  // Can't get here, but saves a compiler warning
+}
+
+long GetCorr2ThreadMemory(void* corr, int d1, int d2, int bin_type)
+{
+    switch(d1) {
+      case NData:
+           return GetCorr2ThreadMemorya<NData>(corr, d2, bin_type);
+      case KData:
+           return GetCorr2ThreadMemorya<KData>(corr, d2, bin_type);
+      case GData:
+           return GetCorr2ThreadMemorya<GData>(corr, d2, bin_type);
+      default:
+           Assert(false);
+    }
+    return 0;  // Can't get here, but saves a compiler warning
+}
+
+template <int D1, int D2>
+void TakeCorr2PatchResultsb(void* corr, int bin_type, long* p1, long* p2,
+                            double* xi0, double* xi1, double* xi2, double* xi3,
+                            double* meanr, double* meanlogr, double* weight, double* npairs)
+{
+    switch(bin_type) {
+      case Log:
+           static_cast<BinnedCorr2<D1,D2,Log>*>(corr)->takePatchResults(
+               p1, p2, xi0, xi1, xi2, xi3, meanr, meanlogr, weight, npairs);
+           break;
+      case Linear:
+           static_cast<BinnedCorr2<D1,D2,Linear>*>(corr)->takePatchResults(
+               p1, p2, xi0, xi1, xi2, xi3, meanr, meanlogr, weight, npairs);
+           break;
+      case TwoD:
+           static_cast<BinnedCorr2<D1,D2,TwoD>*>(corr)->takePatchResults(
+               p1, p2, xi0, xi1, xi2, xi3, meanr, meanlogr, weight, npairs);
+           break;
+      default:
+           Assert(false);
+    }
+}
+
+template <int D1>
+void TakeCorr2PatchResultsa(void* corr, int d2, int bin_type, long* p1, long* p2,
+                            double* xi0, double* xi1, double* xi2, double* xi3,
+                            double* meanr, double* meanlogr, double* weight, double* npairs)
+{
+    switch(d2) {
+      case NData:
+           TakeCorr2PatchResultsb<D1,MAX(D1,NData)>(corr, bin_type, p1, p2, xi0, xi1, xi2, xi3,
+                                                    meanr, meanlogr, weight, npairs);
+           break;
+      case KData:
+           TakeCorr2PatchResultsb<D1,MAX(D1,KData)>(corr, bin_type, p1, p2, xi0, xi1, xi2, xi3,
+                                                    meanr, meanlogr, weight, npairs);
+           break;
+      case GData:
+           TakeCorr2PatchResultsb<D1,MAX(D1,GData)>(corr, bin_type, p1, p2, xi0, xi1, xi2, xi3,
+                                                    meanr, meanlogr, weight, npairs);
+           break;
+      default:
+           Assert(false);
+    }
+}
+
+void TakeCorr2PatchResults(void* corr, int d1, int d2, int bin_type, long* p1, long* p2,
+                           double* xi0, double* xi1, double* xi2, double* xi3,
+                           double* meanr, double* meanlogr, double* weight, double* npairs)
+{
+    switch(d1) {
+      case NData:
+           TakeCorr2PatchResultsa<NData>(corr, d2, bin_type, p1, p2, xi0, xi1, xi2, xi3,
+                                         meanr, meanlogr, weight, npairs);
+           break;
+      case KData:
+           TakeCorr2PatchResultsa<KData>(corr, d2, bin_type, p1, p2, xi0, xi1, xi2, xi3,
+                                         meanr, meanlogr, weight, npairs);
+           break;
+      case GData:
+           TakeCorr2PatchResultsa<GData>(corr, d2, bin_type, p1, p2, xi0, xi1, xi2, xi3,
+                                         meanr, meanlogr, weight, npairs);
+           break;
+      default:
+           Assert(false);
+    }
+}
+
 void DestroyCorr2(void* corr, int d1, int d2, int bin_type)
 {
     dbg<<"Start DestroyCorr2: "<<d1<<" "<<d2<<" "<<bin_type<<std::endl;
@@ -18,6 +18,9 @@
 #include "BinnedCorr3.h"
 #include "Split.h"
 #include "ProjectHelper.h"
+#include "Schedule.h"
+#include <algorithm>
+#include <iterator>
 
 #ifdef _OPENMP
 #include "omp.h"
@@ -42,7 +45,7 @@ BinnedCorr3<D1,D2,D3,B>::BinnedCorr3(
     _zeta(zeta0,zeta1,zeta2,zeta3,zeta4,zeta5,zeta6,zeta7),
     _meand1(meand1), _meanlogd1(meanlogd1), _meand2(meand2), _meanlogd2(meanlogd2),
     _meand3(meand3), _meanlogd3(meanlogd3), _meanu(meanu), _meanv(meanv),
-    _weight(weight), _ntri(ntri)
+    _weight(weight), _ntri(ntri), _thread_memory(0)
 {
     // Some helpful variables we can calculate once here.
     _logminsep = log(_minsep);
@@ -77,7 +80,7 @@ BinnedCorr3<D1,D2,D3,B>::BinnedCorr3(const BinnedCorr3<D1,D2,D3,B>& rhs, bool co
     _minvsq(rhs._minvsq), _maxvsq(rhs._maxvsq),
     _bsq(rhs._bsq), _busq(rhs._busq), _bvsq(rhs._bvsq), _sqrttwobv(rhs._sqrttwobv),
     _coords(rhs._coords), _nvbins2(rhs._nvbins2), _nuv(rhs._nuv), _ntot(rhs._ntot),
-    _owns_data(true), _zeta(0,0,0,0,0,0,0,0), _weight(0)
+    _owns_data(true), _zeta(0,0,0,0,0,0,0,0), _weight(0), _thread_memory(0)
 {
     _zeta.new_data(_ntot);
     _meand1 = new double[_ntot];
@@ -179,52 +182,95 @@ void BinnedCorr3<D1,D2,D3,B>::process(const Field<D1,C>& field, bool dots)
 
     MetricHelper<M> metric(_minrpar, _maxrpar, _xp, _yp, _zp);
 
+    // Make the list of pairs of top-level cells to process, with the slowest ones first.
+    // Each job (i,j) with i < j also does the loop over the third cell k > j, so scale the
+    // cost of the pair by the number of objects that can be the third point.
+    // The triangle sides can be as large as 2 maxsep, so use that for finding the cells
+    // that are near each other.  The third cells only need to be near both c1 and c2.
+    const std::vector<Cell<D1,C>*>& cells = field.getCells();
+    std::vector<std::vector<long> > near;
+    FindNearCells(cells, cells, metric, 2.*_maxsep, near);
+    std::vector<CellPairJob> jobs;
+    BuildAutoJobs(cells, near, metric, 2.*_maxsep, jobs);
+    std::vector<double> nafter(n1+1, 0.);  // The total N in cells k..n1-1.
+    for (long k=n1-1;k>=0;--k) nafter[k] = nafter[k+1] + cells[k]->getN();
+    for (size_t k=0;k<jobs.size();++k) {
+        const long i = jobs[k].i;
+        const long j = jobs[k].j;
+        if (i == j) jobs[k].cost *= 1. + cells[i]->getN();
+        else jobs[k].cost *= 1. + cells[i]->getN() + nafter[j];
+    }
+    // Each job loops over the third cells, so even the ones with zero cost are worth
+    // handing out one at a time.
+    SortJobs(jobs);
+    const long njobs = jobs.size();
+    // Print about one dot per top-level cell.
+    const long dot_every = std::max(njobs / n1, 1L);
+
 #ifdef _OPENMP
+    ThreadData thread_data(*this, omp_get_max_threads());
 #pragma omp parallel
     {
-        // Give each thread their own copy of the data vector to fill in.
-        BinnedCorr3<D1,D2,D3,B> bc3(*this,false);
 #else
-        BinnedCorr3<D1,D2,D3,B>& bc3 = *this;
+    ThreadData thread_data(*this, 1);
 #endif
+        std::vector<long> near3;
 
 #ifdef _OPENMP
 #pragma omp for schedule(dynamic)
 #endif
-        for (int i=0;i<n1;++i) {
-            const Cell<D1,C>* c1 = field.getCells()[i];
+        for (long n=0;n<njobs;++n) {
+            const long i = jobs[n].i;
+            const long j = jobs[n].j;
+            const Cell<D1,C>* c1 = cells[i];
+            // Only enter the critical section when there is something to print, since
+            // there are a lot of jobs.
+            if (dots && n % dot_every == 0) {
 #ifdef _OPENMP
 #pragma omp critical
 #endif
-            {
-                if (dots) std::cout<<'.'<<std::flush;
+                std::cout<<'.'<<std::flush;
+            }
 #ifdef _OPENMP
-                dbg<<omp_get_thread_num()<<" "<<i<<std::endl;
+            dbg<<omp_get_thread_num()<<" "<<i<<" "<<j<<std::endl;
 #endif
-                xdbg<<"field = \n";
 #ifdef DEBUGLOGGING
-                if (verbose_level >= 2) c1->WriteTree(get_dbgout());
+            if (verbose_level >= 2) {
+#ifdef _OPENMP
+#pragma omp critical
 #endif
+                {
+                    xdbg<<"field = \n";
+                    c1->WriteTree(get_dbgout());
+                }
             }
-            ProcessHelper<D1,D2,D3,B,C,M>::process3(bc3,c1, metric);
-            for (int j=i+1;j<n1;++j) {
-                const Cell<D1,C>* c2 = field.getCells()[j];
+#endif
+            // Each thread gets its own copy of the data vector to fill in.
+            BinnedCorr3<D1,D2,D3,B>& bc3 = thread_data.getCorr();
+            if (i == j) {
+                ProcessHelper<D1,D2,D3,B,C,M>::process3(bc3,c1, metric);
+            } else {
+                const Cell<D1,C>* c2 = cells[j];
                 ProcessHelper<D1,D2,D3,B,C,M>::process21(bc3,c1,c2, metric);
                 ProcessHelper<D1,D2,D3,B,C,M>::process21(bc3,c2,c1, metric);
-                for (int k=j+1;k<n1;++k) {
-                    const Cell<D1,C>* c3 = field.getCells()[k];
+                near3.clear();
+                std::set_intersection(
+                    std::upper_bound(near[i].begin(), near[i].end(), j), near[i].end(),
+                    std::upper_bound(near[j].begin(), near[j].end(), j), near[j].end(),
+                    std::back_inserter(near3));
+                for (size_t k=0;k<near3.size();++k) {
+                    const Cell<D1,C>* c3 = cells[near3[k]];
                     ProcessHelper<D1,D2,D3,B,C,M>::process111(bc3,c1,c2,c3, metric);
                 }
             }
         }
-#ifdef _OPENMP
         // Accumulate the results
-#pragma omp critical
-        {
-            *this += bc3;
-        }
+        thread_data.reduce();
+#ifdef _OPENMP
     }
 #endif
+    _thread_memory = thread_data.getMemory();
+    dbg<<"thread copies used "<<_thread_memory<<" bytes\n";
     if (dots) std::cout<<std::endl;
     xdbg<<"zeta[0] -> "<<_zeta<<std::endl;
 }
@@ -272,45 +318,63 @@ void BinnedCorr3<D1,D2,D3,B>::process(const Field<D1,C>& field1, const Field<D2,
     }
 #endif
 
+    // As above, but here each job (i,j) loops over the cells in field3 that are near both.
+    std::vector<std::vector<long> > near12, near13, near23;
+    FindNearCells(field1.getCells(), field2.getCells(), metric, 2.*_maxsep, near12);
+    FindNearCells(field1.getCells(), field3.getCells(), metric, 2.*_maxsep, near13);
+    FindNearCells(field2.getCells(), field3.getCells(), metric, 2.*_maxsep, near23);
+    std::vector<CellPairJob> jobs;
+    BuildCrossJobs(field1.getCells(), field2.getCells(), near12, metric, 2.*_maxsep, jobs);
+    double n3tot = 0.;
+    for (long k=0;k<n3;++k) n3tot += field3.getCells()[k]->getN();
+    for (size_t k=0;k<jobs.size();++k) jobs[k].cost *= 1. + n3tot;
+    SortJobs(jobs);
+    const long njobs = jobs.size();
+    const long dot_every = std::max(njobs / n1, 1L);
+
 #ifdef _OPENMP
+    ThreadData thread_data(*this, omp_get_max_threads());
 #pragma omp parallel
     {
-        // Give each thread their own copy of the data vector to fill in.
-        BinnedCorr3<D1,D2,D3,B> bc3(*this,false);
 #else
-        BinnedCorr3<D1,D2,D3,B>& bc3 = *this;
+    ThreadData thread_data(*this, 1);
 #endif
+        std::vector<long> near3;
 
 #ifdef _OPENMP
 #pragma omp for schedule(dynamic)
 #endif
-        for (int i=0;i<n1;++i) {
+        for (long n=0;n<njobs;++n) {
+            const long i = jobs[n].i;
+            const long j = jobs[n].j;
+            if (dots && n % dot_every == 0) {
 #ifdef _OPENMP
 #pragma omp critical
 #endif
-            {
-                if (dots) std::cout<<'.'<<std::flush;
+                std::cout<<'.'<<std::flush;
+            }
 #ifdef _OPENMP
-                dbg<<omp_get_thread_num()<<" "<<i<<std::endl;
+            dbg<<omp_get_thread_num()<<" "<<i<<" "<<j<<std::endl;
 #endif
-            }
+            BinnedCorr3<D1,D2,D3,B>& bc3 = thread_data.getCorr();
             const Cell<D1,C>* c1 = field1.getCells()[i];
-            for (int j=0;j<n2;++j) {
-                const Cell<D2,C>* c2 = field2.getCells()[j];
-                for (int k=0;k<n3;++k) {
-                    const Cell<D3,C>* c3 = field3.getCells()[k];
-                    bc3.template process111<false,C,M>(c1, c2, c3, metric);
-                }
+            const Cell<D2,C>* c2 = field2.getCells()[j];
+            near3.clear();
+            std::set_intersection(near13[i].begin(), near13[i].end(),
+                                  near23[j].begin(), near23[j].end(),
+                                  std::back_inserter(near3));
+            for (size_t k=0;k<near3.size();++k) {
+                const Cell<D3,C>* c3 = field3.getCells()[near3[k]];
+                bc3.template process111<false,C,M>(c1, c2, c3, metric);
             }
         }
-#ifdef _OPENMP
         // Accumulate the results
-#pragma omp critical
-        {
-            *this += bc3;
-        }
+        thread_data.reduce();
+#ifdef _OPENMP
     }
 #endif
+    _thread_memory = thread_data.getMemory();
+    dbg<<"thread copies used "<<_thread_memory<<" bytes\n";
     if (dots) std::cout<<std::endl;
 }
 
@@ -1173,19 +1237,71 @@ void BinnedCorr3<D1,D2,D3,B>::operator=(const BinnedCorr3<D1,D2,D3,B>& rhs)
 
 template <int D1, int D2, int D3, int B>
 void BinnedCorr3<D1,D2,D3,B>::operator+=(const BinnedCorr3<D1,D2,D3,B>& rhs)
+{
+    add(rhs, 0, _ntot);
+}
+
+template <int D1, int D2, int D3, int B>
+void BinnedCorr3<D1,D2,D3,B>::add(const BinnedCorr3<D1,D2,D3,B>& rhs, int i1, int i2)
 {
     Assert(rhs._ntot == _ntot);
-    _zeta.add(rhs._zeta,_ntot);
-    for (int i=0; i<_ntot; ++i) _meand1[i] += rhs._meand1[i];
-    for (int i=0; i<_ntot; ++i) _meanlogd1[i] += rhs._meanlogd1[i];
-    for (int i=0; i<_ntot; ++i) _meand2[i] += rhs._meand2[i];
-    for (int i=0; i<_ntot; ++i) _meanlogd2[i] += rhs._meanlogd2[i];
-    for (int i=0; i<_ntot; ++i) _meand3[i] += rhs._meand3[i];
-    for (int i=0; i<_ntot; ++i) _meanlogd3[i] += rhs._meanlogd3[i];
-    for (int i=0; i<_ntot; ++i) _meanu[i] += rhs._meanu[i];
-    for (int i=0; i<_ntot; ++i) _meanv[i] += rhs._meanv[i];
-    for (int i=0; i<_ntot; ++i) _weight[i] += rhs._weight[i];
-    for (int i=0; i<_ntot; ++i) _ntri[i] += rhs._ntri[i];
+    _zeta.add(rhs._zeta, i1, i2);
+    for (int i=i1; i<i2; ++i) _meand1[i] += rhs._meand1[i];
+    for (int i=i1; i<i2; ++i) _meanlogd1[i] += rhs._meanlogd1[i];
+    for (int i=i1; i<i2; ++i) _meand2[i] += rhs._meand2[i];
+    for (int i=i1; i<i2; ++i) _meanlogd2[i] += rhs._meanlogd2[i];
+    for (int i=i1; i<i2; ++i) _meand3[i] += rhs._meand3[i];
+    for (int i=i1; i<i2; ++i) _meanlogd3[i] += rhs._meanlogd3[i];
+    for (int i=i1; i<i2; ++i) _meanu[i] += rhs._meanu[i];
+    for (int i=i1; i<i2; ++i) _meanv[i] += rhs._meanv[i];
+    for (int i=i1; i<i2; ++i) _weight[i] += rhs._weight[i];
+    for (int i=i1; i<i2; ++i) _ntri[i] += rhs._ntri[i];
+}
+
+template <int D1, int D2, int D3, int B>
+BinnedCorr3<D1,D2,D3,B>::ThreadData::~ThreadData()
+{
+    for (size_t k=0; k<corrs.size(); ++k) delete corrs[k];
+}
+
+template <int D1, int D2, int D3, int B>
+BinnedCorr3<D1,D2,D3,B>& BinnedCorr3<D1,D2,D3,B>::ThreadData::getCorr()
+{
+#ifdef _OPENMP
+    if (omp_get_num_threads() > 1) {
+        const int thread = omp_get_thread_num();
+        if (!corrs[thread]) corrs[thread] = new BinnedCorr3<D1,D2,D3,B>(parent,false);
+        return *corrs[thread];
+    }
+#endif
+    // With only one thread, just accumulate into the parent directly.
+    return parent;
+}
+
+template <int D1, int D2, int D3, int B>
+void BinnedCorr3<D1,D2,D3,B>::ThreadData::reduce()
+{
+#ifdef _OPENMP
+    const int thread = omp_get_thread_num();
+    const int nthreads = omp_get_num_threads();
+#else
+    const int thread = 0;
+    const int nthreads = 1;
+#endif
+    const int ntot = parent._ntot;
+    const int i1 = int(long(ntot) * thread / nthreads);
+    const int i2 = int(long(ntot) * (thread+1) / nthreads);
+    for (size_t k=0; k<corrs.size(); ++k) {
+        if (corrs[k]) parent.add(*corrs[k], i1, i2);
+    }
+}
+
+template <int D1, int D2, int D3, int B>
+long BinnedCorr3<D1,D2,D3,B>::ThreadData::getMemory() const
+{
+    long ncopies = 0;
+    for (size_t k=0; k<corrs.size(); ++k) if (corrs[k]) ++ncopies;
+    return ncopies * parent.getMemory();
 }
 
 //
@@ -1303,6 +1419,30 @@ void DestroyCorr3(void* corr, int d1, int d2, int d3, int bin_type)
     }
 }
 
+template <int D1, int D2, int D3>
+long GetCorr3ThreadMemoryc(void* corr, int bin_type)
+{
+    Assert(bin_type == Log);
+    return static_cast<BinnedCorr3<D1,D2,D3,Log>*>(corr)->getThreadMemory();
+}
+
+long GetCorr3ThreadMemory(void* corr, int d1, int d2, int d3, int bin_type)
+{
+    Assert(d2 == d1);
+    Assert(d3 == d1);
+    switch(d1) {
+      case NData:
+           return GetCorr3ThreadMemoryc<NData, NData, NData>(corr, bin_type);
+      case KData:
+           return GetCorr3ThreadMemoryc<KData, KData, KData>(corr, bin_type);
+      case GData:
+           return GetCorr3ThreadMemoryc<GData, GData, GData>(corr, bin_type);
+      default:
+           Assert(false);
+    }
+    return 0;  // Can't get here, but saves a compiler warning
+}
+
 template <int M, int D, int B>
 void ProcessAuto3e(BinnedCorr3<D,D,D,B>* corr, void* field, int dots, int coords)
 {
@@ -26,14 +26,33 @@
 // CellData
 //
 
+// Ranges larger than this are split in half, with the halves done as separate OpenMP tasks.
+const size_t MIN_SIZESQ_TASK_SIZE = 100000;
+
 template <int D, int C>
 double CalculateSizeSq(
-    const Position<C>& cen, const std::vector<std::pair<CellData<D,C>*,WPosLeafInfo> >& vdata,
+    const Position<C>& cen, const std::vector<std::pair<CellData<D,C>,WPosLeafInfo> >& vdata,
     size_t start, size_t end)
 {
+    if (end - start > MIN_SIZESQ_TASK_SIZE) {
+        // This is only worth doing in parallel near the top of the tree, but it's a
+        // significant fraction of the build time there.  When not in a parallel region,
+        // the tasks are just executed immediately, so this is still fine.
+        size_t mid = (start + end)/2;
+        double sizesq1, sizesq2;
+#ifdef _OPENMP
+#pragma omp task shared(cen, vdata, sizesq1)
+#endif
+        sizesq1 = CalculateSizeSq(cen,vdata,start,mid);
+        sizesq2 = CalculateSizeSq(cen,vdata,mid,end);
+#ifdef _OPENMP
+#pragma omp taskwait
+#endif
+        return std::max(sizesq1,sizesq2);
+    }
     double sizesq = 0.;
     for(size_t i=start;i<end;++i) {
-        double devsq = (cen-vdata[i].first->getPos()).normSq();
+        double devsq = (cen-vdata[i].first.getPos()).normSq();
         if (devsq > sizesq) sizesq = devsq;
     }
     return sizesq;
@@ -41,18 +60,18 @@ double CalculateSizeSq(
 
 template <int D, int C>
 void BuildCellData(
-    const std::vector<std::pair<CellData<D,C>*,WPosLeafInfo> >& vdata, size_t start, size_t end,
+    const std::vector<std::pair<CellData<D,C>,WPosLeafInfo> >& vdata, size_t start, size_t end,
     Position<C>& pos, float& w, long& n)
 {
     Assert(start < end);
     double wp = vdata[start].second.wpos;
-    pos = vdata[start].first->getPos();
+    pos = vdata[start].first.getPos();
     pos *= wp;
-    w = vdata[start].first->getW();
+    w = vdata[start].first.getW();
     n = (w != 0);
     double sumwp = wp;
     for(size_t i=start+1; i!=end; ++i) {
-        const CellData<D,C>& data = *vdata[i].first;
+        const CellData<D,C>& data = vdata[i].first;
         wp = vdata[i].second.wpos;
         pos += data.getPos() * wp;
         sumwp += wp;
@@ -66,7 +85,7 @@ void BuildCellData(
         pos.normalize();
     } else {
         // Make sure we don't have an invalid position, even if all wpos == 0.
-        pos = vdata[start].first->getPos();
+        pos = vdata[start].first.getPos();
         // But in this case, we should have w == 0 too!
         Assert(w == 0.);
     }
@@ -74,45 +93,45 @@ void BuildCellData(
 
 template <int C>
 CellData<NData,C>::CellData(
-    const std::vector<std::pair<CellData<NData,C>*,WPosLeafInfo> >& vdata, size_t start, size_t end) :
+    const std::vector<std::pair<CellData<NData,C>,WPosLeafInfo> >& vdata, size_t start, size_t end) :
     _w(0.), _n(0)
 { BuildCellData(vdata,start,end,_pos,_w,_n); }
 
 template <int C>
 CellData<KData,C>::CellData(
-    const std::vector<std::pair<CellData<KData,C>*,WPosLeafInfo> >& vdata, size_t start, size_t end) :
+    const std::vector<std::pair<CellData<KData,C>,WPosLeafInfo> >& vdata, size_t start, size_t end) :
     _wk(0.), _w(0.), _n(0)
 { BuildCellData(vdata,start,end,_pos,_w,_n); }
 
 template <int C>
 CellData<GData,C>::CellData(
-    const std::vector<std::pair<CellData<GData,C>*,WPosLeafInfo> >& vdata, size_t start, size_t end) :
+    const std::vector<std::pair<CellData<GData,C>,WPosLeafInfo> >& vdata, size_t start, size_t end) :
     _wg(0.), _w(0.), _n(0)
 { BuildCellData(vdata,start,end,_pos,_w,_n); }
 
 template <int C>
 void CellData<KData,C>::finishAverages(
-    const std::vector<std::pair<CellData<KData,C>*,WPosLeafInfo> >& vdata, size_t start, size_t end)
+    const std::vector<std::pair<CellData<KData,C>,WPosLeafInfo> >& vdata, size_t start, size_t end)
 {
     // Accumulate in double precision for better accuracy.
     double dwk = 0.;
-    for(size_t i=start;i<end;++i) dwk += vdata[i].first->getWK();
+    for(size_t i=start;i<end;++i) dwk += vdata[i].first.getWK();
     _wk = dwk;
 }
 
 template <>
 void CellData<GData,Flat>::finishAverages(
-    const std::vector<std::pair<CellData<GData,Flat>*,WPosLeafInfo> >& vdata, size_t start, size_t end)
+    const std::vector<std::pair<CellData<GData,Flat>,WPosLeafInfo> >& vdata, size_t start, size_t end)
 {
     // Accumulate in double precision for better accuracy.
     std::complex<double> dwg(0.);
-    for(size_t i=start;i<end;++i) dwg += vdata[i].first->getWG();
+    for(size_t i=start;i<end;++i) dwg += vdata[i].first.getWG();
     _wg = dwg;
 }
 
 template <int C>
 std::complex<double> ParallelTransportShift(
-    const std::vector<std::pair<CellData<GData,C>*,WPosLeafInfo> >& vdata,
+    const std::vector<std::pair<CellData<GData,C>,WPosLeafInfo> >& vdata,
     const Position<C>& center, size_t start, size_t end)
 {
     // For the average shear, we need to parallel transport each one to the center
@@ -120,8 +139,8 @@ std::complex<double> ParallelTransportShift(
     xdbg<<"Finish Averages for Center = "<<center<<std::endl;
     std::complex<double> dwg=0.;
     for(size_t i=start;i<end;++i) {
-        xxdbg<<"Project shear "<<(vdata[i].first->getWG()/vdata[i].first->getW())<<
-            " at point "<<vdata[i].first->getPos()<<std::endl;
+        xxdbg<<"Project shear "<<(vdata[i].first.getWG()/vdata[i].first.getW())<<
+            " at point "<<vdata[i].first.getPos()<<std::endl;
         // This is a lot like the ProjectShear function in BinCorr2.cpp
         // The difference is that here, we just rotate the single shear by
         // (Pi-A-B).  See the comments in ProjectShear2 for understanding
@@ -129,9 +148,9 @@ std::complex<double> ParallelTransportShift(
         double x1 = center.getX();
         double y1 = center.getY();
         double z1 = center.getZ();
-        double x2 = vdata[i].first->getPos().getX();
-        double y2 = vdata[i].first->getPos().getY();
-        double z2 = vdata[i].first->getPos().getZ();
+        double x2 = vdata[i].first.getPos().getX();
+        double y2 = vdata[i].first.getPos().getY();
+        double z2 = vdata[i].first.getPos().getZ();
         double temp = x1*x2+y1*y2;
         double cosA = z1*(1.-z2*z2) - z2*temp;
         double sinA = y1*x2 - x1*y2;
@@ -143,7 +162,7 @@ std::complex<double> ParallelTransportShift(
         xxdbg<<"B = atan("<<sinB<<"/"<<cosB<<") = "<<atan2(sinB,cosB)*180./M_PI<<std::endl;
         if (normAsq == 0. || normBsq == 0.) {
             // Then this point is at the center, no need to project.
-            dwg += vdata[i].first->getWG();
+            dwg += vdata[i].first.getWG();
         } else {
             // The angle we need to rotate the shear by is (Pi-A-B)
             // cos(beta) = -cos(A+B)
@@ -155,7 +174,7 @@ std::complex<double> ParallelTransportShift(
             xxdbg<<"expibeta = "<<expibeta/sqrt(normAsq*normBsq)<<std::endl;
             std::complex<double> exp2ibeta = (expibeta * expibeta) / (normAsq*normBsq);
             xxdbg<<"exp2ibeta = "<<exp2ibeta<<std::endl;
-            dwg += vdata[i].first->getWG() * exp2ibeta;
+            dwg += vdata[i].first.getWG() * exp2ibeta;
         }
     }
     return dwg;
@@ -164,14 +183,14 @@ std::complex<double> ParallelTransportShift(
 // These two need to do the same thing, so pull it out into the above function.
 template <>
 void CellData<GData,ThreeD>::finishAverages(
-    const std::vector<std::pair<CellData<GData,ThreeD>*,WPosLeafInfo> >& vdata, size_t start, size_t end)
+    const std::vector<std::pair<CellData<GData,ThreeD>,WPosLeafInfo> >& vdata, size_t start, size_t end)
 {
     _wg = ParallelTransportShift(vdata,_pos,start,end);
 }
 
 template <>
 void CellData<GData,Sphere>::finishAverages(
-    const std::vector<std::pair<CellData<GData,Sphere>*,WPosLeafInfo> >& vdata, size_t start, size_t end)
+    const std::vector<std::pair<CellData<GData,Sphere>,WPosLeafInfo> >& vdata, size_t start, size_t end)
 {
     _wg = ParallelTransportShift(vdata,_pos,start,end);
 }
@@ -186,9 +205,9 @@ struct DataCompare
 {
     int split;
     DataCompare(int s) : split(s) {}
-    bool operator()(const std::pair<CellData<D,C>*,WPosLeafInfo> cd1,
-                    const std::pair<CellData<D,C>*,WPosLeafInfo> cd2) const
-    { return cd1.first->getPos().get(split) < cd2.first->getPos().get(split); }
+    bool operator()(const std::pair<CellData<D,C>,WPosLeafInfo>& cd1,
+                    const std::pair<CellData<D,C>,WPosLeafInfo>& cd2) const
+    { return cd1.first.getPos().get(split) < cd2.first.getPos().get(split); }
 };
 
 template <int D, int C>
@@ -198,8 +217,8 @@ struct DataCompareToValue
     double splitvalue;
 
     DataCompareToValue(int s, double v) : split(s), splitvalue(v) {}
-    bool operator()(const std::pair<CellData<D,C>*,WPosLeafInfo> cd) const
-    { return cd.first->getPos().get(split) < splitvalue; }
+    bool operator()(const std::pair<CellData<D,C>,WPosLeafInfo>& cd) const
+    { return cd.first.getPos().get(split) < splitvalue; }
 };
 
 void seed_urandom()
@@ -250,14 +269,14 @@ size_t select_random(size_t lo, size_t hi)
 
 template <int D, int C>
 size_t SplitData(
-    std::vector<std::pair<CellData<D,C>*,WPosLeafInfo> >& vdata, SplitMethod sm,
+    std::vector<std::pair<CellData<D,C>,WPosLeafInfo> >& vdata, SplitMethod sm,
     size_t start, size_t end, const Position<C>& meanpos)
 {
     Assert(end-start > 1);
     size_t mid=0;
 
     Bounds<C> b;
-    for(size_t i=start;i<end;++i) b += vdata[i].first->getPos();
+    for(size_t i=start;i<end;++i) b += vdata[i].first.getPos();
 
     int split = b.getSplit();
 
@@ -266,7 +285,7 @@ size_t SplitData(
            { // Middle is the average of the min and max value of x or y
                double splitvalue = b.getMiddle(split);
                DataCompareToValue<D,C> comp(split,splitvalue);
-               typename std::vector<std::pair<CellData<D,C>*,WPosLeafInfo> >::iterator middle =
+               typename std::vector<std::pair<CellData<D,C>,WPosLeafInfo> >::iterator middle =
                    std::partition(vdata.begin()+start,vdata.begin()+end,comp);
                mid = middle - vdata.begin();
            } break;
@@ -274,7 +293,7 @@ size_t SplitData(
            { // Median is the point which divides the group into equal numbers
                DataCompare<D,C> comp(split);
                mid = (start+end)/2;
-               typename std::vector<std::pair<CellData<D,C>*,WPosLeafInfo> >::iterator middle =
+               typename std::vector<std::pair<CellData<D,C>,WPosLeafInfo> >::iterator middle =
                    vdata.begin()+mid;
                std::nth_element(vdata.begin()+start,middle,vdata.begin()+end,comp);
            } break;
@@ -282,7 +301,7 @@ size_t SplitData(
            { // Mean is the weighted average value of x or y
                double splitvalue = meanpos.get(split);
                DataCompareToValue<D,C> comp(split,splitvalue);
-               typename std::vector<std::pair<CellData<D,C>*,WPosLeafInfo> >::iterator middle =
+               typename std::vector<std::pair<CellData<D,C>,WPosLeafInfo> >::iterator middle =
                    std::partition(vdata.begin()+start,vdata.begin()+end,comp);
                mid = middle - vdata.begin();
            } break;
@@ -296,7 +315,7 @@ size_t SplitData(
                // result should be mid=2.  Otherwise, we want roughly 2/5 and 3/5 of the span.
                mid = select_random(end-3*(end-start)/5,start+3*(end-start)/5);
 
-               typename std::vector<std::pair<CellData<D,C>*,WPosLeafInfo> >::iterator middle =
+               typename std::vector<std::pair<CellData<D,C>,WPosLeafInfo> >::iterator middle =
                    vdata.begin()+mid;
                std::nth_element(vdata.begin()+start,middle,vdata.begin()+end,comp);
            } break;
@@ -329,76 +348,74 @@ size_t SplitData(
 }
 
 template <int D, int C>
-Cell<D,C>::Cell(std::vector<std::pair<CellData<D,C>*,WPosLeafInfo> >& vdata,
-                 double minsizesq, SplitMethod sm, bool brute, size_t start, size_t end) :
-    _size(0.), _sizesq(0.), _left(0), _right(0)
+void Cell<D,C>::BuildTree(
+    std::vector<Cell<D,C> >& cells,
+    std::vector<std::pair<CellData<D,C>,WPosLeafInfo> >& vdata, long* indices,
+    double minsizesq, SplitMethod sm, bool brute, size_t start, size_t end)
 {
     Assert(vdata.size()>0);
     Assert(end <= vdata.size());
     Assert(end > start);
 
     if (end - start == 1) {
-        xdbg<<"Make leaf cell from "<<*vdata[start].first<<std::endl;
-        xdbg<<"size = "<<_size<<std::endl;
-        _data = vdata[start].first;
-        vdata[start].first = 0; // Make sure calling routine doesn't delete this one!
-        _info = vdata[start].second;  // This only copies as a LeafInfo, so throws away wpos.
-        xdbg<<"_info.index = "<<_info.index<<"  "<<vdata[start].second.index<<std::endl;
+        xdbg<<"Make leaf cell from "<<vdata[start].first<<std::endl;
+        cells.push_back(Cell<D,C>(vdata[start].first, vdata[start].second));
+        indices[start] = vdata[start].second.index;
     } else {
-        _data = new CellData<D,C>(vdata,start,end);
-        _data->finishAverages(vdata,start,end);
-        xdbg<<"Make cell from "<<start<<".."<<end<<" = "<<*_data<<std::endl;
+        CellData<D,C> ave(vdata,start,end);
+        ave.finishAverages(vdata,start,end);
+        xdbg<<"Make cell from "<<start<<".."<<end<<" = "<<ave<<std::endl;
 
-        _sizesq = CalculateSizeSq(_data->getPos(),vdata,start,end);
-        Assert(_sizesq >= 0.);
+        double sizesq = CalculateSizeSq(ave.getPos(),vdata,start,end);
+        Assert(sizesq >= 0.);
 
-        finishInit(vdata, minsizesq, sm, brute, start, end);
+        BuildTree(cells, ave, sizesq, vdata, indices, minsizesq, sm, brute, start, end);
     }
 }
 
 template <int D, int C>
-Cell<D,C>::Cell(CellData<D,C>* ave, double sizesq,
-                 std::vector<std::pair<CellData<D,C>*,WPosLeafInfo> >& vdata,
-                 double minsizesq, SplitMethod sm, bool brute, size_t start, size_t end) :
-    _sizesq(sizesq), _data(ave), _left(0), _right(0)
+void Cell<D,C>::BuildTree(
+    std::vector<Cell<D,C> >& cells, const CellData<D,C>& ave, double sizesq,
+    std::vector<std::pair<CellData<D,C>,WPosLeafInfo> >& vdata, long* indices,
+    double minsizesq, SplitMethod sm, bool brute, size_t start, size_t end)
 {
-    xdbg<<"Make cell starting with ave = "<<*ave<<std::endl;
-    xdbg<<"size = "<<_size<<", brute = "<<brute<<std::endl;
+    xdbg<<"Make cell starting with ave = "<<ave<<std::endl;
+    xdbg<<"sizesq = "<<sizesq<<" cf. "<<minsizesq<<", brute="<<brute<<std::endl;
     Assert(sizesq >= 0.);
     Assert(vdata.size()>0);
     Assert(end <= vdata.size());
     Assert(end > start);
 
-    finishInit(vdata, minsizesq, sm, brute, start, end);
-}
-
-template <int D, int C>
-void Cell<D,C>::finishInit(std::vector<std::pair<CellData<D,C>*,WPosLeafInfo> >& vdata,
-                           double minsizesq, SplitMethod sm, bool brute, size_t start, size_t end)
-{
-    xdbg<<"finishInit: sizesq = "<<_sizesq<<" cf. "<<minsizesq<<", brute="<<brute<<std::endl;
-    if (_sizesq > minsizesq) {
-        _size = brute ? std::numeric_limits<double>::infinity() : sqrt(_sizesq);
-        if (brute) _sizesq = std::numeric_limits<double>::infinity();
-        xdbg<<"size,sizesq = "<<_size<<","<<_sizesq<<std::endl;
-        size_t mid = SplitData(vdata,sm,start,end,_data->getPos());
-        try {
-            _left = new Cell<D,C>(vdata,minsizesq,sm,brute,start,mid);
-            _right = new Cell<D,C>(vdata,minsizesq,sm,brute,mid,end);
-        } catch (std::bad_alloc) {
-            throw std::runtime_error("out of memory - cannot create new Cell");
-        }
+    // Note: cells may be reallocated by the recursive calls, so only refer to this
+    // Cell by its position in the array, not by reference.
+    const size_t k = cells.size();
+    try {
+        cells.push_back(Cell<D,C>());
+    } catch (const std::bad_alloc&) {
+        throw std::runtime_error("out of memory - cannot create new Cell");
+    }
+    cells[k]._data = ave;
+
+    if (sizesq > minsizesq) {
+        cells[k]._size = brute ? std::numeric_limits<double>::infinity() : sqrt(sizesq);
+        cells[k]._sizesq = brute ? std::numeric_limits<double>::infinity() : sizesq;
+        xdbg<<"size,sizesq = "<<cells[k]._size<<","<<cells[k]._sizesq<<std::endl;
+        size_t mid = SplitData(vdata,sm,start,end,ave.getPos());
+        // The left child is always the next Cell in the array.
+        BuildTree(cells,vdata,indices,minsizesq,sm,brute,start,mid);
+        cells[k]._right = long(cells.size() - k);
+        BuildTree(cells,vdata,indices,minsizesq,sm,brute,mid,end);
     } else {
-        _size = _sizesq = 0.;
-        if (_data->getN() == 1) {
-            _info = vdata[start].second;
-            xdbg<<"_info.index = "<<_info.index<<"  "<<vdata[start].second.index<<std::endl;
+        for (size_t i=start; i<end; ++i) {
+            xdbg<<"Set indices["<<i<<"] = "<<vdata[i].second.index<<std::endl;
+            indices[i] = vdata[i].second.index;
+        }
+        if (ave.getN() == 1) {
+            cells[k]._info = vdata[start].second;
+            xdbg<<"_info.index = "<<cells[k]._info.index<<std::endl;
         } else {
-            _listinfo.indices = new std::vector<long>(end-start);
-            for (size_t i=start; i<end; ++i) {
-                xdbg<<"Set indices["<<i-start<<"] = "<<vdata[i].second.index<<std::endl;
-                (*_listinfo.indices)[i-start] = vdata[i].second.index;
-            }
+            // This is converted to the final offset by finishListInfo.
+            cells[k]._listinfo.offset = long(start);
         }
     }
 }
@@ -406,22 +423,21 @@ void Cell<D,C>::finishInit(std::vector<std::pair<CellData<D,C>*,WPosLeafInfo> >&
 template <int D, int C>
 long Cell<D,C>::countLeaves() const
 {
-    if (_left) {
-        Assert(_right);
-        return _left->countLeaves() + _right->countLeaves();
+    if (_right) {
+        return getLeft()->countLeaves() + getRight()->countLeaves();
     } else return 1;
 }
 
 template <int D, int C>
 bool Cell<D,C>::includesIndex(long index) const
 {
-    if (_left) {
-        return _left->includesIndex(index) || _right->includesIndex(index);
+    if (_right) {
+        return getLeft()->includesIndex(index) || getRight()->includesIndex(index);
     } else if (getN() == 1) {
         return _info.index == index;
     } else {
-        const std::vector<long>& indices = *_listinfo.indices;
-        return std::find(indices.begin(), indices.end(), index) != indices.end();
+        const long* indices = _listinfo.indices();
+        return std::find(indices, indices+getN(), index) != indices+getN();
     }
 }
 
@@ -429,11 +445,10 @@ template <int D, int C>
 std::vector<const Cell<D,C>*> Cell<D,C>::getAllLeaves() const
 {
     std::vector<const Cell<D,C>*> ret;
-    if (_left) {
-        std::vector<const Cell<D,C>*> temp = _left->getAllLeaves();
+    if (_right) {
+        std::vector<const Cell<D,C>*> temp = getLeft()->getAllLeaves();
         ret.insert(ret.end(),temp.begin(),temp.end());
-        Assert(_right);
-        temp = _right->getAllLeaves();
+        temp = getRight()->getAllLeaves();
         ret.insert(ret.end(),temp.begin(),temp.end());
     } else {
         ret.push_back(this);
@@ -445,17 +460,16 @@ template <int D, int C>
 std::vector<long> Cell<D,C>::getAllIndices() const
 {
     std::vector<long> ret;
-    if (_left) {
-        std::vector<long> temp = _left->getAllIndices();
+    if (_right) {
+        std::vector<long> temp = getLeft()->getAllIndices();
         ret.insert(ret.end(),temp.begin(),temp.end());
-        Assert(_right);
-        temp = _right->getAllIndices();
+        temp = getRight()->getAllIndices();
         ret.insert(ret.end(),temp.begin(),temp.end());
     } else if (getN() == 1) {
         ret.push_back(_info.index);
     } else {
-        const std::vector<long>& indices = *_listinfo.indices;
-        ret.insert(ret.end(),indices.begin(),indices.end());
+        const long* indices = _listinfo.indices();
+        ret.insert(ret.end(),indices,indices+getN());
     }
     return ret;
 }
@@ -498,37 +512,37 @@ template class Cell<GData,Sphere>;
 
 template double CalculateSizeSq(
     const Position<Flat>& cen,
-    const std::vector<std::pair<CellData<NData,Flat>*,WPosLeafInfo> >& vdata,
+    const std::vector<std::pair<CellData<NData,Flat>,WPosLeafInfo> >& vdata,
     size_t start, size_t end);
 template double CalculateSizeSq(
     const Position<ThreeD>& cen,
-    const std::vector<std::pair<CellData<NData,ThreeD>*,WPosLeafInfo> >& vdata,
+    const std::vector<std::pair<CellData<NData,ThreeD>,WPosLeafInfo> >& vdata,
     size_t start, size_t end);
 template double CalculateSizeSq(
     const Position<Sphere>& cen,
-    const std::vector<std::pair<CellData<NData,Sphere>*,WPosLeafInfo> >& vdata,
+    const std::vector<std::pair<CellData<NData,Sphere>,WPosLeafInfo> >& vdata,
     size_t start, size_t end);
 template double CalculateSizeSq(
     const Position<Flat>& cen,
-    const std::vector<std::pair<CellData<KData,Flat>*,WPosLeafInfo> >& vdata,
+    const std::vector<std::pair<CellData<KData,Flat>,WPosLeafInfo> >& vdata,
     size_t start, size_t end);
 template double CalculateSizeSq(
     const Position<ThreeD>& cen,
-    const std::vector<std::pair<CellData<KData,ThreeD>*,WPosLeafInfo> >& vdata,
+    const std::vector<std::pair<CellData<KData,ThreeD>,WPosLeafInfo> >& vdata,
     size_t start, size_t end);
 template double CalculateSizeSq(
     const Position<Sphere>& cen,
-    const std::vector<std::pair<CellData<KData,Sphere>*,WPosLeafInfo> >& vdata,
+    const std::vector<std::pair<CellData<KData,Sphere>,WPosLeafInfo> >& vdata,
     size_t start, size_t end);
 template double CalculateSizeSq(
     const Position<Flat>& cen,
-    const std::vector<std::pair<CellData<GData,Flat>*,WPosLeafInfo> >& vdata,
+    const std::vector<std::pair<CellData<GData,Flat>,WPosLeafInfo> >& vdata,
     size_t start, size_t end);
 template double CalculateSizeSq(
     const Position<ThreeD>& cen,
-    const std::vector<std::pair<CellData<GData,ThreeD>*,WPosLeafInfo> >& vdata,
+    const std::vector<std::pair<CellData<GData,ThreeD>,WPosLeafInfo> >& vdata,
     size_t start, size_t end);
 template double CalculateSizeSq(
     const Position<Sphere>& cen,
-    const std::vector<std::pair<CellData<GData,Sphere>*,WPosLeafInfo> >& vdata,
+    const std::vector<std::pair<CellData<GData,Sphere>,WPosLeafInfo> >& vdata,
     size_t start, size_t end);
@@ -15,18 +15,34 @@
 //#define DEBUGLOGGING
 
 #include <cstddef>  // for ptrdiff_t
+#include <cstdio>
+#include <cstring>
+#include <limits>
+#include <stdint.h>
+#include <fcntl.h>
+#include <unistd.h>
+#include <sys/mman.h>
+#include <sys/stat.h>
 #include "Field.h"
 #include "Cell.h"
 #include "dbg.h"
 
+#ifdef _OPENMP
+#include "omp.h"
+#endif
+
+// Ranges with fewer than this many objects are handled by a single task when building
+// the top levels of the tree.  Below this, the overhead of making tasks isn't worth it.
+const size_t MIN_TASK_SIZE = 10000;
+
 // This function just works on the top level data to figure out which data goes into
 // each top-level Cell.  It is building up the top_* vectors, which can then be used
 // to build the actual Cells.
 template <int D, int C>
 void SetupTopLevelCells(
-    std::vector<std::pair<CellData<D,C>*,WPosLeafInfo> >& celldata,
+    std::vector<std::pair<CellData<D,C>,WPosLeafInfo> >& celldata,
     double maxsizesq, SplitMethod sm, size_t start, size_t end, int mintop, int maxtop,
-    std::vector<CellData<D,C>*>& top_data,
+    std::vector<CellData<D,C> >& top_data,
     std::vector<double>& top_sizesq,
     std::vector<size_t>& top_start, std::vector<size_t>& top_end)
 {
@@ -37,43 +53,68 @@ void SetupTopLevelCells(
     // The difference is that here we only construct a new Cell (and do the corresponding
     // calculation of the averages) if the size is small enough.  At that point, the
     // rest of the construction is passed onto the Cell class.
-    CellData<D,C>* ave;
+    CellData<D,C> ave;
     double sizesq;
     if (end-start == 1) {
         xdbg<<"Only 1 CellData entry: size = 0\n";
         ave = celldata[start].first;
-        celldata[start].first = 0; // Make sure the calling function doesn't delete this!
         sizesq = 0.;
     } else {
-        ave = new CellData<D,C>(celldata,start,end);
-        xdbg<<"ave pos = "<<ave->getPos()<<std::endl;
-        xdbg<<"n = "<<ave->getN()<<std::endl;
-        xdbg<<"w = "<<ave->getW()<<std::endl;
-        sizesq = CalculateSizeSq(ave->getPos(),celldata,start,end);
+        ave = CellData<D,C>(celldata,start,end);
+        xdbg<<"ave pos = "<<ave.getPos()<<std::endl;
+        xdbg<<"n = "<<ave.getN()<<std::endl;
+        xdbg<<"w = "<<ave.getW()<<std::endl;
+        sizesq = CalculateSizeSq(ave.getPos(),celldata,start,end);
         xdbg<<"size = "<<sqrt(sizesq)<<std::endl;
     }
 
     if (sizesq == 0 || (sizesq <= maxsizesq && mintop<=0)) {
         xdbg<<"Small enough.  Make a cell.\n";
-        if (end-start > 1) ave->finishAverages(celldata,start,end);
+        if (end-start > 1) ave.finishAverages(celldata,start,end);
         top_data.push_back(ave);
         top_sizesq.push_back(sizesq);
         top_start.push_back(start);
         top_end.push_back(end);
     } else if (maxtop <= 0) {
         xdbg<<"At specified end of top layer recusion\n";
-        if (end-start > 1) ave->finishAverages(celldata,start,end);
+        if (end-start > 1) ave.finishAverages(celldata,start,end);
         top_data.push_back(ave);
         top_sizesq.push_back(sizesq);
         top_start.push_back(start);
         top_end.push_back(end);
     } else {
-        size_t mid = SplitData(celldata,sm,start,end,ave->getPos());
+        size_t mid = SplitData(celldata,sm,start,end,ave.getPos());
         xdbg<<"Too big.  Recurse with mid = "<<mid<<std::endl;
-        SetupTopLevelCells(celldata, maxsizesq, sm, start, mid, mintop-1, maxtop-1,
-                           top_data, top_sizesq, top_start, top_end);
-        SetupTopLevelCells(celldata, maxsizesq, sm, mid, end, mintop-1, maxtop-1,
-                           top_data, top_sizesq, top_start, top_end);
+        if (end-start < MIN_TASK_SIZE) {
+            SetupTopLevelCells(celldata, maxsizesq, sm, start, mid, mintop-1, maxtop-1,
+                               top_data, top_sizesq, top_start, top_end);
+            SetupTopLevelCells(celldata, maxsizesq, sm, mid, end, mintop-1, maxtop-1,
+                               top_data, top_sizesq, top_start, top_end);
+        } else {
+            // The two halves are independent, so do the left half as a separate task.
+            // It can add directly to the output vectors, since nothing else touches them
+            // until the taskwait.  The right half goes into temporary vectors, which are
+            // appended afterwards to keep the top-level cells in the same order as the
+            // serial version.
+            std::vector<CellData<D,C> > right_data;
+            std::vector<double> right_sizesq;
+            std::vector<size_t> right_start;
+            std::vector<size_t> right_end;
+#ifdef _OPENMP
+#pragma omp task shared(celldata, top_data, top_sizesq, top_start, top_end)
+#endif
+            SetupTopLevelCells(celldata, maxsizesq, sm, start, mid, mintop-1, maxtop-1,
+                               top_data, top_sizesq, top_start, top_end);
+            SetupTopLevelCells(celldata, maxsizesq, sm, mid, end, mintop-1, maxtop-1,
+                               right_data, right_sizesq, right_start, right_end);
+#ifdef _OPENMP
+#pragma omp taskwait
+#endif
+            top_data.insert(top_data.end(), right_data.begin(), right_data.end());
+            top_sizesq.insert(top_sizesq.end(), right_sizesq.begin(), right_sizesq.end());
+            top_start.insert(top_start.end(), right_start.begin(), right_start.end());
+            top_end.insert(top_end.end(), right_end.begin(), right_end.end());
+        }
     }
 }
 
@@ -85,46 +126,46 @@ struct CellDataHelper;
 template <>
 struct CellDataHelper<NData,Flat>
 {
-    static CellData<NData,Flat>* build(double x, double y, double,
+    static CellData<NData,Flat> build(double x, double y, double,
                                        double , double , double, double w)
-    { return new CellData<NData,Flat>(Position<Flat>(x,y), w); }
+    { return CellData<NData,Flat>(Position<Flat>(x,y), w); }
 };
 template <>
 struct CellDataHelper<KData,Flat>
 {
-    static CellData<KData,Flat>* build(double x, double y, double,
+    static CellData<KData,Flat> build(double x, double y, double,
                                        double , double , double k, double w)
-    { return new CellData<KData,Flat>(Position<Flat>(x,y), k, w); }
+    { return CellData<KData,Flat>(Position<Flat>(x,y), k, w); }
 };
 template <>
 struct CellDataHelper<GData,Flat>
 {
-    static CellData<GData,Flat>* build(double x, double y,  double,
+    static CellData<GData,Flat> build(double x, double y,  double,
                                        double g1, double g2, double, double w)
-    { return new CellData<GData,Flat>(Position<Flat>(x,y), std::complex<double>(g1,g2), w); }
+    { return CellData<GData,Flat>(Position<Flat>(x,y), std::complex<double>(g1,g2), w); }
 };
 
 
 template <>
 struct CellDataHelper<NData,ThreeD>
 {
-    static CellData<NData,ThreeD>* build(double x, double y, double z,
+    static CellData<NData,ThreeD> build(double x, double y, double z,
                                          double , double , double, double w)
-    { return new CellData<NData,ThreeD>(Position<ThreeD>(x,y,z), w); }
+    { return CellData<NData,ThreeD>(Position<ThreeD>(x,y,z), w); }
 };
 template <>
 struct CellDataHelper<KData,ThreeD>
 {
-    static CellData<KData,ThreeD>* build(double x, double y, double z,
+    static CellData<KData,ThreeD> build(double x, double y, double z,
                                          double , double , double k, double w)
-    { return new CellData<KData,ThreeD>(Position<ThreeD>(x,y,z), k, w); }
+    { return CellData<KData,ThreeD>(Position<ThreeD>(x,y,z), k, w); }
 };
 template <>
 struct CellDataHelper<GData,ThreeD>
 {
-    static CellData<GData,ThreeD>* build(double x, double y, double z,
+    static CellData<GData,ThreeD> build(double x, double y, double z,
                                          double g1, double g2, double, double w)
-    { return new CellData<GData,ThreeD>(Position<ThreeD>(x,y,z), std::complex<double>(g1,g2), w); }
+    { return CellData<GData,ThreeD>(Position<ThreeD>(x,y,z), std::complex<double>(g1,g2), w); }
 };
 
 
@@ -132,26 +173,27 @@ struct CellDataHelper<GData,ThreeD>
 template <>
 struct CellDataHelper<NData,Sphere>
 {
-    static CellData<NData,Sphere>* build(double x, double y, double z,
+    static CellData<NData,Sphere> build(double x, double y, double z,
                                          double , double , double, double w)
-    { return new CellData<NData,Sphere>(Position<Sphere>(x,y,z), w); }
+    { return CellData<NData,Sphere>(Position<Sphere>(x,y,z), w); }
 };
 template <>
 struct CellDataHelper<KData,Sphere>
 {
-    static CellData<KData,Sphere>* build(double x, double y, double z,
+    static CellData<KData,Sphere> build(double x, double y, double z,
                                          double , double , double k, double w)
-    { return new CellData<KData,Sphere>(Position<Sphere>(x,y,z), k, w); }
+    { return CellData<KData,Sphere>(Position<Sphere>(x,y,z), k, w); }
 };
 template <>
 struct CellDataHelper<GData,Sphere>
 {
-    static CellData<GData,Sphere>* build(double x, double y, double z,
+    static CellData<GData,Sphere> build(double x, double y, double z,
                                          double g1, double g2, double, double w)
-    { return new CellData<GData,Sphere>(Position<Sphere>(x,y,z), std::complex<double>(g1,g2), w); }
+    { return CellData<GData,Sphere>(Position<Sphere>(x,y,z), std::complex<double>(g1,g2), w); }
 };
 
-inline WPosLeafInfo get_wpos(double* wpos, double* w, int i)
+template <typename T>
+inline WPosLeafInfo get_wpos(T* wpos, T* w, long i)
 {
     WPosLeafInfo wp;
     wp.wpos = wpos ? wpos[i] : w[i];
@@ -159,12 +201,81 @@ inline WPosLeafInfo get_wpos(double* wpos, double* w, int i)
     return wp;
 }
 
+// Fill celldata with the objects that have wpos != 0.
+// This is done in parallel, with each thread taking a contiguous chunk of the input.
+// First each thread counts how many objects in its chunk will be kept, which tells it
+// where in celldata to start writing, and then it fills in its part of the vector.
+// The inputs may be float rather than double, in which case each value is converted to
+// double here, so the celldata (and hence the tree) is always double precision.
+template <int D, int C, typename T>
+void FillCellData(T* x, T* y, T* z, T* g1, T* g2, T* k,
+                  T* w, T* wpos, long nobj,
+                  std::vector<std::pair<CellData<D,C>,WPosLeafInfo> >& celldata)
+{
+    Assert(z || C == Flat);
+#ifdef _OPENMP
+    std::vector<long> offset(omp_get_max_threads()+1, 0);
+#pragma omp parallel
+#else
+    std::vector<long> offset(2, 0);
+#endif
+    {
+#ifdef _OPENMP
+        const int ithread = omp_get_thread_num();
+        const int nthreads = omp_get_num_threads();
+#else
+        const int ithread = 0;
+        const int nthreads = 1;
+#endif
+        const long i1 = long(double(nobj) * ithread / nthreads);
+        const long i2 = long(double(nobj) * (ithread+1) / nthreads);
+        long nkeep = 0;
+        for(long i=i1;i<i2;++i) {
+            if ((wpos ? wpos[i] : w[i]) != 0.) ++nkeep;
+        }
+        offset[ithread+1] = nkeep;
+#ifdef _OPENMP
+#pragma omp barrier
+#pragma omp single
+#endif
+        {
+            for(int t=0;t<nthreads;++t) offset[t+1] += offset[t];
+            celldata.resize(offset[nthreads]);
+        }
+        // (There is an implicit barrier at the end of the single block.)
+
+        long j = offset[ithread];
+        for(long i=i1;i<i2;++i) {
+            WPosLeafInfo wp = get_wpos(wpos,w,i);
+            if (wp.wpos != 0.) {
+                celldata[j++] = std::make_pair(
+                    CellDataHelper<D,C>::build(x[i],y[i],z?z[i]:0.,g1[i],g2[i],k[i],w[i]), wp);
+            }
+        }
+        Assert(j == offset[ithread+1]);
+    }
+}
+
+// A comparison functor to sort the celldata by the patch numbers of the original objects.
 template <int D, int C>
+struct PatchCompare
+{
+    const long* _patch;
+    PatchCompare(const long* patch) : _patch(patch) {}
+    bool operator()(const std::pair<CellData<D,C>,WPosLeafInfo>& cd1,
+                    const std::pair<CellData<D,C>,WPosLeafInfo>& cd2) const
+    { return _patch[cd1.second.index] < _patch[cd2.second.index]; }
+};
+
+template <int D, int C>
+template <typename T>
 Field<D,C>::Field(
-    double* x, double* y, double* z, double* g1, double* g2, double* k,
-    double* w, double* wpos, long nobj,
+    T* x, T* y, T* z, T* g1, T* g2, T* k,
+    T* w, T* wpos, long nobj, long* patch,
     double minsize, double maxsize,
-    int sm_int, bool brute, int mintop, int maxtop)
+    int sm_int, bool brute, int mintop, int maxtop) :
+    _nobj(nobj), _minsize(minsize), _maxsize(maxsize), _sm(static_cast<SplitMethod>(sm_int)),
+    _brute(brute), _mintop(mintop), _maxtop(maxtop), _map(0), _map_size(0)
 {
     //set_verbose(2);
     dbg<<"Starting to Build Field with "<<nobj<<" objects\n";
@@ -173,26 +284,8 @@ Field<D,C>::Field(
     for(int i=0;i<5;++i) {
         xdbg<<x[i]<<"  "<<y[i]<<"  "<<(z?z[i]:0)<<"  "<<g1[i]<<"  "<<g2[i]<<"  "<<k[i]<<"  "<<w[i]<<"  "<<(wpos?wpos[i]:0)<<std::endl;
     }
-    std::vector<std::pair<CellData<D,C>*,WPosLeafInfo> > celldata;
-    celldata.reserve(nobj);
-    if (z) {
-        for(int i=0;i<nobj;++i) {
-            WPosLeafInfo wp = get_wpos(wpos,w,i);
-            if (wp.wpos != 0.)
-                celldata.push_back(std::make_pair(
-                        CellDataHelper<D,C>::build(x[i],y[i],z[i],g1[i],g2[i],k[i],w[i]),
-                        wp));
-        }
-    } else {
-        Assert(C == Flat);
-        for(int i=0;i<nobj;++i) {
-            WPosLeafInfo wp = get_wpos(wpos,w,i);
-            if (wp.wpos != 0.)
-                celldata.push_back(std::make_pair(
-                        CellDataHelper<D,C>::build(x[i],y[i],0.,g1[i],g2[i],k[i],w[i]),
-                        wp));
-        }
-    }
+    std::vector<std::pair<CellData<D,C>,WPosLeafInfo> > celldata;
+    FillCellData(x,y,z,g1,g2,k,w,wpos,nobj,celldata);
     dbg<<"Built celldata with "<<celldata.size()<<" entries\n";
 
     // We don't build Cells that are too big or too small based on the min/max separation:
@@ -211,36 +304,299 @@ Field<D,C>::Field(
     // First we setup what all the top-level cells are going to be.
     // Then we build them and their sub-nodes.
 
-    std::vector<CellData<D,C>*> top_data;
+    std::vector<CellData<D,C> > top_data;
     std::vector<double> top_sizesq;
     std::vector<size_t> top_start;
     std::vector<size_t> top_end;
 
+    // If there are patches, then each patch gets its own top-level cells, so that every
+    // cell in the tree only has objects from a single patch.  This lets the correlation
+    // functions keep track of the results for each pair of patches.
+    std::vector<size_t> patch_start(1, 0);
+    if (patch) {
+        std::stable_sort(celldata.begin(), celldata.end(), PatchCompare<D,C>(patch));
+        for(size_t i=1; i<celldata.size(); ++i) {
+            if (patch[celldata[i].second.index] != patch[celldata[i-1].second.index])
+                patch_start.push_back(i);
+        }
+    }
+    patch_start.push_back(celldata.size());
+    const size_t npatch = patch_start.size()-1;
+    dbg<<"Building top-level cells for "<<npatch<<" patches\n";
+
+    // The patches already split up the data, so use correspondingly fewer top levels within
+    // each patch.  This keeps the total number of top-level cells about the same as without
+    // patches, which matters since the correlations process every pair of top-level cells.
+    int nlevels = 0;
+    while ((size_t(1) << nlevels) < npatch) ++nlevels;
+    mintop = std::max(mintop - nlevels, 0);
+    maxtop = std::max(maxtop - nlevels, 0);
+
     // Setup the top level cells:
-    SetupTopLevelCells(celldata,maxsizesq,sm,0,celldata.size(),mintop,maxtop,
-                       top_data,top_sizesq,top_start,top_end);
+    // The recursion uses OpenMP tasks for the large ranges, so start it from a single
+    // thread inside a parallel region.
+#ifdef _OPENMP
+#pragma omp parallel
+#pragma omp single
+#endif
+    for(size_t ip=0; ip<npatch; ++ip) {
+        if (patch_start[ip] == patch_start[ip+1]) continue;
+        SetupTopLevelCells(celldata,maxsizesq,sm,patch_start[ip],patch_start[ip+1],
+                           mintop,maxtop,top_data,top_sizesq,top_start,top_end);
+        if (patch) {
+            const long p = patch[celldata[patch_start[ip]].second.index];
+            _patches.resize(top_data.size(), p);
+        }
+    }
     const ptrdiff_t n = top_data.size();
     dbg<<"Field has "<<n<<" top-level nodes.  Building lower nodes...\n";
+
+    // Each top-level tree is built into its own array, and then they are all copied into
+    // the final contiguous _nodes array once we know how big each one is.
+    _indices.resize(celldata.size());
+    long* indices = _indices.empty() ? 0 : &_indices[0];
+    std::vector<std::vector<Cell<D,C> > > trees(n);
+#ifdef _OPENMP
+#pragma omp parallel for schedule(dynamic)
+#endif
+    for(ptrdiff_t i=0;i<n;++i) {
+        Cell<D,C>::BuildTree(trees[i],top_data[i],top_sizesq[i],celldata,indices,
+                             minsizesq,sm,brute,top_start[i],top_end[i]);
+    }
+
+    std::vector<size_t> offset(n+1);
+    offset[0] = 0;
+    for(ptrdiff_t i=0;i<n;++i) offset[i+1] = offset[i] + trees[i].size();
+    dbg<<"Total number of nodes = "<<offset[n]<<std::endl;
+    _nodes.resize(offset[n]);
     _cells.resize(n);
 #ifdef _OPENMP
 #pragma omp parallel for
 #endif
     for(ptrdiff_t i=0;i<n;++i) {
-        _cells[i] = new Cell<D,C>(top_data[i],top_sizesq[i],celldata,minsizesq,sm,brute,
-                                  top_start[i],top_end[i]);
+        std::copy(trees[i].begin(), trees[i].end(), _nodes.begin()+offset[i]);
+        std::vector<Cell<D,C> >().swap(trees[i]);
+        for(size_t j=offset[i];j<offset[i+1];++j) _nodes[j].finishListInfo(indices);
+        _cells[i] = &_nodes[offset[i]];
         xdbg<<i<<": "<<_cells[i]->getN()<<"  "<<_cells[i]->getW()<<"  "<<
             _cells[i]->getPos()<<"  "<<_cells[i]->getSize()<<"  "<<_cells[i]->getSizeSq()<<std::endl;
     }
-
-    // delete any CellData elements that didn't get kept in the _cells object.
-    for (size_t i=0;i<celldata.size();++i) if (celldata[i].first) delete celldata[i].first;
+    _node_data = _nodes.empty() ? 0 : &_nodes[0];
+    _nnodes = long(_nodes.size());
+    _index_data = indices;
+    _nindices = long(_indices.size());
     //set_verbose(1);
 }
 
 template <int D, int C>
 Field<D,C>::~Field()
 {
-    for(size_t i=0; i<_cells.size(); ++i) delete _cells[i];
+    if (_map) munmap(_map, _map_size);
+}
+
+template <int D, int C>
+long Field<D,C>::getMemory() const
+{
+    return long(sizeof(Field<D,C>) +
+                _nodes.capacity() * sizeof(Cell<D,C>) +
+                _indices.capacity() * sizeof(long) +
+                _patches.capacity() * sizeof(long) +
+                _cells.capacity() * sizeof(Cell<D,C>*) +
+                _map_size);
+}
+
+// The layout of a saved Field is this header, followed by the positions in the nodes of the
+// top-level Cells, the patch numbers of the top-level Cells, the nodes, and the indices.
+// The nodes start at a multiple of FIELD_FILE_ALIGN bytes.  Everything is in the native
+// byte order, and the file can only be read back with the same sizeof(Cell).
+// Note: treecorr/field.py reads this header too, so keep them in sync.
+const char FIELD_FILE_MAGIC[8] = "TCFIELD";
+const long FIELD_FILE_VERSION = 1;
+const long FIELD_FILE_ALIGN = 64;
+
+struct FieldFileHeader
+{
+    char magic[8];
+    long version;
+    long d;
+    long coords;
+    long cell_size;
+    long nobj;
+    long nnodes;
+    long nindices;
+    long ntop;
+    long npatch;
+    long sm;
+    long brute;
+    long mintop;
+    long maxtop;
+    double minsize;
+    double maxsize;
+};
+
+inline long AlignFieldFile(long pos)
+{ return (pos + FIELD_FILE_ALIGN - 1) / FIELD_FILE_ALIGN * FIELD_FILE_ALIGN; }
+
+// The Field is written either to a file or to a buffer in memory, which are handled by these.
+struct FieldFileWriter
+{
+    FILE* fp;
+    FieldFileWriter(FILE* f) : fp(f) {}
+    bool operator()(const void* data, size_t n) { return std::fwrite(data, 1, n, fp) == n; }
+};
+
+struct FieldBufferWriter
+{
+    char* p;
+    FieldBufferWriter(char* buffer) : p(buffer) {}
+    bool operator()(const void* data, size_t n)
+    { std::memcpy(p, data, n); p += n; return true; }
+};
+
+template <int D, int C>
+long Field<D,C>::getSaveSize() const
+{
+    const long nodes_pos = AlignFieldFile(
+        long(sizeof(FieldFileHeader) + (_cells.size() + _patches.size()) * sizeof(long)));
+    return nodes_pos + _nnodes * long(sizeof(Cell<D,C>)) + _nindices * long(sizeof(long));
+}
+
+template <int D, int C>
+template <class Writer>
+bool Field<D,C>::write(Writer& writer) const
+{
+    FieldFileHeader header;
+    std::memset(&header, 0, sizeof(header));
+    std::memcpy(header.magic, FIELD_FILE_MAGIC, sizeof(header.magic));
+    header.version = FIELD_FILE_VERSION;
+    header.d = D;
+    header.coords = C;
+    header.cell_size = sizeof(Cell<D,C>);
+    header.nobj = _nobj;
+    header.nnodes = _nnodes;
+    header.nindices = _nindices;
+    header.ntop = long(_cells.size());
+    header.npatch = long(_patches.size());
+    header.sm = _sm;
+    header.brute = _brute;
+    header.mintop = _mintop;
+    header.maxtop = _maxtop;
+    header.minsize = _minsize;
+    header.maxsize = _maxsize;
+
+    std::vector<long> top(_cells.size());
+    for(size_t i=0;i<_cells.size();++i) top[i] = long(_cells[i] - _node_data);
+
+    const long head_size = long(sizeof(header) + (top.size() + _patches.size()) * sizeof(long));
+    const long nodes_pos = AlignFieldFile(head_size);
+    const long index_pos = nodes_pos + _nnodes * long(sizeof(Cell<D,C>));
+
+    // The list offsets in the Cells are relative to their location in memory, so they
+    // need to be shifted to point to the right place in the output.
+    const long shift = (index_pos - nodes_pos) -
+        long(reinterpret_cast<intptr_t>(_index_data) - reinterpret_cast<intptr_t>(_node_data));
+
+    bool ok = writer(&header, sizeof(header));
+    if (ok && !top.empty())
+        ok = writer(&top[0], top.size() * sizeof(long));
+    if (ok && !_patches.empty())
+        ok = writer(&_patches[0], _patches.size() * sizeof(long));
+    if (ok && nodes_pos > head_size) {
+        std::vector<char> pad(nodes_pos - head_size, 0);
+        ok = writer(&pad[0], pad.size());
+    }
+    const long block = 4096;
+    std::vector<Cell<D,C> > buf;
+    for(long j=0; ok && j<_nnodes; j+=block) {
+        buf.assign(_node_data + j, _node_data + std::min(j+block, _nnodes));
+        for(size_t m=0;m<buf.size();++m) buf[m].shiftListInfo(shift);
+        ok = writer(&buf[0], buf.size() * sizeof(Cell<D,C>));
+    }
+    if (ok && _nindices > 0)
+        ok = writer(_index_data, _nindices * sizeof(long));
+    return ok;
+}
+
+template <int D, int C>
+long Field<D,C>::save(const char* file_name) const
+{
+    dbg<<"Start Field::save "<<file_name<<std::endl;
+    FILE* fp = std::fopen(file_name, "wb");
+    if (!fp) return -1;
+    FieldFileWriter writer(fp);
+    bool ok = write(writer);
+    if (std::fclose(fp) != 0) ok = false;
+    dbg<<"Done save: ok = "<<ok<<std::endl;
+    return ok ? getSaveSize() : -1;
+}
+
+template <int D, int C>
+void Field<D,C>::saveBuffer(char* buffer) const
+{
+    FieldBufferWriter writer(buffer);
+    write(writer);
+}
+
+template <int D, int C>
+Field<D,C>* Field<D,C>::Load(const char* file_name)
+{
+    dbg<<"Start Field::Load "<<file_name<<std::endl;
+    int fd = open(file_name, O_RDONLY);
+    if (fd < 0) return 0;
+    struct stat st;
+    void* map = MAP_FAILED;
+    if (fstat(fd, &st) == 0 && st.st_size >= long(sizeof(FieldFileHeader))) {
+        map = mmap(0, st.st_size, PROT_READ, MAP_SHARED, fd, 0);
+    }
+    close(fd);
+    if (map == MAP_FAILED) return 0;
+    Field<D,C>* field = LoadBuffer(static_cast<const char*>(map), st.st_size);
+    if (field) {
+        field->_map = map;
+        field->_map_size = st.st_size;
+    } else {
+        munmap(map, st.st_size);
+    }
+    return field;
+}
+
+template <int D, int C>
+Field<D,C>* Field<D,C>::LoadBuffer(const char* data, long size)
+{
+    if (size < long(sizeof(FieldFileHeader))) return 0;
+    const FieldFileHeader& header = *reinterpret_cast<const FieldFileHeader*>(data);
+    const long nodes_pos = AlignFieldFile(
+        long(sizeof(header) + (header.ntop + header.npatch) * sizeof(long)));
+    const long index_pos = nodes_pos + header.nnodes * long(sizeof(Cell<D,C>));
+    if (std::memcmp(header.magic, FIELD_FILE_MAGIC, sizeof(header.magic)) != 0 ||
+        header.version != FIELD_FILE_VERSION || header.d != D || header.coords != C ||
+        header.cell_size != long(sizeof(Cell<D,C>)) ||
+        size != index_pos + header.nindices * long(sizeof(long))) {
+        dbg<<"Invalid field data\n";
+        return 0;
+    }
+
+    Field<D,C>* field = new Field<D,C>();
+    field->_nobj = header.nobj;
+    field->_minsize = header.minsize;
+    field->_maxsize = header.maxsize;
+    field->_sm = static_cast<SplitMethod>(header.sm);
+    field->_brute = header.brute;
+    field->_mintop = header.mintop;
+    field->_maxtop = header.maxtop;
+    field->_node_data = reinterpret_cast<const Cell<D,C>*>(data + nodes_pos);
+    field->_nnodes = header.nnodes;
+    field->_index_data = reinterpret_cast<const long*>(data + index_pos);
+    field->_nindices = header.nindices;
+
+    // The Cells are never modified, so it is safe to cast away the const here.
+    const long* top = reinterpret_cast<const long*>(data + sizeof(header));
+    field->_cells.resize(header.ntop);
+    for(long i=0;i<header.ntop;++i)
+        field->_cells[i] = const_cast<Cell<D,C>*>(field->_node_data + top[i]);
+    field->_patches.assign(top + header.ntop, top + header.ntop + header.npatch);
+    dbg<<"Loaded field with "<<header.nnodes<<" nodes, "<<header.ntop<<" top-level cells\n";
+    return field;
 }
 
 template <int D, int C>
@@ -324,10 +680,9 @@ void GetNear(const Cell<D,C>* cell, const Position<C>& pos, double sep, double s
                 indices[k++] = cell->getInfo().index;
             } else {
                 dbg<<"N > 1 case: "<<n1<<std::endl;
-                std::vector<long>* leaf_indices = cell->getListInfo().indices;
-                Assert(int(leaf_indices->size()) == n1);
+                const long* leaf_indices = cell->getListInfo().indices();
                 for (int m=0; m<n1; ++m)
-                    indices[k++] = (*leaf_indices)[m];
+                    indices[k++] = leaf_indices[m];
             }
             Assert(k <= n);
         } else {
@@ -364,50 +719,250 @@ void Field<D,C>::getNear(double x, double y, double z, double sep, long* indices
     }
 }
 
+// This is the same as the above GetNear, but it appends the indices to a vector rather
+// than writing them into an array that has already been allocated with the right size.
 template <int D, int C>
-SimpleField<D,C>::SimpleField(
-    double* x, double* y, double* z, double* g1, double* g2, double* k,
-    double* w, double* wpos, long nobj)
+void GetNear(const Cell<D,C>* cell, const Position<C>& pos, double sep, double sepsq,
+             std::vector<long>& indices)
 {
-    // This bit is the same as the start of the Field constructor.
-    dbg<<"Starting to Build SimpleField with "<<nobj<<" objects\n";
-    std::vector<std::pair<CellData<D,C>*,WPosLeafInfo> > celldata;
-    celldata.reserve(nobj);
-    if (z) {
-        for(long i=0;i<nobj;++i) {
-            WPosLeafInfo wp = get_wpos(wpos,w,i);
-            if (wp.wpos != 0.)
-                celldata.push_back(std::make_pair(
-                        CellDataHelper<D,C>::build(x[i],y[i],z[i],g1[i],g2[i],k[i],w[i]),
-                        wp));
+    double s = cell->getSize();
+    const double dsq = (cell->getPos() - pos).normSq();
+
+    if (s==0.) {
+        if (dsq <= sepsq) {
+            long n1 = cell->getN();
+            if (n1 == 1) {
+                indices.push_back(cell->getInfo().index);
+            } else {
+                const long* leaf_indices = cell->getListInfo().indices();
+                indices.insert(indices.end(), leaf_indices, leaf_indices + n1);
+            }
+        }
+    } else if (dsq <= sepsq || dsq <= SQR(sep+s)) {
+        Assert(cell->getLeft());
+        Assert(cell->getRight());
+        GetNear(cell->getLeft(), pos, sep, sepsq, indices);
+        GetNear(cell->getRight(), pos, sep, sepsq, indices);
+    }
+}
+
+template <int D, int C>
+void Field<D,C>::getNear(double x, double y, double z, double sep,
+                         const double* catx, const double* caty, const double* catz,
+                         std::vector<long>& indices) const
+{
+    Position<C> pos(x,y,z);
+    const size_t start = indices.size();
+
+    // If minsize > 0, the leaves may include points up to minsize away from the position
+    // of the leaf.  So expand the search radius by this much, and then check the actual
+    // positions of the points we found.
+    const bool check = (_minsize > 0. && catx);
+    const double sep1 = check ? sep + _minsize : sep;
+    const double sep1sq = sep1*sep1;
+    for(size_t i=0; i<_cells.size(); ++i) {
+        GetNear(_cells[i], pos, sep1, sep1sq, indices);
+    }
+
+    if (check) {
+        Assert(caty);
+        Assert(catz || C == Flat);
+        const double sepsq = sep*sep;
+        std::vector<long>::iterator out = indices.begin() + start;
+        for(std::vector<long>::iterator it=out; it!=indices.end(); ++it) {
+            const long j = *it;
+            double rsq = SQR(catx[j]-x) + SQR(caty[j]-y);
+            if (catz) rsq += SQR(catz[j]-z);
+            if (rsq < sepsq) *out++ = j;
+        }
+        indices.erase(out, indices.end());
+    }
+}
+
+template <int D, int C>
+void Field<D,C>::countNearMany(
+    const double* x, const double* y, const double* z, const double* sep, long n,
+    const double* catx, const double* caty, const double* catz, long* counts) const
+{
+    dbg<<"Start countNearMany: "<<n<<" targets\n";
+    const bool check = (_minsize > 0. && catx);
+#ifdef _OPENMP
+#pragma omp parallel
+#endif
+    {
+        // When we need to check the actual positions, each thread needs a vector to hold
+        // the indices for the current target.
+        std::vector<long> indices;
+#ifdef _OPENMP
+#pragma omp for schedule(dynamic, NEAR_BLOCK_SIZE)
+#endif
+        for(long i=0; i<n; ++i) {
+            const double zi = z ? z[i] : 0.;
+            if (check) {
+                indices.clear();
+                getNear(x[i], y[i], zi, sep[i], catx, caty, catz, indices);
+                counts[i] = long(indices.size());
+            } else {
+                counts[i] = countNear(x[i], y[i], zi, sep[i]);
+            }
+        }
+    }
+}
+
+template <int D, int C>
+void Field<D,C>::getNearMany(
+    const double* x, const double* y, const double* z, const double* sep, long n,
+    const double* catx, const double* caty, const double* catz,
+    long* counts, std::vector<std::vector<long> >& blocks) const
+{
+    dbg<<"Start getNearMany: "<<n<<" targets\n";
+    // Each block of targets stores its indices in its own vector.  This lets us use
+    // dynamic scheduling, while still being able to put the indices in order of the
+    // targets at the end.
+    const long nblocks = (n + NEAR_BLOCK_SIZE - 1) / NEAR_BLOCK_SIZE;
+    blocks.resize(nblocks);
+#ifdef _OPENMP
+#pragma omp parallel for schedule(dynamic)
+#endif
+    for(long b=0; b<nblocks; ++b) {
+        std::vector<long>& indices = blocks[b];
+        const long i2 = std::min(n, (b+1) * NEAR_BLOCK_SIZE);
+        for(long i=b*NEAR_BLOCK_SIZE; i<i2; ++i) {
+            const size_t start = indices.size();
+            getNear(x[i], y[i], z ? z[i] : 0., sep[i], catx, caty, catz, indices);
+            // The tree returns them in an arbitrary order, so sort them.
+            std::sort(indices.begin() + start, indices.end());
+            counts[i] = long(indices.size() - start);
+        }
+    }
+}
+
+// Find the k nearest points to pos within cell, using the size of each cell to skip any
+// that cannot have a point closer than the current k-th nearest point.
+// The points found so far are kept in heap, which is a max-heap of (distsq, index), so the
+// front is the farthest of the current k nearest points.
+template <int D, int C>
+void GetKNN(const Cell<D,C>* cell, const Position<C>& pos, double x, double y, double z,
+            size_t k, double minsize,
+            const double* catx, const double* caty, const double* catz,
+            std::vector<std::pair<double,long> >& heap)
+{
+    if (cell->getN() == 0) return;
+    const double dsq = (cell->getPos() - pos).normSq();
+
+    // If minsize > 0, leaves have size 0, but the points in them may be up to minsize
+    // from the position of the leaf.
+    const Cell<D,C>* left = cell->getLeft();
+    const double s = left ? cell->getSize() : minsize;
+    if (heap.size() == k && dsq > SQR(s)) {
+        // No point in this cell can be closer than d - s.
+        const double dmin = sqrt(dsq) - s;
+        if (SQR(dmin) > heap.front().first) return;
+    }
+
+    if (left) {
+        // Check the closer subcell first, since that makes it more likely that we can
+        // skip the other one.
+        const Cell<D,C>* right = cell->getRight();
+        Assert(right);
+        if ((left->getPos() - pos).normSq() <= (right->getPos() - pos).normSq()) {
+            GetKNN(left, pos, x, y, z, k, minsize, catx, caty, catz, heap);
+            GetKNN(right, pos, x, y, z, k, minsize, catx, caty, catz, heap);
+        } else {
+            GetKNN(right, pos, x, y, z, k, minsize, catx, caty, catz, heap);
+            GetKNN(left, pos, x, y, z, k, minsize, catx, caty, catz, heap);
         }
     } else {
-        Assert(C == Flat);
-        for(long i=0;i<nobj;++i) {
-            WPosLeafInfo wp = get_wpos(wpos,w,i);
-            if (wp.wpos != 0.)
-                celldata.push_back(std::make_pair(
-                        CellDataHelper<D,C>::build(x[i],y[i],0.,g1[i],g2[i],k[i],w[i]),
-                        wp));
+        const long n1 = cell->getN();
+        const long* leaf_indices = n1 == 1 ? &cell->getInfo().index : cell->getListInfo().indices();
+        for (long m=0; m<n1; ++m) {
+            const long j = leaf_indices[m];
+            double rsq = dsq;
+            if (catx) {
+                rsq = SQR(catx[j]-x) + SQR(caty[j]-y);
+                if (catz) rsq += SQR(catz[j]-z);
+            }
+            std::pair<double,long> item(rsq, j);
+            if (heap.size() < k) {
+                heap.push_back(item);
+                std::push_heap(heap.begin(), heap.end());
+            } else if (item < heap.front()) {
+                std::pop_heap(heap.begin(), heap.end());
+                heap.back() = item;
+                std::push_heap(heap.begin(), heap.end());
+            }
         }
     }
+}
+
+template <int D, int C>
+void Field<D,C>::getKNN(const double* x, const double* y, const double* z, long n, int k,
+                        const double* catx, const double* caty, const double* catz,
+                        long* indices, double* distsq) const
+{
+    dbg<<"Start getKNN: "<<n<<" targets, k = "<<k<<std::endl;
+    // Only use the catalog positions if we need them.
+    const bool check = (_minsize > 0. && catx);
+    if (!check) catx = caty = catz = 0;
+    const double minsize = check ? _minsize : 0.;
+#ifdef _OPENMP
+#pragma omp parallel
+#endif
+    {
+        std::vector<std::pair<double,long> > heap;
+        heap.reserve(k);
+#ifdef _OPENMP
+#pragma omp for schedule(dynamic, NEAR_BLOCK_SIZE)
+#endif
+        for(long i=0; i<n; ++i) {
+            const double zi = z ? z[i] : 0.;
+            Position<C> pos(x[i], y[i], zi);
+            heap.clear();
+            for(size_t c=0; c<_cells.size(); ++c) {
+                GetKNN(_cells[c], pos, x[i], y[i], zi, size_t(k), minsize, catx, caty, catz, heap);
+            }
+            std::sort_heap(heap.begin(), heap.end());
+            for(int m=0; m<k; ++m) {
+                if (m < int(heap.size())) {
+                    indices[i*k+m] = heap[m].second;
+                    distsq[i*k+m] = heap[m].first;
+                } else {
+                    indices[i*k+m] = -1;
+                    distsq[i*k+m] = std::numeric_limits<double>::infinity();
+                }
+            }
+        }
+    }
+}
+
+template <int D, int C>
+template <typename T>
+SimpleField<D,C>::SimpleField(
+    T* x, T* y, T* z, T* g1, T* g2, T* k,
+    T* w, T* wpos, long nobj)
+{
+    // This bit is the same as the start of the Field constructor.
+    dbg<<"Starting to Build SimpleField with "<<nobj<<" objects\n";
+    std::vector<std::pair<CellData<D,C>,WPosLeafInfo> > celldata;
+    FillCellData(x,y,z,g1,g2,k,w,wpos,nobj,celldata);
     dbg<<"Built celldata with "<<celldata.size()<<" entries\n";
 
     // However, now we just turn each item into a leaf Cell and keep them all in a single vector.
     ptrdiff_t n = celldata.size();
+    _nodes.resize(n);
     _cells.resize(n);
 #ifdef _OPENMP
 #pragma omp parallel for
 #endif
-    for(ptrdiff_t i=0;i<n;++i)
-        _cells[i] = new Cell<D,C>(celldata[i].first, celldata[i].second);
+    for(ptrdiff_t i=0;i<n;++i) {
+        _nodes[i] = Cell<D,C>(celldata[i].first, celldata[i].second);
+        _cells[i] = &_nodes[i];
+    }
 }
 
 template <int D, int C>
 SimpleField<D,C>::~SimpleField()
-{
-    for(size_t i=0; i<_cells.size(); ++i) delete _cells[i];
-}
+{}
 
 
 //
@@ -420,9 +975,9 @@ extern "C" {
 #include "Field_C.h"
 }
 
-template <int D>
-void* BuildField(double* x, double* y, double* z, double* g1, double* g2, double* k,
-                 double* w, double* wpos, long nobj,
+template <int D, typename T>
+void* BuildField(T* x, T* y, T* z, T* g1, T* g2, T* k,
+                 T* w, T* wpos, long nobj, long* patch,
                  double minsize, double maxsize,
                  int sm_int, int brute, int mintop, int maxtop, int coords)
 {
@@ -431,20 +986,20 @@ void* BuildField(double* x, double* y, double* z, double* g1, double* g2, double
     switch(coords) {
       case Flat:
            // Note: Use w for k, since we access k[i], even though value will be ignored.
-           field = static_cast<void*>(new Field<D,Flat>(x, y, 0, g1, g2, k,
-                                                        w, wpos, nobj,
+           field = static_cast<void*>(new Field<D,Flat>(x, y, static_cast<T*>(0), g1, g2, k,
+                                                        w, wpos, nobj, patch,
                                                         minsize, maxsize,
                                                         sm_int, bool(brute), mintop, maxtop));
            break;
       case Sphere:
            field = static_cast<void*>(new Field<D,Sphere>(x, y, z, g1, g2, k,
-                                                          w, wpos, nobj,
+                                                          w, wpos, nobj, patch,
                                                           minsize, maxsize,
                                                           sm_int, bool(brute), mintop, maxtop));
            break;
       case ThreeD:
            field = static_cast<void*>(new Field<D,ThreeD>(x, y, z, g1, g2, k,
-                                                          w, wpos, nobj,
+                                                          w, wpos, nobj, patch,
                                                           minsize, maxsize,
                                                           sm_int, bool(brute), mintop, maxtop));
            break;
@@ -454,33 +1009,62 @@ void* BuildField(double* x, double* y, double* z, double* g1, double* g2, double
 }
 
 void* BuildGField(double* x, double* y, double* z, double* g1, double* g2,
-                  double* w, double* wpos, long nobj,
+                  double* w, double* wpos, long nobj, long* patch,
                   double minsize, double maxsize,
                   int sm_int, int brute, int mintop, int maxtop, int coords)
 {
     // Note: Use w for k, since we access k[i], even though value will be ignored.
-    return BuildField<GData>(x,y,z, g1,g2,w, w,wpos,nobj, minsize,maxsize, sm_int,
+    return BuildField<GData>(x,y,z, g1,g2,w, w,wpos,nobj,patch, minsize,maxsize, sm_int,
                              brute,mintop,maxtop,coords);
 }
 
 
 void* BuildKField(double* x, double* y, double* z, double* k,
-                  double* w, double* wpos, long nobj,
+                  double* w, double* wpos, long nobj, long* patch,
                   double minsize, double maxsize,
                   int sm_int, int brute, int mintop, int maxtop, int coords)
 {
     // Note: Use w for g1,g2, since we access g1[i],g2[i] even though values are ignored.
-    return BuildField<KData>(x,y,z, w,w,k, w,wpos,nobj, minsize,maxsize, sm_int,
+    return BuildField<KData>(x,y,z, w,w,k, w,wpos,nobj,patch, minsize,maxsize, sm_int,
                              brute,mintop,maxtop,coords);
 }
 
 void* BuildNField(double* x, double* y, double* z,
-                  double* w, double* wpos, long nobj,
+                  double* w, double* wpos, long nobj, long* patch,
                   double minsize, double maxsize,
                   int sm_int, int brute, int mintop, int maxtop, int coords)
 {
     // Note: Use w for g1,g2,k for same reasons as above.
-    return BuildField<NData>(x,y,z, w,w,w, w,wpos,nobj, minsize,maxsize, sm_int,
+    return BuildField<NData>(x,y,z, w,w,w, w,wpos,nobj,patch, minsize,maxsize, sm_int,
+                             brute,mintop,maxtop,coords);
+}
+
+// The Float versions are used for catalogs with single_precision=True.  The values are
+// converted to double as the tree is built, which avoids making double copies of the arrays.
+void* BuildGFieldFloat(float* x, float* y, float* z, float* g1, float* g2,
+                       float* w, float* wpos, long nobj, long* patch,
+                       double minsize, double maxsize,
+                       int sm_int, int brute, int mintop, int maxtop, int coords)
+{
+    return BuildField<GData>(x,y,z, g1,g2,w, w,wpos,nobj,patch, minsize,maxsize, sm_int,
+                             brute,mintop,maxtop,coords);
+}
+
+void* BuildKFieldFloat(float* x, float* y, float* z, float* k,
+                       float* w, float* wpos, long nobj, long* patch,
+                       double minsize, double maxsize,
+                       int sm_int, int brute, int mintop, int maxtop, int coords)
+{
+    return BuildField<KData>(x,y,z, w,w,k, w,wpos,nobj,patch, minsize,maxsize, sm_int,
+                             brute,mintop,maxtop,coords);
+}
+
+void* BuildNFieldFloat(float* x, float* y, float* z,
+                       float* w, float* wpos, long nobj, long* patch,
+                       double minsize, double maxsize,
+                       int sm_int, int brute, int mintop, int maxtop, int coords)
+{
+    return BuildField<NData>(x,y,z, w,w,w, w,wpos,nobj,patch, minsize,maxsize, sm_int,
                              brute,mintop,maxtop,coords);
 }
 
@@ -511,6 +1095,169 @@ void DestroyKField(void* field, int coords)
 void DestroyNField(void* field, int coords)
 { DestroyField<NData>(field, coords); }
 
+template <int D>
+long FieldSave1(void* field, int coords, const char* file_name)
+{
+    switch(coords) {
+      case Flat:
+           return static_cast<Field<D,Flat>*>(field)->save(file_name);
+           break;
+      case Sphere:
+           return static_cast<Field<D,Sphere>*>(field)->save(file_name);
+           break;
+      case ThreeD:
+           return static_cast<Field<D,ThreeD>*>(field)->save(file_name);
+           break;
+    }
+    return -1;  // Can't get here, but saves a compiler warning
+}
+
+long FieldSave(void* field, int d, int coords, const char* file_name)
+{
+    switch(d) {
+      case NData:
+        return FieldSave1<NData>(field, coords, file_name);
+        break;
+      case KData:
+        return FieldSave1<KData>(field, coords, file_name);
+        break;
+      case GData:
+        return FieldSave1<GData>(field, coords, file_name);
+        break;
+    }
+    return -1;  // Can't get here, but saves a compiler warning
+}
+
+template <int D>
+void* FieldLoad1(const char* file_name, int coords)
+{
+    switch(coords) {
+      case Flat:
+           return static_cast<void*>(Field<D,Flat>::Load(file_name));
+           break;
+      case Sphere:
+           return static_cast<void*>(Field<D,Sphere>::Load(file_name));
+           break;
+      case ThreeD:
+           return static_cast<void*>(Field<D,ThreeD>::Load(file_name));
+           break;
+    }
+    return 0;  // Can't get here, but saves a compiler warning
+}
+
+void* FieldLoad(const char* file_name, int d, int coords)
+{
+    switch(d) {
+      case NData:
+        return FieldLoad1<NData>(file_name, coords);
+        break;
+      case KData:
+        return FieldLoad1<KData>(file_name, coords);
+        break;
+      case GData:
+        return FieldLoad1<GData>(file_name, coords);
+        break;
+    }
+    return 0;  // Can't get here, but saves a compiler warning
+}
+
+template <int D>
+long FieldGetSaveSize1(void* field, int coords)
+{
+    switch(coords) {
+      case Flat:
+           return static_cast<Field<D,Flat>*>(field)->getSaveSize();
+           break;
+      case Sphere:
+           return static_cast<Field<D,Sphere>*>(field)->getSaveSize();
+           break;
+      case ThreeD:
+           return static_cast<Field<D,ThreeD>*>(field)->getSaveSize();
+           break;
+    }
+    return 0;  // Can't get here, but saves a compiler warning
+}
+
+long FieldGetSaveSize(void* field, int d, int coords)
+{
+    switch(d) {
+      case NData:
+        return FieldGetSaveSize1<NData>(field, coords);
+        break;
+      case KData:
+        return FieldGetSaveSize1<KData>(field, coords);
+        break;
+      case GData:
+        return FieldGetSaveSize1<GData>(field, coords);
+        break;
+    }
+    return 0;  // Can't get here, but saves a compiler warning
+}
+
+template <int D>
+void FieldSaveBuffer1(void* field, int coords, char* buffer)
+{
+    switch(coords) {
+      case Flat:
+           static_cast<Field<D,Flat>*>(field)->saveBuffer(buffer);
+           break;
+      case Sphere:
+           static_cast<Field<D,Sphere>*>(field)->saveBuffer(buffer);
+           break;
+      case ThreeD:
+           static_cast<Field<D,ThreeD>*>(field)->saveBuffer(buffer);
+           break;
+    }
+}
+
+void FieldSaveBuffer(void* field, int d, int coords, char* buffer)
+{
+    switch(d) {
+      case NData:
+        FieldSaveBuffer1<NData>(field, coords, buffer);
+        break;
+      case KData:
+        FieldSaveBuffer1<KData>(field, coords, buffer);
+        break;
+      case GData:
+        FieldSaveBuffer1<GData>(field, coords, buffer);
+        break;
+    }
+}
+
+template <int D>
+void* FieldLoadBuffer1(char* buffer, long size, int coords)
+{
+    switch(coords) {
+      case Flat:
+           return static_cast<void*>(Field<D,Flat>::LoadBuffer(buffer, size));
+           break;
+      case Sphere:
+           return static_cast<void*>(Field<D,Sphere>::LoadBuffer(buffer, size));
+           break;
+      case ThreeD:
+           return static_cast<void*>(Field<D,ThreeD>::LoadBuffer(buffer, size));
+           break;
+    }
+    return 0;  // Can't get here, but saves a compiler warning
+}
+
+void* FieldLoadBuffer(char* buffer, long size, int d, int coords)
+{
+    switch(d) {
+      case NData:
+        return FieldLoadBuffer1<NData>(buffer, size, coords);
+        break;
+      case KData:
+        return FieldLoadBuffer1<KData>(buffer, size, coords);
+        break;
+      case GData:
+        return FieldLoadBuffer1<GData>(buffer, size, coords);
+        break;
+    }
+    return 0;  // Can't get here, but saves a compiler warning
+}
+
 template <int D>
 long FieldGetNTopLevel1(void* field, int coords)
 {
@@ -544,6 +1291,39 @@ long FieldGetNTopLevel(void* field, int d, int coords)
     return 0;  // Can't get here, but saves a compiler warning
 }
 
+template <int D>
+long FieldGetMemory1(void* field, int coords)
+{
+    switch(coords) {
+      case Flat:
+           return static_cast<Field<D,Flat>*>(field)->getMemory();
+           break;
+      case Sphere:
+           return static_cast<Field<D,Sphere>*>(field)->getMemory();
+           break;
+      case ThreeD:
+           return static_cast<Field<D,ThreeD>*>(field)->getMemory();
+           break;
+    }
+    return 0;  // Can't get here, but saves a compiler warning
+}
+
+long FieldGetMemory(void* field, int d, int coords)
+{
+    switch(d) {
+      case NData:
+        return FieldGetMemory1<NData>(field, coords);
+        break;
+      case KData:
+        return FieldGetMemory1<KData>(field, coords);
+        break;
+      case GData:
+        return FieldGetMemory1<GData>(field, coords);
+        break;
+    }
+    return 0;  // Can't get here, but saves a compiler warning
+}
+
 template <int D>
 long FieldCountNear1(void* field, double x, double y, double z, double sep, int coords)
 {
@@ -610,15 +1390,160 @@ void FieldGetNear(void* field, double x, double y, double z, double sep, int d,
     }
 }
 
+template <int D, int C>
+void FieldCountNearMany2(void* field, double* x, double* y, double* z, double* sep, long n,
+                         double* catx, double* caty, double* catz, long* counts)
+{
+    static_cast<Field<D,C>*>(field)->countNearMany(x,y,z,sep,n,catx,caty,catz,counts);
+}
+
 template <int D>
-void* BuildSimpleField(double* x, double* y, double* z, double* g1, double* g2, double* k,
-                       double* w, double* wpos, long nobj, int coords)
+void FieldCountNearMany1(void* field, double* x, double* y, double* z, double* sep, long n,
+                         double* catx, double* caty, double* catz, int coords, long* counts)
+{
+    switch(coords) {
+      case Flat:
+           FieldCountNearMany2<D,Flat>(field, x, y, z, sep, n, catx, caty, catz, counts);
+           break;
+      case Sphere:
+           FieldCountNearMany2<D,Sphere>(field, x, y, z, sep, n, catx, caty, catz, counts);
+           break;
+      case ThreeD:
+           FieldCountNearMany2<D,ThreeD>(field, x, y, z, sep, n, catx, caty, catz, counts);
+           break;
+    }
+}
+
+void FieldCountNearMany(void* field, double* x, double* y, double* z, double* sep, long n,
+                        double* catx, double* caty, double* catz,
+                        int d, int coords, long* counts)
+{
+    switch(d) {
+      case NData:
+           FieldCountNearMany1<NData>(field, x, y, z, sep, n, catx, caty, catz, coords, counts);
+           break;
+      case KData:
+           FieldCountNearMany1<KData>(field, x, y, z, sep, n, catx, caty, catz, coords, counts);
+           break;
+      case GData:
+           FieldCountNearMany1<GData>(field, x, y, z, sep, n, catx, caty, catz, coords, counts);
+           break;
+    }
+}
+
+template <int D, int C>
+void* FieldGetNearMany2(void* field, double* x, double* y, double* z, double* sep, long n,
+                        double* catx, double* caty, double* catz, long* counts)
+{
+    std::vector<std::vector<long> >* blocks = new std::vector<std::vector<long> >();
+    static_cast<Field<D,C>*>(field)->getNearMany(x,y,z,sep,n,catx,caty,catz,counts,*blocks);
+    return static_cast<void*>(blocks);
+}
+
+template <int D>
+void* FieldGetNearMany1(void* field, double* x, double* y, double* z, double* sep, long n,
+                        double* catx, double* caty, double* catz, int coords, long* counts)
+{
+    switch(coords) {
+      case Flat:
+           return FieldGetNearMany2<D,Flat>(field, x, y, z, sep, n, catx, caty, catz, counts);
+           break;
+      case Sphere:
+           return FieldGetNearMany2<D,Sphere>(field, x, y, z, sep, n, catx, caty, catz, counts);
+           break;
+      case ThreeD:
+           return FieldGetNearMany2<D,ThreeD>(field, x, y, z, sep, n, catx, caty, catz, counts);
+           break;
+    }
+    return 0;  // Can't get here, but saves a compiler warning
+}
+
+void* FieldGetNearMany(void* field, double* x, double* y, double* z, double* sep, long n,
+                       double* catx, double* caty, double* catz,
+                       int d, int coords, long* counts)
+{
+    switch(d) {
+      case NData:
+           return FieldGetNearMany1<NData>(field, x, y, z, sep, n, catx, caty, catz,
+                                           coords, counts);
+           break;
+      case KData:
+           return FieldGetNearMany1<KData>(field, x, y, z, sep, n, catx, caty, catz,
+                                           coords, counts);
+           break;
+      case GData:
+           return FieldGetNearMany1<GData>(field, x, y, z, sep, n, catx, caty, catz,
+                                           coords, counts);
+           break;
+    }
+    return 0;  // Can't get here, but saves a compiler warning
+}
+
+void FieldFillNearMany(void* near, long* indices)
+{
+    // Copy the indices from the blocks returned by FieldGetNearMany into a single array,
+    // and then delete the blocks.
+    std::vector<std::vector<long> >* blocks = static_cast<std::vector<std::vector<long> >*>(near);
+    const long nblocks = long(blocks->size());
+    std::vector<long> offset(nblocks+1);
+    offset[0] = 0;
+    for(long b=0; b<nblocks; ++b) offset[b+1] = offset[b] + long((*blocks)[b].size());
+#ifdef _OPENMP
+#pragma omp parallel for
+#endif
+    for(long b=0; b<nblocks; ++b) {
+        std::copy((*blocks)[b].begin(), (*blocks)[b].end(), indices + offset[b]);
+    }
+    delete blocks;
+}
+
+template <int D>
+void FieldGetKNN1(void* field, double* x, double* y, double* z, long n, int k,
+                  double* catx, double* caty, double* catz, int coords,
+                  long* indices, double* distsq)
+{
+    switch(coords) {
+      case Flat:
+           static_cast<Field<D,Flat>*>(field)->getKNN(x, y, z, n, k, catx, caty, catz,
+                                                      indices, distsq);
+           break;
+      case Sphere:
+           static_cast<Field<D,Sphere>*>(field)->getKNN(x, y, z, n, k, catx, caty, catz,
+                                                        indices, distsq);
+           break;
+      case ThreeD:
+           static_cast<Field<D,ThreeD>*>(field)->getKNN(x, y, z, n, k, catx, caty, catz,
+                                                        indices, distsq);
+           break;
+    }
+}
+
+void FieldGetKNN(void* field, double* x, double* y, double* z, long n, int k,
+                 double* catx, double* caty, double* catz, int d, int coords,
+                 long* indices, double* distsq)
+{
+    switch(d) {
+      case NData:
+           FieldGetKNN1<NData>(field, x, y, z, n, k, catx, caty, catz, coords, indices, distsq);
+           break;
+      case KData:
+           FieldGetKNN1<KData>(field, x, y, z, n, k, catx, caty, catz, coords, indices, distsq);
+           break;
+      case GData:
+           FieldGetKNN1<GData>(field, x, y, z, n, k, catx, caty, catz, coords, indices, distsq);
+           break;
+    }
+}
+
+template <int D, typename T>
+void* BuildSimpleField(T* x, T* y, T* z, T* g1, T* g2, T* k,
+                       T* w, T* wpos, long nobj, int coords)
 {
     dbg<<"Start BuildSimpleField "<<D<<"  "<<coords<<std::endl;
     void* field=0;
     switch (coords) {
       case Flat:
-           field = static_cast<void*>(new SimpleField<D,Flat>(x, y, 0, g1, g2, k,
+           field = static_cast<void*>(new SimpleField<D,Flat>(x, y, static_cast<T*>(0), g1, g2, k,
                                                               w, wpos, nobj));
            break;
       case Sphere:
@@ -646,6 +1571,18 @@ void* BuildNSimpleField(double* x, double* y, double* z,
                         double* w, double* wpos, long nobj, int coords)
 { return BuildSimpleField<NData>(x,y,z,w,w,w,w,wpos,nobj,coords); }
 
+void* BuildGSimpleFieldFloat(float* x, float* y, float* z, float* g1, float* g2,
+                             float* w, float* wpos, long nobj, int coords)
+{ return BuildSimpleField<GData>(x,y,z,g1,g2,w,w,wpos,nobj,coords); }
+
+void* BuildKSimpleFieldFloat(float* x, float* y, float* z, float* k,
+                             float* w, float* wpos, long nobj, int coords)
+{ return BuildSimpleField<KData>(x,y,z,w,w,k,w,wpos,nobj,coords); }
+
+void* BuildNSimpleFieldFloat(float* x, float* y, float* z,
+                             float* w, float* wpos, long nobj, int coords)
+{ return BuildSimpleField<NData>(x,y,z,w,w,w,w,wpos,nobj,coords); }
+
 template <int D>
 void DestroySimpleField(void* field, int coords)
 {
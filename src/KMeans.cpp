@@ -0,0 +1,459 @@
+/* Copyright (c) 2003-2019 by Mike Jarvis
+ *
+ * TreeCorr is free software: redistribution and use in source and binary forms,
+ * with or without modification, are permitted provided that the following
+ * conditions are met:
+ *
+ * 1. Redistributions of source code must retain the above copyright notice, this
+ *    list of conditions, and the disclaimer given in the accompanying LICENSE
+ *    file.
+ * 2. Redistributions in binary form must reproduce the above copyright notice,
+ *    this list of conditions, and the disclaimer given in the documentation
+ *    and/or other materials provided with the distribution.
+ */
+
+//#define DEBUGLOGGING
+
+#include <cstddef>  // for ptrdiff_t
+#include <deque>
+#include <limits>
+#include "Field.h"
+#include "Cell.h"
+#include "dbg.h"
+
+#ifdef _OPENMP
+#include "omp.h"
+#endif
+
+// The k-means algorithm here is a version of Lloyd's algorithm that uses the tree to
+// speed up the assignment of points to the nearest center.  For each cell, we find which
+// centers could possibly be the closest center for some point in that cell.  If there is only
+// one, then the whole cell is assigned to that center without looking at the individual
+// points.  Otherwise, we recurse to the sub-cells, only checking the centers that are still
+// possible candidates.
+
+// The centers are passed to and from python as a flat array with 2 values per center for
+// Flat coordinates and 3 values per center otherwise.
+template <int C>
+struct CenterHelper
+{
+    enum { ncol = 3 };
+    static Position<C> read(const double* p) { return Position<C>(p[0], p[1], p[2]); }
+    static void write(const Position<C>& pos, double* p)
+    { p[0] = pos.getX(); p[1] = pos.getY(); p[2] = pos.getZ(); }
+    static double getZ(const Position<C>& pos) { return pos.getZ(); }
+};
+
+template <>
+struct CenterHelper<Flat>
+{
+    enum { ncol = 2 };
+    static Position<Flat> read(const double* p) { return Position<Flat>(p[0], p[1]); }
+    static void write(const Position<Flat>& pos, double* p)
+    { p[0] = pos.getX(); p[1] = pos.getY(); }
+    static double getZ(const Position<Flat>& ) { return 0.; }
+};
+
+template <int C>
+void ReadCenters(std::vector<Position<C> >& centers, const double* pycenters, int npatch)
+{
+    const int ncol = CenterHelper<C>::ncol;
+    centers.resize(npatch);
+    for(int i=0; i<npatch; ++i) centers[i] = CenterHelper<C>::read(pycenters + ncol*i);
+}
+
+template <int C>
+void WriteCenters(const std::vector<Position<C> >& centers, double* pycenters, int npatch)
+{
+    const int ncol = CenterHelper<C>::ncol;
+    for(int i=0; i<npatch; ++i) CenterHelper<C>::write(centers[i], pycenters + ncol*i);
+}
+
+// Decide how many of ncen centers should go to the left group when splitting into two
+// groups with the given weights and numbers of objects.  The split is proportional to
+// the weight, but neither group can get more centers than it has objects.
+inline long SplitCenters(long ncen, double wl, double wr, long nl, long nr)
+{
+    double frac = (wl + wr > 0.) ? wl / (wl + wr) : double(nl) / double(nl + nr);
+    long ncen_left = long(ncen * frac + 0.5);
+    ncen_left = std::min(ncen_left, nl);
+    ncen_left = std::max(ncen_left, ncen - nr);
+    return ncen_left;
+}
+
+// Place ncen initial centers within cell, following the tree structure down until each
+// sub-cell gets a single center, which is placed at the centroid of that sub-cell.
+template <int D, int C>
+void InitializeCentersTree(const Cell<D,C>* cell, long ncen,
+                           std::vector<Position<C> >& centers, long& next)
+{
+    if (ncen == 0) return;
+    const Cell<D,C>* left = cell->getLeft();
+    if (ncen == 1 || !left) {
+        // If a leaf needs more than one center, then they are all at the same position.
+        // This only happens if many objects are at the same location.
+        for(long i=0; i<ncen; ++i) centers[next++] = cell->getPos();
+    } else {
+        const Cell<D,C>* right = cell->getRight();
+        long ncen_left = SplitCenters(ncen, left->getW(), right->getW(),
+                                      left->getN(), right->getN());
+        InitializeCentersTree(left, ncen_left, centers, next);
+        InitializeCentersTree(right, ncen - ncen_left, centers, next);
+    }
+}
+
+// Similar, but for the top-level cells in [c1,c2), which we split in half repeatedly until
+// there is only a single top-level cell.
+template <int D, int C>
+void InitializeCentersTop(const std::vector<Cell<D,C>*>& cells, size_t c1, size_t c2, long ncen,
+                          std::vector<Position<C> >& centers, long& next)
+{
+    if (ncen == 0) return;
+    if (c2 - c1 == 1) {
+        InitializeCentersTree(cells[c1], ncen, centers, next);
+    } else {
+        const size_t mid = (c1 + c2) / 2;
+        double wl=0., wr=0.;
+        long nl=0, nr=0;
+        for(size_t i=c1; i<mid; ++i) { wl += cells[i]->getW(); nl += cells[i]->getN(); }
+        for(size_t i=mid; i<c2; ++i) { wr += cells[i]->getW(); nr += cells[i]->getN(); }
+        long ncen_left = SplitCenters(ncen, wl, wr, nl, nr);
+        InitializeCentersTop(cells, c1, mid, ncen_left, centers, next);
+        InitializeCentersTop(cells, mid, c2, ncen - ncen_left, centers, next);
+    }
+}
+
+template <int D, int C>
+void InitializeCenters(const Field<D,C>& field, double* pycenters, int npatch)
+{
+    dbg<<"Start InitializeCenters: npatch = "<<npatch<<std::endl;
+    const std::vector<Cell<D,C>*>& cells = field.getCells();
+    std::vector<Position<C> > centers(npatch);
+    long next = 0;
+    InitializeCentersTop(cells, 0, cells.size(), npatch, centers, next);
+    Assert(next == npatch);
+    WriteCenters(centers, pycenters, npatch);
+}
+
+// Find which of the candidate centers could be the closest center for some point within
+// a distance s of pos.  The closest center to pos itself is always put first in new_cand.
+template <int C>
+void FilterCenters(const Position<C>& pos, double s, const std::vector<Position<C> >& centers,
+                   const std::vector<long>& cand, std::vector<long>& new_cand)
+{
+    const size_t ncand = cand.size();
+    double mindsq = std::numeric_limits<double>::infinity();
+    size_t imin = 0;
+    for(size_t j=0; j<ncand; ++j) {
+        const double dsq = (centers[cand[j]] - pos).normSq();
+        if (dsq < mindsq) { mindsq = dsq; imin = j; }
+    }
+    new_cand.clear();
+    new_cand.push_back(cand[imin]);
+    if (s > 0.) {
+        // Any point in the cell is at most d1 + s from the closest center, and at least
+        // dj - s from center j.  So center j can only be the closest for some point if
+        // dj <= d1 + 2s.
+        const double maxdsq = SQR(sqrt(mindsq) + 2.*s);
+        for(size_t j=0; j<ncand; ++j) {
+            if (j != imin && (centers[cand[j]] - pos).normSq() <= maxdsq)
+                new_cand.push_back(cand[j]);
+        }
+    }
+}
+
+// Add the weighted position of each cell to the sums for its closest center.
+// sums has 4 values for each center: sum(w x), sum(w y), sum(w z), sum(w).
+// work has a vector of candidates for each depth in the tree, to avoid reallocating these
+// for every cell.  (A deque, so adding a new depth doesn't invalidate the ones in use.)
+template <int D, int C>
+void AccumulateCenters(const Cell<D,C>* cell, const std::vector<Position<C> >& centers,
+                       const std::vector<long>& cand, std::vector<double>& sums,
+                       std::deque<std::vector<long> >& work, size_t depth)
+{
+    const double w = cell->getW();
+    if (w == 0.) return;
+    if (work.size() <= depth) work.push_back(std::vector<long>());
+    std::vector<long>& new_cand = work[depth];
+    FilterCenters(cell->getPos(), cell->getSize(), centers, cand, new_cand);
+
+    if (new_cand.size() == 1 || !cell->getLeft()) {
+        const Position<C>& pos = cell->getPos();
+        double* s = &sums[4*new_cand[0]];
+        s[0] += w * pos.getX();
+        s[1] += w * pos.getY();
+        s[2] += w * CenterHelper<C>::getZ(pos);
+        s[3] += w;
+    } else {
+        AccumulateCenters(cell->getLeft(), centers, new_cand, sums, work, depth+1);
+        AccumulateCenters(cell->getRight(), centers, new_cand, sums, work, depth+1);
+    }
+}
+
+// A rough measure of the size of the whole field: the rms distance of the objects from
+// the mean position, using the top-level cells and their sizes.
+template <int D, int C>
+double FieldSize(const Field<D,C>& field)
+{
+    const std::vector<Cell<D,C>*>& cells = field.getCells();
+    double sumw = 0.;
+    double sumx = 0., sumy = 0., sumz = 0.;
+    for(size_t i=0; i<cells.size(); ++i) {
+        const double w = cells[i]->getW();
+        const Position<C>& pos = cells[i]->getPos();
+        sumw += w;
+        sumx += w * pos.getX();
+        sumy += w * pos.getY();
+        sumz += w * CenterHelper<C>::getZ(pos);
+    }
+    if (sumw == 0.) return 0.;
+    const double meanx = sumx / sumw;
+    const double meany = sumy / sumw;
+    const double meanz = sumz / sumw;
+    double sumdsq = 0.;
+    for(size_t i=0; i<cells.size(); ++i) {
+        const Position<C>& pos = cells[i]->getPos();
+        const double dsq = SQR(pos.getX()-meanx) + SQR(pos.getY()-meany) +
+            SQR(CenterHelper<C>::getZ(pos)-meanz) + cells[i]->getSizeSq();
+        sumdsq += cells[i]->getW() * dsq;
+    }
+    return sqrt(sumdsq / sumw);
+}
+
+// Run Lloyd iterations starting from the given centers until the rms shift in the centers
+// is less than tol times the size of the field, or until max_iter iterations.
+// Returns the number of iterations done.
+template <int D, int C>
+long RunKMeans(const Field<D,C>& field, double* pycenters, int npatch, int max_iter, double tol)
+{
+    dbg<<"Start RunKMeans: npatch = "<<npatch<<", max_iter = "<<max_iter<<std::endl;
+    const std::vector<Cell<D,C>*>& cells = field.getCells();
+    const ptrdiff_t ntop = cells.size();
+    std::vector<Position<C> > centers;
+    ReadCenters(centers, pycenters, npatch);
+
+    std::vector<long> all_cand(npatch);
+    for(int i=0; i<npatch; ++i) all_cand[i] = i;
+
+    const double tolsq = SQR(tol * FieldSize(field));
+    dbg<<"tolsq = "<<tolsq<<std::endl;
+
+    long iter = 0;
+    std::vector<double> sums(4*npatch);
+    while (iter < max_iter) {
+        ++iter;
+        std::fill(sums.begin(), sums.end(), 0.);
+#ifdef _OPENMP
+#pragma omp parallel
+#endif
+        {
+            // Each thread accumulates its own sums, which are added together at the end.
+            std::vector<double> sums1(4*npatch, 0.);
+            std::deque<std::vector<long> > work;
+#ifdef _OPENMP
+#pragma omp for schedule(dynamic)
+#endif
+            for(ptrdiff_t i=0; i<ntop; ++i) {
+                AccumulateCenters(cells[i], centers, all_cand, sums1, work, 0);
+            }
+#ifdef _OPENMP
+#pragma omp critical
+#endif
+            {
+                for(int k=0; k<4*npatch; ++k) sums[k] += sums1[k];
+            }
+        }
+
+        // Move each center to the centroid of the points assigned to it.
+        // If a center didn't get any points, leave it where it is.
+        double shiftsq = 0.;
+        for(int k=0; k<npatch; ++k) {
+            const double* s = &sums[4*k];
+            if (s[3] == 0.) continue;
+            Position<C> new_center(s[0]/s[3], s[1]/s[3], s[2]/s[3]);
+            shiftsq += (new_center - centers[k]).normSq();
+            centers[k] = new_center;
+        }
+        shiftsq /= npatch;
+        dbg<<"iter "<<iter<<": rms shift = "<<sqrt(shiftsq)<<std::endl;
+        if (shiftsq < tolsq) break;
+    }
+    WriteCenters(centers, pycenters, npatch);
+    return iter;
+}
+
+// Set the patch number for all the objects in a cell.
+template <int D, int C>
+void SetPatch(const Cell<D,C>* cell, long p, long* patches)
+{
+    if (cell->getLeft()) {
+        SetPatch(cell->getLeft(), p, patches);
+        SetPatch(cell->getRight(), p, patches);
+    } else {
+        const long n1 = cell->getN();
+        if (n1 == 1) {
+            patches[cell->getInfo().index] = p;
+        } else if (n1 > 1) {
+            const long* leaf_indices = cell->getListInfo().indices();
+            for(long m=0; m<n1; ++m) patches[leaf_indices[m]] = p;
+        }
+    }
+}
+
+// Assign each object in a cell to its closest center.
+template <int D, int C>
+void AssignPatches(const Cell<D,C>* cell, const std::vector<Position<C> >& centers,
+                   const std::vector<long>& cand, long* patches,
+                   std::deque<std::vector<long> >& work, size_t depth)
+{
+    if (cell->getN() == 0) return;
+    if (work.size() <= depth) work.push_back(std::vector<long>());
+    std::vector<long>& new_cand = work[depth];
+    FilterCenters(cell->getPos(), cell->getSize(), centers, cand, new_cand);
+
+    if (new_cand.size() == 1 || !cell->getLeft()) {
+        SetPatch(cell, new_cand[0], patches);
+    } else {
+        AssignPatches(cell->getLeft(), centers, new_cand, patches, work, depth+1);
+        AssignPatches(cell->getRight(), centers, new_cand, patches, work, depth+1);
+    }
+}
+
+// Assign all the objects in the field to the patch with the closest center.
+// Objects that are not in the field (e.g. because w = 0) get patch = -1.
+template <int D, int C>
+void AssignPatches(const Field<D,C>& field, double* pycenters, int npatch, long* patches, long n)
+{
+    dbg<<"Start AssignPatches: npatch = "<<npatch<<", n = "<<n<<std::endl;
+    const std::vector<Cell<D,C>*>& cells = field.getCells();
+    const ptrdiff_t ntop = cells.size();
+    std::vector<Position<C> > centers;
+    ReadCenters(centers, pycenters, npatch);
+
+    std::vector<long> all_cand(npatch);
+    for(int i=0; i<npatch; ++i) all_cand[i] = i;
+
+    std::fill(patches, patches+n, -1);
+#ifdef _OPENMP
+#pragma omp parallel
+#endif
+    {
+        std::deque<std::vector<long> > work;
+#ifdef _OPENMP
+#pragma omp for schedule(dynamic)
+#endif
+        for(ptrdiff_t i=0; i<ntop; ++i) {
+            AssignPatches(cells[i], centers, all_cand, patches, work, 0);
+        }
+    }
+}
+
+//
+//
+// Now the C-C++ interface functions that get used in python:
+//
+//
+
+extern "C" {
+#include "KMeans_C.h"
+}
+
+template <int D>
+void KMeansInitTree1(void* field, double* centers, int npatch, int coords)
+{
+    switch(coords) {
+      case Flat:
+           InitializeCenters(*static_cast<Field<D,Flat>*>(field), centers, npatch);
+           break;
+      case Sphere:
+           InitializeCenters(*static_cast<Field<D,Sphere>*>(field), centers, npatch);
+           break;
+      case ThreeD:
+           InitializeCenters(*static_cast<Field<D,ThreeD>*>(field), centers, npatch);
+           break;
+    }
+}
+
+void KMeansInitTree(void* field, double* centers, int npatch, int d, int coords)
+{
+    switch(d) {
+      case NData:
+           KMeansInitTree1<NData>(field, centers, npatch, coords);
+           break;
+      case KData:
+           KMeansInitTree1<KData>(field, centers, npatch, coords);
+           break;
+      case GData:
+           KMeansInitTree1<GData>(field, centers, npatch, coords);
+           break;
+    }
+}
+
+template <int D>
+long KMeansRun1(void* field, double* centers, int npatch, int max_iter, double tol, int coords)
+{
+    switch(coords) {
+      case Flat:
+           return RunKMeans(*static_cast<Field<D,Flat>*>(field), centers, npatch,
+                            max_iter, tol);
+           break;
+      case Sphere:
+           return RunKMeans(*static_cast<Field<D,Sphere>*>(field), centers, npatch,
+                            max_iter, tol);
+           break;
+      case ThreeD:
+           return RunKMeans(*static_cast<Field<D,ThreeD>*>(field), centers, npatch,
+                            max_iter, tol);
+           break;
+    }
+    return 0;  // Can't get here, but saves a compiler warning
+}
+
+long KMeansRun(void* field, double* centers, int npatch, int max_iter, double tol,
+               int d, int coords)
+{
+    switch(d) {
+      case NData:
+           return KMeansRun1<NData>(field, centers, npatch, max_iter, tol, coords);
+           break;
+      case KData:
+           return KMeansRun1<KData>(field, centers, npatch, max_iter, tol, coords);
+           break;
+      case GData:
+           return KMeansRun1<GData>(field, centers, npatch, max_iter, tol, coords);
+           break;
+    }
+    return 0;  // Can't get here, but saves a compiler warning
+}
+
+template <int D>
+void KMeansAssign1(void* field, double* centers, int npatch, long* patches, long n, int coords)
+{
+    switch(coords) {
+      case Flat:
+           AssignPatches(*static_cast<Field<D,Flat>*>(field), centers, npatch, patches, n);
+           break;
+      case Sphere:
+           AssignPatches(*static_cast<Field<D,Sphere>*>(field), centers, npatch, patches, n);
+           break;
+      case ThreeD:
+           AssignPatches(*static_cast<Field<D,ThreeD>*>(field), centers, npatch, patches, n);
+           break;
+    }
+}
+
+void KMeansAssign(void* field, double* centers, int npatch, long* patches, long n,
+                  int d, int coords)
+{
+    switch(d) {
+      case NData:
+           KMeansAssign1<NData>(field, centers, npatch, patches, n, coords);
+           break;
+      case KData:
+           KMeansAssign1<KData>(field, centers, npatch, patches, n, coords);
+           break;
+      case GData:
+           KMeansAssign1<GData>(field, centers, npatch, patches, n, coords);
+           break;
+    }
+}
@@ -0,0 +1,254 @@
+/* Copyright (c) 2003-2019 by Mike Jarvis
+ *
+ * TreeCorr is free software: redistribution and use in source and binary forms,
+ * with or without modification, are permitted provided that the following
+ * conditions are met:
+ *
+ * 1. Redistributions of source code must retain the above copyright notice, this
+ *    list of conditions, and the disclaimer given in the accompanying LICENSE
+ *    file.
+ * 2. Redistributions in binary form must reproduce the above copyright notice,
+ *    this list of conditions, and the disclaimer given in the documentation
+ *    and/or other materials provided with the distribution.
+ */
+
+
+#include <algorithm>
+#include <cmath>
+#include <stdint.h>
+#include "dbg.h"
+
+#ifdef _OPENMP
+#include "omp.h"
+#endif
+
+extern "C" {
+#include "Randoms_C.h"
+}
+
+// Random points are generated in blocks of fixed size.  Each block gets its own random number
+// generator, seeded from the user's seed, the stream number and the block number.  This way
+// the output only depends on the seed and stream, not on the number of threads used, or on
+// how the blocks get divided among the threads.
+const long BLOCK_SIZE = 4096;
+
+// splitmix64, which we use to seed the main generator.
+inline uint64_t SplitMix64(uint64_t& s)
+{
+    uint64_t z = (s += 0x9e3779b97f4a7c15ULL);
+    z = (z ^ (z >> 30)) * 0xbf58476d1ce4e5b9ULL;
+    z = (z ^ (z >> 27)) * 0x94d049bb133111ebULL;
+    return z ^ (z >> 31);
+}
+
+// xoshiro256**, a fast generator with good statistical properties.
+class Xoshiro256
+{
+public:
+    Xoshiro256(long seed, long stream, long block)
+    {
+        uint64_t s = uint64_t(seed);
+        uint64_t h = SplitMix64(s);
+        s = h ^ uint64_t(stream);
+        h = SplitMix64(s);
+        s = h ^ uint64_t(block);
+        for (int i=0; i<4; ++i) _s[i] = SplitMix64(s);
+    }
+
+    uint64_t next()
+    {
+        const uint64_t result = rotl(_s[1] * 5, 7) * 9;
+        const uint64_t t = _s[1] << 17;
+        _s[2] ^= _s[0];
+        _s[3] ^= _s[1];
+        _s[1] ^= _s[2];
+        _s[0] ^= _s[3];
+        _s[2] ^= t;
+        _s[3] = rotl(_s[3], 45);
+        return result;
+    }
+
+    // A uniform deviate in [0,1)
+    double uniform()
+    { return (next() >> 11) * (1. / 9007199254740992.); }
+
+private:
+    static inline uint64_t rotl(const uint64_t x, int k)
+    { return (x << k) | (x >> (64 - k)); }
+
+    uint64_t _s[4];
+};
+
+// Loop over the blocks in parallel, calling f(rng, i) for each point i.
+template <typename F>
+void GenerateBlocks(long n, long seed, long stream, F& f)
+{
+    long nblocks = (n + BLOCK_SIZE - 1) / BLOCK_SIZE;
+#ifdef _OPENMP
+#pragma omp parallel for schedule(dynamic)
+#endif
+    for (long b=0; b<nblocks; ++b) {
+        Xoshiro256 rng(seed, stream, b);
+        long end = std::min(n, (b+1) * BLOCK_SIZE);
+        for (long i=b*BLOCK_SIZE; i<end; ++i) f(rng, i);
+    }
+}
+
+struct FlatGenerator
+{
+    FlatGenerator(double* _x, double* _y, double* _z,
+                  double _xmin, double _xmax, double _ymin, double _ymax,
+                  double _zmin, double _zmax) :
+        x(_x), y(_y), z(_z), xmin(_xmin), dx(_xmax-_xmin), ymin(_ymin), dy(_ymax-_ymin),
+        zmin(_zmin), dz(_zmax-_zmin) {}
+
+    void operator()(Xoshiro256& rng, long i)
+    {
+        x[i] = xmin + dx * rng.uniform();
+        y[i] = ymin + dy * rng.uniform();
+        if (z) z[i] = zmin + dz * rng.uniform();
+    }
+
+    double* x;
+    double* y;
+    double* z;
+    double xmin, dx, ymin, dy, zmin, dz;
+};
+
+void GenerateFlat(double* x, double* y, double* z, long n,
+                  double xmin, double xmax, double ymin, double ymax,
+                  double zmin, double zmax, long seed, long stream)
+{
+    dbg<<"Start GenerateFlat: n = "<<n<<std::endl;
+    FlatGenerator f(x, y, z, xmin, xmax, ymin, ymax, zmin, zmax);
+    GenerateBlocks(n, seed, stream, f);
+}
+
+// Uniform on the sphere within a range of ra and dec means uniform in ra and sin(dec).
+struct RADecGenerator
+{
+    RADecGenerator(double* _ra, double* _dec,
+                   double _ramin, double _ramax, double _decmin, double _decmax) :
+        ra(_ra), dec(_dec), ramin(_ramin), dra(_ramax-_ramin),
+        zmin(std::sin(_decmin)), dz(std::sin(_decmax)-std::sin(_decmin)) {}
+
+    void operator()(Xoshiro256& rng, long i)
+    {
+        ra[i] = ramin + dra * rng.uniform();
+        dec[i] = std::asin(zmin + dz * rng.uniform());
+    }
+
+    double* ra;
+    double* dec;
+    double ramin, dra, zmin, dz;
+};
+
+void GenerateRADec(double* ra, double* dec, long n,
+                   double ramin, double ramax, double decmin, double decmax,
+                   long seed, long stream)
+{
+    dbg<<"Start GenerateRADec: n = "<<n<<std::endl;
+    RADecGenerator f(ra, dec, ramin, ramax, decmin, decmax);
+    GenerateBlocks(n, seed, stream, f);
+}
+
+// For a spherical cap, generate points uniformly around the north pole, with cos(theta)
+// uniform in [cos(radius), 1], and then rotate the pole to the center of the cap.
+struct CapGenerator
+{
+    CapGenerator(double* _ra, double* _dec, double ra0, double dec0, double radius) :
+        ra(_ra), dec(_dec), cosrmin(std::cos(radius))
+    {
+        double cosra = std::cos(ra0), sinra = std::sin(ra0);
+        double cosdec = std::cos(dec0), sindec = std::sin(dec0);
+        // The center and two unit vectors perpendicular to it (east and north).
+        c[0] = cosdec * cosra;   c[1] = cosdec * sinra;   c[2] = sindec;
+        e[0] = -sinra;           e[1] = cosra;            e[2] = 0.;
+        u[0] = -sindec * cosra;  u[1] = -sindec * sinra;  u[2] = cosdec;
+    }
+
+    void operator()(Xoshiro256& rng, long i)
+    {
+        double costheta = cosrmin + (1.-cosrmin) * rng.uniform();
+        double sintheta = std::sqrt(std::max(0., 1.-costheta*costheta));
+        double phi = 2.*M_PI * rng.uniform();
+        double a = sintheta * std::cos(phi);
+        double b = sintheta * std::sin(phi);
+        double px = a*e[0] + b*u[0] + costheta*c[0];
+        double py = a*e[1] + b*u[1] + costheta*c[1];
+        double pz = a*e[2] + b*u[2] + costheta*c[2];
+        double r = std::atan2(py, px);
+        if (r < 0.) r += 2.*M_PI;
+        ra[i] = r;
+        dec[i] = std::asin(std::max(-1., std::min(1., pz)));
+    }
+
+    double* ra;
+    double* dec;
+    double cosrmin;
+    double c[3], e[3], u[3];
+};
+
+void GenerateCap(double* ra, double* dec, long n,
+                 double ra0, double dec0, double radius, long seed, long stream)
+{
+    dbg<<"Start GenerateCap: n = "<<n<<std::endl;
+    CapGenerator f(ra, dec, ra0, dec0, radius);
+    GenerateBlocks(n, seed, stream, f);
+}
+
+// The mask is a boolean map of nx x ny pixels covering [xmin,xmax) x [ymin,ymax), stored
+// with x varying fastest.  Points outside of the map, or in pixels with mask = 0, get keep = 0.
+void ApplyPixelMask(double* x, double* y, long n, long* mask, long nx, long ny,
+                    double xmin, double xmax, double ymin, double ymax, long* keep)
+{
+    dbg<<"Start ApplyPixelMask: n = "<<n<<std::endl;
+    const double xscale = nx / (xmax - xmin);
+    const double yscale = ny / (ymax - ymin);
+#ifdef _OPENMP
+#pragma omp parallel for schedule(static)
+#endif
+    for (long i=0; i<n; ++i) {
+        if (!keep[i]) continue;
+        double fx = (x[i] - xmin) * xscale;
+        double fy = (y[i] - ymin) * yscale;
+        if (fx < 0. || fy < 0.) { keep[i] = 0; continue; }
+        long ix = long(fx);
+        long iy = long(fy);
+        if (ix >= nx || iy >= ny) { keep[i] = 0; continue; }
+        if (!mask[iy*nx + ix]) keep[i] = 0;
+    }
+}
+
+// Standard even-odd ray casting test for whether (x,y) is inside the polygon with the
+// given n vertices.
+inline bool InsidePolygon(double x, double y, const double* px, const double* py, long n)
+{
+    bool inside = false;
+    for (long i=0, j=n-1; i<n; j=i++) {
+        if (((py[i] > y) != (py[j] > y)) &&
+            (x < (px[j]-px[i]) * (y-py[i]) / (py[j]-py[i]) + px[i]))
+            inside = !inside;
+    }
+    return inside;
+}
+
+// The vertices of polygon k are px[pstart[k]:pstart[k+1]], so pstart has npoly+1 entries.
+// Points that are not inside any of the polygons get keep = 0.
+void ApplyPolygonMask(double* x, double* y, long n, double* px, double* py,
+                      long* pstart, long npoly, long* keep)
+{
+    dbg<<"Start ApplyPolygonMask: n = "<<n<<", npoly = "<<npoly<<std::endl;
+#ifdef _OPENMP
+#pragma omp parallel for schedule(static)
+#endif
+    for (long i=0; i<n; ++i) {
+        if (!keep[i]) continue;
+        bool inside = false;
+        for (long k=0; k<npoly && !inside; ++k) {
+            inside = InsidePolygon(x[i], y[i], px + pstart[k], py + pstart[k],
+                                   pstart[k+1] - pstart[k]);
+        }
+        if (!inside) keep[i] = 0;
+    }
+}
@@ -298,6 +298,98 @@ def test_ascii():
     do_pickle(cat9)
     do_pickle(cat10)
 
+def test_ascii_parser():
+    # Test some of the edge cases of the ASCII parser.
+    nobj = 2000
+    rng = np.random.RandomState(8675309)
+    x = rng.random_sample(nobj)
+    y = rng.random_sample(nobj)
+    k = rng.normal(0,3, (nobj,) )
+    w = rng.random_sample(nobj)
+
+    # Comment lines, comments at the ends of lines, blank lines, tabs, and DOS line endings.
+    file_name = os.path.join('data','test_parser.dat')
+    with open(file_name, 'w') as fid:
+        fid.write('# x y k w\n')
+        fid.write('\n')
+        for i in range(nobj):
+            if i%3 == 0:
+                fid.write('%.12f\t%.12f  %.12f %.12f\r\n'%(x[i],y[i],k[i],w[i]))
+            else:
+                fid.write('  %.12f %.12f %.12f %.12f # object %d\n'%(x[i],y[i],k[i],w[i],i))
+            if i%100 == 0:
+                fid.write('   # A comment line\n\n')
+        # No newline at the end of the file.
+        fid.write('# The end')
+    config = {'x_col':1, 'y_col':2, 'k_col':3, 'w_col':4, 'wpos_col':4}
+    cat1 = treecorr.Catalog(file_name, config)
+    np.testing.assert_almost_equal(cat1.x, x)
+    np.testing.assert_almost_equal(cat1.y, y)
+    np.testing.assert_almost_equal(cat1.k, k)
+    np.testing.assert_almost_equal(cat1.w, w)
+    np.testing.assert_almost_equal(cat1.wpos, w)
+
+    # first_row and last_row count only the data rows.
+    cat2 = treecorr.Catalog(file_name, config, first_row=101, last_row=1500)
+    assert cat2.ntot == 1400
+    np.testing.assert_almost_equal(cat2.x, x[100:1500])
+    np.testing.assert_almost_equal(cat2.k, k[100:1500])
+    cat2 = treecorr.Catalog(file_name, config, first_row=1901, last_row=5000)
+    assert cat2.ntot == 100
+    np.testing.assert_almost_equal(cat2.x, x[1900:])
+    assert_raises(ValueError, treecorr.Catalog, file_name, config, first_row=nobj+1)
+
+    # Multi-character comment marker, and a delimiter with empty fields.
+    csv_file_name = os.path.join('data','test_parser.csv')
+    with open(csv_file_name, 'w') as fid:
+        fid.write('// x,y,k,w\n')
+        for i in range(nobj):
+            k3 = '' if i%10 == 0 else '%.12f'%k[i]
+            fid.write('%.12f, %.12f,%s,%.12f,%.12f  // object %d\n'%(x[i],y[i],k3,k[i],w[i],i))
+    cat3 = treecorr.Catalog(csv_file_name, config, delimiter=',', comment_marker='//',
+                            x_col=1, y_col=2, k_col=4, w_col=5, wpos_col=0)
+    np.testing.assert_almost_equal(cat3.x, x)
+    np.testing.assert_almost_equal(cat3.y, y)
+    np.testing.assert_almost_equal(cat3.k, k)
+    np.testing.assert_almost_equal(cat3.w, w)
+    # An empty field is read as NaN, which gets w=0.
+    with CaptureLog() as cl:
+        cat4 = treecorr.Catalog(csv_file_name, config, delimiter=',', comment_marker='//',
+                                x_col=1, y_col=2, k_col=3, w_col=5, wpos_col=0,
+                                logger=cl.logger)
+    assert "NaNs found in k column." in cl.output
+    bad = np.arange(nobj)%10 == 0
+    np.testing.assert_almost_equal(cat4.w[bad], 0.)
+    np.testing.assert_almost_equal(cat4.w[~bad], w[~bad])
+    np.testing.assert_almost_equal(cat4.k[~bad], k[~bad])
+
+    # Multi-character delimiters use pandas or numpy instead.
+    with open(csv_file_name, 'w') as fid:
+        for i in range(nobj):
+            fid.write('%.12f::%.12f::%.12f::%.12f\n'%(x[i],y[i],k[i],w[i]))
+    with warnings.catch_warnings():
+        warnings.simplefilter("ignore")
+        cat5 = treecorr.Catalog(csv_file_name, config, delimiter='::', last_row=1000)
+    assert cat5.ntot == 1000
+    np.testing.assert_almost_equal(cat5.x, x[:1000])
+    np.testing.assert_almost_equal(cat5.k, k[:1000])
+
+    # Invalid entries give an error that says which row.
+    with open(file_name, 'w') as fid:
+        for i in range(nobj):
+            if i == 1234:
+                fid.write('%.12f %.12f bad %.12f\n'%(x[i],y[i],w[i]))
+            else:
+                fid.write('%.12f %.12f %.12f %.12f\n'%(x[i],y[i],k[i],w[i]))
+    with assert_raises(ValueError) as cm:
+        treecorr.Catalog(file_name, config)
+    assert 'row 1235' in str(cm.exception)
+    # But not if that column isn't used.
+    cat6 = treecorr.Catalog(file_name, config, k_col=0)
+    np.testing.assert_almost_equal(cat6.x, x)
+    assert_raises(IOError, treecorr.Catalog, os.path.join('data','nonexistent.dat'), config)
+
+
 def test_fits():
     try:
         import fitsio
@@ -416,6 +508,658 @@ def test_fits():
     assert_raises(ValueError, treecorr.Catalog, file_name, config, g1_col='0')
     assert_raises(ValueError, treecorr.Catalog, file_name, config, g2_col='0')
 
+def test_read_fits_rows():
+    # Test reading a limited set of rows and columns spread over several hdus.
+    try:
+        import fitsio
+    except ImportError:
+        print('Skipping FITS tests, since fitsio is not installed')
+        return
+
+    nobj = 5000
+    rng = np.random.RandomState(8675309)
+    x = rng.random_sample(nobj)
+    y = rng.random_sample(nobj).astype(np.float32)
+    k = rng.normal(0,3, (nobj,) )
+    w = rng.random_sample(nobj)
+    flag = rng.randint(0,4, (nobj,)).astype(np.int16)
+    extra = rng.random_sample((nobj,20))
+
+    file_name = os.path.join('data','test_rows.fits')
+    data1 = np.empty(nobj, dtype=[('x','>f8'), ('y','>f4'), ('extra','>f8',(20,))])
+    data1['x'] = x
+    data1['y'] = y
+    data1['extra'] = extra
+    data2 = np.empty(nobj, dtype=[('k','<f8'), ('w','f8'), ('flag','i2')])
+    data2['k'] = k
+    data2['w'] = w
+    data2['flag'] = flag
+    with fitsio.FITS(file_name, 'rw', clobber=True) as fits:
+        fits.write(data1)
+        fits.write(data2)
+
+    config = {'x_col':'x', 'y_col':'y', 'k_col':'k', 'k_hdu':2, 'w_col':'w', 'w_hdu':2,
+              'wpos_col':'w', 'wpos_hdu':2, 'flag_col':'flag', 'flag_hdu':2,
+              'ignore_flag':1}
+    cat1 = treecorr.Catalog(file_name, config)
+    good = (flag & 1) == 0
+    np.testing.assert_almost_equal(cat1.x, x)
+    np.testing.assert_almost_equal(cat1.y, y)
+    np.testing.assert_almost_equal(cat1.k, k)
+    np.testing.assert_almost_equal(cat1.w[good], w[good])
+    np.testing.assert_almost_equal(cat1.w[~good], 0.)
+    np.testing.assert_almost_equal(cat1.wpos, w)
+    for a in [cat1.x, cat1.y, cat1.k, cat1.w, cat1.wpos]:
+        assert a.dtype == float
+        assert a.flags['C_CONTIGUOUS']
+
+    cat2 = treecorr.Catalog(file_name, config, first_row=1001, last_row=1250)
+    assert cat2.ntot == 250
+    np.testing.assert_almost_equal(cat2.x, x[1000:1250])
+    np.testing.assert_almost_equal(cat2.y, y[1000:1250])
+    np.testing.assert_almost_equal(cat2.k, k[1000:1250])
+    np.testing.assert_almost_equal(cat2.wpos, w[1000:1250])
+    cat3 = treecorr.Catalog(file_name, config, first_row=4901, last_row=6000)
+    assert cat3.ntot == 100
+    np.testing.assert_almost_equal(cat3.x, x[4900:])
+    cat4 = treecorr.read_catalogs(dict(config, file_name=file_name, last_row=10),
+                                  key='file_name', is_rand=True)[0]
+    assert cat4.ntot == 10
+    assert cat4.k is None
+    np.testing.assert_almost_equal(cat4.x, x[:10])
+
+    assert_raises(ValueError, treecorr.Catalog, file_name, config, first_row=nobj+1)
+    assert_raises(ValueError, treecorr.Catalog, file_name, config, w_hdu=1)
+    assert_raises(ValueError, treecorr.Catalog, file_name, config, w_col='invalid')
+
+
+def test_hdf5():
+    # Test reading catalogs from HDF5 files.
+    try:
+        import h5py
+    except ImportError:
+        print('Skipping HDF5 tests, since h5py is not installed')
+        return
+
+    nobj = 5000
+    rng = np.random.RandomState(8675309)
+    ra = rng.uniform(0, 24, (nobj,) )
+    dec = rng.uniform(-30, 30, (nobj,) )
+    w = rng.random_sample(nobj)
+    g1 = rng.normal(0,0.2, (nobj,) )
+    g2 = rng.normal(0,0.2, (nobj,) )
+    flag = rng.randint(0,4, (nobj,))
+
+    file_name = os.path.join('data','test.hdf5')
+    with h5py.File(file_name, 'w') as hdf:
+        hdf.create_dataset('ra', data=ra)
+        hdf.create_dataset('dec', data=dec.astype('>f4'))
+        hdf.create_dataset('w', data=w, chunks=(1000,))
+        hdf.create_dataset('flag', data=flag.astype(np.int16))
+        hdf.create_dataset('shear/g1', data=g1)
+        hdf.create_dataset('shear/g2', data=g2)
+
+    config = {'ra_col':'ra', 'dec_col':'dec', 'w_col':'w', 'flag_col':'flag', 'ignore_flag':1,
+              'g1_col':'shear/g1', 'g2_col':'shear/g2', 'ra_units':'hours', 'dec_units':'deg'}
+    cat1 = treecorr.Catalog(file_name, config)
+    good = (flag & 1) == 0
+    cat2 = treecorr.Catalog(ra=ra, dec=dec.astype(np.float32), w=w*good, g1=g1, g2=g2,
+                            ra_units='hours', dec_units='deg')
+    assert cat1 == cat2
+    for a in [cat1.ra, cat1.dec, cat1.w, cat1.g1, cat1.g2]:
+        assert a.dtype == float
+        assert a.flags['C_CONTIGUOUS']
+
+    cat3 = treecorr.Catalog(file_name, config, first_row=1001, last_row=3000, file_type='HDF5')
+    assert cat3.ntot == 2000
+    np.testing.assert_almost_equal(cat3.ra, ra[1000:3000] * coord.hours / coord.radians)
+    np.testing.assert_almost_equal(cat3.g2, g2[1000:3000])
+
+    cat4 = treecorr.Catalog(file_name, config, lazy=True)
+    assert sorted(cat4._lazy_cols) == ['g1', 'g2']
+    assert cat4 == cat1
+
+    assert_raises(ValueError, treecorr.Catalog, file_name, config, w_col='invalid')
+    assert_raises(ValueError, treecorr.Catalog, file_name, config, w_col='shear')
+    assert_raises(ValueError, treecorr.Catalog, file_name, config, ra_col='0')
+    assert_raises(ValueError, treecorr.Catalog, file_name, config, dec_col='invalid')
+
+
+def test_parquet():
+    # Test reading catalogs from Parquet files, either a single file or a directory of them.
+    try:
+        import pyarrow
+        import pyarrow.parquet
+    except ImportError:
+        print('Skipping Parquet tests, since pyarrow is not installed')
+        return
+
+    nobj = 5000
+    rng = np.random.RandomState(8675309)
+    x = rng.random_sample(nobj)
+    y = rng.random_sample(nobj).astype(np.float32)
+    k = rng.normal(0,3, (nobj,) )
+    w = rng.random_sample(nobj)
+    patch = rng.randint(0,10, (nobj,))
+    table = pyarrow.table({'x':x, 'y':y, 'k':k, 'w':w, 'patch':patch})
+
+    file_name = os.path.join('data','test.parquet')
+    pyarrow.parquet.write_table(table, file_name, row_group_size=700)
+    config = {'x_col':'x', 'y_col':'y', 'k_col':'k', 'w_col':'w', 'wpos_col':'w',
+              'patch_col':'patch', 'x_units':'arcmin', 'y_units':'arcmin'}
+    cat1 = treecorr.Catalog(file_name, config)
+    cat2 = treecorr.Catalog(x=x, y=y, k=k, w=w, wpos=w, patch=patch,
+                            x_units='arcmin', y_units='arcmin')
+    assert cat1 == cat2
+    assert cat1.patch.dtype == int
+
+    # The rows may cover several row groups.
+    for first_row, last_row in [(1, 700), (650, 2150), (1401, 1405), (4000, 10000)]:
+        cat3 = treecorr.Catalog(file_name, config, first_row=first_row, last_row=last_row)
+        i1 = first_row-1
+        i2 = min(last_row, nobj)
+        assert cat3.ntot == i2-i1
+        np.testing.assert_allclose(cat3.x, x[i1:i2] * (coord.arcmin / coord.radians))
+        np.testing.assert_allclose(cat3.k, k[i1:i2])
+        np.testing.assert_allclose(cat3.w, w[i1:i2])
+
+    # Null values are treated like NaNs, so they get w=0.
+    k_null = pyarrow.array(k, mask=(np.arange(nobj) % 100 == 7))
+    file_name2 = os.path.join('data','test_null.pq')
+    pyarrow.parquet.write_table(table.set_column(2, 'k', k_null), file_name2)
+    cat4 = treecorr.Catalog(file_name2, config)
+    np.testing.assert_array_equal(cat4.w[7::100], 0.)
+    assert cat4.nobj == nobj - nobj//100
+
+    # A partitioned dataset in a directory.
+    dir_name = os.path.join('data','test_parquet_dir')
+    if not os.path.exists(dir_name):
+        os.mkdir(dir_name)
+    for i in range(5):
+        pyarrow.parquet.write_table(table.slice(i*1000, 1000),
+                                    os.path.join(dir_name, 'part%d.parquet'%i),
+                                    row_group_size=300)
+    cat5 = treecorr.Catalog(dir_name, config)
+    assert cat5 == cat1
+    cat6 = treecorr.Catalog(dir_name, config, first_row=901, last_row=3100, lazy=True)
+    assert sorted(cat6._lazy_cols) == ['k']
+    np.testing.assert_allclose(cat6.k, k[900:3100])
+
+    assert_raises(ValueError, treecorr.Catalog, file_name, config, w_col='invalid')
+    assert_raises(ValueError, treecorr.Catalog, file_name, config, x_col='invalid')
+    cat7 = treecorr.Catalog(file_name, config, k_col='invalid')  # Invalid, but not needed.
+    assert cat7.k is None
+
+    # Check that running via the corr2 script works correctly.
+    out_file_name = os.path.join('output','kk_parquet.out')
+    config = dict(config, file_name=dir_name, min_sep=0.01, max_sep=0.5, nbins=10,
+                  sep_units='arcmin', kk_file_name=out_file_name, verbose=0)
+    treecorr.corr2(config)
+    kk = treecorr.KKCorrelation(min_sep=0.01, max_sep=0.5, nbins=10, sep_units='arcmin')
+    kk.process(cat2)
+    data = np.genfromtxt(out_file_name, names=True, skip_header=1)
+    np.testing.assert_allclose(data['npairs'], kk.npairs, rtol=1.e-3)
+    np.testing.assert_allclose(data['xi'], kk.xi, rtol=1.e-3)
+
+
+def test_lazy():
+    # Test that lazy=True only reads g1, g2, k when they are needed.
+    nobj = 5000
+    rng = np.random.RandomState(8675309)
+    x = rng.random_sample(nobj)
+    y = rng.random_sample(nobj)
+    w = rng.random_sample(nobj)
+    g1 = rng.normal(0,0.2, (nobj,) )
+    g2 = rng.normal(0,0.2, (nobj,) )
+    k = rng.normal(0,3, (nobj,) )
+    g1[17] = np.nan
+    k[23] = np.nan
+
+    file_name = os.path.join('data','test_lazy.dat')
+    with open(file_name, 'w') as fid:
+        for i in range(nobj):
+            fid.write(('%.8f %.8f %.8f %.8f %.8f %.8f\n')%(x[i],y[i],w[i],g1[i],g2[i],k[i]))
+    config = {'x_col':1, 'y_col':2, 'w_col':3, 'g1_col':4, 'g2_col':5, 'k_col':6,
+              'flip_g2':True}
+
+    cat1 = treecorr.Catalog(file_name, config)
+    cat2 = treecorr.Catalog(file_name, config, lazy=True)
+    assert sorted(cat2._lazy_cols) == ['g1', 'g2', 'k']
+    assert cat2.ntot == nobj
+    np.testing.assert_almost_equal(cat2.x, x)
+    np.testing.assert_almost_equal(cat2.w, w)
+
+    # Building an NField doesn't read anything else.  Neither do nobj, sumw.
+    cat2.getNField()
+    assert cat2.nobj == nobj
+    np.testing.assert_almost_equal(cat2.sumw, np.sum(w))
+    assert sorted(cat2._lazy_cols) == ['g1', 'g2', 'k']
+
+    # Accessing g1 reads both g1 and g2, with the flip applied.  The NaN sets w=0.
+    np.testing.assert_almost_equal(cat2.g1[:17], g1[:17])
+    assert sorted(cat2._lazy_cols) == ['k']
+    np.testing.assert_almost_equal(cat2.g2, -g2)
+    assert cat2.w[17] == 0.
+    assert cat2.nobj == nobj-1
+    assert cat2.nfields.count == 0
+
+    # varg, vark read whatever else they need.
+    assert cat2.vark == cat1.vark
+    assert cat2.varg == cat1.varg
+    assert not cat2._lazy_cols
+    for name in ['w', 'g1', 'g2', 'k']:
+        np.testing.assert_array_equal(getattr(cat2,name), getattr(cat1,name))
+    assert cat2.nobj == cat1.nobj
+    assert cat2.sumw == cat1.sumw
+
+    # Pickling reads any columns that haven't been read yet.
+    cat3 = treecorr.Catalog(file_name, config, lazy=True)
+    import pickle
+    cat3 = pickle.loads(pickle.dumps(cat3))
+    assert not cat3._lazy_cols
+    for name in ['w', 'g1', 'g2', 'k']:
+        np.testing.assert_array_equal(getattr(cat3,name), getattr(cat1,name))
+
+    # Nothing is deferred for random catalogs.
+    cat4 = treecorr.Catalog(file_name, config, lazy=True, is_rand=True, flip_g2=False)
+    assert not cat4._lazy_cols
+    assert cat4.g1 is None
+
+    # Reading a column with NaNs after a field was built changes the weights, so this gives
+    # a warning.  Until then, the lazy catalog has the weights without the NaN rows zeroed.
+    with CaptureLog(level=1) as cl:
+        cat5 = treecorr.Catalog(file_name, config, lazy=True, logger=cl.logger)
+        cat5.getNField()
+        assert cat5.nobj == nobj
+        assert cat5.nfields.count == 1
+        cat5.k
+    assert 'change the weights' in cl.output
+    assert cat5.w[23] == 0.
+    assert cat5.nfields.count == 0
+    with CaptureLog(level=1) as cl:
+        cat5.g1
+    assert 'change the weights' not in cl.output
+    assert cat5.nobj == cat1.nobj
+
+    # The same works for FITS files.
+    try:
+        import fitsio
+    except ImportError:
+        print('Skipping FITS tests, since fitsio is not installed')
+        return
+
+    file_name = os.path.join('data','test_lazy.fits')
+    data = np.empty(nobj, dtype=[('x',float), ('y',float), ('w',float), ('g1',float),
+                                 ('g2',float), ('k',float)])
+    for name, a in [('x',x), ('y',y), ('w',w), ('g1',g1), ('g2',g2), ('k',k)]:
+        data[name] = a
+    with fitsio.FITS(file_name, 'rw', clobber=True) as fits:
+        fits.write(data)
+    config = {'x_col':'x', 'y_col':'y', 'w_col':'w', 'g1_col':'g1', 'g2_col':'g2', 'k_col':'k',
+              'first_row':101, 'last_row':4000}
+    cat5 = treecorr.Catalog(file_name, config)
+    cat6 = treecorr.Catalog(file_name, config, lazy=True)
+    assert sorted(cat6._lazy_cols) == ['g1', 'g2', 'k']
+    cat6.getNField()
+    assert sorted(cat6._lazy_cols) == ['g1', 'g2', 'k']
+    cat6.getKField()
+    assert sorted(cat6._lazy_cols) == ['g1', 'g2']
+    np.testing.assert_almost_equal(cat6.k[:22], k[100:122])
+    assert cat6.varg == cat5.varg
+    assert cat6 == cat5
+
+
+def test_cache():
+    # Test using cache_dir to save the processed arrays for later reads of the same file.
+    import shutil
+    nobj = 5000
+    rng = np.random.RandomState(8675309)
+    ra = rng.uniform(0, 360, (nobj,) )
+    dec = rng.uniform(-30, 30, (nobj,) )
+    r = rng.uniform(10, 20, (nobj,) )
+    w = rng.random_sample(nobj)
+    k = rng.normal(0,3, (nobj,) )
+    flag = rng.randint(0,4, (nobj,))
+    w[12] = np.nan
+
+    file_name = os.path.join('data','test_cache.dat')
+    np.savetxt(file_name, np.array([ra, dec, r, w, k, flag]).T)
+    cache_dir = os.path.join('output','test_cache')
+    if os.path.exists(cache_dir):
+        shutil.rmtree(cache_dir)
+    config = {'ra_col':1, 'dec_col':2, 'r_col':3, 'w_col':4, 'k_col':5, 'flag_col':6,
+              'ignore_flag':2, 'ra_units':'deg', 'dec_units':'deg'}
+
+    cat1 = treecorr.Catalog(file_name, config)
+    cat2 = treecorr.Catalog(file_name, config, cache_dir=cache_dir)
+    assert cat2 == cat1
+    assert len(os.listdir(cache_dir)) == 1
+
+    # The second time, the arrays are memory mapped from the cache.
+    cat3 = treecorr.Catalog(file_name, config, cache_dir=cache_dir)
+    assert isinstance(cat3.x, np.memmap)
+    assert cat3 == cat1
+    assert cat3.coords == '3d'
+    assert cat3.nobj == cat1.nobj
+    assert cat3.vark == cat1.vark
+    assert cat3.ra_units == cat1.ra_units
+    kk1 = treecorr.KKCorrelation(min_sep=0.1, max_sep=1., nbins=5)
+    kk1.process(cat1)
+    kk3 = treecorr.KKCorrelation(min_sep=0.1, max_sep=1., nbins=5)
+    kk3.process(cat3)
+    np.testing.assert_array_equal(kk3.npairs, kk1.npairs)
+    np.testing.assert_allclose(kk3.xi, kk1.xi)
+
+    # Other parameters are cached separately.
+    cat4 = treecorr.Catalog(file_name, config, cache_dir=cache_dir, flag_col=0)
+    assert len(os.listdir(cache_dir)) == 2
+    cat5 = treecorr.Catalog(file_name, config, cache_dir=cache_dir, flag_col=0)
+    assert isinstance(cat5.w, np.memmap)
+    assert cat5 == cat4
+    assert cat5.nobj == nobj-1
+    cat6 = treecorr.Catalog(file_name, config, cache_dir=cache_dir, first_row=101)
+    assert len(os.listdir(cache_dir)) == 3
+    assert cat6.ntot == nobj-100
+
+    # Parameters that don't change the arrays use the same cache.
+    cat7 = treecorr.Catalog(file_name, config, cache_dir=cache_dir, verbose=0, lazy=True)
+    assert len(os.listdir(cache_dir)) == 3
+    assert isinstance(cat7.k, np.memmap)
+
+    # Changing the file means it needs to be read again.
+    np.savetxt(file_name, np.array([ra, dec, r, w, k, flag]).T[:nobj//2])
+    cat8 = treecorr.Catalog(file_name, config, cache_dir=cache_dir)
+    assert len(os.listdir(cache_dir)) == 4
+    assert cat8.ntot == nobj//2
+
+
+def _process_shared(cat):
+    # Used by test_shared_memory in a multiprocessing pool.
+    kk = treecorr.KKCorrelation(min_sep=1., max_sep=20., nbins=10)
+    kk.process(cat)
+    return kk.xi, kk.npairs, hasattr(cat.field, '_buffer')
+
+def test_shared_memory():
+    # Test putting the catalog arrays and fields in shared memory.
+    try:
+        from multiprocessing import shared_memory
+    except ImportError:
+        print('Skipping shared memory tests, since multiprocessing.shared_memory is not available')
+        return
+    import pickle
+    import multiprocessing
+
+    nobj = 20000
+    rng = np.random.RandomState(8675309)
+    x = rng.uniform(0, 100, (nobj,) )
+    y = rng.uniform(0, 100, (nobj,) )
+    w = rng.random_sample(nobj)
+    k = rng.normal(0,3, (nobj,) )
+    patch = rng.randint(0,4, (nobj,))
+    cat = treecorr.Catalog(x=x, y=y, w=w, k=k, patch=patch, x_units='arcmin', y_units='arcmin')
+    cat1 = cat.copy()
+    xi1, npairs1, _ = _process_shared(cat)
+    size1 = len(pickle.dumps(cat))
+
+    cat.share_memory()
+    assert cat == cat1
+    assert cat.kfields.count == 0
+    assert len(cat._shared_fields) == 1
+    # Calling again does nothing.
+    cat.share_memory()
+    assert len(cat._shared_fields) == 1
+
+    # Pickling only sends the names of the shared memory blocks.
+    s = pickle.dumps(cat)
+    assert len(s) < size1 / 100
+    cat2 = pickle.loads(s)
+    assert cat2 == cat1
+    assert cat2.patch.dtype == cat1.patch.dtype
+
+    # Both catalogs use the same memory.
+    cat.k[0] += 1
+    assert cat2.k[0] == cat.k[0]
+    cat.k[0] -= 1
+
+    # The field is used from shared memory, rather than built again.
+    xi2, npairs2, shared = _process_shared(cat2)
+    assert shared
+    np.testing.assert_array_equal(npairs2, npairs1)
+    np.testing.assert_array_equal(xi2, xi1)
+    xi2, npairs2, shared = _process_shared(cat)
+    assert shared
+    np.testing.assert_array_equal(xi2, xi1)
+
+    # Fields with other parameters are built as usual.
+    kk = treecorr.KKCorrelation(min_sep=2., max_sep=20., nbins=10)
+    kk.process(cat2)
+    assert not hasattr(cat2.field, '_buffer')
+
+    # In other processes.
+    pool = multiprocessing.Pool(2)
+    results = pool.map(_process_shared, [cat, cat2])
+    pool.close()
+    pool.join()
+    for xi, npairs, shared in results:
+        assert shared
+        np.testing.assert_array_equal(npairs, npairs1)
+        np.testing.assert_array_equal(xi, xi1)
+
+    # After closing, the arrays are in regular memory again.
+    name = cat._shm.name
+    cat.close_shared_memory()
+    assert cat._shm is None
+    assert cat == cat1
+    assert len(pickle.dumps(cat)) > size1 / 2
+    with assert_raises(FileNotFoundError):
+        shared_memory.SharedMemory(name=name)
+    xi3, npairs3, shared = _process_shared(cat)
+    assert not shared
+    np.testing.assert_array_equal(xi3, xi1)
+
+    # The other catalog still works until it is closed too.
+    assert cat2 == cat1
+    cat2.close_shared_memory()
+    assert cat2 == cat1
+    cat2.close_shared_memory()  # Does nothing the second time.
+
+
+def test_copy_arrays():
+    # Test that copy_arrays=False uses the input arrays without copying or modifying them.
+    nobj = 5000
+    rng = np.random.RandomState(8675309)
+    x = rng.random_sample(nobj)
+    y = rng.random_sample(nobj)
+    z = rng.random_sample(nobj)
+    ra = rng.random_sample(nobj) * 24.
+    dec = rng.random_sample(nobj) * 180. - 90.
+    w = rng.random_sample(nobj)
+    k = rng.normal(0,3, (nobj,) )
+    flag = rng.randint(0,4, (nobj,))
+    x_orig = x.copy()
+    w_orig = w.copy()
+    ra_orig = ra.copy()
+    dec_orig = dec.copy()
+
+    cat1 = treecorr.Catalog(x=x, y=y, z=z, w=w, k=k, copy_arrays=False)
+    assert cat1.x is x
+    assert cat1.y is y
+    assert cat1.z is z
+    assert cat1.w is w
+    assert cat1.k is k
+    cat2 = treecorr.Catalog(x=x, y=y, z=z, w=w, k=k)
+    assert cat2.x is not x
+    assert cat2 == cat1
+
+    # Non-contiguous or non-float64 inputs are converted.
+    x32 = x.astype(np.float32)
+    cat3 = treecorr.Catalog(x=x32, y=y[::-1], copy_arrays=False)
+    assert cat3.x.dtype == float
+    np.testing.assert_array_equal(cat3.x, x32)
+    assert cat3.y.flags['C_CONTIGUOUS']
+    np.testing.assert_array_equal(cat3.y, y[::-1])
+
+    # Units are applied when the positions are accessed, not to the input arrays.
+    cat4 = treecorr.Catalog(x=x, y=y, w=w, x_units='arcmin', y_units='arcmin',
+                            copy_arrays=False)
+    cat5 = treecorr.Catalog(x=x, y=y, w=w, x_units='arcmin', y_units='arcmin')
+    np.testing.assert_array_equal(x, x_orig)
+    np.testing.assert_allclose(cat4.x, x * (coord.arcmin / coord.radians))
+    np.testing.assert_allclose(cat4.x, cat5.x)
+    np.testing.assert_allclose(cat4.y, cat5.y)
+    cat6 = treecorr.Catalog(ra=ra, dec=dec, w=w, ra_units='hours', dec_units='deg',
+                            copy_arrays=False)
+    cat7 = treecorr.Catalog(ra=ra, dec=dec, w=w, ra_units='hours', dec_units='deg')
+    np.testing.assert_array_equal(ra, ra_orig)
+    np.testing.assert_array_equal(dec, dec_orig)
+    np.testing.assert_allclose(cat6.ra, cat7.ra)
+    np.testing.assert_allclose(cat6.dec, cat7.dec)
+    np.testing.assert_allclose(cat6.x, cat7.x)
+    np.testing.assert_allclose(cat6.z, cat7.z)
+
+    # The fields and correlations are the same either way.
+    field4 = cat4.getNField()
+    field5 = cat5.getNField()
+    assert field4.nTopLevelNodes == field5.nTopLevelNodes
+    nn4 = treecorr.NNCorrelation(min_sep=1., max_sep=20., nbins=10, sep_units='arcmin')
+    nn4.process(cat4)
+    nn5 = treecorr.NNCorrelation(min_sep=1., max_sep=20., nbins=10, sep_units='arcmin')
+    nn5.process(cat5)
+    np.testing.assert_allclose(nn4.npairs, nn5.npairs)
+    np.testing.assert_allclose(nn4.weight, nn5.weight)
+    nn6 = treecorr.NNCorrelation(min_sep=1., max_sep=20., nbins=10, sep_units='arcmin')
+    nn6.process(cat6)
+    nn7 = treecorr.NNCorrelation(min_sep=1., max_sep=20., nbins=10, sep_units='arcmin')
+    nn7.process(cat7)
+    np.testing.assert_allclose(nn6.npairs, nn7.npairs)
+
+    do_pickle(cat4)
+    do_pickle(cat6)
+
+    # Setting some weights to zero doesn't modify the input w.
+    x[10] = np.nan
+    cat8 = treecorr.Catalog(x=x, y=y, w=w, flag=flag, copy_arrays=False)
+    np.testing.assert_array_equal(w, w_orig)
+    assert cat8.w is not w
+    assert cat8.w[10] == 0.
+    np.testing.assert_array_equal(cat8.w[flag!=0], 0.)
+    np.testing.assert_array_equal(cat8.w[(flag==0) & (np.arange(nobj)!=10)],
+                                  w[(flag==0) & (np.arange(nobj)!=10)])
+
+    # first_row, last_row give views.
+    cat9 = treecorr.Catalog(x=x_orig, y=y, w=w, first_row=11, last_row=20, copy_arrays=False)
+    assert cat9.x.base is x_orig
+    np.testing.assert_array_equal(cat9.x, x_orig[10:20])
+
+
+def test_single_precision():
+    # Test that single_precision=True stores the arrays as float32, and that the results
+    # are very close to the double precision ones.
+    nobj = 5000
+    rng = np.random.RandomState(8675309)
+    x = rng.random_sample(nobj) * 100.
+    y = rng.random_sample(nobj) * 100.
+    z = rng.random_sample(nobj) * 100.
+    ra = rng.random_sample(nobj) * 24.
+    dec = rng.random_sample(nobj) * 20. - 10.
+    w = rng.random_sample(nobj) + 0.5
+    g1 = rng.normal(0,0.2, (nobj,) )
+    g2 = rng.normal(0,0.2, (nobj,) )
+    k = rng.normal(0,3, (nobj,) )
+
+    cat1 = treecorr.Catalog(x=x, y=y, z=z, w=w, g1=g1, g2=g2, k=k)
+    cat2 = treecorr.Catalog(x=x, y=y, z=z, w=w, g1=g1, g2=g2, k=k, single_precision=True)
+    for name in ['x', 'y', 'z', 'w', 'g1', 'g2', 'k']:
+        assert getattr(cat2, name).dtype == np.float32
+        assert getattr(cat2, name).nbytes == getattr(cat1, name).nbytes // 2
+        np.testing.assert_allclose(getattr(cat2, name), getattr(cat1, name), rtol=1.e-7)
+    # The summary statistics are accumulated in double precision.
+    assert type(cat2.sumw) == type(cat1.sumw)
+    np.testing.assert_allclose(cat2.sumw, cat1.sumw, rtol=1.e-7)
+    np.testing.assert_allclose(cat2.varg, cat1.varg, rtol=1.e-6)
+    np.testing.assert_allclose(cat2.vark, cat1.vark, rtol=1.e-6)
+
+    # The fields are built in double precision from the float32 arrays.
+    nn1 = treecorr.NNCorrelation(min_sep=1., max_sep=30., nbins=10, bin_slop=0)
+    nn1.process(cat1)
+    nn2 = treecorr.NNCorrelation(min_sep=1., max_sep=30., nbins=10, bin_slop=0)
+    nn2.process(cat2)
+    np.testing.assert_allclose(nn2.npairs, nn1.npairs, rtol=1.e-5)
+    np.testing.assert_allclose(nn2.meanr, nn1.meanr, rtol=1.e-6)
+    gg1 = treecorr.GGCorrelation(min_sep=1., max_sep=30., nbins=10)
+    gg1.process(cat1)
+    gg2 = treecorr.GGCorrelation(min_sep=1., max_sep=30., nbins=10)
+    gg2.process(cat2)
+    np.testing.assert_allclose(gg2.xip, gg1.xip, atol=1.e-7)
+    np.testing.assert_allclose(gg2.xim, gg1.xim, atol=1.e-7)
+
+    # The float32 values are converted to double as the trees are built, so the results are
+    # exactly the same as for a double precision catalog of the rounded values.
+    cat1r = treecorr.Catalog(**dict((name, getattr(cat2, name).astype(float))
+                                    for name in ['x', 'y', 'z', 'w', 'g1', 'g2', 'k']))
+    assert cat1r.x.dtype == np.float64
+    gg1r = treecorr.GGCorrelation(min_sep=1., max_sep=30., nbins=10)
+    gg1r.process(cat1r)
+    np.testing.assert_array_equal(gg2.npairs, gg1r.npairs)
+    np.testing.assert_array_equal(gg2.xip, gg1r.xip)
+    np.testing.assert_array_equal(gg2.xim, gg1r.xim)
+    kk1r = treecorr.KKCorrelation(min_sep=1., max_sep=30., nbins=10)
+    kk1r.process_pairwise(cat1r, cat1r)
+    kk2 = treecorr.KKCorrelation(min_sep=1., max_sep=30., nbins=10)
+    kk2.process_pairwise(cat2, cat2)
+    np.testing.assert_array_equal(kk2.npairs, kk1r.npairs)
+    np.testing.assert_array_equal(kk2.xi, kk1r.xi)
+
+    kk2 =treecorr.KKCorrelation(min_sep=1., max_sep=30., nbins=10)
+    kk2.process(cat2)
+    field = cat2.getKField(min_size=1.)
+    assert field.count_near(x=50., y=50., z=50., sep=20.) > 0
+
+    # Spherical coordinates work too.
+    cat3 = treecorr.Catalog(ra=ra, dec=dec, k=k, ra_units='hours', dec_units='deg')
+    cat4 = treecorr.Catalog(ra=ra, dec=dec, k=k, ra_units='hours', dec_units='deg',
+                            single_precision=True)
+    assert cat4.ra.dtype == cat4.x.dtype == np.float32
+    np.testing.assert_allclose(cat4.x, cat3.x, atol=1.e-6)
+    kk3 = treecorr.KKCorrelation(min_sep=10., max_sep=300., nbins=10, sep_units='arcmin')
+    kk3.process(cat3)
+    kk4 = treecorr.KKCorrelation(min_sep=10., max_sep=300., nbins=10, sep_units='arcmin')
+    kk4.process(cat4)
+    np.testing.assert_allclose(kk4.npairs, kk3.npairs, rtol=1.e-5)
+    np.testing.assert_allclose(kk4.xi, kk3.xi, atol=1.e-5)
+
+    # With copy_arrays=False, float32 inputs are used as is.
+    x32 = x.astype(np.float32)
+    y32 = y.astype(np.float32)
+    cat5 = treecorr.Catalog(x=x32, y=y32, copy_arrays=False, single_precision=True)
+    assert cat5.x is x32
+    assert cat5.y is y32
+    cat6 = treecorr.Catalog(x=x32, y=y32, x_units='arcmin', y_units='arcmin',
+                            copy_arrays=False, single_precision=True)
+    assert cat6.x.dtype == np.float32
+    np.testing.assert_array_equal(x32, x.astype(np.float32))
+    do_pickle(cat2)
+    do_pickle(cat6)
+
+    # Columns read from a file, including lazy ones, are converted as well.
+    file_name = os.path.join('data','test_single_precision.dat')
+    with open(file_name, 'w') as fid:
+        for i in range(nobj):
+            fid.write(('%.8f %.8f %.8f %.8f\n')%(x[i],y[i],w[i],k[i]))
+    config = {'x_col':1, 'y_col':2, 'w_col':3, 'k_col':4}
+    cat7 = treecorr.Catalog(file_name, config, single_precision=True, lazy=True)
+    assert cat7.x.dtype == cat7.w.dtype == np.float32
+    assert 'k' in cat7._lazy_cols
+    assert cat7.k.dtype == np.float32
+    np.testing.assert_allclose(cat7.k, k, atol=1.e-6)
+
+    # The split random catalogs also use single precision.
+    rand = treecorr.Catalog(x=x, y=y, z=z, single_precision=True)
+    dd = treecorr.NNCorrelation(min_sep=1., max_sep=30., nbins=10)
+    dd.process(rand, num_split=2)
+    assert rand._subset(np.arange(10)).x.dtype == np.float32
+
+
 def test_direct():
 
     nobj = 5000
@@ -1184,6 +1928,7 @@ def test_lru():
     assert (0,) not in cache.cache
     assert cache.size == size
     assert cache.count == size
+    assert sorted(cache.items()) == [((i,), f(i)) for i in range(1, size+1)]
 
     # Test non-destructive cache expansion
     newsize = 20
@@ -1242,7 +1987,16 @@ def test_lru():
 
 if __name__ == '__main__':
     test_ascii()
+    test_ascii_parser()
     test_fits()
+    test_read_fits_rows()
+    test_hdf5()
+    test_parquet()
+    test_lazy()
+    test_cache()
+    test_shared_memory()
+    test_copy_arrays()
+    test_single_precision()
     test_direct()
     test_var()
     test_nan()
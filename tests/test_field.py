@@ -0,0 +1,187 @@
+# Copyright (c) 2003-2019 by Mike Jarvis
+#
+# TreeCorr is free software: redistribution and use in source and binary forms,
+# with or without modification, are permitted provided that the following
+# conditions are met:
+#
+# 1. Redistributions of source code must retain the above copyright notice, this
+#    list of conditions, and the disclaimer given in the accompanying LICENSE
+#    file.
+# 2. Redistributions in binary form must reproduce the above copyright notice,
+#    this list of conditions, and the disclaimer given in the documentation
+#    and/or other materials provided with the distribution.
+
+from __future__ import print_function
+import numpy as np
+import os
+import time
+import multiprocessing
+import treecorr
+
+from test_helper import timer
+
+
+@timer
+def test_build_threads(nobj=200000):
+    # Build the same fields with different numbers of threads.
+    # The trees should be identical regardless of the number of threads, and the
+    # times give a benchmark of how the build scales with the number of threads.
+    # Run this file as a script to use a larger catalog.
+    rng = np.random.RandomState(8675309)
+    x = rng.random_sample(nobj)
+    y = rng.random_sample(nobj)
+    z = rng.random_sample(nobj)
+    w = rng.random_sample(nobj)
+    g1 = rng.normal(0,0.2,nobj)
+    g2 = rng.normal(0,0.2,nobj)
+    # Some objects have w = 0, which get skipped when building.
+    w[rng.randint(30, size=nobj) == 0] = 0
+
+    ncpu = multiprocessing.cpu_count()
+    all_nthreads = [1, 2, 4]
+    while all_nthreads[-1] < ncpu:
+        all_nthreads.append(min(2*all_nthreads[-1], ncpu))
+
+    for coords in ['flat', '3d']:
+        if coords == 'flat':
+            cat = treecorr.Catalog(x=x, y=y, w=w, g1=g1, g2=g2)
+            pos = dict(x=0.3, y=0.6)
+        else:
+            cat = treecorr.Catalog(x=x, y=y, z=z, w=w, g1=g1, g2=g2)
+            pos = dict(x=0.3, y=0.6, z=0.5)
+        print(coords,':')
+        print('  nthreads   time')
+        results = []
+        for nthreads in all_nthreads:
+            treecorr.set_omp_threads(nthreads)
+            t0 = time.time()
+            field = treecorr.GField(cat, min_size=0.001, max_size=0.2, max_top=12)
+            t1 = time.time()
+            print('  %5d    %.3f'%(nthreads, t1-t0))
+            results.append((field.nTopLevelNodes, field.nbytes,
+                            field.count_near(sep=0.1, **pos)))
+        print('  results = ',results)
+        for r in results[1:]:
+            assert r == results[0]
+    treecorr.set_omp_threads(None)
+
+    # Check that the resulting correlation function doesn't depend on the number of threads
+    cat = treecorr.Catalog(x=x, y=y, w=w, g1=g1, g2=g2)
+    treecorr.set_omp_threads(1)
+    gg1 = treecorr.GGCorrelation(bin_size=0.2, min_sep=0.01, max_sep=0.1)
+    gg1.process(cat)
+    treecorr.set_omp_threads(4)
+    cat.clear_cache()
+    gg2 = treecorr.GGCorrelation(bin_size=0.2, min_sep=0.01, max_sep=0.1)
+    gg2.process(cat)
+    treecorr.set_omp_threads(None)
+    np.testing.assert_array_equal(gg2.npairs, gg1.npairs)
+    np.testing.assert_allclose(gg2.xip, gg1.xip, rtol=1.e-6, atol=1.e-12)
+
+
+@timer
+def test_save_field():
+    # Test saving a field to a file and loading it back.
+    nobj = 20000
+    rng = np.random.RandomState(8675309)
+    x = rng.random_sample(nobj)
+    y = rng.random_sample(nobj)
+    w = rng.random_sample(nobj)
+    g1 = rng.normal(0,0.2, (nobj,))
+    g2 = rng.normal(0,0.2, (nobj,))
+    k = rng.normal(0,3, (nobj,))
+    patch = rng.randint(0,4, (nobj,))
+    w[:100] = 0
+    cat = treecorr.Catalog(x=x, y=y, w=w, g1=g1, g2=g2, k=k, patch=patch)
+    file_name = os.path.join('output','test_save_field.tree')
+
+    for get_field in [cat.getNField, cat.getKField, cat.getGField]:
+        field1 = get_field(min_size=0.01, max_size=0.2, split_method='median')
+        field1.save(file_name)
+        field2 = cat.load_field(file_name)
+        assert type(field2) == type(field1)
+        assert cat.field is field2
+        for attr in ['min_size', 'max_size', 'split_method', 'brute', 'min_top', 'max_top',
+                     'coords']:
+            assert getattr(field2, attr) == getattr(field1, attr)
+        assert field2.nTopLevelNodes == field1.nTopLevelNodes
+        assert field2.count_near(x=0.5, y=0.5, sep=0.1) == field1.count_near(x=0.5, y=0.5, sep=0.1)
+        np.testing.assert_array_equal(field2.get_near(x=0.5, y=0.5, sep=0.1),
+                                      field1.get_near(x=0.5, y=0.5, sep=0.1))
+        i1, d1 = field1.get_knn(x[:50], y[:50], k=5)
+        i2, d2 = field2.get_knn(x[:50], y[:50], k=5)
+        np.testing.assert_array_equal(i2, i1)
+        np.testing.assert_array_equal(d2, d1)
+
+        # A loaded field can be saved again.
+        field2.save(file_name + '2')
+        with open(file_name, 'rb') as f1, open(file_name + '2', 'rb') as f2:
+            assert f1.read() == f2.read()
+
+    # Spherical coordinates
+    ra = rng.uniform(0, 30, (nobj,))
+    dec = rng.uniform(-10, 10, (nobj,))
+    scat = treecorr.Catalog(ra=ra[:15000], dec=dec[:15000], k=k[:15000],
+                            ra_units='deg', dec_units='deg')
+    field1 = scat.getKField(min_size=0.001, max_size=0.1)
+    field1.save(file_name)
+    field2 = scat.load_field(file_name)
+    assert field2.coords == 'spherical'
+    np.testing.assert_array_equal(field2.get_near(ra=10, dec=0, sep=1, ra_units='deg',
+                                                  dec_units='deg', sep_units='deg'),
+                                  field1.get_near(ra=10, dec=0, sep=1, ra_units='deg',
+                                                  dec_units='deg', sep_units='deg'))
+
+    # Errors
+    cat_file = os.path.join('data','test_save_field.dat')
+    np.savetxt(cat_file, np.array([x, y, w, g1, g2]).T)
+    with np.testing.assert_raises(ValueError):
+        cat.load_field(file_name)  # Wrong catalog
+    with np.testing.assert_raises(ValueError):
+        cat.load_field(cat_file)  # Not a field file
+    with np.testing.assert_raises(IOError):
+        field1.save(os.path.join('output','invalid','test_save_field.tree'))
+    with open(file_name, 'r+b') as f:
+        f.seek(32)  # The size of the Cells.
+        f.write(np.array([1], dtype=np.int64).tobytes())
+    with np.testing.assert_raises(ValueError):
+        scat.load_field(file_name)
+
+    # With cache_fields, the fields are saved along with the catalog cache, and then later
+    # catalogs for the same file use them rather than building the field again.
+    import shutil
+    cache_dir = os.path.join('output','test_save_field')
+    if os.path.exists(cache_dir):
+        shutil.rmtree(cache_dir)
+    config = {'x_col':1, 'y_col':2, 'w_col':3, 'g1_col':4, 'g2_col':5}
+    cat1 = treecorr.Catalog(cat_file, config, cache_dir=cache_dir, cache_fields=True)
+    gg1 = treecorr.GGCorrelation(min_sep=0.01, max_sep=0.2, nbins=10)
+    gg1.process(cat1)
+    entry = os.path.join(cache_dir, os.listdir(cache_dir)[0])
+    tree_files = [f for f in os.listdir(entry) if f.endswith('.tree')]
+    assert len(tree_files) == 1
+    mtime = os.path.getmtime(os.path.join(entry, tree_files[0]))
+
+    cat2 = treecorr.Catalog(cat_file, config, cache_dir=cache_dir, cache_fields=True)
+    gg2 = treecorr.GGCorrelation(min_sep=0.01, max_sep=0.2, nbins=10)
+    gg2.process(cat2)
+    assert [f for f in os.listdir(entry) if f.endswith('.tree')] == tree_files
+    assert os.path.getmtime(os.path.join(entry, tree_files[0])) == mtime
+    np.testing.assert_array_equal(gg2.npairs, gg1.npairs)
+    np.testing.assert_array_equal(gg2.xip, gg1.xip)
+    np.testing.assert_array_equal(gg2.xim, gg1.xim)
+
+    # Different parameters make a different field.
+    gg3 = treecorr.GGCorrelation(min_sep=0.02, max_sep=0.2, nbins=10)
+    gg3.process(cat2)
+    assert len([f for f in os.listdir(entry) if f.endswith('.tree')]) == 2
+
+    # Without cache_fields, no fields are saved.
+    cat3 = treecorr.Catalog(cat_file, config, cache_dir=cache_dir)
+    gg3.process(cat3)
+    assert len([f for f in os.listdir(entry) if f.endswith('.tree')]) == 2
+
+
+if __name__ == '__main__':
+    test_build_threads(nobj=10000000)
+    test_save_field()
@@ -95,6 +95,25 @@ def test_direct():
     np.testing.assert_allclose(gg.xim, true_xim.real, rtol=1.e-4, atol=1.e-8)
     np.testing.assert_allclose(gg.xim_im, true_xim.imag, rtol=1.e-4, atol=1.e-8)
 
+    # Using buckets for the smallest cells should give the same answer.
+    gg_bucket = treecorr.GGCorrelation(min_sep=min_sep, max_sep=max_sep, nbins=nbins, brute=True,
+                                       bucket_size=16)
+    gg_bucket.process(cat1, cat2)
+    np.testing.assert_array_equal(gg_bucket.npairs, true_npairs)
+    np.testing.assert_allclose(gg_bucket.weight, gg.weight, rtol=1.e-10)
+    np.testing.assert_allclose(gg_bucket.xip, gg.xip, rtol=1.e-10, atol=1.e-12)
+    np.testing.assert_allclose(gg_bucket.xip_im, gg.xip_im, rtol=1.e-10, atol=1.e-12)
+    np.testing.assert_allclose(gg_bucket.xim, gg.xim, rtol=1.e-10, atol=1.e-12)
+    np.testing.assert_allclose(gg_bucket.xim_im, gg.xim_im, rtol=1.e-10, atol=1.e-12)
+
+    # Even without brute, all the pairs within the buckets are projected exactly.
+    gg_bucket = treecorr.GGCorrelation(min_sep=min_sep, max_sep=max_sep, nbins=nbins, bin_slop=0,
+                                       max_top=0, bucket_size=ngal)
+    gg_bucket.process(cat1, cat2)
+    np.testing.assert_array_equal(gg_bucket.npairs, true_npairs)
+    np.testing.assert_allclose(gg_bucket.xim, gg.xim, rtol=1.e-10, atol=1.e-12)
+    np.testing.assert_allclose(gg_bucket.xim_im, gg.xim_im, rtol=1.e-10, atol=1.e-12)
+
     try:
         import fitsio
     except ImportError:
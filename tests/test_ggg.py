@@ -293,6 +293,27 @@ def test_direct():
     np.testing.assert_allclose(ggg4.gam3r, ggg.gam3r)
     np.testing.assert_allclose(ggg4.gam3i, ggg.gam3i)
 
+    try:
+        import h5py
+    except ImportError:
+        print('Skipping HDF5 tests, since h5py is not installed')
+    else:
+        hdf_name = 'output/ggg_hdf.hdf5'
+        ggg.write(hdf_name, name='ggg')
+        ggg2.write(hdf_name, name='ggg2')
+        ggg5 = treecorr.GGGCorrelation(min_sep=min_sep, bin_size=bin_size, nbins=nrbins)
+        ggg5.read(hdf_name, name='ggg')
+        np.testing.assert_array_equal(ggg5.ntri, ggg.ntri)
+        np.testing.assert_array_equal(ggg5.weight, ggg.weight)
+        np.testing.assert_array_equal(ggg5.meand1, ggg.meand1)
+        np.testing.assert_array_equal(ggg5.meanu, ggg.meanu)
+        np.testing.assert_array_equal(ggg5.meanv, ggg.meanv)
+        np.testing.assert_array_equal(ggg5.gam0r, ggg.gam0r)
+        np.testing.assert_array_equal(ggg5.gam3i, ggg.gam3i)
+        ggg5.read(hdf_name, name='ggg2')
+        np.testing.assert_array_equal(ggg5.ntri, ggg2.ntri)
+        np.testing.assert_array_equal(ggg5.gam0r, ggg2.gam0r)
+
     with assert_raises(TypeError):
         ggg2 += config
     ggg5 = treecorr.GGGCorrelation(min_sep=min_sep/2, bin_size=bin_size, nbins=nrbins)
@@ -555,7 +555,222 @@ def test_sample_pairs():
 
 
 
+def test_field_nbytes():
+    # The tree is stored in a few contiguous arrays, so the memory should scale linearly
+    # with the number of objects, and be much smaller when min_size > 0.
+    nobj = 100000
+    rng = np.random.RandomState(8675309)
+    x = rng.random_sample(nobj)
+    y = rng.random_sample(nobj)
+    z = rng.random_sample(nobj)
+    w = rng.random_sample(nobj)
+
+    cat = treecorr.Catalog(x=x, y=y, w=w)
+    field1 = cat.getNField()
+    print('nbytes = ',field1.nbytes, field1.nbytes/nobj)
+    assert field1.nbytes > 0
+    # 2N-1 cells plus N indices.
+    assert field1.nbytes < 200 * nobj
+
+    field2 = cat.getNField(min_size=0.01)
+    print('nbytes with min_size = ',field2.nbytes, field2.nbytes/nobj)
+    assert field2.nbytes < field1.nbytes / 5
+
+    # The leaves have multiple objects, which use the shared index array.
+    x0 = 0.5
+    y0 = 0.8
+    sep = 0.05
+    i1 = np.sort(field1.get_near(x=x0, y=y0, sep=sep))
+    i2 = np.sort(field2.get_near(x=x0, y=y0, sep=sep))
+    i3 = np.where((x-x0)**2 + (y-y0)**2 < sep**2)[0]
+    np.testing.assert_array_equal(i1, i3)
+    np.testing.assert_array_equal(i2, i3)
+
+    cat = treecorr.Catalog(x=x, y=y, z=z, k=w, g1=w, g2=w)
+    kfield = cat.getKField()
+    gfield = cat.getGField()
+    print('nbytes k,g = ',kfield.nbytes, gfield.nbytes)
+    assert field1.nbytes < kfield.nbytes < gfield.nbytes
+
+
+def test_near_many():
+    # Test count_near and get_near with arrays of target locations.
+
+    nobj = 100000
+    ntarget = 1000
+    rng = np.random.RandomState(8675309)
+    x = rng.random_sample(nobj)   # All from 0..1
+    y = rng.random_sample(nobj)
+    z = rng.random_sample(nobj)
+    w = rng.random_sample(nobj)
+    use = rng.randint(30, size=nobj).astype(float)
+    w[use == 0] = 0
+
+    x0 = rng.random_sample(ntarget)
+    y0 = rng.random_sample(ntarget)
+    z0 = rng.random_sample(ntarget)
+    sep = rng.uniform(0.01, 0.04, ntarget)
+
+    # Flat coords, with both a single sep and an array of sep values
+    cat = treecorr.Catalog(x=x, y=y, w=w)
+    for min_size in [0, 0.01]:
+        field = cat.getNField(min_size=min_size)
+        for s in [0.03, sep]:
+            s1 = s * np.ones(ntarget)
+            t0 = time.time()
+            counts = field.count_near(x0, y0, s)
+            offsets, ind = field.get_near(x0, y0, s)
+            t1 = time.time()
+            n1 = [field.count_near(x0[i], y0[i], s1[i]) for i in range(ntarget)]
+            i1 = [field.get_near(x0[i], y0[i], s1[i]) for i in range(ntarget)]
+            t2 = time.time()
+            print('min_size = %s: time for arrays = %.3f, one at a time = %.3f'%(
+                  min_size, t1-t0, t2-t1))
+            assert len(offsets) == ntarget+1
+            assert offsets[-1] == len(ind)
+            np.testing.assert_array_equal(counts, n1)
+            np.testing.assert_array_equal(np.diff(offsets), counts)
+            for i in range(ntarget):
+                np.testing.assert_array_equal(ind[offsets[i]:offsets[i+1]], i1[i])
+            # Check a few against brute force
+            for i in range(0, ntarget, 100):
+                near = np.where(((x-x0[i])**2 + (y-y0[i])**2 < s1[i]**2) & (w > 0))[0]
+                np.testing.assert_array_equal(ind[offsets[i]:offsets[i+1]], near)
+
+    # 3D coords, specified with ra, dec, r arrays
+    r = np.sqrt(x*x+y*y+z*z)
+    dec = np.arcsin(z/r) * coord.radians / coord.degrees
+    ra = np.arctan2(y,x) * coord.radians / coord.degrees
+    r0 = np.sqrt(x0*x0+y0*y0+z0*z0)
+    dec0 = np.arcsin(z0/r0) * coord.radians / coord.degrees
+    ra0 = np.arctan2(y0,x0) * coord.radians / coord.degrees
+    cat = treecorr.Catalog(ra=ra, dec=dec, r=r, ra_units='deg', dec_units='deg', w=w, k=w)
+    field = cat.getKField(min_size=0.005)
+    counts = field.count_near(x0, y0, z0, sep=sep)
+    offsets, ind = field.get_near(ra=ra0, dec=dec0, r=r0, sep=sep, ra_units='deg',
+                                  dec_units='deg')
+    np.testing.assert_array_equal(np.diff(offsets), counts)
+    for i in range(0, ntarget, 100):
+        near = np.where(((x-x0[i])**2 + (y-y0[i])**2 + (z-z0[i])**2 < sep[i]**2) & (w > 0))[0]
+        np.testing.assert_array_equal(ind[offsets[i]:offsets[i+1]], near)
+        np.testing.assert_array_equal(field.get_near(x0[i], y0[i], z0[i], sep=sep[i]), near)
+
+    # Spherical coords
+    cat = treecorr.Catalog(ra=ra, dec=dec, ra_units='deg', dec_units='deg', w=w, g1=w, g2=w)
+    field = cat.getGField(min_size=0.1 * coord.degrees / coord.radians)
+    sep_deg = 2.
+    offsets, ind = field.get_near(ra0, dec0, sep_deg, ra_units='deg', dec_units='deg',
+                                  sep_units='deg')
+    counts = field.count_near(ra=ra0, dec=dec0, sep=sep_deg, ra_units='deg', dec_units='deg',
+                              sep_units='deg')
+    np.testing.assert_array_equal(np.diff(offsets), counts)
+    for i in range(0, ntarget, 100):
+        c0 = coord.CelestialCoord(ra0[i] * coord.degrees, dec0[i] * coord.degrees)
+        i1 = field.get_near(c0, sep=sep_deg * coord.degrees)
+        np.testing.assert_array_equal(ind[offsets[i]:offsets[i+1]], i1)
+        assert counts[i] == field.count_near(c0, sep_deg * coord.degrees)
+
+    # Arrays that don't match are invalid.
+    assert_raises(ValueError, field.get_near, ra0, dec0[:10], sep_deg, ra_units='deg',
+                  dec_units='deg', sep_units='deg')
+
+def test_knn():
+    # Test get_knn against brute force nearest neighbors.
+
+    nobj = 100000
+    ntarget = 1000
+    k = 8
+    rng = np.random.RandomState(8675309)
+    x = rng.random_sample(nobj)   # All from 0..1
+    y = rng.random_sample(nobj)
+    z = rng.random_sample(nobj)
+    w = rng.random_sample(nobj)
+    use = rng.randint(30, size=nobj).astype(float)
+    w[use == 0] = 0
+    good = w > 0
+
+    x0 = rng.random_sample(ntarget)
+    y0 = rng.random_sample(ntarget)
+    z0 = rng.random_sample(ntarget)
+
+    def brute_knn(dsq):
+        dsq = np.where(good, dsq, np.inf)
+        ind = np.argsort(dsq)[:k]
+        return ind, np.sqrt(dsq[ind])
+
+    # Flat coords
+    cat = treecorr.Catalog(x=x, y=y, w=w)
+    for min_size in [0, 0.01]:
+        field = cat.getNField(min_size=min_size)
+        t0 = time.time()
+        ind, dist = field.get_knn(x0, y0, k=k)
+        t1 = time.time()
+        print('min_size = %s: time for knn = %.3f'%(min_size, t1-t0))
+        assert ind.shape == (ntarget, k)
+        assert dist.shape == (ntarget, k)
+        assert np.all(np.diff(dist, axis=1) >= 0)
+        for i in range(0, ntarget, 50):
+            i1, d1 = brute_knn((x-x0[i])**2 + (y-y0[i])**2)
+            np.testing.assert_array_equal(ind[i], i1)
+            np.testing.assert_allclose(dist[i], d1, rtol=1.e-10)
+            i2, d2 = field.get_knn(x0[i], y0[i], k)
+            np.testing.assert_array_equal(i2, i1)
+            np.testing.assert_allclose(d2, d1, rtol=1.e-10)
+
+    # 3D coords, specified with ra, dec, r arrays
+    r = np.sqrt(x*x+y*y+z*z)
+    dec = np.arcsin(z/r) * coord.radians / coord.degrees
+    ra = np.arctan2(y,x) * coord.radians / coord.degrees
+    r0 = np.sqrt(x0*x0+y0*y0+z0*z0)
+    dec0 = np.arcsin(z0/r0) * coord.radians / coord.degrees
+    ra0 = np.arctan2(y0,x0) * coord.radians / coord.degrees
+    cat = treecorr.Catalog(ra=ra, dec=dec, r=r, ra_units='deg', dec_units='deg', w=w, k=w)
+    field = cat.getKField(min_size=0.005)
+    ind, dist = field.get_knn(ra=ra0, dec=dec0, r=r0, k=k, ra_units='deg', dec_units='deg')
+    for i in range(0, ntarget, 50):
+        i1, d1 = brute_knn((x-x0[i])**2 + (y-y0[i])**2 + (z-z0[i])**2)
+        np.testing.assert_array_equal(ind[i], i1)
+        np.testing.assert_allclose(dist[i], d1, rtol=1.e-8)
+        i2, d2 = field.get_knn(x0[i], y0[i], z0[i], k=k)
+        np.testing.assert_array_equal(i2, i1)
+
+    # Spherical coords.  Distances are great circle distances.
+    cat = treecorr.Catalog(ra=ra, dec=dec, ra_units='deg', dec_units='deg', w=w, g1=w, g2=w)
+    field = cat.getGField(min_size=0.1 * coord.degrees / coord.radians)
+    ind, dist = field.get_knn(ra0, dec0, k, ra_units='deg', dec_units='deg', sep_units='arcmin')
+    for i in range(0, ntarget, 50):
+        c0 = coord.CelestialCoord(ra0[i] * coord.degrees, dec0[i] * coord.degrees)
+        cx, cy, cz = c0.get_xyz()
+        i1, d1 = brute_knn((cat.x-cx)**2 + (cat.y-cy)**2 + (cat.z-cz)**2)
+        np.testing.assert_array_equal(ind[i], i1)
+        arc = [c0.distanceTo(coord.CelestialCoord(ra[j] * coord.degrees,
+                                                  dec[j] * coord.degrees)).deg * 60 for j in i1]
+        np.testing.assert_allclose(dist[i], arc, rtol=1.e-6)
+        i2, d2 = field.get_knn(c0, k=k)
+        np.testing.assert_array_equal(i2, i1)
+        np.testing.assert_allclose(d2, dist[i] * (coord.arcmin / coord.radians), rtol=1.e-10)
+
+    # If k is more than the number of points, the extras are -1 and inf.
+    cat = treecorr.Catalog(x=x[:5], y=y[:5], w=np.ones(5))
+    field = cat.getNField()
+    ind, dist = field.get_knn(0.5, 0.5, k=k)
+    np.testing.assert_array_equal(np.sort(ind[:5]), np.arange(5))
+    np.testing.assert_array_equal(ind[5:], -1)
+    assert np.all(np.isinf(dist[5:]))
+
+    # Invalid arguments
+    assert_raises(ValueError, field.get_knn, 0.5, 0.5, k=0)
+    assert_raises(ValueError, field.get_knn, 0.5, 0.5, k=1.5)
+    assert_raises(TypeError, field.get_knn, 0.5, 0.5)
+    assert_raises(TypeError, field.get_knn, 0.5, 0.5, k=2, sep_units='deg')
+    assert_raises(TypeError, field.get_knn, 0.5, 0.5, k=2, invalid=True)
+    assert_raises(ValueError, field.get_knn, x0, y0[:10], k=2)
+
+
 if __name__ == '__main__':
     test_count_near()
     test_get_near()
+    test_near_many()
+    test_knn()
     test_sample_pairs()
+    test_field_nbytes()
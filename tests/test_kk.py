@@ -157,6 +157,64 @@ def test_direct():
     with assert_raises(ValueError):
         kk2 += kk6
 
+    try:
+        import h5py
+    except ImportError:
+        print('Skipping HDF5 tests, since h5py is not installed')
+        return
+
+    hdf_name = 'output/kk_hdf.hdf5'
+    kk.write(hdf_name)
+    kk7 = treecorr.KKCorrelation(min_sep=min_sep, max_sep=max_sep, nbins=nbins)
+    kk7.read(hdf_name)
+    np.testing.assert_array_equal(kk7.npairs, kk.npairs)
+    np.testing.assert_array_equal(kk7.weight, kk.weight)
+    np.testing.assert_array_equal(kk7.meanr, kk.meanr)
+    np.testing.assert_array_equal(kk7.meanlogr, kk.meanlogr)
+    np.testing.assert_array_equal(kk7.xi, kk.xi)
+    assert kk7.coords == kk.coords
+    assert kk7.metric == kk.metric
+    assert kk7.sep_units == kk.sep_units
+    assert kk7.bin_type == kk.bin_type
+    # Each parameter is written as its own attribute.
+    with h5py.File(hdf_name, 'r') as fid:
+        assert fid.attrs['coords'] == kk.coords
+        assert fid.attrs['bin_type'] == kk.bin_type
+
+    # Several results can be written to the same file with different names.
+    kk8 = kk.copy()
+    kk8 += kk
+    kk.write(hdf_name, name='kk')
+    kk8.write(hdf_name, name='kk8')
+    kk9 = treecorr.KKCorrelation(min_sep=min_sep, max_sep=max_sep, nbins=nbins)
+    kk9.read(hdf_name, name='kk8')
+    np.testing.assert_array_equal(kk9.npairs, kk8.npairs)
+    np.testing.assert_array_equal(kk9.xi, kk8.xi)
+    kk9.read(hdf_name, name='kk')
+    np.testing.assert_array_equal(kk9.npairs, kk.npairs)
+    np.testing.assert_array_equal(kk9.xi, kk.xi)
+    kk9.read(hdf_name)
+    np.testing.assert_array_equal(kk9.npairs, kk.npairs)
+    # Writing the same name again replaces that result.
+    kk8.write(hdf_name, name='kk')
+    kk9.read(hdf_name, name='kk')
+    np.testing.assert_array_equal(kk9.npairs, kk8.npairs)
+    with assert_raises(ValueError):
+        kk9.read(hdf_name, name='invalid')
+    # Without a name, the file is overwritten.
+    kk.write(hdf_name)
+    with assert_raises(ValueError):
+        kk9.read(hdf_name, name='kk8')
+
+    # corr2 writes the result in a group named kk.
+    config['kk_file_name'] = 'output/kk_direct.hdf5'
+    treecorr.corr2(config)
+    kk10 = treecorr.KKCorrelation(min_sep=min_sep, max_sep=max_sep, nbins=nbins)
+    kk10.read(config['kk_file_name'], name='kk')
+    np.testing.assert_allclose(kk10.npairs, kk.npairs)
+    np.testing.assert_allclose(kk10.weight, kk.weight)
+    np.testing.assert_allclose(kk10.xi, kk.xi, rtol=1.e-3)
+
 
 def test_direct_spherical():
     # Repeat in spherical coords
@@ -602,6 +660,107 @@ def test_varxi():
     print('max relerr for xi = ',np.max(np.abs((var_xi - mean_varxi)/var_xi)))
     np.testing.assert_allclose(mean_varxi, var_xi, rtol=0.02 * tol_factor)
 
+def test_tasks():
+    # Test that using OpenMP tasks for the large pairs of cells gives the same answer.
+
+    ngal = 5000
+    L = 100.
+    rng = np.random.RandomState(8675309)
+    x1 = rng.uniform(0, L, ngal)
+    y1 = rng.uniform(0, L, ngal)
+    k1 = rng.normal(0, 0.2, ngal)
+    x2 = rng.uniform(0, L, ngal//10)
+    y2 = rng.uniform(0, L, ngal//10)
+    k2 = rng.normal(0, 0.2, ngal//10)
+    patch1 = (x1 // (L/3)).astype(int) * 3 + (y1 // (L/3)).astype(int)
+    patch2 = (x2 // (L/3)).astype(int) * 3 + (y2 // (L/3)).astype(int)
+
+    cat1 = treecorr.Catalog(x=x1, y=y1, k=k1)
+    cat2 = treecorr.Catalog(x=x2, y=y2, k=k2)
+    pcat1 = treecorr.Catalog(x=x1, y=y1, k=k1, patch=patch1)
+    pcat2 = treecorr.Catalog(x=x2, y=y2, k=k2, patch=patch2)
+
+    # Use more threads than cores if necessary, so the tasks really run on different threads.
+    # max_top=0 puts all the work in a single top-level cell, which is the case tasks are for.
+    for max_top in [10, 0]:
+        config = dict(min_sep=1., max_sep=30., nbins=10, bin_slop=0.5, max_top=max_top,
+                      num_threads=4)
+        for c1, c2 in [(cat1, None), (cat1, cat2), (pcat1, None), (pcat1, pcat2)]:
+            kk0 = treecorr.KKCorrelation(config)
+            kk1 = treecorr.KKCorrelation(config, min_task_pairs=100)
+            kk0.process(c1, c2)
+            kk1.process(c1, c2)
+            print('max_top = %d, npairs = %s'%(max_top, kk1.npairs))
+            np.testing.assert_array_equal(kk1.npairs, kk0.npairs)
+            np.testing.assert_allclose(kk1.weight, kk0.weight, rtol=1.e-10)
+            np.testing.assert_allclose(kk1.xi, kk0.xi, rtol=1.e-10, atol=1.e-14)
+            np.testing.assert_allclose(kk1.meanr, kk0.meanr, rtol=1.e-10)
+            assert sorted(kk1.results.keys()) == sorted(kk0.results.keys())
+            for key in kk0.results:
+                np.testing.assert_allclose(kk1.results[key], kk0.results[key],
+                                           rtol=1.e-10, atol=1.e-14)
+
+    assert_raises(ValueError, treecorr.KKCorrelation, min_sep=1., max_sep=30., nbins=10,
+                  min_task_pairs='invalid')
+
+
+def test_thread_memory():
+    # Each thread that has any work to do accumulates into its own copy of the results,
+    # which are added together at the end.  Check that this gives the same answer as a
+    # single thread, and that the memory used for the copies is reported in the log.
+    ngal = 5000
+    L = 100.
+    rng = np.random.RandomState(8675309)
+    x = rng.uniform(0, L, ngal)
+    y = rng.uniform(0, L, ngal)
+    k = rng.normal(0, 0.2, ngal)
+    patch = (x // (L/3)).astype(int) * 3 + (y // (L/3)).astype(int)
+    cat = treecorr.Catalog(x=x, y=y, k=k)
+    pcat = treecorr.Catalog(x=x, y=y, k=k, patch=patch)
+
+    config = dict(bin_type='TwoD', max_sep=20., nbins=41, bin_slop=0.5)
+    kk1 = treecorr.KKCorrelation(config, num_threads=1)
+    kk1.process(cat)
+    # Use more threads than cores if necessary, so there really are multiple copies.
+    with CaptureLog() as cl:
+        kk4 = treecorr.KKCorrelation(config, num_threads=4, logger=cl.logger)
+        kk4.process(cat)
+    print(cl.output)
+    np.testing.assert_array_equal(kk4.npairs, kk1.npairs)
+    np.testing.assert_allclose(kk4.weight, kk1.weight, rtol=1.e-10)
+    np.testing.assert_allclose(kk4.xi, kk1.xi, rtol=1.e-10, atol=1.e-14)
+    # Each copy has 5 arrays: xi, meanr, meanlogr, weight, npairs.
+    assert "Per-thread accumulators used" in cl.output
+    mb = float(cl.output.split("Per-thread accumulators used ")[1].split(" MB")[0])
+    assert mb <= 4 * 5 * 41**2 * 8 / 2**20 + 0.05
+
+    # With one thread, there are no copies.
+    with CaptureLog() as cl:
+        kk1 = treecorr.KKCorrelation(config, num_threads=1, logger=cl.logger)
+        kk1.process(cat)
+    assert "Per-thread accumulators used 0.0 MB" in cl.output
+
+    # With patches, the results are accumulated separately for each pair of patches, so the
+    # threads don't need their own copies.  Instead, each thread has a copy for each pair of
+    # patches that it found any pairs for.  With one thread, that is one copy per result.
+    copy_mb = 5 * 41**2 * 8 / 2**20
+    with CaptureLog() as cl:
+        kkp1 = treecorr.KKCorrelation(config, num_threads=1, logger=cl.logger)
+        kkp1.process(pcat)
+    mb = float(cl.output.split("Per-thread accumulators used ")[1].split(" MB")[0])
+    assert abs(mb - len(kkp1.results) * copy_mb) <= 0.05
+    with CaptureLog() as cl:
+        kkp4 = treecorr.KKCorrelation(config, num_threads=4, logger=cl.logger)
+        kkp4.process(pcat)
+    mb = float(cl.output.split("Per-thread accumulators used ")[1].split(" MB")[0])
+    # With more threads, some pairs of patches are split among several threads.
+    assert len(kkp4.results) * copy_mb - 0.05 <= mb <= 4 * len(kkp4.results) * copy_mb + 0.05
+    np.testing.assert_array_equal(kkp4.npairs, kkp1.npairs)
+    np.testing.assert_allclose(kkp4.xi, kkp1.xi, rtol=1.e-10, atol=1.e-14)
+    assert sorted(kkp4.results.keys()) == sorted(kkp1.results.keys())
+    for key in kkp1.results:
+        np.testing.assert_allclose(kkp4.results[key], kkp1.results[key], rtol=1.e-10, atol=1.e-14)
+    np.testing.assert_allclose(sum(kkp4.results.values())[7], kkp4.npairs.ravel())
 
 
 if __name__ == '__main__':
@@ -612,3 +771,5 @@ if __name__ == '__main__':
     test_kk()
     test_large_scale()
     test_varxi()
+    test_tasks()
+    test_thread_memory()
@@ -555,8 +555,37 @@ def test_kkk():
     assert kkk2.sep_units == kkk.sep_units
     assert kkk2.bin_type == kkk.bin_type
 
+def test_thread_memory():
+    # Check that using multiple threads, which each accumulate into their own copy of the
+    # results, gives the same answer as a single thread.
+    ngal = 2000
+    L = 100.
+    rng = np.random.RandomState(8675309)
+    x = rng.uniform(0, L, ngal)
+    y = rng.uniform(0, L, ngal)
+    k = rng.normal(0, 0.2, ngal)
+    cat = treecorr.Catalog(x=x, y=y, k=k)
+
+    config = dict(min_sep=1., max_sep=10., nbins=5, nubins=5, nvbins=5, bin_slop=0.5)
+    kkk1 = treecorr.KKKCorrelation(config, num_threads=1)
+    kkk1.process(cat)
+    kkk4 = treecorr.KKKCorrelation(config, num_threads=4)
+    kkk4.process(cat)
+    print('ntri = ',kkk4.ntri)
+    assert np.sum(kkk4.ntri) > 0
+    np.testing.assert_array_equal(kkk4.ntri, kkk1.ntri)
+    np.testing.assert_allclose(kkk4.weight, kkk1.weight, rtol=1.e-10)
+    np.testing.assert_allclose(kkk4.zeta, kkk1.zeta, rtol=1.e-10, atol=1.e-14)
+    np.testing.assert_allclose(kkk4.meand1, kkk1.meand1, rtol=1.e-10)
+
+    kkk1.process(cat, cat, cat)
+    kkk4.process(cat, cat, cat)
+    np.testing.assert_array_equal(kkk4.ntri, kkk1.ntri)
+    np.testing.assert_allclose(kkk4.zeta, kkk1.zeta, rtol=1.e-10, atol=1.e-14)
+
 if __name__ == '__main__':
     test_direct()
     test_direct_spherical()
     test_constant()
     test_kkk()
+    test_thread_memory()
@@ -2207,6 +2207,352 @@ def test_linear_binslop():
             np.testing.assert_allclose(dd1.npairs, dd0.npairs, rtol=bin_slop)
 
 
+def test_split_randoms():
+    # Check the split-random version of RR, where the pairs are only counted within
+    # random sub-catalogs.
+    ngal = 2000
+    nrand = 20000
+    L = 100.
+    rng = np.random.RandomState(8675309)
+    x = rng.uniform(0,L,ngal)
+    y = rng.uniform(0,L,ngal)
+    rx = rng.uniform(0,L,nrand)
+    ry = rng.uniform(0,L,nrand)
+    rw = rng.uniform(0.5,1.5,nrand)
+    cat = treecorr.Catalog(x=x, y=y)
+    rand = treecorr.Catalog(x=rx, y=ry, w=rw)
+
+    config = dict(min_sep=1., max_sep=20., nbins=10)
+    dd = treecorr.NNCorrelation(config)
+    dd.process(cat)
+    dr = treecorr.NNCorrelation(config)
+    dr.process(cat, rand)
+    rr = treecorr.NNCorrelation(config)
+    rr.process(rand)
+    xi, varxi = dd.calculateXi(rr, dr)
+
+    nsplit = 8
+    rr_split = treecorr.NNCorrelation(config)
+    rr_split.process(rand, num_split=nsplit, rng=np.random.RandomState(1234))
+    print('rr.npairs = ',rr.npairs)
+    print('rr_split.npairs = ',rr_split.npairs)
+    print('ratio = ',rr.npairs / rr_split.npairs)
+
+    # This should be the same as processing the sub-catalogs directly.
+    index = np.random.RandomState(1234).permutation(nrand)
+    rr_manual = treecorr.NNCorrelation(config)
+    tot = 0.
+    for i in range(nsplit):
+        k = np.sort(index[i::nsplit])
+        sub = treecorr.Catalog(x=rx[k], y=ry[k], w=rw[k])
+        rr_manual.process_auto(sub)
+        tot += 0.5 * np.sum(rw[k])**2
+    rr_manual.finalize()
+    np.testing.assert_allclose(rr_split.npairs, rr_manual.npairs)
+    np.testing.assert_allclose(rr_split.weight, rr_manual.weight)
+    np.testing.assert_allclose(rr_split.tot, tot)
+    # About 1/nsplit of the pairs are used.
+    np.testing.assert_allclose(rr.npairs / rr_split.npairs, nsplit, rtol=0.1)
+
+    # The normalization is handled by tot, so xi is nearly the same.
+    xi_split, varxi_split = dd.calculateXi(rr_split, dr)
+    print('xi = ',xi)
+    print('xi_split = ',xi_split)
+    np.testing.assert_array_less(np.abs(xi_split - xi), 3*np.sqrt(varxi))
+
+    # Cross-correlations use sub-catalog i of rand1 with sub-catalog i of rand2.
+    rand2 = treecorr.Catalog(x=rx[::-1], y=ry[::-1])
+    rr_cross = treecorr.NNCorrelation(config)
+    rr_cross.process(rand, rand2, num_split=nsplit, rng=np.random.RandomState(1234))
+    rr_full = treecorr.NNCorrelation(config)
+    rr_full.process(rand, rand2)
+    np.testing.assert_allclose(rr_full.npairs / rr_cross.npairs, nsplit, rtol=0.1)
+    np.testing.assert_allclose(rr_full.tot / rr_cross.tot, nsplit, rtol=0.1)
+
+    # Check the corr2 version.
+    file_name = os.path.join('data','nn_split_data.dat')
+    rand_file_name = os.path.join('data','nn_split_rand.dat')
+    np.savetxt(file_name, np.column_stack((x, y, np.ones(ngal))))
+    np.savetxt(rand_file_name, np.column_stack((rx, ry, rw)))
+    out_file_name = os.path.join('output','nn_split.out')
+    corr2_config = dict(config, file_name=file_name, rand_file_name=rand_file_name,
+                        x_col=1, y_col=2, w_col=3, nn_file_name=out_file_name,
+                        rr_split=nsplit, verbose=0)
+    treecorr.corr2(corr2_config)
+    corr2_output = np.genfromtxt(out_file_name, names=True, skip_header=1)
+    print('xi from corr2 = ',corr2_output['xi'])
+    np.testing.assert_array_less(np.abs(corr2_output['xi'] - xi), 3*np.sqrt(varxi))
+    np.testing.assert_allclose(corr2_output['RR'] / rr.weight, (dd.tot/rr.tot), rtol=0.1)
+
+    # Spherical catalogs can be split (and diluted) too.
+    rra = rng.uniform(0, 20, nrand)
+    rdec = rng.uniform(-10, 10, nrand)
+    srand = treecorr.Catalog(ra=rra, dec=rdec, w=rw, ra_units='deg', dec_units='deg')
+    sconfig = dict(min_sep=10., max_sep=200., nbins=10, sep_units='arcmin')
+    srr_split = treecorr.NNCorrelation(sconfig)
+    srr_split.process(srand, num_split=nsplit, rng=np.random.RandomState(1234))
+    srr_manual = treecorr.NNCorrelation(sconfig)
+    for i in range(nsplit):
+        k = np.sort(index[i::nsplit])
+        sub = treecorr.Catalog(ra=rra[k], dec=rdec[k], w=rw[k], ra_units='deg', dec_units='deg')
+        srr_manual.process_auto(sub)
+    srr_manual.finalize()
+    np.testing.assert_allclose(srr_split.npairs, srr_manual.npairs)
+    np.testing.assert_allclose(srr_split.weight, srr_manual.weight)
+    np.testing.assert_allclose(srr_split.tot, tot)
+    # With dilute_fraction=1, the diluted catalog is the whole catalog.
+    srr = treecorr.NNCorrelation(sconfig)
+    srr.process(srand)
+    srr_dil = treecorr.NNCorrelation(sconfig)
+    srr_dil.process(srand, dilute_scale=50., dilute_fraction=1.)
+    np.testing.assert_array_equal(srr_dil.npairs, srr.npairs)
+    np.testing.assert_array_equal(srr_dil.weight, srr.weight)
+
+    srand_file_name = os.path.join('data','nn_split_srand.dat')
+    np.savetxt(srand_file_name, np.column_stack((rra, rdec, rw)))
+    corr2_config = dict(sconfig, file_name=srand_file_name, ra_col=1, dec_col=2, w_col=3,
+                        ra_units='deg', dec_units='deg', rand_file_name=srand_file_name,
+                        nn_file_name=out_file_name, rr_split=nsplit, verbose=0)
+    treecorr.corr2(corr2_config)
+    corr2_output = np.genfromtxt(out_file_name, names=True, skip_header=1)
+    np.testing.assert_allclose(corr2_output['RR'], srr.weight, rtol=0.2)
+
+    assert_raises(ValueError, rr.process, rand, num_split=0)
+    small = treecorr.Catalog(x=rx[:5], y=ry[:5])
+    assert_raises(ValueError, rr.process, small, num_split=10)
+
+
+def test_dilute_randoms():
+    # Check using diluted random catalogs for the larger bins.
+    ngal = 2000
+    nrand = 20000
+    L = 100.
+    rng = np.random.RandomState(8675309)
+    x = rng.uniform(0,L,ngal)
+    y = rng.uniform(0,L,ngal)
+    rx = rng.uniform(0,L,nrand)
+    ry = rng.uniform(0,L,nrand)
+    cat = treecorr.Catalog(x=x, y=y)
+    rand = treecorr.Catalog(x=rx, y=ry)
+
+    config = dict(min_sep=0.5, max_sep=40., nbins=20)
+    dd = treecorr.NNCorrelation(config)
+    dd.process(cat)
+    dr = treecorr.NNCorrelation(config)
+    dr.process(cat, rand)
+    rr = treecorr.NNCorrelation(config)
+    rr.process(rand)
+    assert rr.dilution is None
+    xi, varxi = dd.calculateXi(rr, dr)
+
+    scale = 5.
+    f = 0.5
+    k = np.sum(rr.left_edges < scale)
+    print('k = ',k)
+    rr_dil = treecorr.NNCorrelation(config)
+    rr_dil.process(rand, dilute_scale=scale, dilute_fraction=f, rng=np.random.RandomState(123))
+    print('rr.npairs = ',rr.npairs)
+    print('rr_dil.npairs = ',rr_dil.npairs)
+    print('dilution = ',rr_dil.dilution)
+
+    # The small scales use the full catalogs with the same binning, so they are identical.
+    np.testing.assert_array_equal(rr_dil.npairs[:k], rr.npairs[:k])
+    np.testing.assert_array_equal(rr_dil.weight[:k], rr.weight[:k])
+    np.testing.assert_array_equal(rr_dil.meanr[:k], rr.meanr[:k])
+    np.testing.assert_array_equal(rr_dil.dilution[:k], 1.)
+    assert rr_dil.tot == rr.tot
+    # The large scales are scaled up to match.
+    np.testing.assert_allclose(rr_dil.dilution[k:], f**2, rtol=0.05)
+    np.testing.assert_allclose(rr_dil.weight[k:], rr.weight[k:], rtol=0.03)
+    np.testing.assert_allclose(rr_dil.meanr[k:], rr.meanr[k:], rtol=1.e-2)
+
+    # The pass over the full catalogs stops at the start of bin k, so it doesn't do any of
+    # the work for the diluted bins.  Catch the inner NNCorrelations to check this.
+    passes = []
+    orig_process_auto = treecorr.NNCorrelation.process_auto
+    def process_auto(nn, *args, **kwargs):
+        passes.append(nn)
+        orig_process_auto(nn, *args, **kwargs)
+    treecorr.NNCorrelation.process_auto = process_auto
+    try:
+        rr_dil2 = treecorr.NNCorrelation(config)
+        rr_dil2.process(rand, dilute_scale=scale, dilute_fraction=f,
+                        rng=np.random.RandomState(123))
+    finally:
+        treecorr.NNCorrelation.process_auto = orig_process_auto
+    assert len(passes) == 2
+    full, diluted = passes
+    assert full.nbins == diluted.nbins == rr.nbins
+    np.testing.assert_array_equal(full.npairs[:k], rr.npairs[:k])
+    np.testing.assert_array_equal(full.npairs[k:], 0.)
+    assert np.all(diluted.npairs[k:] > 0)
+    np.testing.assert_array_equal(rr_dil2.npairs, rr_dil.npairs)
+
+    # For DR, only dilute the randoms.
+    dr_dil = treecorr.NNCorrelation(config)
+    dr_dil.process(cat, rand, dilute=2, dilute_scale=scale, dilute_fraction=f,
+                   rng=np.random.RandomState(234))
+    np.testing.assert_array_equal(dr_dil.npairs[:k], dr.npairs[:k])
+    np.testing.assert_allclose(dr_dil.dilution[k:], f, rtol=0.05)
+    np.testing.assert_allclose(dr_dil.weight[k:], dr.weight[k:], rtol=0.03)
+
+    xi_dil, varxi_dil = dd.calculateXi(rr_dil, dr_dil)
+    print('xi = ',xi)
+    print('xi_dil = ',xi_dil)
+    # The diluted bins have extra noise from the dilution, which is a few percent here.
+    np.testing.assert_allclose(xi_dil[:k], xi[:k], atol=0.005)
+    np.testing.assert_allclose(xi_dil[k:], xi[k:], atol=0.03)
+
+    # Check the corr2 version.
+    file_name = os.path.join('data','nn_dilute_data.dat')
+    rand_file_name = os.path.join('data','nn_dilute_rand.dat')
+    np.savetxt(file_name, np.column_stack((x, y)))
+    np.savetxt(rand_file_name, np.column_stack((rx, ry)))
+    out_file_name = os.path.join('output','nn_dilute.out')
+    corr2_config = dict(config, file_name=file_name, rand_file_name=rand_file_name,
+                        x_col=1, y_col=2, nn_file_name=out_file_name,
+                        rand_dilute_scale=scale, rand_dilute_fraction=f, verbose=0)
+    treecorr.corr2(corr2_config)
+    corr2_output = np.genfromtxt(out_file_name, names=True, skip_header=1)
+    print('xi from corr2 = ',corr2_output['xi'])
+    np.testing.assert_allclose(corr2_output['xi'][:k], xi[:k], atol=0.005)
+    np.testing.assert_allclose(corr2_output['xi'][k:], xi[k:], atol=0.03)
+    np.testing.assert_allclose(corr2_output['RR_frac'][:k], 1.)
+    np.testing.assert_allclose(corr2_output['RR_frac'][k:], f**2, rtol=0.05)
+    np.testing.assert_allclose(corr2_output['DR_frac'][k:], f, rtol=0.05)
+
+    # All bins diluted, or none.
+    rr_all = treecorr.NNCorrelation(config)
+    rr_all.process(rand, dilute_scale=0.1, dilute_fraction=f)
+    np.testing.assert_allclose(rr_all.dilution, f**2, rtol=0.05)
+    assert rr_all.tot == rr.tot
+    # With dilute_fraction=1, the "diluted" bins should be exactly the undiluted ones.
+    rr_one = treecorr.NNCorrelation(config)
+    rr_one.process(rand, dilute_scale=scale, dilute_fraction=1.)
+    np.testing.assert_array_equal(rr_one.npairs, rr.npairs)
+    np.testing.assert_array_equal(rr_one.dilution, 1.)
+    dr_one = treecorr.NNCorrelation(config)
+    dr_one.process(cat, rand, dilute=2, dilute_scale=scale, dilute_fraction=1.)
+    np.testing.assert_array_equal(dr_one.npairs, dr.npairs)
+    rr_one.process(rand, dilute_scale=0.1, dilute_fraction=1.)
+    np.testing.assert_array_equal(rr_one.npairs, rr.npairs)
+    assert rr_one.tot == rr.tot
+
+    rr_none = treecorr.NNCorrelation(config)
+    rr_none.process(rand, dilute_scale=100., dilute_fraction=f)
+    np.testing.assert_array_equal(rr_none.npairs, rr.npairs)
+
+    assert_raises(TypeError, rr.process, rand, dilute_scale=scale)
+    assert_raises(ValueError, rr.process, rand, dilute_scale=scale, dilute_fraction=0.)
+    assert_raises(ValueError, rr.process, rand, dilute_scale=scale, dilute_fraction=1.5)
+    assert_raises(ValueError, rr.process, rand, dilute_scale=scale, dilute_fraction=f, dilute=3)
+    rr2d = treecorr.NNCorrelation(max_sep=10., bin_size=1., bin_type='TwoD')
+    assert_raises(ValueError, rr2d.process, rand, dilute_scale=scale, dilute_fraction=f)
+
+
+def test_sparse_top():
+    # With a small max_sep compared to the size of the field, most of the pairs of top-level
+    # cells are too far apart to matter, so they are skipped before processing.  Check that
+    # this gives the same answer as using a single top-level cell (max_top=0), where nothing
+    # gets skipped.
+
+    ngal = 2000
+    L = 1000.
+    rng = np.random.RandomState(8675309)
+    x = rng.uniform(0, L, ngal)
+    y = rng.uniform(0, L, ngal)
+    z = rng.uniform(0, L, ngal)
+    ra = rng.uniform(0, 60, ngal)
+    dec = rng.uniform(-30, 30, ngal)
+
+    cats = [ (treecorr.Catalog(x=x, y=y), treecorr.Catalog(x=y, y=x), {}),
+             (treecorr.Catalog(x=x, y=y, z=z), treecorr.Catalog(x=y, y=z, z=x), {}),
+             (treecorr.Catalog(ra=ra, dec=dec, ra_units='deg', dec_units='deg'),
+              treecorr.Catalog(ra=ra[::-1], dec=dec, ra_units='deg', dec_units='deg'),
+              dict(sep_units='arcmin')) ]
+    for cat1, cat2, kwargs in cats:
+        for bin_type in ['Log', 'TwoD']:
+            if bin_type == 'TwoD' and cat1.coords != 'flat': continue
+            config = dict(min_sep=3., max_sep=30., nbins=10, bin_slop=0, bin_type=bin_type)
+            config.update(kwargs)
+            if bin_type == 'TwoD': del config['min_sep']
+            dd = treecorr.NNCorrelation(config)
+            dd0 = treecorr.NNCorrelation(config, max_top=0)
+            dd.process(cat1)
+            dd0.process(cat1)
+            print(cat1.coords, bin_type, 'auto: npairs = ', dd.npairs.sum(), dd0.npairs.sum())
+            assert dd.npairs.sum() > 0
+            np.testing.assert_array_equal(dd.npairs, dd0.npairs)
+
+            dd.process(cat1, cat2)
+            dd0.process(cat1, cat2)
+            print(cat1.coords, bin_type, 'cross: npairs = ', dd.npairs.sum(), dd0.npairs.sum())
+            assert dd.npairs.sum() > 0
+            np.testing.assert_array_equal(dd.npairs, dd0.npairs)
+
+
+
+def test_bucket_size():
+    # With bucket_size > 0, small pairs of cells that need to be split are done by looping
+    # over all the pairs of their leaves.  With brute=True, this should give the same answer
+    # as recursing down to the leaves.
+
+    ngal = 1000
+    L = 100.
+    rng = np.random.RandomState(8675309)
+    x = rng.uniform(0, L, ngal)
+    y = rng.uniform(0, L, ngal)
+    z = rng.uniform(0, L, ngal)
+    ra = rng.uniform(0, 20, ngal)
+    dec = rng.uniform(-10, 10, ngal)
+
+    cats = [ (treecorr.Catalog(x=x, y=y), treecorr.Catalog(x=y, y=x), {}),
+             (treecorr.Catalog(x=x, y=y, z=z), treecorr.Catalog(x=y, y=z, z=x), {}),
+             (treecorr.Catalog(x=x, y=y, z=z), treecorr.Catalog(x=y, y=z, z=x),
+              dict(metric='Rperp')),
+             (treecorr.Catalog(ra=ra, dec=dec, ra_units='deg', dec_units='deg'),
+              treecorr.Catalog(ra=ra[::-1], dec=dec, ra_units='deg', dec_units='deg'),
+              dict(sep_units='arcmin')) ]
+    for cat1, cat2, kwargs in cats:
+        for bin_type in ['Log', 'TwoD']:
+            if bin_type == 'TwoD' and cat1.coords != 'flat': continue
+            config = dict(min_sep=1., max_sep=20., nbins=10, brute=True, bin_type=bin_type)
+            config.update(kwargs)
+            if bin_type == 'TwoD': del config['min_sep']
+            dd = treecorr.NNCorrelation(config, bucket_size=32)
+            dd0 = treecorr.NNCorrelation(config)
+            dd.process(cat1)
+            dd0.process(cat1)
+            print(cat1.coords, bin_type, 'auto: npairs = ', dd.npairs.sum(), dd0.npairs.sum())
+            assert dd.npairs.sum() > 0
+            np.testing.assert_array_equal(dd.npairs, dd0.npairs)
+            np.testing.assert_allclose(dd.meanr, dd0.meanr, rtol=1.e-10)
+            np.testing.assert_allclose(dd.meanlogr, dd0.meanlogr, rtol=1.e-10)
+
+            dd.process(cat1, cat2)
+            dd0.process(cat1, cat2)
+            print(cat1.coords, bin_type, 'cross: npairs = ', dd.npairs.sum(), dd0.npairs.sum())
+            assert dd.npairs.sum() > 0
+            np.testing.assert_array_equal(dd.npairs, dd0.npairs)
+            np.testing.assert_allclose(dd.meanr, dd0.meanr, rtol=1.e-10)
+            np.testing.assert_allclose(dd.meanlogr, dd0.meanlogr, rtol=1.e-10)
+
+    # Without brute, the pairs within the buckets are still done exactly.  So with a single
+    # top-level cell and a bucket as big as the whole catalog, it matches brute force.
+    cat1 = treecorr.Catalog(x=x, y=y)
+    config = dict(min_sep=1., max_sep=20., nbins=10, bin_slop=0.3)
+    dd = treecorr.NNCorrelation(config, bucket_size=ngal, max_top=0)
+    dd.process(cat1)
+    ddb = treecorr.NNCorrelation(config, brute=True)
+    ddb.process(cat1)
+    print('bucket: ', dd.npairs)
+    print('brute: ', ddb.npairs)
+    np.testing.assert_array_equal(dd.npairs, ddb.npairs)
+    np.testing.assert_allclose(dd.meanr, ddb.meanr, rtol=1.e-10)
+
+    assert_raises(ValueError, treecorr.NNCorrelation, config, bucket_size='a')
+
+
 if __name__ == '__main__':
     test_log_binning()
     test_linear_binning()
@@ -2228,3 +2574,7 @@ if __name__ == '__main__':
     test_varxi()
     test_sph_linear()
     test_linear_binslop()
+    test_split_randoms()
+    test_dilute_randoms()
+    test_sparse_top()
+    test_bucket_size()
@@ -2274,6 +2274,34 @@ def test_list():
     np.testing.assert_allclose(corr3_output['zeta'], zeta.flatten(), rtol=1.e-3)
 
 
+def test_sparse_top():
+    # As in test_nn.py, check that skipping the top-level cells that are too far apart to
+    # matter gives the same answer as using a single top-level cell.
+
+    ngal = 1000
+    L = 1000.
+    rng = np.random.RandomState(8675309)
+    x = rng.uniform(0, L, ngal)
+    y = rng.uniform(0, L, ngal)
+    cat1 = treecorr.Catalog(x=x, y=y)
+    cat2 = treecorr.Catalog(x=y, y=x)
+
+    config = dict(min_sep=5., max_sep=40., nbins=5, nubins=3, nvbins=3, bin_slop=0)
+    ddd = treecorr.NNNCorrelation(config)
+    ddd0 = treecorr.NNNCorrelation(config, max_top=0)
+    ddd.process(cat1)
+    ddd0.process(cat1)
+    print('auto: ntri = ', ddd.ntri.sum(), ddd0.ntri.sum())
+    assert ddd.ntri.sum() > 0
+    np.testing.assert_array_equal(ddd.ntri, ddd0.ntri)
+
+    ddd.process(cat1, cat2, cat1)
+    ddd0.process(cat1, cat2, cat1)
+    print('cross: ntri = ', ddd.ntri.sum(), ddd0.ntri.sum())
+    assert ddd.ntri.sum() > 0
+    np.testing.assert_array_equal(ddd.ntri, ddd0.ntri)
+
+
 if __name__ == '__main__':
     test_log_binning()
     test_direct_count_auto()
@@ -2286,3 +2314,4 @@ if __name__ == '__main__':
     test_nnn()
     test_3d()
     test_list()
+    test_sparse_top()
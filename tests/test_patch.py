@@ -0,0 +1,405 @@
+# Copyright (c) 2003-2019 by Mike Jarvis
+#
+# TreeCorr is free software: redistribution and use in source and binary forms,
+# with or without modification, are permitted provided that the following
+# conditions are met:
+#
+# 1. Redistributions of source code must retain the above copyright notice, this
+#    list of conditions, and the disclaimer given in the accompanying LICENSE
+#    file.
+# 2. Redistributions in binary form must reproduce the above copyright notice,
+#    this list of conditions, and the disclaimer given in the documentation
+#    and/or other materials provided with the distribution.
+
+from __future__ import print_function
+import numpy as np
+import os
+import time
+import treecorr
+
+from test_helper import assert_raises, timer
+
+
+def make_patches(x, y, L, n):
+    # Simple square patches on an n x n grid.
+    ix = np.clip((x / L * n).astype(int), 0, n-1)
+    iy = np.clip((y / L * n).astype(int), 0, n-1)
+    return ix * n + iy
+
+
+@timer
+def test_cat_patches():
+    # Test the patch column in Catalog.
+    nobj = 1000
+    rng = np.random.RandomState(8675309)
+    x = rng.uniform(0, 100, nobj)
+    y = rng.uniform(0, 100, nobj)
+    k = rng.normal(0, 1, nobj)
+    patch = make_patches(x, y, 100, 4)
+
+    cat = treecorr.Catalog(x=x, y=y, k=k, patch=patch)
+    np.testing.assert_array_equal(cat.patch, patch)
+    assert cat.npatch == 16
+
+    cat2 = treecorr.Catalog(x=x, y=y, k=k)
+    assert cat2.patch is None
+    assert cat2.npatch == 1
+
+    # Read the patches from an ASCII file
+    file_name = os.path.join('output','test_cat_patches.dat')
+    np.savetxt(file_name, np.array([x, y, k, patch]).T)
+    cat3 = treecorr.Catalog(file_name, x_col=1, y_col=2, k_col=3, patch_col=4)
+    np.testing.assert_array_equal(cat3.patch, patch)
+    assert cat3.npatch == 16
+
+    # Write it back out and read it in again
+    file_name2 = os.path.join('output','test_cat_patches2.dat')
+    cat.write(file_name2)
+    cat4 = treecorr.Catalog(file_name2, x_col=1, y_col=2, k_col=3, patch_col=4)
+    np.testing.assert_array_equal(cat4.patch, patch)
+
+    assert_raises(ValueError, treecorr.Catalog, x=x, y=y, patch=patch[:10])
+    assert_raises(ValueError, treecorr.Catalog, x=x, y=y, patch=patch-1)
+    assert_raises(TypeError, treecorr.Catalog, file_name, x_col=1, y_col=2, patch_col=5)
+
+    # The fields have top-level cells that are each within a single patch.
+    field = cat.getKField()
+    assert field.nTopLevelNodes >= 16
+    for p in range(16):
+        assert np.sum(cat.patch == p) > 0
+
+
+@timer
+def test_gg_jk():
+    # Test that the patch results give the same answers as running with each patch removed.
+    nobj = 2000
+    npatch = 9
+    rng = np.random.RandomState(8675309)
+    L = 100
+    x = rng.uniform(0, L, nobj)
+    y = rng.uniform(0, L, nobj)
+    g1 = rng.normal(0, 0.2, nobj)
+    g2 = rng.normal(0, 0.2, nobj)
+    patch = make_patches(x, y, L, 3)
+
+    # Use brute force, so the tree structure doesn't matter.
+    config = dict(min_sep=1., max_sep=20., nbins=8, brute=True)
+    cat = treecorr.Catalog(x=x, y=y, g1=g1, g2=g2, patch=patch)
+    gg = treecorr.GGCorrelation(config)
+    t0 = time.time()
+    gg.process(cat)
+    t1 = time.time()
+    cat0 = treecorr.Catalog(x=x, y=y, g1=g1, g2=g2)
+    gg0 = treecorr.GGCorrelation(config)
+    gg0.process(cat0)
+    t2 = time.time()
+    print('time with patches = ',t1-t0)
+    print('time without patches = ',t2-t1)
+    assert gg.npatch == npatch
+    np.testing.assert_array_equal(gg.npairs, gg0.npairs)
+    np.testing.assert_allclose(gg.xip, gg0.xip, rtol=1.e-6, atol=1.e-10)
+    np.testing.assert_allclose(gg.xim, gg0.xim, rtol=1.e-6, atol=1.e-10)
+
+    # The results are accumulated for each pair of patches with i <= j.
+    assert all(i <= j for i,j in gg.results)
+    tot = np.sum(list(gg.results.values()), axis=0)
+    np.testing.assert_array_equal(tot[7], gg.npairs)
+
+    # Only the patch pairs that have any pairs in range are kept.
+    r = np.sqrt((x[:,None]-x[None,:])**2 + (y[:,None]-y[None,:])**2)
+    i1, i2 = np.where((r >= 1.) & (r < 20.))
+    pairs = set(zip(np.minimum(patch[i1], patch[i2]), np.maximum(patch[i1], patch[i2])))
+    assert set(gg.results.keys()) == pairs
+    assert len(pairs) < npatch * (npatch+1) // 2
+    assert all(np.sum(v[7]) > 0 for v in gg.results.values())
+
+    # Compare each jackknife realization to the answer from leaving out that patch.
+    xi_jk = []
+    for k in range(npatch):
+        w = np.ones(nobj)
+        w[patch == k] = 0
+        catk = treecorr.Catalog(x=x, y=y, g1=g1, g2=g2, w=w)
+        ggk = treecorr.GGCorrelation(config)
+        ggk.process(catk)
+        m = np.ones(npatch, dtype=int)
+        m[k] = 0
+        xi = gg._calculate_xi_from_pairs(m)
+        np.testing.assert_allclose(xi, np.concatenate([ggk.xip, ggk.xim]),
+                                   rtol=1.e-6, atol=1.e-10)
+        xi_jk.append(xi)
+    xi_jk = np.array(xi_jk)
+    xi_jk -= np.mean(xi_jk, axis=0)
+    cov_jk = (npatch-1.)/npatch * xi_jk.T.dot(xi_jk)
+
+    cov = gg.estimate_cov('jackknife')
+    assert cov.shape == (16, 16)
+    np.testing.assert_allclose(cov, cov_jk, rtol=1.e-6, atol=1.e-16)
+    np.testing.assert_array_equal(gg.cov, cov)
+    print('jackknife sigma_xip = ',np.sqrt(np.diag(cov)[:8]))
+    print('shot noise sigma_xip = ',np.sqrt(gg.varxip))
+
+    # Bootstrap is repeatable given the rng.
+    cov_b1 = gg.estimate_cov('bootstrap', num_bootstrap=100, rng=np.random.RandomState(1234))
+    cov_b2 = gg.estimate_cov('bootstrap', num_bootstrap=100, rng=np.random.RandomState(1234))
+    np.testing.assert_array_equal(cov_b1, cov_b2)
+    assert cov_b1.shape == (16, 16)
+    assert np.all(np.diag(cov_b1) > 0)
+    # And roughly consistent with the jackknife estimate.
+    np.testing.assert_allclose(np.diag(cov_b1), np.diag(cov), rtol=1.)
+
+    assert_raises(ValueError, gg.estimate_cov, 'invalid')
+    assert_raises(ValueError, gg0.estimate_cov)
+
+    # The results are kept through +=, and cleared by process.
+    gg2 = treecorr.GGCorrelation(config)
+    gg2 += gg
+    assert gg2.npatch == npatch
+    assert sorted(gg2.results.keys()) == sorted(gg.results.keys())
+    gg2.process(cat0)
+    assert gg2.results == {}
+    assert gg2.npatch == 1
+
+    # Both catalogs need patches for cross-correlations.
+    assert_raises(ValueError, gg2.process, cat, cat0)
+
+
+@timer
+def test_cross_jk():
+    # Test cross correlations with patches, using NK and NG.
+    nlens = 1000
+    nsource = 3000
+    npatch = 9
+    rng = np.random.RandomState(8675309)
+    L = 100
+    x1 = rng.uniform(0, L, nlens)
+    y1 = rng.uniform(0, L, nlens)
+    x2 = rng.uniform(0, L, nsource)
+    y2 = rng.uniform(0, L, nsource)
+    k = rng.normal(0, 1, nsource)
+    g1 = rng.normal(0, 0.2, nsource)
+    g2 = rng.normal(0, 0.2, nsource)
+    p1 = make_patches(x1, y1, L, 3)
+    p2 = make_patches(x2, y2, L, 3)
+
+    config = dict(min_sep=1., max_sep=20., nbins=8, brute=True)
+    lens = treecorr.Catalog(x=x1, y=y1, patch=p1)
+    source = treecorr.Catalog(x=x2, y=y2, k=k, g1=g1, g2=g2, patch=p2)
+    nk = treecorr.NKCorrelation(config)
+    nk.process(lens, source)
+    ng = treecorr.NGCorrelation(config)
+    ng.process(lens, source)
+
+    # Cross-correlations have results for both orders of patch pairs.
+    assert any(i > j for i,j in nk.results)
+    assert any(i < j for i,j in nk.results)
+
+    k = 4
+    w1 = np.ones(nlens)
+    w1[p1 == k] = 0
+    w2 = np.ones(nsource)
+    w2[p2 == k] = 0
+    lensk = treecorr.Catalog(x=x1, y=y1, w=w1)
+    sourcek = treecorr.Catalog(x=x2, y=y2, k=source.k, g1=g1, g2=g2, w=w2)
+    nkk = treecorr.NKCorrelation(config)
+    nkk.process(lensk, sourcek)
+    ngk = treecorr.NGCorrelation(config)
+    ngk.process(lensk, sourcek)
+    m = np.ones(npatch, dtype=int)
+    m[k] = 0
+    np.testing.assert_allclose(nk._calculate_xi_from_pairs(m), nkk.xi, rtol=1.e-6, atol=1.e-10)
+    np.testing.assert_allclose(ng._calculate_xi_from_pairs(m), ngk.xi, rtol=1.e-6, atol=1.e-10)
+
+    cov = ng.estimate_cov()
+    assert cov.shape == (8, 8)
+    assert np.all(np.diag(cov) > 0)
+
+
+@timer
+def test_nn_jk():
+    # Test the jackknife covariance for NN, which also needs the randoms to have patches.
+    ndata = 5000
+    nrand = 20000
+    npatch = 9
+    rng = np.random.RandomState(8675309)
+    L = 100
+    # Some clustering: make half the points near a few centers.
+    xc = rng.uniform(0, L, 50)
+    yc = rng.uniform(0, L, 50)
+    ic = rng.randint(50, size=ndata//2)
+    x = np.concatenate([rng.uniform(0, L, ndata//2), xc[ic] + rng.normal(0, 2, ndata//2)])
+    y = np.concatenate([rng.uniform(0, L, ndata//2), yc[ic] + rng.normal(0, 2, ndata//2)])
+    x = np.clip(x, 0, L)
+    y = np.clip(y, 0, L)
+    rx = rng.uniform(0, L, nrand)
+    ry = rng.uniform(0, L, nrand)
+    p = make_patches(x, y, L, 3)
+    rp = make_patches(rx, ry, L, 3)
+
+    config = dict(min_sep=1., max_sep=20., nbins=8, bin_slop=0)
+    cat = treecorr.Catalog(x=x, y=y, patch=p)
+    rand = treecorr.Catalog(x=rx, y=ry, patch=rp)
+    dd = treecorr.NNCorrelation(config)
+    dd.process(cat)
+    rr = treecorr.NNCorrelation(config)
+    rr.process(rand)
+    dr = treecorr.NNCorrelation(config)
+    dr.process(cat, rand)
+
+    assert_raises(ValueError, dd.estimate_cov)   # Need to call calculateXi first.
+    xi, varxi = dd.calculateXi(rr, dr)
+
+    # Check one jackknife realization by hand.
+    k = 2
+    catk = treecorr.Catalog(x=x[p!=k], y=y[p!=k])
+    randk = treecorr.Catalog(x=rx[rp!=k], y=ry[rp!=k])
+    ddk = treecorr.NNCorrelation(config)
+    ddk.process(catk)
+    rrk = treecorr.NNCorrelation(config)
+    rrk.process(randk)
+    drk = treecorr.NNCorrelation(config)
+    drk.process(catk, randk)
+    xik, _ = ddk.calculateXi(rrk, drk)
+    m = np.ones(npatch, dtype=int)
+    m[k] = 0
+    np.testing.assert_allclose(dd._calculate_xi_from_pairs(m), xik, rtol=1.e-6)
+
+    # With all patches, we get the regular answer.
+    np.testing.assert_allclose(dd._calculate_xi_from_pairs(np.ones(npatch, dtype=int)), xi,
+                               rtol=1.e-6)
+
+    cov = dd.estimate_cov()
+    print('jackknife sigma = ',np.sqrt(np.diag(cov)))
+    print('shot noise sigma = ',np.sqrt(varxi))
+    assert cov.shape == (8, 8)
+    assert np.all(np.diag(cov) > 0)
+
+    # If the randoms don't have patches, this is an error.
+    rand0 = treecorr.Catalog(x=rx, y=ry)
+    rr0 = treecorr.NNCorrelation(config)
+    rr0.process(rand0)
+    dd.calculateXi(rr0)
+    assert_raises(ValueError, dd.estimate_cov)
+
+
+@timer
+def test_kmeans():
+    # Test the k-means patch assignment in the different coordinate systems.
+    nobj = 50000
+    npatch = 20
+    rng = np.random.RandomState(8675309)
+
+    def check(cat, rand):
+        t0 = time.time()
+        p = cat.run_kmeans(npatch)
+        t1 = time.time()
+        print('time for k-means with %s coords = '%cat.coords, t1-t0)
+        np.testing.assert_array_equal(cat.patch, p)
+        assert cat.npatch == npatch
+        cen = cat.patch_centers
+        assert cen.shape == (npatch, 2 if cat.coords == 'flat' else 3)
+        counts = np.bincount(p, minlength=npatch)
+        print('counts = ',counts)
+        assert np.all(counts > 0)
+
+        # Each object is assigned to its closest center.
+        if cat.coords == 'flat':
+            pos = np.column_stack([cat.x, cat.y])
+        else:
+            pos = np.column_stack([cat.x, cat.y, cat.z])
+        dsq = np.sum((pos[:,np.newaxis,:] - cen[np.newaxis,:,:])**2, axis=2)
+        np.testing.assert_array_equal(p, np.argmin(dsq, axis=1))
+
+        # And the centers are (nearly) the centroids of their patches.
+        w = cat.w
+        for k in range(pos.shape[1]):
+            centroid = np.bincount(p, w*pos[:,k]) / np.bincount(p, w)
+            if cat.coords == 'spherical':
+                centroid /= np.sqrt(np.sum([(np.bincount(p, w*pos[:,j]) / np.bincount(p, w))**2
+                                            for j in range(3)], axis=0))
+            np.testing.assert_allclose(centroid, cen[:,k], atol=1.e-2 * np.std(pos[:,k]))
+
+        # The randoms are assigned to the same patches.
+        rp = rand.assign_patches(cen)
+        assert rand.npatch == npatch
+        np.testing.assert_array_equal(rand.patch_centers, cen)
+        if cat.coords == 'flat':
+            rpos = np.column_stack([rand.x, rand.y])
+        else:
+            rpos = np.column_stack([rand.x, rand.y, rand.z])
+        dsq = np.sum((rpos[:,np.newaxis,:] - cen[np.newaxis,:,:])**2, axis=2)
+        np.testing.assert_array_equal(rp, np.argmin(dsq, axis=1))
+
+        # Random initialization also works, and is repeatable given the rng.
+        p1 = cat.run_kmeans(npatch, init='random', rng=np.random.RandomState(1234))
+        p2 = cat.run_kmeans(npatch, init='random', rng=np.random.RandomState(1234))
+        np.testing.assert_array_equal(p1, p2)
+        assert len(np.unique(p1)) == npatch
+
+    # Flat, with a few zero weights, which are still assigned to a patch.
+    x = rng.normal(0, 10, nobj)
+    y = rng.normal(0, 10, nobj)
+    w = rng.uniform(0, 2, nobj)
+    w[::100] = 0
+    cat = treecorr.Catalog(x=x, y=y, w=w)
+    rand = treecorr.Catalog(x=rng.normal(0, 10, nobj), y=rng.normal(0, 10, nobj))
+    check(cat, rand)
+
+    # 3D
+    z = rng.normal(0, 10, nobj)
+    cat = treecorr.Catalog(x=x, y=y, z=z, w=w)
+    rand = treecorr.Catalog(x=rng.normal(0, 10, nobj), y=rng.normal(0, 10, nobj),
+                            z=rng.normal(0, 10, nobj))
+    check(cat, rand)
+
+    # Spherical
+    ra = rng.uniform(0, 60, nobj)
+    dec = np.degrees(np.arcsin(rng.uniform(-0.5, 0.5, nobj)))
+    cat = treecorr.Catalog(ra=ra, dec=dec, ra_units='deg', dec_units='deg', w=w)
+    rra = rng.uniform(0, 60, nobj)
+    rdec = np.degrees(np.arcsin(rng.uniform(-0.5, 0.5, nobj)))
+    rand = treecorr.Catalog(ra=rra, dec=rdec, ra_units='deg', dec_units='deg')
+    check(cat, rand)
+    np.testing.assert_allclose(np.sum(cat.patch_centers**2, axis=1), 1.)
+
+    # The patches and centers can be cached to disk.
+    patch_file = os.path.join('output','test_kmeans_patches.dat')
+    center_file = os.path.join('output','test_kmeans_centers.dat')
+    p = cat.run_kmeans(npatch)
+    cat.write_patches(patch_file)
+    cat.write_patch_centers(center_file)
+    cat2 = treecorr.Catalog(ra=ra, dec=dec, ra_units='deg', dec_units='deg', w=w)
+    cat2.read_patches(patch_file)
+    np.testing.assert_array_equal(cat2.patch, p)
+    assert cat2.npatch == npatch
+    np.testing.assert_allclose(cat.read_patch_centers(center_file), cat.patch_centers,
+                               rtol=1.e-12)
+    rp = rand.assign_patches(center_file)
+    rp2 = rand.assign_patches(cat.patch_centers)
+    np.testing.assert_array_equal(rp, rp2)
+
+    # The new patches are used for the correlations.
+    dd = treecorr.NNCorrelation(min_sep=1., max_sep=60., nbins=5, sep_units='arcmin')
+    dd.process(cat)
+    assert dd.npatch == npatch
+    assert len(dd.results) > npatch
+
+    # Errors
+    cen = cat.patch_centers
+    assert_raises(ValueError, cat.run_kmeans, 0)
+    assert_raises(ValueError, cat.run_kmeans, nobj+1)
+    assert_raises(ValueError, cat.run_kmeans, npatch, init='invalid')
+    assert_raises(ValueError, rand.assign_patches, cen[:,:2])
+    field = cat.getNField()
+    assert_raises(TypeError, field.kmeans_refine_centers, cen.tolist())
+    cat3 = treecorr.Catalog(x=x, y=y)
+    assert_raises(ValueError, cat3.write_patches, patch_file)
+    assert_raises(ValueError, cat3.write_patch_centers, center_file)
+    assert_raises(ValueError, cat3.read_patches, os.path.join('output','test_cat_patches.dat'))
+
+
+if __name__ == '__main__':
+    test_cat_patches()
+    test_gg_jk()
+    test_cross_jk()
+    test_nn_jk()
+    test_kmeans()
@@ -486,9 +486,169 @@ def test_3pt():
 
 
 
+def test_analytic_rr():
+    # For uniform points in a periodic box, the analytic RR should match the actual pair counts
+    # up to shot noise, including separations larger than half the box size.
+    Lx = 100.
+    Ly = 80.
+    Lz = 120.
+    rng = np.random.RandomState(8675309)
+    for coords in ['flat', '3d']:
+        ngal = 20000
+        x = rng.uniform(0, Lx, ngal)
+        y = rng.uniform(0, Ly, ngal)
+        z = rng.uniform(0, Lz, ngal) if coords == '3d' else None
+        cat = treecorr.Catalog(x=x, y=y, z=z)
+
+        nn = treecorr.NNCorrelation(min_sep=5., max_sep=90., nbins=8, bin_slop=0,
+                                    xperiod=Lx, yperiod=Ly, zperiod=Lz)
+        nn.process(cat, metric='Periodic')
+        rr = nn.analytic_rr()
+        print(coords, 'ratio = ', nn.npairs / rr.npairs)
+        np.testing.assert_allclose(rr.npairs, nn.npairs, rtol=0.02)
+        np.testing.assert_allclose(rr.weight, rr.npairs)
+        np.testing.assert_allclose(rr.meanr, nn.rnom)
+        assert rr.tot == nn.tot
+
+        # The total over all separations (including the corners of the box) is tot.
+        nn2 = treecorr.NNCorrelation(min_sep=1.e-3, max_sep=200., nbins=50,
+                                     xperiod=Lx, yperiod=Ly, zperiod=Lz)
+        nn2.process(cat, metric='Periodic')
+        np.testing.assert_allclose(np.sum(nn2.analytic_rr().npairs), nn2.tot, rtol=1.e-6)
+
+        # calculateXi uses the analytic rr by default for the Periodic metric.
+        xi, varxi = nn.calculateXi()
+        xi2, varxi2 = nn.calculateXi(rr)
+        np.testing.assert_allclose(xi, xi2)
+        np.testing.assert_allclose(xi, 0, atol=0.02)
+
+    # corr2 uses the analytic RR if there are no random catalogs.
+    file_name = os.path.join('data','nn_periodic_analytic.dat')
+    np.savetxt(file_name, np.array([x,y,z]).T)
+    config = { 'file_name' : file_name, 'x_col' : 1, 'y_col' : 2, 'z_col' : 3,
+               'min_sep' : 5., 'max_sep' : 90., 'nbins' : 8, 'bin_slop' : 0,
+               'metric' : 'Periodic', 'xperiod' : Lx, 'yperiod' : Ly, 'zperiod' : Lz,
+               'nn_file_name' : os.path.join('output','nn_periodic_analytic.out'),
+               'verbose' : 0 }
+    treecorr.corr2(config)
+    corr2_output = np.genfromtxt(config['nn_file_name'], names=True, skip_header=1)
+    np.testing.assert_allclose(corr2_output['DD'], nn.npairs, rtol=1.e-3)
+    np.testing.assert_allclose(corr2_output['RR'], rr.npairs, rtol=1.e-3)
+    np.testing.assert_allclose(corr2_output['xi'], xi, rtol=1.e-3, atol=1.e-5)
+
+    # TwoD binning.  First check that the pairs that wrap around the edges of the box land
+    # in the right pixels.
+    ngal = 1000
+    x = rng.uniform(0, Lx, ngal)
+    y = rng.uniform(0, Ly, ngal)
+    cat = treecorr.Catalog(x=x, y=y)
+    nn = treecorr.NNCorrelation(max_sep=20., bin_size=4., bin_type='TwoD', brute=True,
+                                xperiod=Lx, yperiod=Ly)
+    nn.process(cat, metric='Periodic')
+    dx = x[None,:] - x[:,None]
+    dy = y[None,:] - y[:,None]
+    dx = (dx + Lx/2.) % Lx - Lx/2.
+    dy = (dy + Ly/2.) % Ly - Ly/2.
+    use = (dx != 0) | (dy != 0)
+    true_npairs, _, _ = np.histogram2d(dy[use], dx[use], bins=10, range=[[-20,20],[-20,20]])
+    np.testing.assert_array_equal(nn.npairs, true_npairs)
+
+    # Then the analytic RR, which counts the auto-correlation pairs in both directions.
+    ngal = 20000
+    x = rng.uniform(0, Lx, ngal)
+    y = rng.uniform(0, Ly, ngal)
+    cat = treecorr.Catalog(x=x, y=y)
+    cat2 = treecorr.Catalog(x=rng.uniform(0, Lx, ngal), y=rng.uniform(0, Ly, ngal))
+    for min_sep in [0., 5.]:
+        # With bin_slop=0, pairs of cells that straddle min_sep are still counted using their
+        # centers, so use brute force when min_sep > 0.
+        nn = treecorr.NNCorrelation(min_sep=min_sep, max_sep=20., bin_size=4., bin_type='TwoD',
+                                    bin_slop=0, brute=(min_sep > 0), xperiod=Lx, yperiod=Ly)
+        nn.process(cat, metric='Periodic')
+        rr = nn.analytic_rr()
+        print('TwoD auto ratio = ', nn.npairs / rr.npairs)
+        np.testing.assert_allclose(rr.npairs, nn.npairs, rtol=0.02)
+        if min_sep == 0.:
+            np.testing.assert_allclose(np.sum(rr.npairs), 2 * nn.tot * 40.**2 / (Lx*Ly))
+        xi, varxi = nn.calculateXi()
+        np.testing.assert_allclose(xi, 0, atol=0.02)
+
+        nn.process(cat, cat2, metric='Periodic')
+        rr = nn.analytic_rr()
+        print('TwoD cross ratio = ', nn.npairs / rr.npairs)
+        np.testing.assert_allclose(rr.npairs, nn.npairs, rtol=0.02)
+
+    nn = treecorr.NNCorrelation(max_sep=50., bin_size=10., bin_type='TwoD',
+                                xperiod=Lx, yperiod=Ly)
+    nn.process(cat, metric='Periodic')
+    with assert_raises(ValueError):
+        nn.analytic_rr()   # max_sep > Ly/2
+
+    # Errors
+    nn = treecorr.NNCorrelation(min_sep=5., max_sep=90., nbins=8)
+    with assert_raises(ValueError):
+        nn.analytic_rr()   # No tot yet.
+    nn.process(cat)
+    with assert_raises(ValueError):
+        nn.analytic_rr()   # Not Periodic.
+    with assert_raises(TypeError):
+        nn.calculateXi()
+
+
+def test_analytic_rrr():
+    # Same idea for the three-point RRR.
+    L = 100.
+    rng = np.random.RandomState(8675309)
+    for coords, ngal in [('flat', 1500), ('3d', 3000)]:
+        x = rng.uniform(0, L, ngal)
+        y = rng.uniform(0, L, ngal)
+        z = rng.uniform(0, L, ngal) if coords == '3d' else None
+        cat = treecorr.Catalog(x=x, y=y, z=z)
+
+        nnn = treecorr.NNNCorrelation(min_sep=10., max_sep=25., nbins=2,
+                                      min_u=0.5, max_u=1., nubins=2,
+                                      min_v=0., max_v=1., nvbins=2,
+                                      bin_slop=0.1, period=L)
+        t0 = time.time()
+        nnn.process(cat, metric='Periodic')
+        t1 = time.time()
+        print(coords, 'time for process = ',t1-t0)
+        rrr = nnn.analytic_rrr()
+        t2 = time.time()
+        print(coords, 'time for analytic_rrr = ',t2-t1)
+        print('ratio = ', nnn.ntri / rrr.ntri)
+        np.testing.assert_allclose(rrr.ntri, nnn.ntri, rtol=0.05)
+        np.testing.assert_allclose(np.sum(rrr.ntri), np.sum(nnn.ntri), rtol=0.01)
+        # Positive and negative v are symmetric.
+        np.testing.assert_allclose(rrr.ntri[:,:,:2], rrr.ntri[:,:,:1:-1])
+
+        zeta, varzeta = nnn.calculateZeta()
+        zeta2, varzeta2 = nnn.calculateZeta(rrr)
+        np.testing.assert_allclose(zeta, zeta2)
+        np.testing.assert_allclose(zeta, 0, atol=0.05)
+
+    # Errors
+    cat = treecorr.Catalog(x=x[:200], y=y[:200], z=z[:200])
+    nnn = treecorr.NNNCorrelation(min_sep=10., max_sep=30., nbins=2, nubins=2, nvbins=2)
+    with assert_raises(ValueError):
+        nnn.analytic_rrr()   # No tot yet.
+    nnn.process(cat)
+    with assert_raises(ValueError):
+        nnn.analytic_rrr()   # Not Periodic.
+    with assert_raises(TypeError):
+        nnn.calculateZeta()
+    nnn = treecorr.NNNCorrelation(min_sep=10., max_sep=30., nbins=2, nubins=2, nvbins=2,
+                                  period=L/2)
+    nnn.process(cat, metric='Periodic')
+    with assert_raises(ValueError):
+        nnn.analytic_rrr()   # max_sep > period/4
+
+
 if __name__ == '__main__':
     test_direct_count()
     test_direct_3d()
     test_periodic_ps()
     test_halotools()
     test_3pt()
+    test_analytic_rr()
+    test_analytic_rrr()
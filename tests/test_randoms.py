@@ -0,0 +1,251 @@
+# Copyright (c) 2003-2019 by Mike Jarvis
+#
+# TreeCorr is free software: redistribution and use in source and binary forms,
+# with or without modification, are permitted provided that the following
+# conditions are met:
+#
+# 1. Redistributions of source code must retain the above copyright notice, this
+#    list of conditions, and the disclaimer given in the accompanying LICENSE
+#    file.
+# 2. Redistributions in binary form must reproduce the above copyright notice,
+#    this list of conditions, and the disclaimer given in the documentation
+#    and/or other materials provided with the distribution.
+
+from __future__ import print_function
+import numpy as np
+import os
+import coord
+import treecorr
+
+from test_helper import assert_raises, timer
+
+
+@timer
+def test_flat():
+    nrand = 100000
+    rand = treecorr.generate_randoms(nrand, x_range=(-10,30), y_range=(5,25), seed=1234)
+    print('x range = ',rand.x.min(),rand.x.max())
+    print('y range = ',rand.y.min(),rand.y.max())
+    assert rand.ntot == nrand
+    assert rand.z is None
+    assert np.all((rand.x >= -10) & (rand.x < 30))
+    assert np.all((rand.y >= 5) & (rand.y < 25))
+    # Uniform distributions have mean (a+b)/2 and variance (b-a)^2/12
+    np.testing.assert_allclose(np.mean(rand.x), 10., atol=40*3/np.sqrt(12*nrand))
+    np.testing.assert_allclose(np.mean(rand.y), 15., atol=20*3/np.sqrt(12*nrand))
+    np.testing.assert_allclose(np.std(rand.x), 40/np.sqrt(12), rtol=0.01)
+
+    # Repeatable with the same seed, and different with a different seed.
+    rand2 = treecorr.generate_randoms(nrand, x_range=(-10,30), y_range=(5,25), seed=1234)
+    np.testing.assert_array_equal(rand2.x, rand.x)
+    np.testing.assert_array_equal(rand2.y, rand.y)
+    rand3 = treecorr.generate_randoms(nrand, x_range=(-10,30), y_range=(5,25), seed=1235)
+    assert not np.any(rand3.x == rand.x)
+
+    # The result doesn't depend on the number of threads.
+    treecorr.set_omp_threads(1)
+    rand4 = treecorr.generate_randoms(nrand, x_range=(-10,30), y_range=(5,25), seed=1234)
+    treecorr.set_omp_threads(None)
+    np.testing.assert_array_equal(rand4.x, rand.x)
+
+    # 3d box
+    rand = treecorr.generate_randoms(nrand, x_range=(0,1), y_range=(0,2), z_range=(-3,3),
+                                     seed=1234)
+    assert rand.z is not None
+    assert np.all((rand.z >= -3) & (rand.z < 3))
+    np.testing.assert_allclose(np.mean(rand.z), 0., atol=6*3/np.sqrt(12*nrand))
+
+    # Units are passed through to the Catalog.
+    rand = treecorr.generate_randoms(nrand, x_range=(0,60), y_range=(0,60),
+                                     x_units='arcmin', y_units='arcmin', seed=1234)
+    assert rand.x.max() < 60 * (coord.arcmin / coord.radians)
+
+    assert_raises(ValueError, treecorr.generate_randoms, 0, x_range=(0,1), y_range=(0,1))
+    assert_raises(TypeError, treecorr.generate_randoms, nrand, x_range=(0,1))
+    assert_raises(TypeError, treecorr.generate_randoms, nrand, x_range=(0,1,2), y_range=(0,1))
+    assert_raises(ValueError, treecorr.generate_randoms, nrand, x_range=(1,0), y_range=(0,1))
+    assert_raises(TypeError, treecorr.generate_randoms, nrand)
+    assert_raises(TypeError, treecorr.generate_randoms, nrand, x_range=(0,1), y_range=(0,1),
+                  ra_range=(0,1), ra_units='deg', dec_units='deg')
+
+
+@timer
+def test_sphere():
+    nrand = 100000
+    rand = treecorr.generate_randoms(nrand, ra_range=(350,370), dec_range=(-30,10),
+                                     ra_units='deg', dec_units='deg', seed=1234)
+    assert rand.ntot == nrand
+    ra = rand.ra * (coord.radians / coord.degrees)
+    dec = rand.dec * (coord.radians / coord.degrees)
+    print('ra range = ',ra.min(),ra.max())
+    print('dec range = ',dec.min(),dec.max())
+    assert np.all((ra >= 350) & (ra < 370))
+    assert np.all((dec >= -30) & (dec < 10))
+    # Uniform on the sphere means uniform in sin(dec)
+    sindec = np.sin(rand.dec)
+    s1, s2 = np.sin(-30*np.pi/180), np.sin(10*np.pi/180)
+    np.testing.assert_allclose(np.mean(sindec), (s1+s2)/2, atol=(s2-s1)*3/np.sqrt(12*nrand))
+
+    # Spherical cap
+    radius = 5.
+    rand = treecorr.generate_randoms(nrand, cap_center=(3,60), cap_radius=radius,
+                                     ra_units='hours', dec_units='deg', seed=1234)
+    assert rand.ntot == nrand
+    center = coord.CelestialCoord(3 * coord.hours, 60 * coord.degrees)
+    sep = np.array([ center.distanceTo(coord.CelestialCoord(r*coord.radians,
+                                                               d*coord.radians)).deg
+                     for r,d in zip(rand.ra[:2000], rand.dec[:2000]) ])
+    print('max sep = ',sep.max())
+    assert np.all(sep <= radius * (1.+1.e-10))
+    # The area within r is proportional to 1-cos(r), so half the points are within r_half.
+    r_half = np.arccos(1 - (1-np.cos(radius*np.pi/180))/2) * 180/np.pi
+    frac = np.mean(sep < r_half)
+    print('frac within r_half = ',frac)
+    np.testing.assert_allclose(frac, 0.5, atol=0.05)
+
+    assert_raises(TypeError, treecorr.generate_randoms, nrand, ra_range=(0,10),
+                  dec_range=(0,10), dec_units='deg')
+    assert_raises(TypeError, treecorr.generate_randoms, nrand, ra_range=(0,10),
+                  ra_units='deg', dec_units='deg')
+    assert_raises(ValueError, treecorr.generate_randoms, nrand, ra_range=(0,10),
+                  dec_range=(0,100), ra_units='deg', dec_units='deg')
+    assert_raises(TypeError, treecorr.generate_randoms, nrand, cap_center=(0,10),
+                  ra_units='deg', dec_units='deg')
+    assert_raises(TypeError, treecorr.generate_randoms, nrand, cap_center=(0,10),
+                  cap_radius=3, ra_range=(0,10), ra_units='deg', dec_units='deg')
+    assert_raises(ValueError, treecorr.generate_randoms, nrand, cap_center=(0,10),
+                  cap_radius=200, ra_units='deg', dec_units='deg')
+
+
+@timer
+def test_masks():
+    nrand = 50000
+    # A checkerboard mask on a 4x3 grid.
+    mask = np.zeros((3,4), dtype=bool)
+    mask[0,::2] = mask[1,1::2] = mask[2,::2] = True
+    rand = treecorr.generate_randoms(nrand, x_range=(0,4), y_range=(0,3), mask=mask,
+                                     seed=1234)
+    assert rand.ntot == nrand
+    ix = rand.x.astype(int)
+    iy = rand.y.astype(int)
+    assert np.all(mask[iy,ix])
+    counts = np.bincount(iy*4+ix, minlength=12)
+    print('counts = ',counts)
+    n6 = nrand / 6.
+    np.testing.assert_allclose(counts[mask.ravel()], n6, rtol=5/np.sqrt(n6))
+
+    # A triangle and a square.
+    polygons = [ [(0,0), (2,0), (0,2)], np.array([(3,3), (4,3), (4,4), (3,4)]) ]
+    rand = treecorr.generate_randoms(nrand, polygons=polygons, seed=1234)
+    assert rand.ntot == nrand
+    in_tri = (rand.x >= 0) & (rand.y >= 0) & (rand.x + rand.y < 2)
+    in_sq = (rand.x >= 3) & (rand.x < 4) & (rand.y >= 3) & (rand.y < 4)
+    assert np.all(in_tri | in_sq)
+    # Both have area 2 and 1 respectively.
+    np.testing.assert_allclose(np.mean(in_tri), 2./3., atol=0.01)
+
+    # Polygons in ra, dec combined with a pixel mask.
+    polygons = [ [(10,-10), (20,-10), (20,10), (10,10)] ]
+    mask = np.array([[True, False], [False, True]])
+    rand = treecorr.generate_randoms(nrand, ra_range=(0,20), dec_range=(-10,10),
+                                     mask=mask, polygons=polygons,
+                                     ra_units='deg', dec_units='deg', seed=1234)
+    ra = rand.ra * (coord.radians / coord.degrees)
+    dec = rand.dec * (coord.radians / coord.degrees)
+    assert np.all((ra >= 10) & (ra < 20) & (dec >= 0) & (dec < 10))
+
+    # A small footprint in a large range.  The first batch probably keeps nothing, so the
+    # batches need to grow gradually rather than jumping to 1000 times nrand.
+    mask = np.zeros((100,100), dtype=bool)
+    mask[37,52] = True
+    max_batch = treecorr.randoms._max_batch
+    try:
+        treecorr.randoms._max_batch = 100000
+        rand = treecorr.generate_randoms(1000, x_range=(0,100), y_range=(0,100), mask=mask,
+                                         seed=1234)
+    finally:
+        treecorr.randoms._max_batch = max_batch
+    assert rand.ntot == 1000
+    assert np.all((rand.x >= 52) & (rand.x < 53) & (rand.y >= 37) & (rand.y < 38))
+
+    assert_raises(ValueError, treecorr.generate_randoms, nrand, x_range=(0,1), y_range=(0,1),
+                  mask=np.zeros((2,2), dtype=bool))
+    assert_raises(ValueError, treecorr.generate_randoms, nrand, x_range=(0,1), y_range=(0,1),
+                  mask=np.ones(4, dtype=bool))
+    assert_raises(ValueError, treecorr.generate_randoms, nrand, polygons=[[(0,0),(1,1)]])
+    assert_raises(TypeError, treecorr.generate_randoms, nrand, cap_center=(0,0), cap_radius=1,
+                  mask=mask, ra_units='deg', dec_units='deg')
+
+
+@timer
+def test_corr2():
+    # Check that corr2 can use randoms generated in memory rather than a rand_file_name.
+    ngal = 5000
+    L = 100.
+    rng = np.random.RandomState(8675309)
+    x = rng.uniform(0,L,ngal)
+    y = rng.uniform(0,L,ngal)
+    cat_file = os.path.join('data','randoms_data.dat')
+    treecorr.Catalog(x=x, y=y).write(cat_file)
+
+    mask_file = os.path.join('data','randoms_mask.dat')
+    np.savetxt(mask_file, np.ones((2,2), dtype=int), fmt='%d')
+    out_file = os.path.join('output','randoms_nn.out')
+    config = {
+        'file_name' : cat_file,
+        'x_col' : 1, 'y_col' : 2,
+        'rand_factor' : 2,
+        'rand_seed' : 1234,
+        'rand_x_range' : [0, L],
+        'rand_y_range' : [0, L],
+        'rand_mask_file' : mask_file,
+        'min_sep' : 1., 'max_sep' : 20., 'nbins' : 10,
+        'nn_file_name' : out_file,
+        'verbose' : 0,
+    }
+    config = treecorr.config.check_config(config, treecorr.corr2_valid_params)
+    treecorr.corr2(config)
+    corr2_output = np.genfromtxt(out_file, names=True, skip_header=1)
+
+    rand = treecorr.generate_randoms(2*ngal, x_range=(0,L), y_range=(0,L), seed=1234)
+    cat = treecorr.Catalog(cat_file, x_col=1, y_col=2)
+    dd = treecorr.NNCorrelation(min_sep=1., max_sep=20., nbins=10)
+    rr = treecorr.NNCorrelation(min_sep=1., max_sep=20., nbins=10)
+    dr = treecorr.NNCorrelation(min_sep=1., max_sep=20., nbins=10)
+    dd.process(cat)
+    rr.process(rand)
+    dr.process(cat, rand)
+    xi, varxi = dd.calculateXi(rr, dr)
+    print('xi = ',xi)
+    print('from corr2: ',corr2_output['xi'])
+    np.testing.assert_allclose(corr2_output['xi'], xi, rtol=1.e-3, atol=1.e-5)
+    # Randoms with the same density as the data give xi ~ 0.
+    assert np.all(np.abs(xi) < 0.1)
+
+    # With a second file, the second randoms use rand_seed + 1.
+    config['file_name2'] = cat_file
+    config['rand_nobj'] = 3000
+    del config['rand_factor']
+    rand2 = treecorr.generate_random_catalogs(config, 1)
+    rand2b = treecorr.generate_randoms(3000, x_range=(0,L), y_range=(0,L), seed=1235)
+    np.testing.assert_array_equal(rand2[0].x, rand2b.x)
+    treecorr.corr2(config)
+
+    # Polygon file
+    poly_file = os.path.join('data','randoms_poly.dat')
+    np.savetxt(poly_file, np.array([[7, 0, 0], [7, L, 0], [7, 0, L]]))
+    config2 = { 'rand_nobj' : 1000, 'rand_polygon_file' : poly_file, 'rand_seed' : 1 }
+    rand = treecorr.generate_random_catalogs(config2)[0]
+    assert np.all(rand.x + rand.y < L)
+
+    assert treecorr.generate_random_catalogs({}) == []
+    assert_raises(TypeError, treecorr.generate_random_catalogs, {'rand_factor' : 2})
+    assert_raises(TypeError, treecorr.generate_random_catalogs,
+                  {'rand_factor' : 2, 'rand_nobj' : 10}, ndata=10)
+
+
+if __name__ == '__main__':
+    test_flat()
+    test_sphere()
+    test_masks()
+    test_corr2()
@@ -46,6 +46,7 @@ Rperp_alias = 'FisherRperp'
 from . import util
 from .config import read_config, set_omp_threads
 from .catalog import Catalog, read_catalogs, calculateVarG, calculateVarK
+from .randoms import generate_randoms, generate_random_catalogs
 from .binnedcorr2 import BinnedCorr2
 from .ggcorrelation import GGCorrelation
 from .nncorrelation import NNCorrelation
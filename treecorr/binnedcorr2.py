@@ -77,6 +77,15 @@ class BinnedCorr2(object):
 
     See `Binning` for more information about the different binning options.
 
+    If the catalogs have patch numbers (cf. the patch parameter of `Catalog`), then the
+    results for each pair of patches are also accumulated separately during the normal
+    processing.  These are stored in the ``results`` attribute, which is a dict keyed by the
+    patch numbers (i,j).  Only the pairs of patches that have at least one pair of objects
+    in the range of separations being binned have an entry, and the arrays for these are
+    only allocated when the first such pair is found, so far apart patches don't use any
+    memory.  (For auto-correlations, i <= j.)  Then `estimate_cov` can compute a jackknife or bootstrap
+    estimate of the covariance matrix without needing to process the catalogs again.
+
     Parameters:
         config (dict):      A configuration dict that can be used to pass in the below kwargs if
                             desired.  This dict is allowed to have addition entries in addition
@@ -122,6 +131,13 @@ class BinnedCorr2(object):
                                cat2 when the error is compatible with the given bin_slop.
                              - 2: Always go to the leaves for cat2, but stop at non-leaf cells of
                                cat1 when the error is compatible with the given bin_slop.
+        bucket_size (int):  If > 0, pairs of cells that both have at most this many objects
+                            and would need to be split are instead done by looping directly over
+                            all the pairs of their leaves, rather than recursing down to them.
+                            This is much faster when most of the pairs end up going to the
+                            leaves, as with brute=True or a very small bin_slop.  Something
+                            like 32 is usually a good value in that case.  (default: 0, which
+                            means not to use buckets)
 
         verbose (int):      If no logger is provided, this will optionally specify a logging level
                             to use:
@@ -185,6 +201,13 @@ class BinnedCorr2(object):
                             (default: use the number of cpu cores; this value can also be given in
                             the constructor in the config dict.) Note that this won't work if the
                             system's C compiler cannot use OptnMP (e.g. clang prior to version 3.7.)
+        min_task_pairs (float): If > 0, pairs of cells with more than this many pairs of objects
+                            are split into separate OpenMP tasks, which any idle thread can
+                            process.  Normally, each thread processes all the pairs starting from
+                            one top-level cell at a time, so a few large top-level cells (e.g. when
+                            max_top is small or one catalog is much smaller than the other) can
+                            leave most of the threads idle.  Something like 1.e6 is usually a good
+                            value in that case. (default: 0, which means not to use tasks)
     """
     _valid_params = {
         'nbins' : (int, False, None, None,
@@ -202,6 +225,9 @@ class BinnedCorr2(object):
                 'The default is to use 1 if bin_size <= 0.1, or 0.1/bin_size if bin_size > 0.1.'),
         'brute' : (bool, False, False, [False, True, 1, 2],
                 'Whether to use brute-force algorithm'),
+        'bucket_size' : (int, False, 0, None,
+                'The maximum number of objects in a pair of cells to loop over their leaves directly.',
+                '0 means not to use buckets.'),
         'verbose' : (int, False, 1, [0, 1, 2, 3],
                 'How verbose the code should be during processing. ',
                 '0 = Errors Only, 1 = Warnings, 2 = Progress, 3 = Debugging'),
@@ -223,6 +249,9 @@ class BinnedCorr2(object):
                 'Whether to do a pair-wise cross-correlation '),
         'num_threads' : (int, False, None, None,
                 'How many threads should be used. num_threads <= 0 means auto based on num cores.'),
+        'min_task_pairs' : (float, False, 0., None,
+                'The minimum number of pairs in a pair of cells to split it into OpenMP tasks.',
+                '0 means not to use tasks.'),
         'm2_uform' : (str, False, 'Crittenden', ['Crittenden', 'Schneider'],
                 'The function form of the mass aperture.'),
         'metric': (str, False, 'Euclidean', ['Euclidean', 'Rperp', 'FisherRperp', 'OldRperp',
@@ -405,6 +434,7 @@ class BinnedCorr2(object):
 
         self.min_top = treecorr.config.get(self.config,'min_top',int,3)
         self.max_top = treecorr.config.get(self.config,'max_top',int,10)
+        self.min_task_pairs = treecorr.config.get(self.config,'min_task_pairs',float,0.)
 
         self.bin_slop = treecorr.config.get(self.config,'bin_slop',float,-1.0)
         if self.bin_slop < 0.0:
@@ -423,6 +453,7 @@ class BinnedCorr2(object):
             self.logger.info("Doing brute force calculation%s.",
                              self.brute is 1 and " for first field" or
                              (self.brute is 2 and " for second field" or ""))
+        self.bucket_size = treecorr.config.get(self.config,'bucket_size',int,0)
         self.coords = None
         self.metric = None
         self.min_rpar = treecorr.config.get(self.config,'min_rpar',float,-sys.float_info.max)
@@ -434,6 +465,10 @@ class BinnedCorr2(object):
         self.yperiod = treecorr.config.get(self.config,'yperiod',float,period)
         self.zperiod = treecorr.config.get(self.config,'zperiod',float,period)
 
+        self.npatch = 1
+        self.results = {}
+        self._patch_arrays = None
+
     def _process_all_auto(self, cat1, metric, num_threads):
         for i,c1 in enumerate(cat1):
             self.process_auto(c1,metric,num_threads)
@@ -463,6 +498,13 @@ class BinnedCorr2(object):
             self.logger.debug('Set num_threads = %d',num_threads)
         treecorr.set_omp_threads(num_threads, self.logger)
 
+    def _log_thread_memory(self):
+        # Each OpenMP thread that had any work to do accumulated its results in its own copy
+        # of the data vector.  With patches, there is instead a copy for each pair of patches
+        # that had any pairs.  Report how much memory these used.
+        nbytes = treecorr._lib.GetCorr2ThreadMemory(self.corr, self._d1, self._d2, self._bintype)
+        self.logger.info('Per-thread accumulators used %.1f MB.', nbytes / 2.**20)
+
     def _set_metric(self, metric, coords1, coords2=None):
         if metric is None:
             metric = treecorr.config.get(self.config,'metric',str,'Euclidean')
@@ -622,3 +664,138 @@ class BinnedCorr2(object):
         self.logger.info("Sampled %d pairs out of a total of %d.", n, ntot)
 
         return i1, i2, sep
+
+    def _set_npatch(self, cat1, cat2=None):
+        # Check that the catalogs agree about whether to use patches, and update npatch.
+        if cat2 is not None and (cat1.patch is None) != (cat2.patch is None):
+            raise ValueError("Either both or neither catalog may have patches.")
+        if cat1.patch is not None:
+            self.npatch = max(self.npatch, cat1.npatch)
+            if cat2 is not None:
+                self.npatch = max(self.npatch, cat2.npatch)
+
+    def _collect_patch_results(self):
+        # Get the results for each pair of patches from the C layer, and add them to results.
+        # The arrays for each patch pair are stacked in the same order as the arguments to
+        # BuildCorr2: xi0, xi1, xi2, xi3, meanr, meanlogr, weight, npairs.
+        from treecorr.util import double_ptr as dp
+        from treecorr.util import long_ptr as lp
+        npp = treecorr._lib.GetCorr2NPatchPairs(self.corr, self._d1, self._d2, self._bintype)
+        if npp == 0: return
+        p1 = np.empty(npp, dtype=int)
+        p2 = np.empty(npp, dtype=int)
+        rows = [np.zeros((npp, self._nbins), dtype=float) for k in range(8)]
+        treecorr._lib.TakeCorr2PatchResults(self.corr, self._d1, self._d2, self._bintype,
+                                            lp(p1), lp(p2), *[dp(r) for r in rows])
+        data = np.stack(rows, axis=1)
+        for i, j, d in zip(p1, p2, data):
+            key = (int(i), int(j))
+            if key in self.results:
+                self.results[key] += d
+            else:
+                self.results[key] = d
+        self._patch_arrays = None
+
+    def _clear_patch_results(self):
+        self.npatch = 1
+        self.results = {}
+        self._patch_arrays = None
+
+    def _add_patch_results(self, other):
+        self.npatch = max(self.npatch, other.npatch)
+        for key, d in other.results.items():
+            if key in self.results:
+                self.results[key] = self.results[key] + d
+            else:
+                self.results[key] = d.copy()
+        self._patch_arrays = None
+
+    def _sum_patch_results(self, m):
+        """Sum the results of the patch pairs, given the number of times, m, each patch is used.
+
+        A pair of different patches i,j is counted m[i]*m[j] times, and the pairs within a
+        single patch are counted m[i] times.
+
+        Returns:
+            The summed raw results, stacked as in the values of the results dict.
+        """
+        if self._patch_arrays is None:
+            keys = np.array(list(self.results.keys()), dtype=int).reshape(-1,2)
+            data = np.array(list(self.results.values())).reshape(-1,8,self._nbins)
+            self._patch_arrays = (keys, data)
+        keys, data = self._patch_arrays
+        i, j = keys[:,0], keys[:,1]
+        w = np.where(i == j, m[i], m[i] * m[j]).astype(float)
+        return np.tensordot(w, data, axes=1)
+
+    def _get_npatch(self):
+        return self.npatch
+
+    def _calculate_xi_from_pairs(self, m):
+        # Calculate the data vector for the covariance from the patch results, given the number
+        # of times each patch is used.  This works for the classes whose main result is the
+        # first xi array divided by the weight.  GGCorrelation and NNCorrelation override this.
+        raw = self._sum_patch_results(m)
+        xi = raw[0]
+        weight = raw[6]
+        mask1 = weight != 0
+        xi[mask1] /= weight[mask1]
+        xi[~mask1] = 0.
+        return xi
+
+    def estimate_cov(self, method='jackknife', num_bootstrap=500, rng=None):
+        """Estimate the covariance matrix of the correlation function using the patches.
+
+        This requires that the catalogs used to compute the correlation had patch numbers
+        (cf. the patch parameter of `Catalog`), so that the results for each pair of patches
+        were accumulated in the ``results`` attribute.  The correlation function is
+        recomputed from these for each resampling of the patches, so this is fast compared
+        to the original processing.
+
+        The valid methods are:
+
+            - 'jackknife': Each jackknife realization leaves out one patch, and the covariance
+              is :math:`(N-1)/N \\sum_k (\\xi_k - \\bar\\xi) (\\xi_k - \\bar\\xi)^T`.
+            - 'bootstrap': Each bootstrap realization selects N patches with replacement.
+              Pairs of objects in different patches i,j are counted m_i m_j times, where m_i
+              is the number of times patch i was selected, and pairs within a single patch are
+              counted m_i times.  The covariance is the sample covariance of the
+              realizations.
+
+        The data vector for the covariance matrix is the main correlation function for each
+        class (e.g. xi for most classes, or xip followed by xim for `GGCorrelation`).  For
+        `NNCorrelation`, `NNCorrelation.calculateXi` must have been called first with random
+        catalogs that also had patches.
+
+        The covariance matrix is also saved as the ``cov`` attribute.
+
+        Parameters:
+            method (str):       Which method to use: 'jackknife' or 'bootstrap'.
+                                (default: 'jackknife')
+            num_bootstrap (int): How many bootstrap realizations to use. (default: 500)
+            rng (RandomState):  A numpy RandomState to use for the bootstrap selections.
+                                (default: None, which means to make a new one)
+
+        Returns:
+            The estimated covariance matrix.
+        """
+        if len(self.results) == 0:
+            raise ValueError("No patch results are available.  Catalogs need patch numbers "
+                             "to estimate the covariance.")
+        npatch = self._get_npatch()
+        if method == 'jackknife':
+            ms = 1 - np.eye(npatch, dtype=int)
+        elif method == 'bootstrap':
+            if rng is None:
+                rng = np.random.RandomState()
+            ms = [np.bincount(rng.randint(npatch, size=npatch), minlength=npatch)
+                  for k in range(num_bootstrap)]
+        else:
+            raise ValueError("Invalid method for estimate_cov: %s"%method)
+        v = np.array([self._calculate_xi_from_pairs(m) for m in ms])
+        v -= np.mean(v, axis=0)
+        if method == 'jackknife':
+            self.cov = (1. - 1./npatch) * v.T.dot(v)
+        else:
+            self.cov = v.T.dot(v) / (num_bootstrap - 1)
+        return self.cov
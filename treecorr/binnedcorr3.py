@@ -512,6 +512,13 @@ class BinnedCorr3(object):
             self.logger.debug('Set num_threads = %d',num_threads)
         treecorr.set_omp_threads(num_threads, self.logger)
 
+    def _log_thread_memory(self):
+        # Each OpenMP thread that had any work to do accumulated its results in its own copy
+        # of the data vector.  Report how much memory these used.
+        nbytes = treecorr._lib.GetCorr3ThreadMemory(self.corr, self._d1, self._d2, self._d3,
+                                                  self._bintype)
+        self.logger.info('Per-thread accumulators used %.1f MB.', nbytes / 2.**20)
+
     def _set_metric(self, metric, coords1, coords2=None, coords3=None):
         if metric is None:
             metric = treecorr.config.get(self.config,'metric',str,'Euclidean')
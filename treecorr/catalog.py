@@ -18,6 +18,7 @@
 import numpy as np
 import coord
 import weakref
+import os
 import treecorr
 
 class Catalog(object):
@@ -50,8 +51,8 @@ class Catalog(object):
         >>> cat = treecorr.Catalog('data.fits', ra_col='ALPHA2000', dec_col='DELTA2000',
         ...                        g1_col='E1', g2_col='E2', ra_units='deg', dec_units='deg')
 
-    This reads the given columns from the input file.  The input file may be either
-    a FITS catalog or an ASCII catalog.  Normally the file type is determined according to the
+    This reads the given columns from the input file.  The input file may be a FITS, HDF5,
+    Parquet or ASCII catalog.  Normally the file type is determined according to the
     file's extension (e.g. '.fits' here), but it can also be set explicitly with **file_type**.
 
     Finally, you may store all the various parameters in a configuration dict
@@ -97,6 +98,12 @@ class Catalog(object):
         g1:     The g1 component of the shear, if defined, as a numpy array. (None otherwise)
         g2:     The g2 component of the shear, if defined, as a numpy array. (None otherwise)
         k:      The convergence, kappa, if defined, as a numpy array. (None otherwise)
+        patch:  The patch number of each object, if defined, as a numpy array. (None otherwise)
+
+        npatch: The number of patches.  (1 if patch is not defined)
+        patch_centers: The centers of the patches, if they were found with `run_kmeans` or
+                `assign_patches`, as a numpy array with shape (npatch, 2) for flat
+                coordinates or (npatch, 3) for 3d or spherical coordinates. (None otherwise)
 
         ntot:   The total number of objects (including those with zero weight)
         nobj:   The number of objects with non-zero weight
@@ -168,18 +175,43 @@ class Catalog(object):
                             spinor field.) (default: None)
         k (array):          The kappa values to use for scalar correlations. (This may represent
                             any scalar field.) (default: None)
+        patch (array):      An optional array of patch numbers (integers from 0 to npatch-1) for
+                            each object.  These are used to estimate the covariance matrix of
+                            correlation functions by jackknife or bootstrap resampling of the
+                            patches.  (default: None)  Alternatively, the patches may be found
+                            after construction with `run_kmeans`.
 
     Keyword Arguments:
 
-        file_type (str):    What kind of file is the input file. Valid options are 'ASCII' or
-                            'FITS' (default: if the file_name extension starts with .fit, then use
-                            'FITS', else 'ASCII')
+        file_type (str):    What kind of file is the input file. Valid options are 'ASCII',
+                            'FITS', 'HDF5' or 'Parquet' (default: if the file_name extension
+                            starts with .fit, then use 'FITS'; if it is .hdf5, .hdf or .h5, then
+                            use 'HDF5'; if it is .parquet or .pq or file_name is a directory, then
+                            use 'Parquet', else 'ASCII')
         delimiter (str):    For ASCII files, what delimiter to use between values. (default: None,
                             which means any whitespace)
         comment_marker (str): For ASCII files, what token indicates a comment line. (default: '#')
         first_row (int):    Which row to take as the first row to be used. (default: 1)
         last_row (int):     Which row to take as the last row to be used. (default: -1, which means
                             the last row in the file)
+        lazy (bool):        Whether to wait to read the g1, g2 and k columns from the file until
+                            they are first needed.  Then e.g. building an `NField` only reads the
+                            positions and weights.  Note that rows with NaN in g1, g2 or k get
+                            w=0, but in lazy mode this only happens when these columns are read.
+                            So a lazy catalog that is only used for NN correlations keeps the
+                            weights of these rows, unlike a normal catalog, and reading the
+                            columns later changes w, sumw and nobj and clears any fields that
+                            were already built (with a warning). (default: False)
+        cache_dir (str):    A directory in which to save the final arrays after reading a file.
+                            The next time the same file is read with the same parameters, the
+                            arrays are memory mapped from the cache rather than reading and
+                            processing the file again.  If the file changes (as determined by
+                            its size and modification time), it is read again.  (default: None,
+                            which means not to use a cache)
+        cache_fields (bool): Whether to also save the fields built from this catalog in the
+                            cache_dir entry for the file.  Then later runs that need the same
+                            field memory map the saved tree rather than building it again.
+                            cf. `Field.save` and `load_field`. (default: False)
 
         x_col (str or int): The column to use for the x values. This should be an integer for ASCII
                             files or a string for FITS files. (default: 0 or '0', which means not
@@ -235,6 +267,9 @@ class Catalog(object):
         wpos_col (str or int): The column to use for the position weight values. This should be an
                             integer for ASCII files or a string for FITS files. (default: 0 or '0',
                             which means not to read in this column.)
+        patch_col (str or int): The column to use for the patch numbers. This should be an
+                            integer for ASCII files or a string for FITS files. (default: 0 or
+                            '0', which means not to read in this column.)
         flag_col (str or int): The column to use for the flag values. This should be an integer for
                             ASCII files or a string for FITS files. Any row with flag != 0 (or
                             technically flag & ~ok_flag != 0) will be given a weight of 0.
@@ -260,6 +295,7 @@ class Catalog(object):
         w_hdu (int):        Which hdu to use for the w values. (default: hdu)
         wpos_hdu (int):     Which hdu to use for the wpos values. (default: hdu)
         flag_hdu (int):     Which hdu to use for the flag values. (default: hdu)
+        patch_hdu (int):    Which hdu to use for the patch values. (default: hdu)
 
         verbose (int):      If no logger is provided, this will optionally specify a logging level
                             to use.
@@ -286,6 +322,25 @@ class Catalog(object):
         cat_precision (int): The precision to use when writing a Catalog to an ASCII file. This
                             should be an integer, which specifies how many digits to write.
                             (default: 16)
+
+        copy_arrays (bool): Whether to copy the input arrays when they are passed in directly.
+                            If False, contiguous float64 arrays are used as is, and other
+                            arrays are only converted if necessary.  The input arrays are never
+                            modified in this case; any units for x, y, ra, dec are applied when
+                            these attributes are accessed (e.g. when building the fields),
+                            and w is only copied if some weights need to be set to zero.
+                            (default: True)
+
+        single_precision (bool): Whether to store the floating point arrays (positions, weights,
+                            and values) as float32 rather than float64, which halves the memory
+                            used by the catalog.  The positions are only accurate to about 1 part
+                            in 10^7 in this case.  This only applies to the catalog arrays.
+                            The trees are always double precision (the values are converted
+                            as the tree is built, without float64 copies of the arrays), so
+                            they use the same memory as without this option.  The correlation functions are also accumulated in
+                            double precision.
+                            With copy_arrays=False, contiguous float32 input arrays are then
+                            used as is.  (default: False)
     """
     # Dict describing the valid kwarg parameters, what types they are, and a description:
     # Each value is a tuple with the following elements:
@@ -295,7 +350,7 @@ class Catalog(object):
     #    list of valid values
     #    description
     _valid_params = {
-        'file_type' : (str, False, None, ['ASCII', 'FITS'],
+        'file_type' : (str, False, None, ['ASCII', 'FITS', 'HDF5', 'Parquet'],
                 'The file type of the input files. The default is to use the file name extension.'),
         'delimiter' : (str, True, None, None,
                 'The delimeter between values in an ASCII catalog. The default is any whitespace.'),
@@ -305,6 +360,8 @@ class Catalog(object):
                 'The first row to use from the input catalog'),
         'last_row' : (int, True, -1, None,
                 'The last row to use from the input catalog.  The default is to use all of them.'),
+        'lazy' : (bool, True, False, None,
+                'Whether to wait to read the g1, g2, k columns until they are needed.'),
         'x_col' : (str, True, '0', None,
                 'Which column to use for x. Should be an integer for ASCII catalogs.'),
         'y_col' : (str, True, '0', None,
@@ -338,6 +395,8 @@ class Catalog(object):
                 'Which column to use for position weight. Should be an integer for ASCII catalogs.'),
         'flag_col' : (str, True, '0', None,
                 'Which column to use for flag. Should be an integer for ASCII catalogs.'),
+        'patch_col' : (str, True, '0', None,
+                'Which column to use for patch numbers. Should be an integer for ASCII catalogs.'),
         'ignore_flag': (int, True, None, None,
                 'Ignore objects with flag & ignore_flag != 0 (bitwise &)'),
         'ok_flag': (int, True, 0, None,
@@ -368,6 +427,8 @@ class Catalog(object):
                 'Which HDU to use for the wpos_col. default is the global hdu value.'),
         'flag_hdu': (int, True, None, None,
                 'Which HDU to use for the flag_col. default is the global hdu value.'),
+        'patch_hdu': (int, True, None, None,
+                'Which HDU to use for the patch_col. default is the global hdu value.'),
         'flip_g1' : (bool, True, False, None,
                 'Whether to flip the sign of g1'),
         'flip_g2' : (bool, True, False, None,
@@ -382,10 +443,49 @@ class Catalog(object):
                 'Which method to use for splitting cells.'),
         'cat_precision' : (int, False, 16, None,
                 'The number of digits after the decimal in the output.'),
+        'copy_arrays' : (bool, False, True, None,
+                'Whether to copy arrays that are passed in directly.'),
+        'single_precision' : (bool, False, False, None,
+                'Whether to store the catalog arrays (not the trees) as float32 to save memory.'),
+        'cache_dir' : (str, False, None, None,
+                'A directory in which to cache the processed catalog arrays for faster reloading.'),
+        'cache_fields' : (bool, False, False, None,
+                'Whether to also save the fields built from this catalog in cache_dir.'),
     }
+    # The positions that may have units.  When copy_arrays=False, these may be views of the
+    # user's arrays, in which case the units are applied when the attribute is accessed.
+    def _scaled_column(name):
+        def getter(self):
+            a = getattr(self, '_'+name)
+            scale = getattr(self, '_'+name+'_scale')
+            return a if a is None or scale == 1. else a * scale
+        def setter(self, a):
+            setattr(self, '_'+name, a)
+            setattr(self, '_'+name+'_scale', 1.)
+        return property(getter, setter)
+    x = _scaled_column('x')
+    y = _scaled_column('y')
+    ra = _scaled_column('ra')
+    dec = _scaled_column('dec')
+    del _scaled_column
+
+    # The columns that may be read lazily from a file.  cf. lazy.
+    def _lazy_column(name):
+        def getter(self):
+            if name in self._lazy_cols:
+                self._read_lazy([name])
+            return getattr(self, '_'+name)
+        def setter(self, a):
+            setattr(self, '_'+name, a)
+        return property(getter, setter)
+    g1 = _lazy_column('g1')
+    g2 = _lazy_column('g2')
+    k = _lazy_column('k')
+    del _lazy_column
+
     def __init__(self, file_name=None, config=None, num=0, logger=None, is_rand=False,
                  x=None, y=None, z=None, ra=None, dec=None, r=None, w=None, wpos=None, flag=None,
-                 g1=None, g2=None, k=None, **kwargs):
+                 g1=None, g2=None, k=None, patch=None, **kwargs):
 
         self.config = treecorr.config.merge_config(config,kwargs,Catalog._valid_params)
         self.orig_config = config.copy() if config is not None else {}
@@ -400,6 +500,18 @@ class Catalog(object):
                     self.config.get('log_file',None))
 
         # Start with everything set to None.  Overwrite as appropriate.
+        self._copy_arrays = treecorr.config.get(self.config,'copy_arrays',bool,True)
+        self._single = treecorr.config.get(self.config,'single_precision',bool,False)
+        self._float = np.float32 if self._single else float  # The dtype of the float arrays.
+        self._w_shared = False  # Set to True if w is the user's array, so we can't modify it.
+        self._lazy_cols = {}    # Columns that haven't been read yet, and the function to read them.
+        self._lazy_read = None
+        self._nobj = self._sumw = self._varg = self._vark = None
+        self._field_dir = None  # Where to save built fields if cache_fields is set.
+        self._shm = None        # The shared memory block with the arrays.  cf. share_memory
+        self._shm_owner = False
+        self._shm_layout = []
+        self._shared_fields = {}
         self.x = None
         self.y = None
         self.z = None
@@ -412,22 +524,41 @@ class Catalog(object):
         self.g1 = None
         self.g2 = None
         self.k = None
+        self.patch = None
+        self.patch_centers = None
         self._setup_fields()
 
         # First style -- read from a file
+        cache_name = None
         if file_name is not None:
-            if any([v is not None for v in [x,y,z,ra,dec,r,g1,g2,k,w,wpos,flag]]):
+            if any([v is not None for v in [x,y,z,ra,dec,r,g1,g2,k,w,wpos,flag,patch]]):
                 raise TypeError("Vectors may not be provided when file_name is provided.")
             self.name = file_name
+
+            # If this file has been read before with the same parameters, use the cached arrays.
+            cache_dir = treecorr.config.get(self.config,'cache_dir',str,None)
+            if cache_dir is not None:
+                cache_name = self._cache_name(cache_dir, file_name, num, is_rand)
+                if treecorr.config.get(self.config,'cache_fields',bool,False):
+                    self._field_dir = cache_name
+                if os.path.exists(cache_name):
+                    self._read_cache(cache_name)
+                    self.logger.info("   nobj = %d",self.nobj)
+                    return
+
             self.logger.info("Reading input file %s",self.name)
+            self._lazy = treecorr.config.get_from_list(self.config,'lazy',num,bool,False)
 
             # Figure out which file type the catalog is
             file_type = treecorr.config.get_from_list(self.config,'file_type',num)
             if file_type is None:
-                import os
                 name, ext = os.path.splitext(file_name)
                 if ext.lower().startswith('.fit'):
                     file_type = 'FITS'
+                elif ext.lower() in ['.hdf5', '.hdf', '.h5']:
+                    file_type = 'HDF5'
+                elif ext.lower() in ['.parquet', '.pq'] or os.path.isdir(file_name):
+                    file_type = 'Parquet'
                 else:
                     file_type = 'ASCII'
                 self.logger.info("   file_type assumed to be %s from the file name.",file_type)
@@ -435,10 +566,16 @@ class Catalog(object):
             # Read the input file
             if file_type == 'FITS':
                 self.read_fits(file_name,num,is_rand)
+            elif file_type == 'HDF5':
+                self.read_hdf5(file_name,num,is_rand)
+            elif file_type == 'Parquet':
+                self.read_parquet(file_name,num,is_rand)
             elif file_type == 'ASCII':
                 self.read_ascii(file_name,num,is_rand)
             else:  # pragma: no cover (This is already ensured by the config processing)
                 raise ValueError("Invalid file_type %s"%file_type)
+            # Columns read without copying (e.g. from Parquet) may be read-only.
+            self._w_shared = self.w is not None and not self.w.flags.writeable
 
         # Second style -- pass in the vectors directly
         else:
@@ -456,21 +593,23 @@ class Catalog(object):
                 if g1 is None or g2 is None:
                     raise TypeError("g1 and g2 must both be provided")
             self.name = ''
-            self.x = self.makeArray(x,'x')
-            self.y = self.makeArray(y,'y')
-            self.z = self.makeArray(z,'z')
-            self.ra = self.makeArray(ra,'ra')
-            self.dec = self.makeArray(dec,'dec')
-            self.r = self.makeArray(r,'r')
-            self.w = self.makeArray(w,'w')
-            self.wpos = self.makeArray(wpos,'wpos')
+            self.x = self.makeArray(x,'x',self._float)
+            self.y = self.makeArray(y,'y',self._float)
+            self.z = self.makeArray(z,'z',self._float)
+            self.ra = self.makeArray(ra,'ra',self._float)
+            self.dec = self.makeArray(dec,'dec',self._float)
+            self.r = self.makeArray(r,'r',self._float)
+            self.w = self.makeArray(w,'w',self._float)
+            self.wpos = self.makeArray(wpos,'wpos',self._float)
             self.flag = self.makeArray(flag,'flag',int)
-            self.g1 = self.makeArray(g1,'g1')
-            self.g2 = self.makeArray(g2,'g2')
-            self.k = self.makeArray(k,'k')
+            self.g1 = self.makeArray(g1,'g1',self._float)
+            self.g2 = self.makeArray(g2,'g2',self._float)
+            self.k = self.makeArray(k,'k',self._float)
+            self.patch = self.makeArray(patch,'patch',int)
+            self._w_shared = self.w is not None and not self._copy_arrays
 
         # Apply units to x,y,ra,dec
-        if self.x is not None:
+        if self._x is not None:
             if 'x_units' in self.config and not 'y_units' in self.config:
                 raise TypeError("x_units specified without specifying y_units")
             if 'y_units' in self.config and not 'x_units' in self.config:
@@ -481,8 +620,14 @@ class Catalog(object):
                 raise TypeError("dec_units is invalid without dec")
             self.x_units = treecorr.config.get_from_list(self.config,'x_units',num,str,'radians')
             self.y_units = treecorr.config.get_from_list(self.config,'y_units',num,str,'radians')
-            self.x *= self.x_units
-            self.y *= self.y_units
+            if ((self._copy_arrays or file_name is not None) and
+                    self._x.flags.writeable and self._y.flags.writeable):
+                self._x *= self.x_units
+                self._y *= self.y_units
+            else:
+                # Don't modify the input arrays.  Apply the units when x,y are accessed.
+                self._x_scale = self.x_units
+                self._y_scale = self.y_units
         else:
             if not self.config.get('ra_units',None):
                 raise TypeError("ra_units is required when using ra, dec")
@@ -494,18 +639,20 @@ class Catalog(object):
                 raise TypeError("y_units is invalid without y")
             self.ra_units = treecorr.config.get_from_list(self.config,'ra_units',num)
             self.dec_units = treecorr.config.get_from_list(self.config,'dec_units',num)
-            self.ra *= self.ra_units
-            self.dec *= self.dec_units
+            if ((self._copy_arrays or file_name is not None) and
+                    self._ra.flags.writeable and self._dec.flags.writeable):
+                self._ra *= self.ra_units
+                self._dec *= self.dec_units
+            else:
+                # Don't modify the input arrays.  Apply the units when ra,dec are accessed.
+                self._ra_scale = self.ra_units
+                self._dec_scale = self.dec_units
 
         # Apply flips if requested
-        flip_g1 = treecorr.config.get_from_list(self.config,'flip_g1',num,bool,False)
-        flip_g2 = treecorr.config.get_from_list(self.config,'flip_g2',num,bool,False)
-        if flip_g1:
-            self.logger.info("   Flipping sign of g1.")
-            self.g1 = -self.g1
-        if flip_g2:
-            self.logger.info("   Flipping sign of g2.")
-            self.g2 = -self.g2
+        self._flip_g1 = treecorr.config.get_from_list(self.config,'flip_g1',num,bool,False)
+        self._flip_g2 = treecorr.config.get_from_list(self.config,'flip_g2',num,bool,False)
+        if 'g1' not in self._lazy_cols:
+            self._apply_flips()
 
         # Convert the flag to a weight
         if self.flag is not None:
@@ -517,17 +664,17 @@ class Catalog(object):
             # If we don't already have a weight column, make one with all values = 1.
             if self.w is None:
                 self.w = np.ones_like(self.flag, dtype=float)
-            self.w[(self.flag & ignore_flag)!=0] = 0
+            self._writable_w()[(self.flag & ignore_flag)!=0] = 0
             self.logger.debug('Applied flag: w => %s',str(self.w))
 
         # Check that all columns have the same length:
-        if self.x is not None:
-            self.ntot = len(self.x)
-            if len(self.y) != self.ntot:
+        if self._x is not None:
+            self.ntot = len(self._x)
+            if len(self._y) != self.ntot:
                 raise ValueError("x and y have different numbers of elements")
         else:
-            self.ntot = len(self.ra)
-            if len(self.dec) != self.ntot:
+            self.ntot = len(self._ra)
+            if len(self._dec) != self.ntot:
                 raise ValueError("ra and dec have different numbers of elements")
         if self.ntot == 0:
             raise ValueError("Catalog has no objects!")
@@ -539,52 +686,48 @@ class Catalog(object):
             raise ValueError("w has the wrong numbers of elements")
         if self.wpos is not None and len(self.wpos) != self.ntot:
             raise ValueError("wpos has the wrong numbers of elements")
-        if self.g1 is not None and len(self.g1) != self.ntot:
+        if self._g1 is not None and len(self._g1) != self.ntot:
             raise ValueError("g1 has the wrong numbers of elements")
-        if self.g2 is not None and len(self.g2) != self.ntot:
+        if self._g2 is not None and len(self._g2) != self.ntot:
             raise ValueError("g1 has the wrong numbers of elements")
-        if self.k is not None and len(self.k) != self.ntot:
+        if self._k is not None and len(self._k) != self.ntot:
             raise ValueError("k has the wrong numbers of elements")
+        if self.patch is not None and len(self.patch) != self.ntot:
+            raise ValueError("patch has the wrong numbers of elements")
 
         # Update the data according to the specified first and last row
-        first_row = treecorr.config.get_from_list(self.config,'first_row',num,int,1)
-        if first_row < 1:
-            raise ValueError("first_row should be >= 1")
-        last_row = treecorr.config.get_from_list(self.config,'last_row',num,int,-1)
-        if last_row > 0 and last_row < first_row:
-            raise ValueError("last_row should be >= first_row")
-        if last_row > 0:
-            end = last_row
-        else:
-            end = self.ntot
-        if first_row > 1:
-            start = first_row-1
-        else:
+        # (Files only read the requested rows in the first place.)
+        start, end = self._get_row_range(num)
+        if file_name is not None:
             start = 0
-        self.ntot = end-start
-        self.logger.debug('start..end = %d..%d',start,end)
-        if self.x is not None: self.x = self.x[start:end]
-        if self.y is not None: self.y = self.y[start:end]
-        if self.z is not None: self.z = self.z[start:end]
-        if self.ra is not None: self.ra = self.ra[start:end]
-        if self.dec is not None: self.dec = self.dec[start:end]
-        if self.r is not None: self.r = self.r[start:end]
-        if self.w is not None: self.w = self.w[start:end]
-        if self.wpos is not None: self.wpos = self.wpos[start:end]
-        if self.g1 is not None: self.g1 = self.g1[start:end]
-        if self.g2 is not None: self.g2 = self.g2[start:end]
-        if self.k is not None: self.k = self.k[start:end]
+        if file_name is not None or end is None or end > self.ntot:
+            end = self.ntot
+        if start > 0 or end < self.ntot:
+            self.ntot = end-start
+            self.logger.debug('start..end = %d..%d',start,end)
+            if self._x is not None: self._x = self._x[start:end]
+            if self._y is not None: self._y = self._y[start:end]
+            if self.z is not None: self.z = self.z[start:end]
+            if self._ra is not None: self._ra = self._ra[start:end]
+            if self._dec is not None: self._dec = self._dec[start:end]
+            if self.r is not None: self.r = self.r[start:end]
+            if self.w is not None: self.w = self.w[start:end]
+            if self.wpos is not None: self.wpos = self.wpos[start:end]
+            if self._g1 is not None: self._g1 = self._g1[start:end]
+            if self._g2 is not None: self._g2 = self._g2[start:end]
+            if self._k is not None: self._k = self._k[start:end]
+            if self.patch is not None: self.patch = self.patch[start:end]
 
         # Check for NaN's:
-        self.checkForNaN(self.x,'x')
-        self.checkForNaN(self.y,'y')
+        self.checkForNaN(self._x,'x')
+        self.checkForNaN(self._y,'y')
         self.checkForNaN(self.z,'z')
-        self.checkForNaN(self.ra,'ra')
-        self.checkForNaN(self.dec,'dec')
+        self.checkForNaN(self._ra,'ra')
+        self.checkForNaN(self._dec,'dec')
         self.checkForNaN(self.r,'r')
-        self.checkForNaN(self.g1,'g1')
-        self.checkForNaN(self.g2,'g2')
-        self.checkForNaN(self.k,'k')
+        self.checkForNaN(self._g1,'g1')
+        self.checkForNaN(self._g2,'g2')
+        self.checkForNaN(self._k,'k')
         self.checkForNaN(self.w,'w')
         self.checkForNaN(self.wpos,'wpos')
 
@@ -602,45 +745,21 @@ class Catalog(object):
                     if np.any(self.w[self.wpos == 0.] != 0.):
                         self.logger.error('Some wpos values = 0 but have w!=0. This is invalid.\n'
                                           'Setting w=0 for these points.')
-                self.w[self.wpos == 0.] = 0.
+                self._writable_w()[self.wpos == 0.] = 0.
 
-        # Calculate some summary parameters here that will typically be needed
+        # The summary parameters (nobj, sumw, varg, vark) are calculated when they are needed.
         if self.w is not None:
             self.nontrivial_w = True
-            use = self.w != 0
-            self.nobj = np.sum(use)
-            self.sumw = np.sum(self.w)
             if self.sumw == 0.:
                 raise ValueError("Catalog has invalid sumw == 0")
-            if self.g1 is not None:
-                self.varg = np.sum(self.w[use]**2 * (self.g1[use]**2 + self.g2[use]**2))
-                # The 2 is because we need the variance _per componenet_.
-                self.varg /= 2.*self.sumw
-            else:
-                self.varg = 0.
-            if self.k is not None:
-                self.vark = np.sum(self.w[use]**2 * self.k[use]**2)
-                self.vark /= self.sumw
-            else:
-                self.vark = 0.
         else:
             self.nontrivial_w = False
-            self.nobj = self.ntot
-            self.sumw = self.ntot
-            if self.g1 is not None:
-                self.varg = np.sum(self.g1**2 + self.g2**2) / (2.*self.nobj)
-            else:
-                self.varg = 0.
-            if self.k is not None:
-                self.vark = np.sum(self.k**2) / self.nobj
-            else:
-                self.vark = 0.
             self.w = np.ones((self.ntot), dtype=float)
 
-        if self.ra is not None:
+        if self._ra is not None:
             # Should have already been checked above, so just use assert here.
-            assert self.x is None
-            assert self.y is None
+            assert self._x is None
+            assert self._y is None
             assert self.z is None
             self.x, self.y, self.z = coord.CelestialCoord.radec_to_xyz(self.ra, self.dec)
             if self.r is None:
@@ -657,8 +776,21 @@ class Catalog(object):
             else:
                 self.coords = '3d'
 
+        if self._single:
+            self._use_single_precision(Catalog._float_cols)
+
+        if self.patch is not None:
+            if np.any(self.patch < 0):
+                raise ValueError("patch numbers must be >= 0")
+            self.npatch = int(np.max(self.patch)) + 1
+        else:
+            self.npatch = 1
+
         self.logger.info("   nobj = %d",self.nobj)
 
+        if cache_name is not None:
+            self._write_cache(cache_name)
+
 
     def makeArray(self, col, col_str, dtype=float):
         """Turn the input column into a numpy array if it wasn't already.
@@ -673,7 +805,11 @@ class Catalog(object):
             The column converted to a 1-d numpy array.
         """
         if col is not None:
-            col = np.array(col,dtype=dtype)
+            if self._copy_arrays:
+                col = np.array(col,dtype=dtype)
+            else:
+                # This only makes a copy if it needs to.
+                col = np.ascontiguousarray(col,dtype=dtype)
             if len(col.shape) != 1:
                 s = col.shape
                 col = col.reshape(-1)
@@ -695,11 +831,202 @@ class Catalog(object):
                                 col_str,str(index.tolist())))
             if self.w is None:
                 self.w = np.ones_like(col, dtype=float)
-            self.w[index] = 0
+            self._writable_w()[index] = 0
+
+    def _writable_w(self):
+        # With copy_arrays=False, w may be the user's array, so copy it before modifying it.
+        if self._w_shared:
+            self.w = self.w.copy()
+            self._w_shared = False
+        return self.w
+
+    def _apply_flips(self):
+        if self._flip_g1:
+            self.logger.info("   Flipping sign of g1.")
+            self.g1 = -self.g1
+        if self._flip_g2:
+            self.logger.info("   Flipping sign of g2.")
+            self.g2 = -self.g2
+
+    # The floating point arrays, which are float32 with single_precision=True.
+    # (The underscore names are the ones that may be scaled or read lazily on access.)
+    _float_cols = ['_x', '_y', 'z', '_ra', '_dec', 'r', 'w', 'wpos', '_g1', '_g2', '_k']
+
+    def _use_single_precision(self, names):
+        # Convert the given arrays to float32, unless they already are.
+        for name in names:
+            a = getattr(self, name)
+            if a is not None and a.dtype != np.float32:
+                setattr(self, name, a.astype(np.float32))
+                if name == 'w':
+                    self._w_shared = False
+
+    def _read_columns(self, cols, read):
+        # Read the columns in cols with read(cols).  If lazy, g1, g2, k are set aside to be read
+        # with the same function when they are first accessed.
+        if self._lazy:
+            for name in ['g1', 'g2', 'k']:
+                if name in cols:
+                    self._lazy_cols[name] = cols.pop(name)
+            if self._lazy_cols:
+                self._lazy_read = read
+        read(cols)
+
+    def _read_lazy(self, names):
+        # Read the given columns, which were deferred in lazy mode.  g1 and g2 are always
+        # read together.
+        if 'g1' in names or 'g2' in names:
+            names = names + ['g1', 'g2']
+        cols = {}
+        for name in names:
+            if name in self._lazy_cols:
+                cols[name] = self._lazy_cols.pop(name)
+        self.logger.info("Reading %s from input file %s",', '.join(sorted(cols)),self.name)
+        self._lazy_read(cols)
+        if not self._lazy_cols:
+            self._lazy_read = None
+
+        for name in cols:
+            if len(getattr(self, '_'+name)) != self.ntot:
+                raise ValueError("%s has the wrong numbers of elements"%name)
+        if self._single:
+            self._use_single_precision(['_'+name for name in cols])
+        if 'g1' in cols:
+            self._apply_flips()
+
+        # NaNs in these columns set w=0 for those objects, which changes anything calculated
+        # from the weights, including any fields that have already been built.
+        if any(np.any(np.isnan(getattr(self, '_'+name))) for name in cols):
+            caches = [self.nfields, self.kfields, self.gfields,
+                      self.nsimplefields, self.ksimplefields, self.gsimplefields]
+            if any(cache.count > 0 for cache in caches):
+                self.logger.warning(
+                    "Warning: NaNs in the lazily read %s column(s) change the weights of "
+                    "catalog %s after fields were already built from it.  Any results using "
+                    "those fields used the old weights.", ', '.join(sorted(cols)), self.name)
+            for name in sorted(cols):
+                self.checkForNaN(getattr(self, '_'+name), name)
+            self.nontrivial_w = True
+            self._nobj = self._sumw = self._varg = self._vark = None
+            self.clear_cache()
+
+    @property
+    def nobj(self):
+        if self._nobj is None:
+            self._nobj = np.sum(self.w != 0) if self.nontrivial_w else self.ntot
+        return self._nobj
+
+    @property
+    def sumw(self):
+        if self._sumw is None:
+            self._sumw = np.sum(self.w, dtype=float) if self.nontrivial_w else self.ntot
+        return self._sumw
+
+    @property
+    def varg(self):
+        if self._varg is None:
+            if self.g1 is None:
+                self._varg = 0.
+            elif self.nontrivial_w:
+                use = self.w != 0
+                self._varg = np.sum(self.w[use]**2 * (self.g1[use]**2 + self.g2[use]**2),
+                                    dtype=float)
+                # The 2 is because we need the variance _per componenet_.
+                self._varg /= 2.*self.sumw
+            else:
+                self._varg = np.sum(self.g1**2 + self.g2**2, dtype=float) / (2.*self.nobj)
+        return self._varg
+
+    @property
+    def vark(self):
+        if self._vark is None:
+            if self.k is None:
+                self._vark = 0.
+            elif self.nontrivial_w:
+                use = self.w != 0
+                self._vark = np.sum(self.w[use]**2 * self.k[use]**2, dtype=float)
+                self._vark /= self.sumw
+            else:
+                self._vark = np.sum(self.k**2, dtype=float) / self.nobj
+        return self._vark
+
+    # The columns and other attributes that are saved in the catalog cache.  cf. cache_dir
+    _cache_cols = ['x', 'y', 'z', 'ra', 'dec', 'r', 'w', 'wpos', 'flag', 'g1', 'g2', 'k', 'patch']
+    _cache_attrs = ['ntot', 'coords', 'nontrivial_w', 'npatch',
+                    'x_units', 'y_units', 'ra_units', 'dec_units']
+    # The parameters that don't affect the catalog arrays, so they aren't part of the cache key.
+    _cache_ignore = ['verbose', 'log_file', 'split_method', 'cat_precision', 'copy_arrays',
+                     'lazy', 'cache_dir', 'cache_fields']
+
+    def _cache_name(self, cache_dir, file_name, num, is_rand):
+        # The cache is keyed by the file name, size and modification time (of each file if
+        # file_name is a directory), along with all the parameters that affect the arrays.
+        import hashlib
+        if os.path.isdir(file_name):
+            files = [os.path.join(file_name, f) for f in sorted(os.listdir(file_name))]
+        else:
+            files = [file_name]
+        stats = [(f, os.stat(f).st_size, os.stat(f).st_mtime) for f in files]
+        params = sorted((key, value) for key, value in self.config.items()
+                        if key in Catalog._valid_params and key not in Catalog._cache_ignore)
+        key = repr((os.path.abspath(file_name), stats, num, bool(is_rand), params))
+        return os.path.join(cache_dir, hashlib.sha1(key.encode()).hexdigest())
+
+    def _write_cache(self, cache_name):
+        # Write the final arrays as .npy files, which can be memory mapped when reading them.
+        # They are written to a temporary directory first, so other processes reading the same
+        # file never see an incomplete cache.
+        import json
+        import shutil
+        import tempfile
+        cache_dir = os.path.dirname(cache_name)
+        try:
+            os.makedirs(cache_dir)
+        except OSError:
+            if not os.path.isdir(cache_dir): raise
+        tmp_name = tempfile.mkdtemp(dir=cache_dir)
+        for name in Catalog._cache_cols:
+            array = getattr(self, name)
+            if array is not None:
+                np.save(os.path.join(tmp_name, name+'.npy'), array)
+        attrs = {}
+        for name in Catalog._cache_attrs:
+            if hasattr(self, name):
+                value = getattr(self, name)
+                attrs[name] = value if isinstance(value, str) else float(value)
+        with open(os.path.join(tmp_name, 'attrs.json'), 'w') as fid:
+            json.dump(attrs, fid)
+        try:
+            os.rename(tmp_name, cache_name)
+            self.logger.info("Wrote catalog cache %s",cache_name)
+        except OSError:  # pragma: no cover  (Another process wrote the same cache first.)
+            shutil.rmtree(tmp_name)
+
+    def _read_cache(self, cache_name):
+        import json
+        self.logger.info("Reading input file %s from cache %s",self.name,cache_name)
+        for name in Catalog._cache_cols:
+            file_name = os.path.join(cache_name, name+'.npy')
+            if os.path.exists(file_name):
+                setattr(self, name, np.load(file_name, mmap_mode='r'))
+        with open(os.path.join(cache_name, 'attrs.json')) as fid:
+            attrs = json.load(fid)
+        for name in attrs:
+            setattr(self, name, attrs[name])
+        self.ntot = int(self.ntot)
+        self.npatch = int(self.npatch)
+        self.nontrivial_w = bool(self.nontrivial_w)
+        self._lazy = False
+        self._flip_g1 = self._flip_g2 = False
+        # The memory mapped arrays are read-only.
+        self._w_shared = True
 
     def read_ascii(self, file_name, num=0, is_rand=False):
         """Read the catalog from an ASCII file
 
+        The file is parsed by a multi-threaded C++ reader, which only converts the columns
+        that are actually needed and only the rows between first_row and last_row.
+
         Parameters:
             file_name (str):    The name of the file to read in.
             num (int):          Which number catalog are we reading. (default: 0)
@@ -707,40 +1034,22 @@ class Catalog(object):
         """
         comment_marker = self.config.get('comment_marker','#')
         delimiter = self.config.get('delimiter',None)
-        try:
-            import pandas
-            # I want read_csv to ignore header lines that start with the comment marker, but
-            # there is currently a bug in read_csv that messing things up when we do this.
-            # cf. https://github.com/pydata/pandas/issues/4623
-            # For now, my workaround in to count how many lines start with the comment marker
-            # and skip them by hand.
-            skip = 0
-            with open(file_name, 'r') as fid:
-                for line in fid:  # pragma: no branch
-                    if line.startswith(comment_marker): skip += 1
-                    else: break
-            if delimiter is None:
-                data = pandas.read_csv(file_name, comment=comment_marker, delim_whitespace=True,
-                                       header=None, skiprows=skip)
-            else:
-                data = pandas.read_csv(file_name, comment=comment_marker, delimiter=delimiter,
-                                       header=None, skiprows=skip)
-            data = data.dropna(axis=0).values
-        except ImportError:
-            self.logger.warning("Unable to import pandas..  Using np.genfromtxt instead.\n"+
-                                "Installing pandas is recommended for increased speed when "+
-                                "reading ASCII catalogs.")
-            data = np.genfromtxt(file_name, comments=comment_marker, delimiter=delimiter)
-
-        self.logger.debug('read data from %s, num=%d',file_name,num)
-        self.logger.debug('data shape = %s',str(data.shape))
+        start, end = self._get_row_range(num)
 
-        # If only one row, and not using pands, then the shape comes in as one-d.  Reshape it:
-        if len(data.shape) == 1:
-            data = data.reshape(1,-1)
-        if len(data.shape) != 2:  # pragma: no cover
-            raise IOError('Unable to parse the input catalog as a 2-d array')
-        ncols = data.shape[1]
+        if delimiter is not None and len(delimiter) != 1:
+            # The C++ reader only handles single-character delimiters.
+            data = self._read_ascii_data(file_name, comment_marker, delimiter)
+            data = data[start:end]
+            ncols = data.shape[1]
+        else:
+            nc = np.zeros(1, dtype=int)
+            nrows = treecorr._lib.CountAsciiRows(file_name.encode(), comment_marker.encode(),
+                                                 ord(delimiter or '\0'),
+                                                 treecorr.util.long_ptr(nc))
+            if nrows < 0:
+                raise IOError("Unable to open %s"%file_name)
+            ncols = nc[0]
+            self.logger.debug('file %s has %d rows, %d columns',file_name,nrows,ncols)
 
         # Get the column numbers or names
         x_col = treecorr.config.get_from_list(self.config,'x_col',num,int,0)
@@ -752,11 +1061,13 @@ class Catalog(object):
         w_col = treecorr.config.get_from_list(self.config,'w_col',num,int,0)
         wpos_col = treecorr.config.get_from_list(self.config,'wpos_col',num,int,0)
         flag_col = treecorr.config.get_from_list(self.config,'flag_col',num,int,0)
+        patch_col = treecorr.config.get_from_list(self.config,'patch_col',num,int,0)
         g1_col = treecorr.config.get_from_list(self.config,'g1_col',num,int,0)
         g2_col = treecorr.config.get_from_list(self.config,'g2_col',num,int,0)
         k_col = treecorr.config.get_from_list(self.config,'k_col',num,int,0)
 
-        # Read x,y or ra,dec
+        # Check the columns and collect the ones we need to read.
+        cols = {}
         if x_col != 0 or y_col != 0:
             if x_col <= 0 or x_col > ncols:
                 raise TypeError("x_col missing or invalid for file %s"%file_name)
@@ -770,16 +1081,10 @@ class Catalog(object):
                 raise TypeError("dec_col not allowed in conjunction with x/y cols")
             if r_col != 0:
                 raise TypeError("r_col not allowed in conjunction with x/y cols")
-            # NB. astype always copies, even if the type is already correct.
-            # We actually want this, since it makes the result contiguous in memory,
-            # which we will need.
-            self.x = data[:,x_col-1].astype(float)
-            self.logger.debug('read x = %s',str(self.x))
-            self.y = data[:,y_col-1].astype(float)
-            self.logger.debug('read y = %s',str(self.y))
+            cols['x'] = x_col
+            cols['y'] = y_col
             if z_col != 0:
-                self.z = data[:,z_col-1].astype(float)
-                self.logger.debug('read r = %s',str(self.r))
+                cols['z'] = z_col
         elif ra_col != 0 or dec_col != 0:
             if ra_col <= 0 or ra_col > ncols:
                 raise TypeError("ra_col missing or invalid for file %s"%file_name)
@@ -789,67 +1094,142 @@ class Catalog(object):
                 raise TypeError("r_col is invalid for file %s"%file_name)
             if z_col != 0:
                 raise TypeError("z_col not allowed in conjunction with ra/dec cols")
-            self.ra = data[:,ra_col-1].astype(float)
-            self.logger.debug('read ra = %s',str(self.ra))
-            self.dec = data[:,dec_col-1].astype(float)
-            self.logger.debug('read dec = %s',str(self.dec))
+            cols['ra'] = ra_col
+            cols['dec'] = dec_col
             if r_col != 0:
-                self.r = data[:,r_col-1].astype(float)
-                self.logger.debug('read r = %s',str(self.r))
+                cols['r'] = r_col
         else:
             raise TypeError("No valid position columns specified for file %s"%file_name)
 
-        # Read w
         if w_col != 0:
             if w_col <= 0 or w_col > ncols:
                 raise TypeError("w_col is invalid for file %s"%file_name)
-            self.w = data[:,w_col-1].astype(float)
-            self.logger.debug('read w = %s',str(self.w))
+            cols['w'] = w_col
 
-        # Read wpos
         if wpos_col != 0:
             if wpos_col <= 0 or wpos_col > ncols:
                 raise TypeError("wpos_col is invalid for file %s"%file_name)
-            self.wpos = data[:,wpos_col-1].astype(float)
-            self.logger.debug('read wpos = %s',str(self.wpos))
+            cols['wpos'] = wpos_col
 
-        # Read flag
         if flag_col != 0:
             if flag_col <= 0 or flag_col > ncols:
                 raise TypeError("flag_col is invalid for file %s"%file_name)
-            self.flag = data[:,flag_col-1].astype(int)
-            self.logger.debug('read flag = %s',str(self.flag))
+            cols['flag'] = flag_col
 
-        # Return here if this file is a random catalog
-        if is_rand: return
+        if patch_col != 0:
+            if patch_col <= 0 or patch_col > ncols:
+                raise TypeError("patch_col is invalid for file %s"%file_name)
+            cols['patch'] = patch_col
 
-        # Read g1,g2
-        if (g1_col != 0 or g2_col != 0):
-            if g1_col <= 0 or g1_col > ncols or g2_col <= 0 or g2_col > ncols:
-                if isGColRequired(self.orig_config,num):
-                    raise TypeError("g1_col, g2_col are invalid for file %s"%file_name)
+        # Skip g1,g2,k if this file is a random catalog
+        if not is_rand:
+            if (g1_col != 0 or g2_col != 0):
+                if g1_col <= 0 or g1_col > ncols or g2_col <= 0 or g2_col > ncols:
+                    if isGColRequired(self.orig_config,num):
+                        raise TypeError("g1_col, g2_col are invalid for file %s"%file_name)
+                    else:
+                        self.logger.warning("Warning: skipping g1_col, g2_col for %s, num=%d "%(
+                                            file_name,num) +
+                                            "because they are invalid, but unneeded.")
                 else:
-                    self.logger.warning("Warning: skipping g1_col, g2_col for %s, num=%d "%(
-                                        file_name,num) +
-                                        "because they are invalid, but unneeded.")
-            else:
-                self.g1 = data[:,g1_col-1].astype(float)
-                self.logger.debug('read g1 = %s',str(self.g1))
-                self.g2 = data[:,g2_col-1].astype(float)
-                self.logger.debug('read g2 = %s',str(self.g2))
-
-        # Read k
-        if k_col != 0:
-            if k_col <= 0 or k_col > ncols:
-                if isKColRequired(self.orig_config,num):
-                    raise TypeError("k_col is invalid for file %s"%file_name)
+                    cols['g1'] = g1_col
+                    cols['g2'] = g2_col
+
+            if k_col != 0:
+                if k_col <= 0 or k_col > ncols:
+                    if isKColRequired(self.orig_config,num):
+                        raise TypeError("k_col is invalid for file %s"%file_name)
+                    else:
+                        self.logger.warning("Warning: skipping k_col for %s, num=%d "%(
+                                            file_name,num) +
+                                            "because it is invalid, but unneeded.")
                 else:
-                    self.logger.warning("Warning: skipping k_col for %s, num=%d "%(file_name,num)+
-                                        "because it is invalid, but unneeded.")
-            else:
-                self.k = data[:,k_col-1].astype(float)
-                self.logger.debug('read k = %s',str(self.k))
+                    cols['k'] = k_col
+
+        # Read the columns we need
+        if delimiter is not None and len(delimiter) != 1:
+            # The data are already read in, so there is no point in deferring any columns.
+            for name in cols:
+                # NB. astype always copies, even if the type is already correct.
+                # We actually want this, since it makes the result contiguous in memory,
+                # which we will need.
+                self._set_column(name, data[:,cols[name]-1].astype(float))
+        else:
+            if end is None or end > nrows: end = nrows
+            def read(cols):
+                self._read_ascii_columns(file_name, cols, comment_marker, delimiter, start, end)
+            self._read_columns(cols, read)
+        self.logger.debug('read data from %s, num=%d',file_name,num)
 
+    def _read_ascii_columns(self, file_name, cols, comment_marker, delimiter, start, end):
+        # Read the given columns (name -> column number) from rows start..end of the file.
+        names = list(cols.keys())
+        n = max(end-start, 0)
+        arrays = [ np.empty(n, dtype=float) for name in names ]
+        col_nums = np.array([cols[name] for name in names], dtype=int)
+        err_row = np.zeros(1, dtype=int)
+        out = treecorr._ffi.new('double*[]', [treecorr.util.double_ptr(a) for a in arrays])
+        nread = treecorr._lib.ReadAsciiColumns(
+                file_name.encode(), comment_marker.encode(), ord(delimiter or '\0'),
+                start, end, treecorr.util.long_ptr(col_nums), len(names), out,
+                treecorr.util.long_ptr(err_row))
+        if nread == -1:  # pragma: no cover  (Only if the file changed since counting.)
+            raise IOError("Unable to open %s"%file_name)
+        if nread == -2:
+            raise ValueError("Unable to parse row %d of %s as numbers"%(
+                             err_row[0]+1, file_name))
+        for name, array in zip(names, arrays):
+            self._set_column(name, array)
+
+    def _set_column(self, name, array):
+        if name in ['flag', 'patch']:
+            array = array.astype(int)
+        setattr(self, name, array)
+        self.logger.debug('read %s = %s',name,str(array))
+
+    def _read_ascii_data(self, file_name, comment_marker, delimiter):
+        # Read all the columns into a 2-d array using pandas or numpy.
+        try:
+            import pandas
+            # I want read_csv to ignore header lines that start with the comment marker, but
+            # there is currently a bug in read_csv that messing things up when we do this.
+            # cf. https://github.com/pydata/pandas/issues/4623
+            # For now, my workaround in to count how many lines start with the comment marker
+            # and skip them by hand.
+            skip = 0
+            with open(file_name, 'r') as fid:
+                for line in fid:  # pragma: no branch
+                    if line.startswith(comment_marker): skip += 1
+                    else: break
+            data = pandas.read_csv(file_name, comment=comment_marker, delimiter=delimiter,
+                                   header=None, skiprows=skip)
+            data = data.dropna(axis=0).values
+        except ImportError:
+            self.logger.warning("Unable to import pandas..  Using np.genfromtxt instead.\n"+
+                                "Installing pandas is recommended for increased speed when "+
+                                "reading ASCII catalogs.")
+            data = np.genfromtxt(file_name, comments=comment_marker, delimiter=delimiter)
+
+        self.logger.debug('data shape = %s',str(data.shape))
+
+        # If only one row, and not using pands, then the shape comes in as one-d.  Reshape it:
+        if len(data.shape) == 1:
+            data = data.reshape(1,-1)
+        if len(data.shape) != 2:  # pragma: no cover
+            raise IOError('Unable to parse the input catalog as a 2-d array')
+        return data
+
+    def _get_row_range(self, num):
+        # Get the range of rows to use from first_row, last_row.
+        # Returns start, end as for a slice, with end=None meaning through the end.
+        first_row = treecorr.config.get_from_list(self.config,'first_row',num,int,1)
+        if first_row < 1:
+            raise ValueError("first_row should be >= 1")
+        last_row = treecorr.config.get_from_list(self.config,'last_row',num,int,-1)
+        if last_row > 0 and last_row < first_row:
+            raise ValueError("last_row should be >= first_row")
+        end = last_row if last_row > 0 else None
+        return first_row-1, end
 
     def read_fits(self, file_name, num=0, is_rand=False):
         """Read the catalog from a FITS file
@@ -865,7 +1245,25 @@ class Catalog(object):
             self.logger.error("Unable to import fitsio.  Cannot read catalog %s"%file_name)
             raise
 
-        # Get the column names
+        hdu = treecorr.config.get_from_list(self.config,'hdu',num,int,1)
+        start, end = self._get_row_range(num)
+
+        with fitsio.FITS(file_name, 'r') as fits:
+            def find_col(name, col):
+                h = treecorr.config.get_from_list(self.config,name+'_hdu',num,int,hdu)
+                return (h, col) if col in fits[h].get_colnames() else None
+            cols = self._get_named_cols(file_name, num, is_rand, find_col)
+
+        # If lazy, some of these may be read later, so this opens the file again.
+        def read(cols):
+            with fitsio.FITS(file_name, 'r') as fits:
+                self._read_fits_columns(fits, cols, start, end)
+        self._read_columns(cols, read)
+
+    def _get_named_cols(self, file_name, num, is_rand, find_col):
+        # Check the column names for file types whose columns are given by name, and find
+        # each one with find_col(name, col), which returns None if it isn't in the file.
+        # Returns a dict of name -> the location returned by find_col.
         x_col = treecorr.config.get_from_list(self.config,'x_col',num,str,'0')
         y_col = treecorr.config.get_from_list(self.config,'y_col',num,str,'0')
         z_col = treecorr.config.get_from_list(self.config,'z_col',num,str,'0')
@@ -875,6 +1273,7 @@ class Catalog(object):
         w_col = treecorr.config.get_from_list(self.config,'w_col',num,str,'0')
         wpos_col = treecorr.config.get_from_list(self.config,'wpos_col',num,str,'0')
         flag_col = treecorr.config.get_from_list(self.config,'flag_col',num,str,'0')
+        patch_col = treecorr.config.get_from_list(self.config,'patch_col',num,str,'0')
         g1_col = treecorr.config.get_from_list(self.config,'g1_col',num,str,'0')
         g2_col = treecorr.config.get_from_list(self.config,'g2_col',num,str,'0')
         k_col = treecorr.config.get_from_list(self.config,'k_col',num,str,'0')
@@ -912,80 +1311,41 @@ class Catalog(object):
         if (g1_col != '0' and g2_col == '0') or (g1_col == '0' and g2_col != '0'):
             raise ValueError("g1_col, g2_col are invalid for file %s"%file_name)
 
-        # OK, now go ahead and read all the columns.
-        hdu = treecorr.config.get_from_list(self.config,'hdu',num,int,1)
-
-        with fitsio.FITS(file_name, 'r') as fits:
-
-            # Read x,y or ra,dec,r
-            if x_col != '0':
-                x_hdu = treecorr.config.get_from_list(self.config,'x_hdu',num,int,hdu)
-                y_hdu = treecorr.config.get_from_list(self.config,'y_hdu',num,int,hdu)
-                if x_col not in fits[x_hdu].get_colnames():
-                    raise ValueError("x_col is invalid for file %s"%file_name)
-                if y_col not in fits[y_hdu].get_colnames():
-                    raise ValueError("y_col is invalid for file %s"%file_name)
-                self.x = fits[x_hdu].read_column(x_col).astype(float)
-                self.logger.debug('read x = %s',str(self.x))
-                self.y = fits[y_hdu].read_column(y_col).astype(float)
-                self.logger.debug('read y = %s',str(self.y))
-                if z_col != '0':
-                    z_hdu = treecorr.config.get_from_list(self.config,'z_hdu',num,int,hdu)
-                    if z_col not in fits[z_hdu].get_colnames():
-                        raise ValueError("z_col is invalid for file %s"%file_name)
-                    self.z = fits[z_hdu].read_column(z_col).astype(float)
-                    self.logger.debug('read z = %s',str(self.z))
-            else:
-                ra_hdu = treecorr.config.get_from_list(self.config,'ra_hdu',num,int,hdu)
-                dec_hdu = treecorr.config.get_from_list(self.config,'dec_hdu',num,int,hdu)
-                if ra_col not in fits[ra_hdu].get_colnames():
-                    raise ValueError("ra_col is invalid for file %s"%file_name)
-                if dec_col not in fits[dec_hdu].get_colnames():
-                    raise ValueError("dec_col is invalid for file %s"%file_name)
-                self.ra = fits[ra_hdu].read_column(ra_col).astype(float)
-                self.logger.debug('read ra = %s',str(self.ra))
-                self.dec = fits[dec_hdu].read_column(dec_col).astype(float)
-                self.logger.debug('read dec = %s',str(self.dec))
-                if r_col != '0':
-                    r_hdu = treecorr.config.get_from_list(self.config,'r_hdu',num,int,hdu)
-                    if r_col not in fits[r_hdu].get_colnames():
-                        raise ValueError("r_col is invalid for file %s"%file_name)
-                    self.r = fits[r_hdu].read_column(r_col).astype(float)
-                    self.logger.debug('read r = %s',str(self.r))
-
-            # Read w
-            if w_col != '0':
-                w_hdu = treecorr.config.get_from_list(self.config,'w_hdu',num,int,hdu)
-                if w_col not in fits[w_hdu].get_colnames():
-                    raise ValueError("w_col is invalid for file %s"%file_name)
-                self.w = fits[w_hdu].read_column(w_col).astype(float)
-                self.logger.debug('read w = %s',str(self.w))
-
-            # Read wpos
-            if wpos_col != '0':
-                wpos_hdu = treecorr.config.get_from_list(self.config,'wpos_hdu',num,int,hdu)
-                if wpos_col not in fits[wpos_hdu].get_colnames():
-                    raise ValueError("wpos_col is invalid for file %s"%file_name)
-                self.wpos = fits[wpos_hdu].read_column(wpos_col).astype(float)
-                self.logger.debug('read wpos = %s',str(self.wpos))
-
-            # Read flag
-            if flag_col != '0':
-                flag_hdu = treecorr.config.get_from_list(self.config,'flag_hdu',num,int,hdu)
-                if flag_col not in fits[flag_hdu].get_colnames():
-                    raise ValueError("flag_col is invalid for file %s"%file_name)
-                self.flag = fits[flag_hdu].read_column(flag_col).astype(int)
-                self.logger.debug('read flag = %s',str(self.flag))
-
-            # Return here if this file is a random catalog
-            if is_rand: return
-
-            # Read g1,g2
+        # Now find where each of the columns are.
+        cols = {}
+        def add_col(name, col):
+            loc = find_col(name, col)
+            if loc is None:
+                raise ValueError("%s_col is invalid for file %s"%(name,file_name))
+            cols[name] = loc
+
+        # x,y or ra,dec,r
+        if x_col != '0':
+            add_col('x', x_col)
+            add_col('y', y_col)
+            if z_col != '0':
+                add_col('z', z_col)
+        else:
+            add_col('ra', ra_col)
+            add_col('dec', dec_col)
+            if r_col != '0':
+                add_col('r', r_col)
+
+        if w_col != '0':
+            add_col('w', w_col)
+        if wpos_col != '0':
+            add_col('wpos', wpos_col)
+        if flag_col != '0':
+            add_col('flag', flag_col)
+        if patch_col != '0':
+            add_col('patch', patch_col)
+
+        # Skip g1,g2,k if this file is a random catalog
+        if not is_rand:
             if g1_col != '0':
-                g1_hdu = treecorr.config.get_from_list(self.config,'g1_hdu',num,int,hdu)
-                g2_hdu = treecorr.config.get_from_list(self.config,'g2_hdu',num,int,hdu)
-                if (g1_col not in fits[g1_hdu].get_colnames() or
-                    g2_col not in fits[g2_hdu].get_colnames()):
+                g1_loc = find_col('g1', g1_col)
+                g2_loc = find_col('g2', g2_col)
+                if g1_loc is None or g2_loc is None:
                     if isGColRequired(self.orig_config,num):
                         raise ValueError("g1_col, g2_col are invalid for file %s"%file_name)
                     else:
@@ -993,15 +1353,12 @@ class Catalog(object):
                                             file_name,num) +
                                             "because they are invalid, but unneeded.")
                 else:
-                    self.g1 = fits[g1_hdu].read_column(g1_col).astype(float)
-                    self.logger.debug('read g1 = %s',str(self.g1))
-                    self.g2 = fits[g2_hdu].read_column(g2_col).astype(float)
-                    self.logger.debug('read g2 = %s',str(self.g2))
+                    cols['g1'] = g1_loc
+                    cols['g2'] = g2_loc
 
-            # Read k
             if k_col != '0':
-                k_hdu = treecorr.config.get_from_list(self.config,'k_hdu',num,int,hdu)
-                if k_col not in fits[k_hdu].get_colnames():
+                k_loc = find_col('k', k_col)
+                if k_loc is None:
                     if isKColRequired(self.orig_config,num):
                         raise ValueError("k_col is invalid for file %s"%file_name)
                     else:
@@ -1009,17 +1366,159 @@ class Catalog(object):
                                             file_name,num)+
                                             "because it is invalid, but unneeded.")
                 else:
-                    self.k = fits[k_hdu].read_column(k_col).astype(float)
-                    self.logger.debug('read k = %s',str(self.k))
+                    cols['k'] = k_loc
+
+        return cols
+
+    def _read_fits_columns(self, fits, cols, start, end):
+        # Read the given columns (name -> (hdu, col)).  All the columns from each hdu are
+        # read at once, and only the rows we need.
+        hdus = sorted(set(h for h, col in cols.values()))
+        for h in hdus:
+            names = [name for name in cols if cols[name][0] == h]
+            col_names = []
+            for name in names:
+                if cols[name][1] not in col_names:
+                    col_names.append(cols[name][1])
+            nrows = fits[h].get_nrows()
+            h_end = nrows if end is None else min(end, nrows)
+            h_start = min(start, h_end)
+            data = fits[h][col_names][h_start:h_end]
+            self.logger.debug('read columns %s from hdu %d, rows %d..%d',
+                              col_names,h,h_start,h_end)
+            for name in names:
+                dtype = int if name in ['flag', 'patch'] else float
+                # This only copies if the column isn't already contiguous with the
+                # right (native-endian) type.
+                array = np.ascontiguousarray(data[cols[name][1]], dtype=dtype)
+                setattr(self, name, array)
+                self.logger.debug('read %s = %s',name,str(array))
+
+    def read_hdf5(self, file_name, num=0, is_rand=False):
+        """Read the catalog from an HDF5 file
+
+        The columns should be 1-d datasets in the file.  Each *_col parameter gives the name
+        (or path, e.g. 'galaxies/ra') of the dataset to use.
+
+        Parameters:
+            file_name (str):    The name of the file to read in.
+            num (int):          Which number catalog are we reading. (default: 0)
+            is_rand (bool):     Is this a random catalog? (default: False)
+        """
+        try:
+            import h5py
+        except ImportError:
+            self.logger.error("Unable to import h5py.  Cannot read catalog %s"%file_name)
+            raise
+
+        start, end = self._get_row_range(num)
+
+        with h5py.File(file_name, 'r') as hdf:
+            def find_col(name, col):
+                return col if isinstance(hdf.get(col), h5py.Dataset) else None
+            cols = self._get_named_cols(file_name, num, is_rand, find_col)
+
+        def read(cols):
+            with h5py.File(file_name, 'r') as hdf:
+                self._read_hdf5_columns(hdf, cols, start, end)
+        self._read_columns(cols, read)
+
+    def _read_hdf5_columns(self, hdf, cols, start, end):
+        # Read the given columns (name -> dataset name), only for the rows we need.
+        for name in cols:
+            dset = hdf[cols[name]]
+            nrows = dset.shape[0]
+            d_end = nrows if end is None else min(end, nrows)
+            d_start = min(start, d_end)
+            dtype = int if name in ['flag', 'patch'] else float
+            # HDF5 does any type conversion while reading directly into the final array.
+            array = np.empty(d_end-d_start, dtype=dtype)
+            if d_end > d_start:
+                dset.read_direct(array, np.s_[d_start:d_end])
+            setattr(self, name, array)
+            self.logger.debug('read %s = %s',name,str(array))
+
+    def read_parquet(self, file_name, num=0, is_rand=False):
+        """Read the catalog from a Parquet file or a directory of Parquet files
+
+        The row groups that include the rows between first_row and last_row are read in
+        parallel, and only for the columns that are needed.  Columns that are already
+        float64 with no missing values are used without copying when possible.
+
+        Parameters:
+            file_name (str):    The name of the file (or directory) to read in.
+            num (int):          Which number catalog are we reading. (default: 0)
+            is_rand (bool):     Is this a random catalog? (default: False)
+        """
+        try:
+            import pyarrow.dataset
+        except ImportError:
+            self.logger.error("Unable to import pyarrow.  Cannot read catalog %s"%file_name)
+            raise
+
+        start, end = self._get_row_range(num)
+
+        dataset = pyarrow.dataset.dataset(file_name, format='parquet')
+        col_names = dataset.schema.names
+        def find_col(name, col):
+            return col if col in col_names else None
+        cols = self._get_named_cols(file_name, num, is_rand, find_col)
+
+        def read(cols):
+            self._read_parquet_columns(dataset, cols, start, end)
+        self._read_columns(cols, read)
+
+    def _read_parquet_columns(self, dataset, cols, start, end):
+        # Read the given columns (name -> column name), only for the rows we need.
+        import pyarrow
+        from concurrent.futures import ThreadPoolExecutor
+
+        # Find which row groups have the rows we need.
+        row_groups = [rg for frag in dataset.get_fragments() for rg in frag.split_by_row_group()]
+        first = np.zeros(len(row_groups)+1, dtype=int)
+        for i, rg in enumerate(row_groups):
+            first[i+1] = first[i] + sum(info.num_rows for info in rg.row_groups)
+        if end is None or end > first[-1]: end = first[-1]
+        start = min(start, end)
+        use = [i for i in range(len(row_groups)) if first[i+1] > start and first[i] < end]
+        self.logger.debug('reading %d of %d row groups for rows %d..%d',
+                          len(use),len(row_groups),start,end)
+
+        col_names = []
+        for name in cols:
+            if cols[name] not in col_names:
+                col_names.append(cols[name])
+        def read_row_group(i):
+            return row_groups[i].to_table(columns=col_names, use_threads=False)
+        with ThreadPoolExecutor() as executor:
+            tables = list(executor.map(read_row_group, use))
+        if len(tables) > 0:
+            table = pyarrow.concat_tables(tables)
+            table = table.slice(start - first[use[0]], end - start)
+        else:
+            table = dataset.schema.empty_table().select(col_names)
+
+        for name in cols:
+            dtype = int if name in ['flag', 'patch'] else float
+            column = table.column(cols[name])
+            if column.num_chunks == 1:
+                # This is a view of the Arrow buffer if the type is right and there are no nulls.
+                # Nulls become NaN.
+                array = column.chunk(0).to_numpy(zero_copy_only=False)
+            else:
+                array = column.to_numpy()
+            array = np.ascontiguousarray(array, dtype=dtype)
+            setattr(self, name, array)
+            self.logger.debug('read %s = %s',name,str(array))
 
     def _setup_fields(self):
         self._field = lambda : None  # Acts like a dead weakref
 
         # Make simple functions that call NField, etc. with self as the first argument.
 
-        def get_nfield(*args, **kwargs): return treecorr.NField(self, *args, **kwargs)
-        def get_kfield(*args, **kwargs): return treecorr.KField(self, *args, **kwargs)
-        def get_gfield(*args, **kwargs): return treecorr.GField(self, *args, **kwargs)
+        def get_nfield(*args, **kwargs): return self._build_field(treecorr.NField, args, kwargs)
+        def get_kfield(*args, **kwargs): return self._build_field(treecorr.KField, args, kwargs)
+        def get_gfield(*args, **kwargs): return self._build_field(treecorr.GField, args, kwargs)
         def get_nsimplefield(*args, **kwargs): return treecorr.NSimpleField(self, *args, **kwargs)
         def get_ksimplefield(*args, **kwargs): return treecorr.KSimpleField(self, *args, **kwargs)
         def get_gsimplefield(*args, **kwargs): return treecorr.GSimpleField(self, *args, **kwargs)
@@ -1032,6 +1531,157 @@ class Catalog(object):
         self.ksimplefields = treecorr.util.LRU_Cache(get_ksimplefield, 1)
         self.gsimplefields = treecorr.util.LRU_Cache(get_gsimplefield, 1)
 
+    def _build_field(self, field_class, args, kwargs):
+        # Use the field from shared memory if it was there when share_memory was called.
+        key = (field_class.__name__,) + tuple(args)
+        if key in self._shared_fields:
+            shm, size = self._shared_fields[key]
+            return treecorr.field._load_field_buffer(self, shm.buf[:size], kwargs.get('logger'))
+
+        # With cache_fields, the fields are saved in the cache entry for the file, keyed by the
+        # arguments used to build them.  So if an earlier run already built this field, we can
+        # just load it.
+        if self._field_dir is None:
+            return field_class(self, *args, **kwargs)
+        import hashlib
+        import tempfile
+        file_name = os.path.join(self._field_dir,
+                                 'field_' + hashlib.sha1(repr(key).encode()).hexdigest() + '.tree')
+        if os.path.exists(file_name):
+            return treecorr.field._load_field(self, file_name, kwargs.get('logger'))
+        field = field_class(self, *args, **kwargs)
+        # As for the catalog cache, write to a temporary file first, so other processes never
+        # see an incomplete file.
+        fd, tmp_name = tempfile.mkstemp(dir=self._field_dir)
+        os.close(fd)
+        field.save(tmp_name)
+        os.rename(tmp_name, file_name)
+        self.logger.info("Wrote field cache %s",file_name)
+        return field
+
+    def load_field(self, file_name, logger=None):
+        """Load a field that was written by `Field.save`.
+
+        The field must have been built from the same catalog (or an identical one, e.g. from
+        reading the same file in another process).  The tree is memory mapped from the file,
+        so this is much faster than building it again, and processes on the same machine that
+        load the same file share a single copy of it in memory.
+
+        This only checks that the number of objects matches, so it is up to you to make sure
+        that the file goes with this catalog.  cf. the cache_fields option, which keeps track
+        of this for you when reading the catalog from a file.
+
+        Parameters:
+            file_name (str):    The name of the file to read.
+            logger:             A Logger object if desired (default: self.logger)
+
+        Returns:
+            An `NField`, `KField`, or `GField`, according to what kind of field was saved.
+        """
+        if logger is None:
+            logger = self.logger
+        field = treecorr.field._load_field(self, file_name, logger)
+        self._field = weakref.ref(field)
+        return field
+
+    def share_memory(self):
+        """Move the arrays of this catalog, and the fields built from it, into shared memory.
+
+        Normally, pickling a catalog (e.g. to send it to a ``multiprocessing`` worker) copies
+        all of its arrays, and the fields are not pickled at all, so each worker has to build
+        them again.  After calling this, the arrays and any fields that are currently cached
+        are stored in POSIX shared memory (cf. ``multiprocessing.shared_memory``), and pickling
+        the catalog only sends the names of the shared memory blocks.  The unpickled catalogs
+        attach to the same memory without copying anything, so many processes can work on one
+        large catalog with only a single copy of it in memory.  E.g.::
+
+            >>> gg.process(cat)     # Builds the GField, so it gets shared too.
+            >>> cat.share_memory()
+            >>> with multiprocessing.Pool() as pool:
+            ...     results = pool.map(run_correlation, [(cat, config) for config in configs])
+            >>> cat.close_shared_memory()
+
+        Fields with other parameters that are built later are not shared, so each process
+        builds its own.
+
+        The process that calls this owns the shared memory, and it should call
+        `close_shared_memory` once the other processes are done with it.
+
+        This requires Python 3.8 or later.
+        """
+        from multiprocessing import shared_memory
+        if self._shm is not None:
+            return
+        if self._lazy_cols:
+            self._read_lazy(list(self._lazy_cols))
+
+        # Put all the arrays in a single block, each aligned to 64 bytes.
+        arrays = [(name, getattr(self, name)) for name in Catalog._cache_cols]
+        arrays = [(name, np.ascontiguousarray(a)) for name, a in arrays if a is not None]
+        layout = []
+        offset = 0
+        for name, a in arrays:
+            layout.append((name, a.dtype.str, a.shape, offset))
+            offset += (a.nbytes + 63) // 64 * 64
+        shm = shared_memory.SharedMemory(create=True, size=max(offset, 1))
+        for (name, a), (_, dtype, shape, offset) in zip(arrays, layout):
+            view = np.ndarray(shape, dtype=dtype, buffer=shm.buf, offset=offset)
+            view[...] = a
+            setattr(self, name, view)
+        self._shm = shm
+        self._shm_owner = True
+        self._shm_layout = layout
+
+        # Each field goes in its own block, in the same format as Field.save uses.
+        for cache in [self.nfields, self.kfields, self.gfields]:
+            for args, field in cache.items():
+                size = treecorr._lib.FieldGetSaveSize(field.data, field._d, field._coords)
+                fshm = shared_memory.SharedMemory(create=True, size=size)
+                treecorr._lib.FieldSaveBuffer(field.data, field._d, field._coords,
+                                              treecorr._ffi.from_buffer(fshm.buf))
+                self._shared_fields[(type(field).__name__,) + args] = (fshm, size)
+        # Use the shared copies of the fields in this process too.
+        self.clear_cache()
+        self.logger.info("Moved catalog %s to shared memory with %d fields",
+                         self.name, len(self._shared_fields))
+
+    def close_shared_memory(self):
+        """Stop using shared memory for this catalog.
+
+        The arrays are copied back into regular memory, and the fields from shared memory are
+        removed from the field caches.  In the process that called `share_memory`, this also
+        unlinks the shared memory, so it is freed once all the processes using it have closed it.
+        """
+        if self._shm is None:
+            return
+        for name, _, _, _ in self._shm_layout:
+            setattr(self, name, np.array(getattr(self, name)))
+        self.clear_cache()
+        blocks = [self._shm] + [shm for shm, size in self._shared_fields.values()]
+        for shm in blocks:
+            if self._shm_owner:
+                shm.unlink()
+            try:
+                shm.close()
+            except BufferError:
+                # Something (e.g. a field) is still using it.  It will be closed when that
+                # is deleted.
+                pass
+        self._shm = None
+        self._shm_owner = False
+        self._shm_layout = []
+        self._shared_fields = {}
+
+    def _attach_shared_memory(self, name, fields):
+        # Attach to the shared memory blocks made by share_memory in another process.
+        from multiprocessing import shared_memory
+        self._shm = shared_memory.SharedMemory(name=name)
+        for col, dtype, shape, offset in self._shm_layout:
+            setattr(self, col, np.ndarray(shape, dtype=dtype, buffer=self._shm.buf, offset=offset))
+        self._shared_fields = {}
+        for key, (name, size) in fields.items():
+            self._shared_fields[key] = (shared_memory.SharedMemory(name=name), size)
+
     def resize_cache(self, maxsize):
         """Resize all field caches.
 
@@ -1291,6 +1941,143 @@ class Catalog(object):
             logger = self.logger
         return self.gsimplefields(logger=logger)
 
+    def run_kmeans(self, npatch, max_iter=200, tol=1.e-5, init='tree', rng=None):
+        """Use k-means to divide the catalog into npatch spatial patches.
+
+        This sets the `patch` attribute to the patch number of each object, and
+        the `patch_centers` attribute to the centers of the patches.  The centers can then be
+        used to assign other catalogs (e.g. randoms) to the same patches with `assign_patches`.
+
+        The k-means algorithm is run in the catalog's own coordinate system, using the tree
+        of an `NField` to speed up the iterations.  See `Field.run_kmeans` for details.
+        For spherical coordinates, the centers are (x,y,z) positions on the unit sphere.
+
+        Parameters:
+            npatch (int):       The number of patches to divide the catalog into.
+            max_iter (int):     The maximum number of iterations. (default: 200)
+            tol (float):        Tolerance in the rms shift of the centers, relative to the
+                                overall size of the field, to consider as converged.
+                                (default: 1.e-5)
+            init (str):         How to choose the initial centers ('tree' or 'random').
+                                (default: 'tree')
+            rng (RandomState):  If init='random', the random number generator to use.
+                                (default: None)
+
+        Returns:
+            The array of patch numbers (also stored as self.patch).
+        """
+        # Any existing patches would affect the tree structure, so remove them first.
+        self._set_patches(None, None)
+        # Use enough top-level cells that there are at least as many as patches.
+        min_top = min(max(3, int(np.ceil(np.log2(max(npatch, 1))))), 10)
+        field = self.getNField(min_top=min_top)
+        self.logger.info("Running k-means with npatch = %d",npatch)
+        patches, centers = field.run_kmeans(npatch, max_iter, tol, init, rng)
+        self._set_patches(patches, centers)
+        return self.patch
+
+    def assign_patches(self, patch_centers):
+        """Assign each object to the patch with the closest center.
+
+        This is typically used to put a random catalog into the same patches as the data
+        catalog, using the `patch_centers` found by `run_kmeans` for the data.  The search
+        for the closest center uses the catalog's tree, so it is efficient even for very
+        large catalogs.
+
+        Parameters:
+            patch_centers (array or str):   The patch centers, given either as an array with
+                                            shape (npatch, 2) or (npatch, 3), or as the name
+                                            of a file written by `write_patch_centers`.
+
+        Returns:
+            The array of patch numbers (also stored as self.patch).
+        """
+        if isinstance(patch_centers, str):
+            patch_centers = self.read_patch_centers(patch_centers)
+        self._set_patches(None, None)
+        field = self.getNField()
+        patches = field.kmeans_assign_patches(patch_centers)
+        self._set_patches(patches, np.array(patch_centers, dtype=float))
+        return self.patch
+
+    def _set_patches(self, patches, centers):
+        self.patch = patches
+        self.patch_centers = centers
+        self.npatch = len(centers) if centers is not None else 1
+        # The cached fields were built without these patches.
+        self.clear_cache()
+
+    def write_patches(self, file_name, file_type=None):
+        """Write the patch numbers to a file.
+
+        This lets the results of `run_kmeans` or `assign_patches` be cached to disk and
+        read back in with `read_patches`.
+
+        Parameters:
+            file_name (str):    The name of the file to write to.
+            file_type (str):    The type of file to write ('ASCII' or 'FITS').  (default:
+                                determine the type automatically from the extension of file_name.)
+        """
+        if self.patch is None:
+            raise ValueError("This catalog does not have patches.")
+        self.logger.info('Writing patches to %s',file_name)
+        # Enough precision for the ASCII output to hold the integers exactly.
+        precision = max(4, len(str(self.npatch)))
+        treecorr.util.gen_write(file_name, ['patch'], [self.patch], precision=precision,
+                                file_type=file_type, logger=self.logger)
+
+    def read_patches(self, file_name, file_type=None):
+        """Read the patch numbers from a file written by `write_patches`.
+
+        Parameters:
+            file_name (str):    The name of the file to read.
+            file_type (str):    The type of file to read ('ASCII' or 'FITS').  (default:
+                                determine the type automatically from the extension of file_name.)
+        """
+        self.logger.info('Reading patches from %s',file_name)
+        data, params = treecorr.util.gen_read(file_name, file_type=file_type, logger=self.logger)
+        patch = np.atleast_1d(data['patch']).astype(int)
+        if len(patch) != self.ntot:
+            raise ValueError("%s has the wrong number of patch numbers"%file_name)
+        self.patch = patch
+        self.npatch = int(np.max(patch)) + 1
+        self.clear_cache()
+
+    def write_patch_centers(self, file_name, file_type=None):
+        """Write the patch centers to a file.
+
+        The centers are written as columns x, y (and z for 3d or spherical coordinates).
+        The file can be given to `assign_patches` for another catalog.
+
+        Parameters:
+            file_name (str):    The name of the file to write to.
+            file_type (str):    The type of file to write ('ASCII' or 'FITS').  (default:
+                                determine the type automatically from the extension of file_name.)
+        """
+        if self.patch_centers is None:
+            raise ValueError("This catalog does not have patch centers.")
+        self.logger.info('Writing patch centers to %s',file_name)
+        col_names = ['x', 'y', 'z'][:self.patch_centers.shape[1]]
+        columns = [self.patch_centers[:,i] for i in range(len(col_names))]
+        treecorr.util.gen_write(file_name, col_names, columns, precision=16,
+                                file_type=file_type, logger=self.logger)
+
+    def read_patch_centers(self, file_name, file_type=None):
+        """Read patch centers from a file written by `write_patch_centers`.
+
+        Parameters:
+            file_name (str):    The name of the file to read.
+            file_type (str):    The type of file to read ('ASCII' or 'FITS').  (default:
+                                determine the type automatically from the extension of file_name.)
+
+        Returns:
+            An array of the patch centers.
+        """
+        self.logger.info('Reading patch centers from %s',file_name)
+        data, params = treecorr.util.gen_read(file_name, file_type=file_type, logger=self.logger)
+        col_names = [name for name in ['x', 'y', 'z'] if name in data.dtype.names]
+        return np.column_stack([np.atleast_1d(data[name]) for name in col_names])
+
     def write(self, file_name, file_type=None, cat_precision=None):
         """Write the catalog to a file.
 
@@ -1320,6 +2107,7 @@ class Catalog(object):
         g1            self.g1 if not None
         g2            self.g2 if not None
         k             self.k if not None
+        patch         self.patch if not None
         meanR         The mean value <R> of pairs that fell into each bin.
         meanlogR      The mean value <logR> of pairs that fell into each bin.
         ========      =======================================================
@@ -1336,7 +2124,7 @@ class Catalog(object):
 
         col_names = []
         columns = []
-        if self.ra is not None:
+        if self._ra is not None:
             col_names.append('ra')
             columns.append(self.ra / self.ra_units)
             col_names.append('dec')
@@ -1367,6 +2155,9 @@ class Catalog(object):
         if self.k is not None:
             col_names.append('k')
             columns.append(self.k)
+        if self.patch is not None:
+            col_names.append('patch')
+            columns.append(self.patch)
 
         if cat_precision is None:
             cat_precision = treecorr.config.get(self.config,'cat_precision',int,16)
@@ -1379,9 +2170,32 @@ class Catalog(object):
         import copy
         return copy.deepcopy(self)
 
+    def _subset(self, index):
+        # Make a new Catalog with only the objects selected by index (a slice, an index
+        # array or a boolean mask).  The positions are already in radians, so we don't want
+        # the units to be applied a second time.  Catalogs made from ra, dec also have x, y, z,
+        # but these are computed from ra, dec, so only give the new Catalog ra, dec (and r).
+        def sub(a):
+            return None if a is None else a[index]
+        if self._ra is not None:
+            kwargs = dict(ra=sub(self.ra), dec=sub(self.dec), r=sub(self.r),
+                          ra_units='rad', dec_units='rad')
+        else:
+            kwargs = dict(x=sub(self.x), y=sub(self.y), z=sub(self.z))
+        kwargs['single_precision'] = self._single
+        cat = Catalog(w=sub(self.w), wpos=sub(self.wpos), g1=sub(self.g1), g2=sub(self.g2),
+                      k=sub(self.k), patch=sub(self.patch), logger=self.logger, **kwargs)
+        # Keep the same patch numbering, even if some patches aren't in the subset.
+        cat.npatch = self.npatch
+        cat.patch_centers = self.patch_centers
+        return cat
+
     def __getstate__(self):
+        # The function to read any lazy columns can't be pickled, so read them now.
+        if self._lazy_cols:
+            self._read_lazy(list(self._lazy_cols))
         d = self.__dict__.copy()
-        print('d = ',d)
+        del d['_lazy_read']
         del d['logger']  # Oh well.  This is just lost in the copy.  Can't be pickled.
         del d['_field']
         del d['nfields']
@@ -1390,14 +2204,25 @@ class Catalog(object):
         del d['nsimplefields']
         del d['ksimplefields']
         del d['gsimplefields']
+        if self._shm is not None:
+            # Only send the names of the shared memory blocks, not the arrays.
+            for name, _, _, _ in self._shm_layout:
+                d['_'+name if '_'+name in d else name] = None
+            d['_shm'] = self._shm.name
+            d['_shm_owner'] = False
+            d['_shared_fields'] = dict((key, (shm.name, size))
+                                       for key, (shm, size) in self._shared_fields.items())
         return d
 
     def __setstate__(self, d):
         self.__dict__ = d
+        self._lazy_read = None
         self.logger = treecorr.config.setup_logger(
                 treecorr.config.get(self.config,'verbose',int,1),
                 self.config.get('log_file',None))
         self._setup_fields()
+        if d.get('_shm') is not None:
+            self._attach_shared_memory(self._shm, self._shared_fields)
 
     def __repr__(self):
         s = 'Catalog('
@@ -1412,6 +2237,7 @@ class Catalog(object):
         if self.g1 is not None: s += 'g1='+repr(self.g1)+','
         if self.g2 is not None: s += 'g2='+repr(self.g2)+','
         if self.k is not None: s += 'k='+repr(self.k)+','
+        if self.patch is not None: s += 'patch='+repr(self.patch)+','
         # remove the last ','
         s = s[:-1] + ')'
         return s
@@ -1434,7 +2260,8 @@ class Catalog(object):
                 np.array_equal(self.wpos, other.wpos) and
                 np.array_equal(self.g1, other.g1) and
                 np.array_equal(self.g2, other.g2) and
-                np.array_equal(self.k, other.k))
+                np.array_equal(self.k, other.k) and
+                np.array_equal(self.patch, other.patch))
 
 
 def read_catalogs(config, key=None, list_key=None, num=0, logger=None, is_rand=None):
@@ -51,6 +51,14 @@ corr2_valid_params = {
             'The output filename for point-point correlation function.'),
     'nn_statistic' : (str, False, 'compensated', ['compensated','simple'],
             'Which statistic to use for omega as the estimator fo the NN correlation function. '),
+    'rand_dilute_scale' : (float, False, None, None,
+            'The separation (in sep_units) above which to use diluted random catalogs for '
+            'the RR, DR and RD calculations.'),
+    'rand_dilute_fraction' : (float, False, None, None,
+            'The fraction of the random objects to keep for bins above rand_dilute_scale.'),
+    'rr_split' : (int, False, 1, None,
+            'Split the randoms into this many sub-catalogs for the RR calculation, using only '
+            'the pairs within each sub-catalog.  DR and RD still use the full random catalogs.'),
     'ng_file_name' : (str, False, None, None,
             'The output filename for point-shear correlation function.'),
     'ng_statistic' : (str, False, None, ['compensated', 'simple'],
@@ -81,6 +89,7 @@ corr2_valid_params = {
 # Add in the valid parameters for the relevant classes
 for c in [ treecorr.Catalog, treecorr.BinnedCorr2 ]:
     corr2_valid_params.update(c._valid_params)
+corr2_valid_params.update(treecorr.randoms.random_valid_params)
 
 corr2_aliases = {
 }
@@ -130,6 +139,11 @@ def corr2(config, logger=None):
     rand2 = treecorr.read_catalogs(config, 'rand_file_name2', 'rand_file_list2', 1, logger)
     if len(cat1) == 0:
         raise TypeError("Either file_name or file_list is required")
+    # If requested, generate the random catalogs in memory rather than reading them.
+    if len(rand1) == 0:
+        rand1 = treecorr.generate_random_catalogs(config, 0, sum(c.nobj for c in cat1), logger)
+    if len(rand2) == 0 and len(cat2) > 0:
+        rand2 = treecorr.generate_random_catalogs(config, 1, sum(c.nobj for c in cat2), logger)
     if len(cat2) == 0: cat2 = None
     if len(rand1) == 0: rand1 = None
     if len(rand2) == 0: rand2 = None
@@ -144,7 +158,7 @@ def corr2(config, logger=None):
         gg.process(cat1,cat2)
         logger.info("Done GG calculations.")
         if 'gg_file_name' in config:
-            gg.write(config['gg_file_name'])
+            gg.write(config['gg_file_name'], name='gg')
             logger.warning("Wrote GG correlation to %s",config['gg_file_name'])
         if 'm2_file_name' in config:
             gg.writeMapSq(config['m2_file_name'], m2_uform=config['m2_uform'])
@@ -170,7 +184,7 @@ def corr2(config, logger=None):
             logger.info("Done RG calculation.")
 
         if 'ng_file_name' in config:
-            ng.write(config['ng_file_name'], rg)
+            ng.write(config['ng_file_name'], rg, name='ng')
             logger.warning("Wrote NG correlation to %s",config['ng_file_name'])
         if 'nm_file_name' in config:
             ng.writeNMap(config['nm_file_name'], rg=rg, m2_uform=config['m2_uform'],
@@ -206,37 +220,44 @@ def corr2(config, logger=None):
 
         dr = None
         rd = None
-        if rand1 is None:
+        dilute_kwargs = {}
+        if 'rand_dilute_scale' in config:
+            dilute_kwargs['dilute_scale'] = config['rand_dilute_scale']
+            dilute_kwargs['dilute_fraction'] = config.get('rand_dilute_fraction',None)
+        if rand1 is None and dd.metric == 'Periodic':
+            logger.warning("No random catalogs given.  Using analytic RR for periodic box.")
+            rr = dd.analytic_rr()
+        elif rand1 is None:
             logger.warning("No random catalogs given.  Only doing npairs calculation.")
             rr = None
         elif cat2 is None:
             logger.warning("Performing RR calculations...")
             rr = treecorr.NNCorrelation(config,logger)
-            rr.process(rand1)
+            rr.process(rand1, num_split=config['rr_split'], **dilute_kwargs)
             logger.info("Done RR calculations.")
 
             if config['nn_statistic'] == 'compensated':
                 logger.warning("Performing DR calculations...")
                 dr = treecorr.NNCorrelation(config,logger)
-                dr.process(cat1,rand1)
+                dr.process(cat1,rand1, dilute=2, **dilute_kwargs)
                 logger.info("Done DR calculations.")
         else:
             if rand2 is None:
                 raise TypeError("rand_file_name2 is required when file_name2 is given")
             logger.warning("Performing RR calculations...")
             rr = treecorr.NNCorrelation(config,logger)
-            rr.process(rand1,rand2)
+            rr.process(rand1,rand2, num_split=config['rr_split'], **dilute_kwargs)
             logger.info("Done RR calculations.")
 
             if config['nn_statistic'] == 'compensated':
                 logger.warning("Performing DR calculations...")
                 dr = treecorr.NNCorrelation(config,logger)
-                dr.process(cat1,rand2)
+                dr.process(cat1,rand2, dilute=2, **dilute_kwargs)
                 logger.info("Done DR calculations.")
                 rd = treecorr.NNCorrelation(config,logger)
-                rd.process(rand1,cat2)
+                rd.process(rand1,cat2, dilute=1, **dilute_kwargs)
                 logger.info("Done RD calculations.")
-        dd.write(config['nn_file_name'],rr,dr,rd)
+        dd.write(config['nn_file_name'],rr,dr,rd, name='nn')
         logger.warning("Wrote NN correlation to %s",config['nn_file_name'])
 
     # Do KK correlation function if necessary
@@ -245,7 +266,7 @@ def corr2(config, logger=None):
         kk = treecorr.KKCorrelation(config,logger)
         kk.process(cat1,cat2)
         logger.info("Done KK calculations.")
-        kk.write(config['kk_file_name'])
+        kk.write(config['kk_file_name'], name='kk')
         logger.warning("Wrote KK correlation to %s",config['kk_file_name'])
 
     # Do NG correlation function if necessary
@@ -266,7 +287,7 @@ def corr2(config, logger=None):
             rk.process(rand1,cat2)
             logger.info("Done RK calculation.")
 
-        nk.write(config['nk_file_name'], rk)
+        nk.write(config['nk_file_name'], rk, name='nk')
         logger.warning("Wrote NK correlation to %s",config['nk_file_name'])
 
     # Do KG correlation function if necessary
@@ -277,7 +298,7 @@ def corr2(config, logger=None):
         kg = treecorr.KGCorrelation(config,logger)
         kg.process(cat1,cat2)
         logger.info("Done KG calculation.")
-        kg.write(config['kg_file_name'])
+        kg.write(config['kg_file_name'], name='kg')
         logger.warning("Wrote KG correlation to %s",config['kg_file_name'])
 
 
@@ -73,6 +73,7 @@ corr3_valid_params = {
 # Add in the valid parameters for the relevant classes
 for c in [ treecorr.Catalog, treecorr.BinnedCorr3 ]:
     corr3_valid_params.update(c._valid_params)
+corr3_valid_params.update(treecorr.randoms.random_valid_params)
 
 
 corr3_aliases = {
@@ -125,6 +126,13 @@ def corr3(config, logger=None):
     rand3 = treecorr.read_catalogs(config, 'rand_file_name3', 'rand_file_list3', 1, logger)
     if len(cat1) == 0:
         raise TypeError("Either file_name or file_list is required")
+    # If requested, generate the random catalogs in memory rather than reading them.
+    if len(rand1) == 0:
+        rand1 = treecorr.generate_random_catalogs(config, 0, sum(c.nobj for c in cat1), logger)
+    if len(rand2) == 0 and len(cat2) > 0:
+        rand2 = treecorr.generate_random_catalogs(config, 1, sum(c.nobj for c in cat2), logger)
+    if len(rand3) == 0 and len(cat3) > 0:
+        rand3 = treecorr.generate_random_catalogs(config, 2, sum(c.nobj for c in cat3), logger)
     if len(cat2) == 0: cat2 = None
     if len(cat3) == 0: cat3 = None
     if len(rand1) == 0: rand1 = None
@@ -147,7 +155,7 @@ def corr3(config, logger=None):
         ggg.process(cat1,cat2,cat3)
         logger.info("Done GGG calculations.")
         if 'ggg_file_name' in config:
-            ggg.write(config['ggg_file_name'])
+            ggg.write(config['ggg_file_name'], name='ggg')
             logger.warning("Wrote GGG correlation to %s",config['ggg_file_name'])
         if 'm3_file_name' in config:
             ggg.writeMap3(config['m3_file_name'])
@@ -169,8 +177,13 @@ def corr3(config, logger=None):
         if rand1 is None:
             if rand2 is not None or rand3 is not None:
                 raise TypeError("rand_file_name is required if rand2 or rand3 is given")
-            logger.warning("No random catalogs given.  Only doing ntri calculation.")
-            rrr = None
+            if ddd.metric == 'Periodic' and cat2 is None:
+                logger.warning("No random catalogs given.  "
+                               "Using analytic RRR for periodic box.")
+                rrr = ddd.analytic_rrr()
+            else:
+                logger.warning("No random catalogs given.  Only doing ntri calculation.")
+                rrr = None
         elif cat2 is None:
             logger.warning("Performing RRR calculations...")
             rrr = treecorr.NNNCorrelation(config,logger)
@@ -190,7 +203,7 @@ def corr3(config, logger=None):
             rrr.process(rand1,rand2,rand3)
             logger.info("Done RRR calculations.")
 
-        if rrr is not None and config['nnn_statistic'] == 'compensated':
+        if rand1 is not None and config['nnn_statistic'] == 'compensated':
             logger.warning("Performing DRR calculations...")
             drr = treecorr.NNNCorrelation(config,logger)
             drr.process(cat1,rand2,rand3)
@@ -215,7 +228,7 @@ def corr3(config, logger=None):
             rdd = treecorr.NNNCorrelation(config,logger)
             rdd.process(rand1,cat2,cat3)
             logger.info("Done RDD calculations.")
-        ddd.write(config['nnn_file_name'],rrr,drr,rdr,rrd,ddr,drd,rdd)
+        ddd.write(config['nnn_file_name'],rrr,drr,rdr,rrd,ddr,drd,rdd, name='nnn')
         logger.warning("Wrote NNN correlation to %s",config['nnn_file_name'])
 
     # Do KKK correlation function if necessary
@@ -224,7 +237,7 @@ def corr3(config, logger=None):
         kkk = treecorr.KKKCorrelation(config,logger)
         kkk.process(cat1,cat2,cat3)
         logger.info("Done KKK calculations.")
-        kkk.write(config['kkk_file_name'])
+        kkk.write(config['kkk_file_name'], name='kkk')
         logger.warning("Wrote KKK correlation to %s",config['kkk_file_name'])
 
 
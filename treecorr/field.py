@@ -17,6 +17,7 @@
 
 import numpy as np
 import weakref
+import coord
 import treecorr
 
 def _parse_split_method(split_method):
@@ -25,6 +26,89 @@ def _parse_split_method(split_method):
     elif split_method == 'mean': return 2
     else: return 3  # random
 
+def _double_arrays(*arrays):
+    # The near neighbor searches take the catalog positions as double precision.  With
+    # single_precision=True, the catalog arrays are float32, so these need float64 copies.
+    return [None if a is None else np.asarray(a, dtype=float) for a in arrays]
+
+def _field_builder(name, cat, *arrays):
+    # Returns the C++ function to build the field, the function to make pointers to the arrays,
+    # and the arrays themselves.  With single_precision=True, the arrays are float32, and the
+    # Float version of the function converts each value to double as it builds the tree, so no
+    # float64 copies of the arrays are made.  The tree itself is always double precision.
+    from treecorr.util import double_ptr, float_ptr
+    if cat._single:
+        build, ptr, dtype = getattr(treecorr._lib, name + 'Float'), float_ptr, np.float32
+    else:
+        build, ptr, dtype = getattr(treecorr._lib, name), double_ptr, float
+    return build, ptr, [None if a is None else np.asarray(a, dtype=dtype) for a in arrays]
+
+# The header of the files written by Field.save.  This needs to match FieldFileHeader in Field.cpp.
+_field_header_dtype = np.dtype([('magic', 'S8'), ('version', np.int64),
+                                ('d', np.int64), ('coords', np.int64), ('cell_size', np.int64),
+                                ('nobj', np.int64), ('nnodes', np.int64), ('nindices', np.int64),
+                                ('ntop', np.int64), ('npatch', np.int64), ('sm', np.int64),
+                                ('brute', np.int64), ('min_top', np.int64), ('max_top', np.int64),
+                                ('min_size', np.float64), ('max_size', np.float64)])
+
+def _load_field(cat, file_name, logger=None):
+    # Read a field written by Field.save for the given catalog.
+    header = np.fromfile(file_name, dtype=_field_header_dtype, count=1)
+    if len(header) != 1 or header['magic'][0] != b'TCFIELD':
+        raise ValueError("%s is not a file written by Field.save"%file_name)
+    header = header[0]
+    _check_field_header(cat, header, file_name)
+    data = treecorr._lib.FieldLoad(file_name.encode(), int(header['d']), int(header['coords']))
+    if data == treecorr._ffi.NULL:
+        raise ValueError("Unable to load the field in %s.  It may have been written on a "
+                         "different kind of machine or by a different version of TreeCorr."%(
+                         file_name))
+    field = _make_field(cat, header, data)
+    if logger:
+        logger.info('Loaded %s from %s: %d top-level nodes',
+                    type(field).__name__, file_name, field.nTopLevelNodes)
+    return field
+
+def _load_field_buffer(cat, buf, logger=None):
+    # Make a field using the tree written into buf (e.g. a shared memory block) by
+    # FieldSaveBuffer.  The buffer is used directly, without copying it.
+    header = np.frombuffer(buf, dtype=_field_header_dtype, count=1)[0]
+    _check_field_header(cat, header, 'shared memory')
+    ptr = treecorr._ffi.from_buffer(buf)
+    data = treecorr._lib.FieldLoadBuffer(ptr, len(buf), int(header['d']), int(header['coords']))
+    if data == treecorr._ffi.NULL:  # pragma: no cover
+        raise ValueError("Invalid field in shared memory")
+    field = _make_field(cat, header, data)
+    field._buffer = ptr  # Keep the buffer alive as long as the field is.
+    if logger:
+        logger.info('Using %s from shared memory: %d top-level nodes',
+                    type(field).__name__, field.nTopLevelNodes)
+    return field
+
+def _check_field_header(cat, header, source):
+    if header['nobj'] != cat.ntot:
+        raise ValueError("The field in %s was built from a catalog with %d objects, not %d"%(
+                         source, header['nobj'], cat.ntot))
+
+def _make_field(cat, header, data):
+    # Bypass the constructor, which would build the tree.
+    field_class = { 1: NField, 2: KField, 3: GField }[int(header['d'])]
+    field = field_class.__new__(field_class)
+    field.data = data
+    field._cat = weakref.ref(cat)
+    field.min_size = float(header['min_size'])
+    field.max_size = float(header['max_size'])
+    field._sm = int(header['sm'])
+    field.split_method = ['middle', 'median', 'mean', 'random'][field._sm]
+    field._d = int(header['d'])
+    field.brute = bool(header['brute'])
+    field.min_top = int(header['min_top'])
+    field.max_top = int(header['max_top'])
+    field._coords = int(header['coords'])
+    field.coords = { treecorr._lib.Flat: 'flat', treecorr._lib.Sphere: 'spherical',
+                     treecorr._lib.ThreeD: '3d' }[field._coords]
+    return field
+
 
 class Field(object):
     """A Field in TreeCorr is the object that stores the tree structure we use for efficient
@@ -86,6 +170,35 @@ class Field(object):
         """
         return treecorr._lib.FieldGetNTopLevel(self.data, self._d, self._coords)
 
+    @property
+    def nbytes(self):
+        """The number of bytes of memory used to store the tree.
+
+        The cells of the tree are stored contiguously in depth-first order along with a single
+        array of the indices of the objects in the leaves, so this is the total size of
+        those arrays.
+        """
+        return treecorr._lib.FieldGetMemory(self.data, self._d, self._coords)
+
+    def save(self, file_name):
+        """Save the tree to a file.
+
+        The file can be read back with `Catalog.load_field`.  It stores the cells of the tree
+        and the indices of the objects in the leaves in the same layout as they have in memory,
+        so reading it just memory maps the file rather than building the tree again.  This also
+        means that processes on the same machine that load the same file share a single copy
+        of the tree in memory.
+
+        The file is only readable on the same kind of machine (and the same version of
+        TreeCorr) as the one that wrote it.
+
+        Parameters:
+            file_name (str):    The name of the file to write.
+        """
+        nbytes = treecorr._lib.FieldSave(self.data, self._d, self._coords, file_name.encode())
+        if nbytes < 0:
+            raise IOError("Unable to write field to %s"%file_name)
+
     @property
     def cat(self):
         """The catalog from which this field was constructed.
@@ -148,22 +261,50 @@ class Field(object):
 
         Finally, in cases where ra, dec are allowed, you may instead provide a
         coord.CelestialCoord instance as the first argument to specify both RA and Dec.
+
+        The target coordinates may also be given as arrays (with angles given as values along
+        with the corresponding units parameters), and sep may be either a single value or an
+        array with a separation for each target.  In this case, the return value is an array
+        with the number of points near each target.  The counts for the different targets are
+        calculated in parallel.
+
+        Returns:
+            The number of points near the target (or an array of these for multiple targets)
         """
-        if self.min_size == 0:
+        x,y,z,sep = treecorr.util.parse_xyzsep(args, kwargs, self._coords)
+        if np.ndim(x) == 0 and self.min_size == 0:
             # If min_size = 0, then regular method is already exact.
-            x,y,z,sep = treecorr.util.parse_xyzsep(args, kwargs, self._coords)
             return self._count_near(x, y, z, sep)
         else:
-            # Otherwise, we need to expand the radius a bit and then check the actual radii
-            # using the catalog values.  This is already done in get_near, so just do that
-            # and take the len of the result.
-            return len(self.get_near(*args, **kwargs))
+            # Otherwise, the C++ layer expands the radius a bit and then checks the actual
+            # radii using the catalog values.
+            counts = self._count_near_many(*[np.atleast_1d(a) for a in (x,y,z,sep)])
+            return counts if np.ndim(x) > 0 else int(counts[0])
 
     def _count_near(self, x, y, z, sep):
         # If self.min_size > 0, these results may be approximate, since the tree will have
         # grouped points within this separation together.
         return treecorr._lib.FieldCountNear(self.data, x, y, z, sep, self._d, self._coords)
 
+    def _cat_xyz(self):
+        # The catalog positions are used for checking the exact separations when min_size > 0.
+        cat = self.cat
+        if self.min_size == 0 or cat is None:
+            return None, None, None
+        else:
+            z = cat.z if self._coords != treecorr._lib.Flat else None
+            return _double_arrays(cat.x, cat.y, z)
+
+    def _count_near_many(self, x, y, z, sep):
+        from treecorr.util import double_ptr as dp
+        from treecorr.util import long_ptr as lp
+        catx, caty, catz = self._cat_xyz()
+        counts = np.empty(len(x), dtype=int)
+        treecorr._lib.FieldCountNearMany(self.data, dp(x), dp(y), dp(z), dp(sep), len(x),
+                                         dp(catx), dp(caty), dp(catz), self._d, self._coords,
+                                         lp(counts))
+        return counts
+
     def get_near(self, *args, **kwargs):
         """Get the indices of points near a given coordinate.
 
@@ -216,36 +357,245 @@ class Field(object):
 
         Finally, in cases where ra, dec are allowed, you may instead provide a
         coord.CelestialCoord instance as the first argument to specify both RA and Dec.
+
+        The target coordinates may also be given as arrays (with angles given as values along
+        with the corresponding units parameters), and sep may be either a single value or an
+        array with a separation for each target.  In this case, the return value is a tuple
+        (offsets, indices) in the CSR style, where the indices of the points near target i
+        are ``indices[offsets[i]:offsets[i+1]]``.  The searches for the different targets
+        are done in parallel.
+
+        Returns:
+            A sorted array of the indices of the points near the target, or for multiple
+            targets, a tuple (offsets, indices) as described above.
         """
         x,y,z,sep = treecorr.util.parse_xyzsep(args, kwargs, self._coords)
-        if self.min_size == 0:
-            # If min_size == 0, then regular method is already exact.
-            ind = self._get_near(x, y, z, sep)
+        if np.ndim(x) == 0:
+            offsets, ind = self._get_near_many(*[np.atleast_1d(a) for a in (x,y,z,sep)])
+            return ind
         else:
-            # Expand the radius by the minimum size of the cells.
-            sep1 = sep + self.min_size
-            # Get those indices
-            ind = self._get_near(x, y, z, sep1)
-            # Now check the actual radii of these points using the catalog x,y,z values.
-            rsq = (self.cat.x[ind]-x)**2 + (self.cat.y[ind]-y)**2
-            if self._coords != treecorr._lib.Flat:
-                rsq += (self.cat.z[ind]-z)**2
-            # Select the ones with r < sep
-            near = rsq < sep**2
-            ind = ind[near]
-        # It comes back unsorted, so sort it.  (Not really required, but nicer output.)
-        return np.sort(ind)
-
-    def _get_near(self, x, y, z, sep):
-        # If self.min_size > 0, these results may be approximate, since the tree will have
-        # grouped points within this separation together.
+            return self._get_near_many(x, y, z, sep)
+
+    def _get_near_many(self, x, y, z, sep):
+        # If self.min_size > 0, the C++ layer expands the search radius by min_size and then
+        # checks the actual radii of the points found using the catalog x,y,z values.
+        # The indices for each target come back sorted.
+        from treecorr.util import double_ptr as dp
+        from treecorr.util import long_ptr as lp
+        catx, caty, catz = self._cat_xyz()
+        n = len(x)
+        offsets = np.zeros(n+1, dtype=int)
+        near = treecorr._lib.FieldGetNearMany(self.data, dp(x), dp(y), dp(z), dp(sep), n,
+                                              dp(catx), dp(caty), dp(catz),
+                                              self._d, self._coords, lp(offsets[1:]))
+        np.cumsum(offsets, out=offsets)
+        ind = np.empty(offsets[-1], dtype=int)
+        treecorr._lib.FieldFillNearMany(near, lp(ind))
+        return offsets, ind
+
+    def get_knn(self, *args, **kwargs):
+        """Get the indices of the k nearest points to a given coordinate.
+
+        Use the existing tree structure to find the k points closest to a target coordinate,
+        along with their distances from it.
+
+        The target coordinate is specified in the same ways as for `get_near`, except that
+        rather than sep, you give the number of neighbors, k.  e.g.
+
+            >>> indices, dist = field.get_knn(x, y, k=10)                   # flat
+            >>> indices, dist = field.get_knn(x, y, z, k=10)                # 3d
+            >>> indices, dist = field.get_knn(ra, dec, k=10, ra_units='deg', dec_units='deg',
+            ...                               sep_units='arcmin')           # spherical
+
+        The target coordinates may be arrays, in which case the searches for the different
+        targets are done in parallel.
+
+        The distances are Euclidean for flat and 3d coordinates.  For spherical coordinates,
+        they are the great circle distances, given in radians unless sep_units is specified.
+
+        If the field has fewer than k points, the extra indices are -1 and the extra
+        distances are infinity.
+
+        Returns:
+            A tuple (indices, dist) of arrays with shape (k,) for a single target or (n,k) for
+            n targets, sorted by increasing distance.
+        """
+        sep_units = kwargs.pop('sep_units', None)
+        if sep_units is not None and self._coords != treecorr._lib.Sphere:
+            raise TypeError("sep_units is only valid for spherical coordinates")
+        x,y,z,k = treecorr.util.parse_xyzk(args, kwargs, self._coords)
+        if np.ndim(x) == 0:
+            ind, dsq = self._get_knn(*[np.atleast_1d(a) for a in (x,y,z)], k=k)
+            ind, dsq = ind[0], dsq[0]
+        else:
+            ind, dsq = self._get_knn(x, y, z, k)
+        dist = np.sqrt(dsq)
+        if self._coords == treecorr._lib.Sphere:
+            # Convert from chord distance to great circle distance.
+            dist = 2. * np.arcsin(np.minimum(dist, 2.) / 2.)
+            if sep_units is not None:
+                dist /= coord.AngleUnit.from_name(sep_units).value
+        return ind, dist
+
+    def _get_knn(self, x, y, z, k):
+        # As for get_near, if self.min_size > 0, the C++ layer uses the catalog x,y,z values
+        # to get the exact distances.
+        from treecorr.util import double_ptr as dp
+        from treecorr.util import long_ptr as lp
+        catx, caty, catz = self._cat_xyz()
+        n = len(x)
+        ind = np.empty((n,k), dtype=int)
+        dsq = np.empty((n,k), dtype=float)
+        treecorr._lib.FieldGetKNN(self.data, dp(x), dp(y), dp(z), n, k,
+                                  dp(catx), dp(caty), dp(catz), self._d, self._coords,
+                                  lp(ind), dp(dsq))
+        return ind, dsq
+
+    def run_kmeans(self, npatch, max_iter=200, tol=1.e-5, init='tree', rng=None):
+        """Use the k-means algorithm to divide the field into patches.
+
+        This uses Lloyd's algorithm, but with the assignment of points to the nearest center
+        accelerated by the tree.  For each cell, we check which centers could possibly be the
+        closest for some point in the cell, and if there is only one, the whole cell is assigned
+        to it without looking at the individual points.  The top-level cells are processed
+        in parallel.
+
+        The centers are in the coordinate system of the field.  For spherical coordinates,
+        they are (x,y,z) positions on the unit sphere.
+
+        Parameters:
+            npatch (int):       The number of patches to divide the field into.
+            max_iter (int):     The maximum number of iterations. (default: 200)
+            tol (float):        Tolerance in the rms shift of the centers, relative to the
+                                overall size of the field, to consider as converged.
+                                (default: 1.e-5)
+            init (str):         How to choose the initial centers ('tree' or 'random').
+                                (default: 'tree')
+            rng (RandomState):  If init='random', the random number generator to use.
+                                (default: None, in which case one will be made for you)
+
+        Returns:
+            Tuple containing
+
+                - patches (array): The patch number of each object in the catalog.
+                - centers (array): The centers of the patches, with shape (npatch, 2) for
+                  flat coordinates or (npatch, 3) for 3d or spherical coordinates.
+        """
+        centers = self.kmeans_initialize_centers(npatch, init, rng)
+        self.kmeans_refine_centers(centers, max_iter, tol)
+        patches = self.kmeans_assign_patches(centers)
+        return patches, centers
+
+    def kmeans_initialize_centers(self, npatch, init='tree', rng=None):
+        """Choose the initial centers for `run_kmeans`.
+
+        With init='tree', the centers are placed at the centroids of sub-cells of the tree,
+        choosing the number of centers in each cell in proportion to its weight.  This is
+        deterministic and usually starts fairly close to the final solution.
+
+        With init='random', the centers are placed at randomly chosen objects.
+
+        Parameters:
+            npatch (int):       The number of patches to divide the field into.
+            init (str):         How to choose the initial centers ('tree' or 'random').
+                                (default: 'tree')
+            rng (RandomState):  If init='random', the random number generator to use.
+                                (default: None, in which case one will be made for you)
+
+        Returns:
+            An array of the initial centers with shape (npatch, 2) or (npatch, 3).
+        """
+        from treecorr.util import double_ptr as dp
+        cat = self.cat
+        if npatch < 1:
+            raise ValueError("npatch must be >= 1")
+        if npatch > cat.nobj:
+            raise ValueError("npatch (%d) must be <= the number of objects (%d)"%(
+                             npatch, cat.nobj))
+        if init == 'tree':
+            centers = np.empty((npatch, self._ncenter_col()), dtype=float)
+            treecorr._lib.KMeansInitTree(self.data, dp(centers), int(npatch),
+                                         self._d, self._coords)
+        elif init == 'random':
+            if rng is None:
+                rng = np.random.RandomState()
+            use = np.where(cat.w != 0)[0]
+            index = rng.choice(use, npatch, replace=False)
+            centers = self._cat_positions(cat, index)
+        else:
+            raise ValueError("Invalid init: %s.  Must be one of 'tree' or 'random'"%init)
+        return centers
+
+    def kmeans_refine_centers(self, centers, max_iter=200, tol=1.e-5):
+        """Run Lloyd iterations for `run_kmeans`, starting from the given centers.
+
+        The centers are updated in place.
+
+        Parameters:
+            centers (array):    An array of the starting centers with shape (npatch, 2)
+                                or (npatch, 3).
+            max_iter (int):     The maximum number of iterations. (default: 200)
+            tol (float):        Tolerance in the rms shift of the centers, relative to the
+                                overall size of the field, to consider as converged.
+                                (default: 1.e-5)
+
+        Returns:
+            The number of iterations done.
+        """
+        from treecorr.util import double_ptr as dp
+        if (not isinstance(centers, np.ndarray) or centers.dtype != float or
+                not centers.flags.c_contiguous):
+            raise TypeError("centers must be a C-contiguous numpy array of floats")
+        self._check_centers(centers)
+        return treecorr._lib.KMeansRun(self.data, dp(centers), len(centers), int(max_iter),
+                                       float(tol), self._d, self._coords)
+
+    def kmeans_assign_patches(self, centers):
+        """Assign each object in the catalog to the patch with the closest center.
+
+        This uses the same tree-based search as `run_kmeans`, so it is an efficient way to
+        assign another catalog (e.g. randoms) to the patches found for a first catalog.
+
+        Objects that are not in the field (because they have w = 0) are assigned
+        to their closest center directly.
+
+        Parameters:
+            centers (array):    An array of the patch centers with shape (npatch, 2)
+                                or (npatch, 3).
+
+        Returns:
+            An array of the patch number of each object in the catalog.
+        """
+        from treecorr.util import double_ptr as dp
         from treecorr.util import long_ptr as lp
-        # First count how many there are, so we can allocate the array for the indices.
-        n = self._count_near(x, y, z, sep)
-        ind = np.empty(n, dtype=int)
-        # Now fill the array with the indices of the nearby points.
-        treecorr._lib.FieldGetNear(self.data, x, y, z, sep, self._d, self._coords, lp(ind), n)
-        return ind
+        centers = np.ascontiguousarray(centers, dtype=float)
+        self._check_centers(centers)
+        cat = self.cat
+        patches = np.empty(cat.ntot, dtype=int)
+        treecorr._lib.KMeansAssign(self.data, dp(centers), len(centers), lp(patches), cat.ntot,
+                                   self._d, self._coords)
+        missing = np.where(patches < 0)[0]
+        # Do these in chunks to keep the memory for the distances reasonable.
+        chunk = 10000
+        for i in range(0, len(missing), chunk):
+            index = missing[i:i+chunk]
+            pos = self._cat_positions(cat, index)
+            dsq = np.sum((pos[:,np.newaxis,:] - centers[np.newaxis,:,:])**2, axis=2)
+            patches[index] = np.argmin(dsq, axis=1)
+        return patches
+
+    def _ncenter_col(self):
+        return 2 if self._coords == treecorr._lib.Flat else 3
+
+    def _cat_positions(self, cat, index):
+        if self._coords == treecorr._lib.Flat:
+            return np.column_stack([cat.x[index], cat.y[index]])
+        else:
+            return np.column_stack([cat.x[index], cat.y[index], cat.z[index]])
+
+    def _check_centers(self, centers):
+        if centers.ndim != 2 or centers.shape[1] != self._ncenter_col():
+            raise ValueError("centers must have shape (npatch, %d)"%self._ncenter_col())
 
 
 class NField(Field):
@@ -271,7 +621,7 @@ class NField(Field):
     """
     def __init__(self, cat, min_size=0, max_size=None, split_method='mean', brute=False,
                  min_top=3, max_top=10, coords=None, logger=None):
-        from treecorr.util import double_ptr as dp
+        from treecorr.util import long_ptr as lp
         if logger:
             if cat.name != '':
                 logger.info('Building NField from cat %s',cat.name)
@@ -290,12 +640,17 @@ class NField(Field):
         self.coords = coords if coords is not None else cat.coords
         self._coords = treecorr.util.coord_enum(self.coords)  # These are the C++-layer enums
 
-        self.data = treecorr._lib.BuildNField(dp(cat.x), dp(cat.y), dp(cat.z),
-                                              dp(cat.w), dp(cat.wpos), cat.ntot,
-                                              self.min_size, self.max_size, self._sm,
-                                              self.brute, self.min_top, self.max_top, self._coords)
+        # With copy_arrays=False, x,y may be computed on access, so keep references to the
+        # arrays until the C++ layer is done with them.
+        build, ptr, (x, y, z, w, wpos) = _field_builder(
+                'BuildNField', cat, cat.x, cat.y, cat.z, cat.w, cat.wpos)
+        self.data = build(ptr(x), ptr(y), ptr(z),
+                          ptr(w), ptr(wpos), cat.ntot, lp(cat.patch),
+                          self.min_size, self.max_size, self._sm,
+                          self.brute, self.min_top, self.max_top, self._coords)
         if logger:
-            logger.debug('Finished building NField (%s)',self.coords)
+            logger.debug('Finished building NField (%s): %d top-level nodes, %d bytes',
+                         self.coords, self.nTopLevelNodes, self.nbytes)
 
     def __del__(self):
         # Using memory allocated from the C layer means we have to explicitly deallocate it
@@ -333,7 +688,7 @@ class KField(Field):
     """
     def __init__(self, cat, min_size=0, max_size=None, split_method='mean', brute=False,
                  min_top=3, max_top=10, coords=None, logger=None):
-        from treecorr.util import double_ptr as dp
+        from treecorr.util import long_ptr as lp
         if logger:
             if cat.name != '':
                 logger.info('Building KField from cat %s',cat.name)
@@ -352,13 +707,18 @@ class KField(Field):
         self.coords = coords if coords is not None else cat.coords
         self._coords = treecorr.util.coord_enum(self.coords)  # These are the C++-layer enums
 
-        self.data = treecorr._lib.BuildKField(dp(cat.x), dp(cat.y), dp(cat.z),
-                                              dp(cat.k),
-                                              dp(cat.w), dp(cat.wpos), cat.ntot,
-                                              self.min_size, self.max_size, self._sm,
-                                              self.brute, self.min_top, self.max_top, self._coords)
+        # With copy_arrays=False, x,y may be computed on access, so keep references to the
+        # arrays until the C++ layer is done with them.
+        build, ptr, (x, y, z, k, w, wpos) = _field_builder(
+                'BuildKField', cat, cat.x, cat.y, cat.z, cat.k, cat.w, cat.wpos)
+        self.data = build(ptr(x), ptr(y), ptr(z),
+                          ptr(k),
+                          ptr(w), ptr(wpos), cat.ntot, lp(cat.patch),
+                          self.min_size, self.max_size, self._sm,
+                          self.brute, self.min_top, self.max_top, self._coords)
         if logger:
-            logger.debug('Finished building KField (%s)',self.coords)
+            logger.debug('Finished building KField (%s): %d top-level nodes, %d bytes',
+                         self.coords, self.nTopLevelNodes, self.nbytes)
 
     def __del__(self):
         # Using memory allocated from the C layer means we have to explicitly deallocate it
@@ -393,7 +753,7 @@ class GField(Field):
     """
     def __init__(self, cat, min_size=0, max_size=None, split_method='mean', brute=False,
                  min_top=3, max_top=10, coords=None, logger=None):
-        from treecorr.util import double_ptr as dp
+        from treecorr.util import long_ptr as lp
         if logger:
             if cat.name != '':
                 logger.info('Building GField from cat %s',cat.name)
@@ -412,13 +772,18 @@ class GField(Field):
         self.coords = coords if coords is not None else cat.coords
         self._coords = treecorr.util.coord_enum(self.coords)  # These are the C++-layer enums
 
-        self.data = treecorr._lib.BuildGField(dp(cat.x), dp(cat.y), dp(cat.z),
-                                              dp(cat.g1), dp(cat.g2),
-                                              dp(cat.w), dp(cat.wpos), cat.ntot,
-                                              self.min_size, self.max_size, self._sm,
-                                              self.brute, self.min_top, self.max_top, self._coords)
+        # With copy_arrays=False, x,y may be computed on access, so keep references to the
+        # arrays until the C++ layer is done with them.
+        build, ptr, (x, y, z, g1, g2, w, wpos) = _field_builder(
+                'BuildGField', cat, cat.x, cat.y, cat.z, cat.g1, cat.g2, cat.w, cat.wpos)
+        self.data = build(ptr(x), ptr(y), ptr(z),
+                          ptr(g1), ptr(g2),
+                          ptr(w), ptr(wpos), cat.ntot, lp(cat.patch),
+                          self.min_size, self.max_size, self._sm,
+                          self.brute, self.min_top, self.max_top, self._coords)
         if logger:
-            logger.debug('Finished building GField (%s)',self.coords)
+            logger.debug('Finished building GField (%s): %d top-level nodes, %d bytes',
+                         self.coords, self.nTopLevelNodes, self.nbytes)
 
     def __del__(self):
         # Using memory allocated from the C layer means we have to explicitly deallocate it
@@ -457,7 +822,6 @@ class NSimpleField(SimpleField):
     :param logger:      A logger file if desired (default: None)
     """
     def __init__(self, cat, logger=None):
-        from treecorr.util import double_ptr as dp
         if logger:
             if cat.name != '':
                 logger.info('Building NSimpleField from cat %s',cat.name)
@@ -467,9 +831,13 @@ class NSimpleField(SimpleField):
         self.coords = cat.coords
         self._coords = treecorr.util.coord_enum(self.coords)  # These are the C++-layer enums
 
-        self.data = treecorr._lib.BuildNSimpleField(dp(cat.x), dp(cat.y), dp(cat.z),
-                                                    dp(cat.w), dp(cat.wpos), cat.ntot,
-                                                    self._coords)
+        # With copy_arrays=False, x,y may be computed on access, so keep references to the
+        # arrays until the C++ layer is done with them.
+        build, ptr, (x, y, z, w, wpos) = _field_builder(
+                'BuildNSimpleField', cat, cat.x, cat.y, cat.z, cat.w, cat.wpos)
+        self.data = build(ptr(x), ptr(y), ptr(z),
+                          ptr(w), ptr(wpos), cat.ntot,
+                          self._coords)
         if logger:
             logger.debug('Finished building NSimpleField (%s)',self.coords)
 
@@ -494,7 +862,6 @@ class KSimpleField(SimpleField):
     :param logger:      A logger file if desired (default: None)
     """
     def __init__(self, cat, logger=None):
-        from treecorr.util import double_ptr as dp
         if logger:
             if cat.name != '':
                 logger.info('Building KSimpleField from cat %s',cat.name)
@@ -504,10 +871,14 @@ class KSimpleField(SimpleField):
         self.coords = cat.coords
         self._coords = treecorr.util.coord_enum(self.coords)  # These are the C++-layer enums
 
-        self.data = treecorr._lib.BuildKSimpleField(dp(cat.x), dp(cat.y), dp(cat.z),
-                                                    dp(cat.k),
-                                                    dp(cat.w), dp(cat.wpos), cat.ntot,
-                                                    self._coords)
+        # With copy_arrays=False, x,y may be computed on access, so keep references to the
+        # arrays until the C++ layer is done with them.
+        build, ptr, (x, y, z, k, w, wpos) = _field_builder(
+                'BuildKSimpleField', cat, cat.x, cat.y, cat.z, cat.k, cat.w, cat.wpos)
+        self.data = build(ptr(x), ptr(y), ptr(z),
+                          ptr(k),
+                          ptr(w), ptr(wpos), cat.ntot,
+                          self._coords)
         if logger:
             logger.debug('Finished building KSimpleField (%s)',self.coords)
 
@@ -532,7 +903,6 @@ class GSimpleField(SimpleField):
     :param logger:      A logger file if desired (default: None)
     """
     def __init__(self, cat, logger=None):
-        from treecorr.util import double_ptr as dp
         if logger:
             if cat.name != '':
                 logger.info('Building GSimpleField from cat %s',cat.name)
@@ -542,10 +912,14 @@ class GSimpleField(SimpleField):
         self.coords = cat.coords
         self._coords = treecorr.util.coord_enum(self.coords)  # These are the C++-layer enums
 
-        self.data = treecorr._lib.BuildGSimpleField(dp(cat.x), dp(cat.y), dp(cat.z),
-                                                    dp(cat.g1), dp(cat.g2),
-                                                    dp(cat.w), dp(cat.wpos), cat.ntot,
-                                                    self._coords)
+        # With copy_arrays=False, x,y may be computed on access, so keep references to the
+        # arrays until the C++ layer is done with them.
+        build, ptr, (x, y, z, g1, g2, w, wpos) = _field_builder(
+                'BuildGSimpleField', cat, cat.x, cat.y, cat.z, cat.g1, cat.g2, cat.w, cat.wpos)
+        self.data = build(ptr(x), ptr(y), ptr(z),
+                          ptr(g1), ptr(g2),
+                          ptr(w), ptr(wpos), cat.ntot,
+                          self._coords)
         if logger:
             logger.debug('Finished building KSimpleField (%s)',self.coords)
 
@@ -289,6 +289,7 @@ class GGGCorrelation(treecorr.BinnedCorr3):
         self.logger.info('Starting %d jobs.',field.nTopLevelNodes)
         treecorr._lib.ProcessAuto3(self.corr, field.data, self.output_dots,
                                    field._d, self._coords, self._bintype, self._metric)
+        self._log_thread_memory()
 
     def process_cross21(self, cat1, cat2, metric=None, num_threads=None):
         """Process two catalogs, accumulating the 3pt cross-correlation, where two of the
@@ -355,6 +356,7 @@ class GGGCorrelation(treecorr.BinnedCorr3):
         self.logger.info('Starting %d jobs.',f1.nTopLevelNodes)
         treecorr._lib.ProcessCross3(self.corr, f1.data, f2.data, f3.data, self.output_dots,
                                     f1._d, f2._d, f3._d, self._coords, self._bintype, self._metric)
+        self._log_thread_memory()
 
 
     def finalize(self, varg1, varg2, varg3):
@@ -540,7 +542,7 @@ class GGGCorrelation(treecorr.BinnedCorr3):
         self.finalize(varg1,varg2,varg3)
 
 
-    def write(self, file_name, file_type=None, precision=None):
+    def write(self, file_name, file_type=None, precision=None, name=None):
         """Write the correlation function to the file, file_name.
 
         As described in the doc string for `GGGCorrelation`, we use the "natural components" of
@@ -586,10 +588,15 @@ class GGGCorrelation(treecorr.BinnedCorr3):
 
         Parameters:
             file_name (str):    The name of the file to write to.
-            file_type (str):    The type of file to write ('ASCII' or 'FITS').  (default: determine
-                                the type automatically from the extension of file_name.)
+            file_type (str):    The type of file to write ('ASCII', 'FITS' or 'HDF5').
+                                (default: determine the type automatically from the extension
+                                of file_name.)
             precision (int):    For ASCII output catalogs, the desired precision. (default: 4;
                                 this value can also be given in the constructor in the config dict.)
+            name (str):         For HDF5 output, the name of the group in which to write the
+                                results.  Results with different names can be written to the
+                                same file.  (default: None, which writes the results at the top
+                                level of a new file)
         """
         self.logger.info('Writing GGG correlations to %s',file_name)
 
@@ -613,10 +620,10 @@ class GGGCorrelation(treecorr.BinnedCorr3):
 
         treecorr.util.gen_write(
             file_name, col_names, columns,
-            params=params, precision=precision, file_type=file_type, logger=self.logger)
+            params=params, precision=precision, file_type=file_type, name=name, logger=self.logger)
 
 
-    def read(self, file_name, file_type=None):
+    def read(self, file_name, file_type=None, name=None):
         """Read in values from a file.
 
         This should be a file that was written by TreeCorr, preferably a FITS file, so there
@@ -628,12 +635,15 @@ class GGGCorrelation(treecorr.BinnedCorr3):
 
         Parameters:
             file_name (str):    The name of the file to read in.
-            file_type (str):    The type of file ('ASCII' or 'FITS').  (default: determine the type
-                                automatically from the extension of file_name.)
+            file_type (str):    The type of file ('ASCII', 'FITS' or 'HDF5').  (default: determine
+                                the type automatically from the extension of file_name.)
+            name (str):         For HDF5 files, the name of the group to read, if the results
+                                were written with a name.  (default: None)
         """
         self.logger.info('Reading GGG correlations from %s',file_name)
 
-        data, params = treecorr.util.gen_read(file_name, file_type=file_type, logger=self.logger)
+        data, params = treecorr.util.gen_read(file_name, file_type=file_type, name=name,
+                                              logger=self.logger)
         s = self.logr.shape
         if 'R_nom' in data.dtype.names:  # pragma: no cover
             self.rnom = data['R_nom'].reshape(s)
@@ -92,6 +92,7 @@ class KGCorrelation(treecorr.BinnedCorr2):
                 self._d1, self._d2, self._bintype,
                 self._min_sep,self._max_sep,self._nbins,self._bin_size,self.b,
                 self.min_rpar, self.max_rpar, self.xperiod, self.yperiod, self.zperiod,
+                self.min_task_pairs, self.bucket_size,
                 dp(self.xi),dp(self.xi_im), dp(None), dp(None),
                 dp(self.meanr),dp(self.meanlogr),dp(self.weight),dp(self.npairs));
 
@@ -176,6 +177,8 @@ class KGCorrelation(treecorr.BinnedCorr2):
 
         self._set_num_threads(num_threads)
 
+        self._set_npatch(cat1, cat2)
+
         min_size, max_size = self._get_minmax_size()
 
         f1 = cat1.getKField(min_size, max_size, self.split_method,
@@ -188,6 +191,8 @@ class KGCorrelation(treecorr.BinnedCorr2):
         self.logger.info('Starting %d jobs.',f1.nTopLevelNodes)
         treecorr._lib.ProcessCross2(self.corr, f1.data, f2.data, self.output_dots,
                                     f1._d, f2._d, self._coords, self._bintype, self._metric)
+        self._log_thread_memory()
+        self._collect_patch_results()
 
 
     def process_pairwise(self, cat1, cat2, metric=None, num_threads=None):
@@ -224,6 +229,7 @@ class KGCorrelation(treecorr.BinnedCorr2):
 
         treecorr._lib.ProcessPair(self.corr, f1.data, f2.data, self.output_dots,
                                   f1._d, f2._d, self._coords, self._bintype, self._metric)
+        self._log_thread_memory()
 
 
     def finalize(self, vark, varg):
@@ -264,6 +270,7 @@ class KGCorrelation(treecorr.BinnedCorr2):
         self.meanlogr.ravel()[:] = 0
         self.weight.ravel()[:] = 0
         self.npairs.ravel()[:] = 0
+        self._clear_patch_results()
 
     def __iadd__(self, other):
         """Add a second KGCorrelation's data to this one.
@@ -286,6 +293,7 @@ class KGCorrelation(treecorr.BinnedCorr2):
         self.meanlogr.ravel()[:] += other.meanlogr.ravel()[:]
         self.weight.ravel()[:] += other.weight.ravel()[:]
         self.npairs.ravel()[:] += other.npairs.ravel()[:]
+        self._add_patch_results(other)
         return self
 
 
@@ -319,7 +327,7 @@ class KGCorrelation(treecorr.BinnedCorr2):
         self.finalize(vark,varg)
 
 
-    def write(self, file_name, file_type=None, precision=None):
+    def write(self, file_name, file_type=None, precision=None, name=None):
         """Write the correlation function to the file, file_name.
 
         The output file will include the following columns:
@@ -343,10 +351,15 @@ class KGCorrelation(treecorr.BinnedCorr2):
 
         Parameters:
             file_name (str):    The name of the file to write to.
-            file_type (str):    The type of file to write ('ASCII' or 'FITS').  (default: determine
-                                the type automatically from the extension of file_name.)
+            file_type (str):    The type of file to write ('ASCII', 'FITS' or 'HDF5').
+                                (default: determine the type automatically from the extension
+                                of file_name.)
             precision (int):    For ASCII output catalogs, the desired precision. (default: 4;
                                 this value can also be given in the constructor in the config dict.)
+            name (str):         For HDF5 output, the name of the group in which to write the
+                                results.  Results with different names can be written to the
+                                same file.  (default: None, which writes the results at the top
+                                level of a new file)
         """
         self.logger.info('Writing KG correlations to %s',file_name)
         if precision is None:
@@ -361,10 +374,10 @@ class KGCorrelation(treecorr.BinnedCorr2):
             [ self.rnom, self.meanr, self.meanlogr,
               self.xi, self.xi_im, np.sqrt(self.varxi),
               self.weight, self.npairs ],
-            params=params, precision=precision, file_type=file_type, logger=self.logger)
+            params=params, precision=precision, file_type=file_type, name=name, logger=self.logger)
 
 
-    def read(self, file_name, file_type=None):
+    def read(self, file_name, file_type=None, name=None):
         """Read in values from a file.
 
         This should be a file that was written by TreeCorr, preferably a FITS file, so there
@@ -376,12 +389,15 @@ class KGCorrelation(treecorr.BinnedCorr2):
 
         Parameters:
             file_name (str):    The name of the file to read in.
-            file_type (str):    The type of file ('ASCII' or 'FITS').  (default: determine the type
-                                automatically from the extension of file_name.)
+            file_type (str):    The type of file ('ASCII', 'FITS' or 'HDF5').  (default: determine
+                                the type automatically from the extension of file_name.)
+            name (str):         For HDF5 files, the name of the group to read, if the results
+                                were written with a name.  (default: None)
         """
         self.logger.info('Reading KG correlations from %s',file_name)
 
-        data, params = treecorr.util.gen_read(file_name, file_type=file_type, logger=self.logger)
+        data, params = treecorr.util.gen_read(file_name, file_type=file_type, name=name,
+                                              logger=self.logger)
         if 'R_nom' in data.dtype.names:  # pragma: no cover
             self.rnom = data['R_nom']
             self.meanr = data['meanR']
@@ -93,6 +93,7 @@ class NGCorrelation(treecorr.BinnedCorr2):
                 self._d1, self._d2, self._bintype,
                 self._min_sep,self._max_sep,self._nbins,self._bin_size,self.b,
                 self.min_rpar, self.max_rpar, self.xperiod, self.yperiod, self.zperiod,
+                self.min_task_pairs, self.bucket_size,
                 dp(self.xi),dp(self.xi_im), dp(None), dp(None),
                 dp(self.meanr),dp(self.meanlogr),dp(self.weight),dp(self.npairs));
 
@@ -177,6 +178,8 @@ class NGCorrelation(treecorr.BinnedCorr2):
 
         self._set_num_threads(num_threads)
 
+        self._set_npatch(cat1, cat2)
+
         min_size, max_size = self._get_minmax_size()
 
         f1 = cat1.getNField(min_size, max_size, self.split_method,
@@ -189,6 +192,8 @@ class NGCorrelation(treecorr.BinnedCorr2):
         self.logger.info('Starting %d jobs.',f1.nTopLevelNodes)
         treecorr._lib.ProcessCross2(self.corr, f1.data, f2.data, self.output_dots,
                                     f1._d, f2._d, self._coords, self._bintype, self._metric)
+        self._log_thread_memory()
+        self._collect_patch_results()
 
 
     def process_pairwise(self, cat1, cat2, metric=None, num_threads=None):
@@ -225,6 +230,7 @@ class NGCorrelation(treecorr.BinnedCorr2):
 
         treecorr._lib.ProcessPair(self.corr, f1.data, f2.data, self.output_dots,
                                   f1._d, f2._d, self._coords, self._bintype, self._metric)
+        self._log_thread_memory()
 
 
     def finalize(self, varg):
@@ -265,6 +271,7 @@ class NGCorrelation(treecorr.BinnedCorr2):
         self.meanlogr.ravel()[:] = 0
         self.weight.ravel()[:] = 0
         self.npairs.ravel()[:] = 0
+        self._clear_patch_results()
 
     def __iadd__(self, other):
         """Add a second NGCorrelation's data to this one.
@@ -288,6 +295,7 @@ class NGCorrelation(treecorr.BinnedCorr2):
         self.meanlogr.ravel()[:] += other.meanlogr.ravel()[:]
         self.weight.ravel()[:] += other.weight.ravel()[:]
         self.npairs.ravel()[:] += other.npairs.ravel()[:]
+        self._add_patch_results(other)
         return self
 
 
@@ -345,7 +353,7 @@ class NGCorrelation(treecorr.BinnedCorr2):
             return (self.xi - rg.xi), (self.xi_im - rg.xi_im), (self.varxi + rg.varxi)
 
 
-    def write(self, file_name, rg=None, file_type=None, precision=None):
+    def write(self, file_name, rg=None, file_type=None, precision=None, name=None):
         """Write the correlation function to the file, file_name.
 
         - If rg is None, the simple correlation function :math:`\\langle \\gamma_T\\rangle` is used.
@@ -375,10 +383,15 @@ class NGCorrelation(treecorr.BinnedCorr2):
             file_name (str):    The name of the file to write to.
             rg (NGCorrelation): The cross-correlation using random locations as the lenses
                                 (RG), if desired.  (default: None)
-            file_type (str):    The type of file to write ('ASCII' or 'FITS').  (default: determine
-                                the type automatically from the extension of file_name.)
+            file_type (str):    The type of file to write ('ASCII', 'FITS' or 'HDF5').
+                                (default: determine the type automatically from the extension
+                                of file_name.)
             precision (int):    For ASCII output catalogs, the desired precision. (default: 4;
                                 this value can also be given in the constructor in the config dict.)
+            name (str):         For HDF5 output, the name of the group in which to write the
+                                results.  Results with different names can be written to the
+                                same file.  (default: None, which writes the results at the top
+                                level of a new file)
         """
         self.logger.info('Writing NG correlations to %s',file_name)
 
@@ -394,10 +407,10 @@ class NGCorrelation(treecorr.BinnedCorr2):
             ['r_nom','meanr','meanlogr','gamT','gamX','sigma','weight','npairs'],
             [ self.rnom, self.meanr, self.meanlogr,
               xi, xi_im, np.sqrt(varxi), self.weight, self.npairs ],
-            params=params, precision=precision, file_type=file_type, logger=self.logger)
+            params=params, precision=precision, file_type=file_type, name=name, logger=self.logger)
 
 
-    def read(self, file_name, file_type=None):
+    def read(self, file_name, file_type=None, name=None):
         """Read in values from a file.
 
         This should be a file that was written by TreeCorr, preferably a FITS file, so there
@@ -409,12 +422,15 @@ class NGCorrelation(treecorr.BinnedCorr2):
 
         Parameters:
             file_name (str):    The name of the file to read in.
-            file_type (str):    The type of file ('ASCII' or 'FITS').  (default: determine the type
-                                automatically from the extension of file_name.)
+            file_type (str):    The type of file ('ASCII', 'FITS' or 'HDF5').  (default: determine
+                                the type automatically from the extension of file_name.)
+            name (str):         For HDF5 files, the name of the group to read, if the results
+                                were written with a name.  (default: None)
         """
         self.logger.info('Reading NG correlations from %s',file_name)
 
-        data, params = treecorr.util.gen_read(file_name, file_type=file_type, logger=self.logger)
+        data, params = treecorr.util.gen_read(file_name, file_type=file_type, name=name,
+                                              logger=self.logger)
         if 'R_nom' in data.dtype.names:  # pragma: no cover
             self.rnom = data['R_nom']
             self.meanr = data['meanR']
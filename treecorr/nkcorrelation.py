@@ -90,6 +90,7 @@ class NKCorrelation(treecorr.BinnedCorr2):
                 self._d1, self._d2, self._bintype,
                 self._min_sep,self._max_sep,self._nbins,self._bin_size,self.b,
                 self.min_rpar, self.max_rpar, self.xperiod, self.yperiod, self.zperiod,
+                self.min_task_pairs, self.bucket_size,
                 dp(self.xi), dp(None), dp(None), dp(None),
                 dp(self.meanr),dp(self.meanlogr),dp(self.weight),dp(self.npairs));
 
@@ -173,6 +174,8 @@ class NKCorrelation(treecorr.BinnedCorr2):
 
         self._set_num_threads(num_threads)
 
+        self._set_npatch(cat1, cat2)
+
         min_size, max_size = self._get_minmax_size()
 
         f1 = cat1.getNField(min_size, max_size, self.split_method,
@@ -185,6 +188,8 @@ class NKCorrelation(treecorr.BinnedCorr2):
         self.logger.info('Starting %d jobs.',f1.nTopLevelNodes)
         treecorr._lib.ProcessCross2(self.corr, f1.data, f2.data, self.output_dots,
                                     f1._d, f2._d, self._coords, self._bintype, self._metric)
+        self._log_thread_memory()
+        self._collect_patch_results()
 
 
     def process_pairwise(self, cat1, cat2, metric=None, num_threads=None):
@@ -221,6 +226,7 @@ class NKCorrelation(treecorr.BinnedCorr2):
 
         treecorr._lib.ProcessPair(self.corr, f1.data, f2.data, self.output_dots,
                                   f1._d, f2._d, self._coords, self._bintype, self._metric)
+        self._log_thread_memory()
 
 
     def finalize(self, vark):
@@ -258,6 +264,7 @@ class NKCorrelation(treecorr.BinnedCorr2):
         self.meanlogr.ravel()[:] = 0
         self.weight.ravel()[:] = 0
         self.npairs.ravel()[:] = 0
+        self._clear_patch_results()
 
     def __iadd__(self, other):
         """Add a second NKCorrelation's data to this one.
@@ -279,6 +286,7 @@ class NKCorrelation(treecorr.BinnedCorr2):
         self.meanlogr.ravel()[:] += other.meanlogr.ravel()[:]
         self.weight.ravel()[:] += other.weight.ravel()[:]
         self.npairs.ravel()[:] += other.npairs.ravel()[:]
+        self._add_patch_results(other)
         return self
 
 
@@ -335,7 +343,7 @@ class NKCorrelation(treecorr.BinnedCorr2):
             return self.xi - rk.xi, self.varxi + rk.varxi
 
 
-    def write(self, file_name, rk=None, file_type=None, precision=None):
+    def write(self, file_name, rk=None, file_type=None, precision=None, name=None):
         """Write the correlation function to the file, file_name.
 
         - If rk is None, the simple correlation function :math:`\\langle \\kappa \\rangle(R)` is
@@ -365,10 +373,15 @@ class NKCorrelation(treecorr.BinnedCorr2):
             file_name (str):    The name of the file to write to.
             rk (NKCorrelation): The cross-correlation using random locations as the lenses (RK),
                                 if desired.  (default: None)
-            file_type (str):    The type of file to write ('ASCII' or 'FITS').  (default: determine
-                                the type automatically from the extension of file_name.)
+            file_type (str):    The type of file to write ('ASCII', 'FITS' or 'HDF5').
+                                (default: determine the type automatically from the extension
+                                of file_name.)
             precision (int):    For ASCII output catalogs, the desired precision. (default: 4;
                                 this value can also be given in the constructor in the config dict.)
+            name (str):         For HDF5 output, the name of the group in which to write the
+                                results.  Results with different names can be written to the
+                                same file.  (default: None, which writes the results at the top
+                                level of a new file)
         """
         self.logger.info('Writing NK correlations to %s',file_name)
 
@@ -384,10 +397,10 @@ class NKCorrelation(treecorr.BinnedCorr2):
             ['r_nom','meanr','meanlogr','kappa','sigma','weight','npairs'],
             [ self.rnom, self.meanr, self.meanlogr,
               xi, np.sqrt(varxi), self.weight, self.npairs ],
-            params=params, precision=precision, file_type=file_type, logger=self.logger)
+            params=params, precision=precision, file_type=file_type, name=name, logger=self.logger)
 
 
-    def read(self, file_name, file_type=None):
+    def read(self, file_name, file_type=None, name=None):
         """Read in values from a file.
 
         This should be a file that was written by TreeCorr, preferably a FITS file, so there
@@ -399,12 +412,15 @@ class NKCorrelation(treecorr.BinnedCorr2):
 
         Parameters:
             file_name (str):    The name of the file to read in.
-            file_type (str):    The type of file ('ASCII' or 'FITS').  (default: determine the type
-                                automatically from the extension of file_name.)
+            file_type (str):    The type of file ('ASCII', 'FITS' or 'HDF5').  (default: determine
+                                the type automatically from the extension of file_name.)
+            name (str):         For HDF5 files, the name of the group to read, if the results
+                                were written with a name.  (default: None)
         """
         self.logger.info('Reading NK correlations from %s',file_name)
 
-        data, params = treecorr.util.gen_read(file_name, file_type=file_type, logger=self.logger)
+        data, params = treecorr.util.gen_read(file_name, file_type=file_type, name=name,
+                                              logger=self.logger)
         if 'R_nom' in data.dtype.names:  # pragma: no cover
             self.rnom = data['R_nom']
             self.meanr = data['meanR']
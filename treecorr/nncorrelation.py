@@ -19,6 +19,47 @@ import treecorr
 import numpy as np
 
 
+def _disk_box_area(rho, a, b):
+    # The area of the intersection of a disk of radius rho with the rectangle |x| < a, |y| < b,
+    # both centered at the origin.  This is 4 times the integral over 0 < x < min(a,rho)
+    # of min(b, sqrt(rho^2-x^2)).
+    rho = np.asarray(rho, dtype=float)
+    def G(x):
+        # The indefinite integral of sqrt(rho^2 - x^2)
+        rsq = rho**2
+        return 0.5 * (x * np.sqrt(np.maximum(rsq - x**2, 0.)) +
+                      rsq * np.arcsin(np.clip(x / np.where(rho > 0, rho, 1.), -1., 1.)))
+    x1 = np.minimum(a, rho)
+    x0 = np.minimum(np.sqrt(np.maximum(rho**2 - b**2, 0.)), x1)
+    return 4. * (b * x0 + G(x1) - G(x0))
+
+def _disk_rect_area(rho, x0, x1, y0, y1):
+    # The area of the intersection of a disk of radius rho centered at the origin with the
+    # rectangle x0 < x < x1, y0 < y < y1.  The area within 0 < x < |x|, 0 < y < |y| is a quarter
+    # of _disk_box_area, so add up the contributions from the four corners with their signs.
+    def Q(x, y):
+        return np.sign(x) * np.sign(y) * _disk_box_area(rho, np.abs(x), np.abs(y)) / 4.
+    return Q(x1,y1) - Q(x0,y1) - Q(x1,y0) + Q(x0,y0)
+
+def _ball_box_volume(r, a, b, c):
+    # The volume of the intersection of a ball of radius r with the box |x|<a, |y|<b, |z|<c.
+    # Integrate the area of the disk at each z through the ball.  The integrand is smooth
+    # between the values of z where the disk radius crosses a, b, or sqrt(a^2+b^2), so
+    # split the integral there and use Gauss-Legendre quadrature on each piece.
+    if r <= min(a, b, c):
+        return 4./3. * np.pi * r**3
+    zmax = min(r, c)
+    breaks = [ np.sqrt(r**2 - rho**2) for rho in (a, b, np.sqrt(a**2 + b**2)) if rho < r ]
+    breaks = np.unique([0.] + [z for z in breaks if z < zmax] + [zmax])
+    x, w = np.polynomial.legendre.leggauss(20)
+    vol = 0.
+    for z0, z1 in zip(breaks[:-1], breaks[1:]):
+        z = 0.5 * (z1 + z0) + 0.5 * (z1 - z0) * x
+        rho = np.sqrt(np.maximum(r**2 - z**2, 0.))
+        vol += 0.5 * (z1 - z0) * np.sum(w * _disk_box_area(rho, a, b))
+    return 2. * vol
+
+
 class NNCorrelation(treecorr.BinnedCorr2):
     """This class handles the calculation and storage of a 2-point count-count correlation
     function.  i.e. the regular density correlation function.
@@ -45,6 +86,8 @@ class NNCorrelation(treecorr.BinnedCorr2):
         npairs:    The number of pairs in each bin.
         tot:       The total number of pairs processed, which is used to normalize
                    the randoms if they have a different number of pairs.
+        dilution:  If `process` was run with dilute_scale, the fraction of the possible pairs
+                   that were actually used in each bin.  Otherwise None.
 
     If **sep_units** are given (either in the config dict or as a named kwarg) then the distances
     will all be in these units.  Note however, that if you separate out the steps of the
@@ -82,15 +125,23 @@ class NNCorrelation(treecorr.BinnedCorr2):
         self.weight = np.zeros_like(self.rnom, dtype=float)
         self.npairs = np.zeros_like(self.rnom, dtype=float)
         self.tot = 0.
+        self._auto_tot = 0.  # The part of tot from auto-correlations.
+        self._patch_tot = None
+        self.dilution = None
+        self._rr = self._dr = self._rd = None
         self._build_corr()
         self.logger.debug('Finished building NNCorr')
 
-    def _build_corr(self):
+    def _build_corr(self, max_sep=None):
+        # If max_sep is given, only the pairs with separations less than this are counted.
+        # The binning and the fields (which use self._max_sep) are otherwise unchanged.
         from treecorr.util import double_ptr as dp
+        if max_sep is None: max_sep = self._max_sep
         self.corr = treecorr._lib.BuildCorr2(
                 self._d1, self._d2, self._bintype,
-                self._min_sep,self._max_sep,self._nbins,self._bin_size,self.b,
+                self._min_sep,max_sep,self._nbins,self._bin_size,self.b,
                 self.min_rpar, self.max_rpar, self.xperiod, self.yperiod, self.zperiod,
+                self.min_task_pairs, self.bucket_size,
                 dp(None), dp(None), dp(None), dp(None),
                 dp(self.meanr),dp(self.meanlogr),dp(self.weight),dp(self.npairs));
 
@@ -170,6 +221,8 @@ class NNCorrelation(treecorr.BinnedCorr2):
 
         self._set_num_threads(num_threads)
 
+        self._set_npatch(cat)
+
         min_size, max_size = self._get_minmax_size()
 
         field = cat.getNField(min_size, max_size, self.split_method,
@@ -178,7 +231,11 @@ class NNCorrelation(treecorr.BinnedCorr2):
         self.logger.info('Starting %d jobs.',field.nTopLevelNodes)
         treecorr._lib.ProcessAuto2(self.corr, field.data, self.output_dots,
                                    field._d, self._coords, self._bintype, self._metric)
+        self._log_thread_memory()
+        self._collect_patch_results()
         self.tot += 0.5 * cat.sumw**2
+        self._auto_tot += 0.5 * cat.sumw**2
+        self._add_patch_tot(cat)
 
 
     def process_cross(self, cat1, cat2, metric=None, num_threads=None):
@@ -208,6 +265,8 @@ class NNCorrelation(treecorr.BinnedCorr2):
 
         self._set_num_threads(num_threads)
 
+        self._set_npatch(cat1, cat2)
+
         min_size, max_size = self._get_minmax_size()
 
         f1 = cat1.getNField(min_size, max_size, self.split_method,
@@ -220,7 +279,10 @@ class NNCorrelation(treecorr.BinnedCorr2):
         self.logger.info('Starting %d jobs.',f1.nTopLevelNodes)
         treecorr._lib.ProcessCross2(self.corr, f1.data, f2.data, self.output_dots,
                                     f1._d, f2._d, self._coords, self._bintype, self._metric)
+        self._log_thread_memory()
+        self._collect_patch_results()
         self.tot += cat1.sumw*cat2.sumw
+        self._add_patch_tot(cat1, cat2)
 
 
     def process_pairwise(self, cat1, cat2, metric=None, num_threads=None):
@@ -256,6 +318,7 @@ class NNCorrelation(treecorr.BinnedCorr2):
 
         treecorr._lib.ProcessPair(self.corr, f1.data, f2.data, self.output_dots,
                                   f1._d, f2._d, self._coords, self._bintype, self._metric)
+        self._log_thread_memory()
         self.tot += (cat1.sumw+cat2.sumw)/2.
 
 
@@ -288,6 +351,10 @@ class NNCorrelation(treecorr.BinnedCorr2):
         self.weight.ravel()[:] = 0.
         self.npairs.ravel()[:] = 0.
         self.tot = 0.
+        self._auto_tot = 0.
+        self._clear_patch_results()
+        self._patch_tot = None
+        self.dilution = None
 
     def __iadd__(self, other):
         """Add a second NNCorrelation's data to this one.
@@ -309,10 +376,78 @@ class NNCorrelation(treecorr.BinnedCorr2):
         self.weight.ravel()[:] += other.weight.ravel()[:]
         self.npairs.ravel()[:] += other.npairs.ravel()[:]
         self.tot += other.tot
+        self._auto_tot += other._auto_tot
+        self._add_patch_results(other)
+        if other._patch_tot is not None:
+            self._patch_tot = self._padded_patch_tot(other._patch_tot)
         return self
 
 
-    def process(self, cat1, cat2=None, metric=None, num_threads=None):
+    def _padded_patch_tot(self, tot):
+        # Return tot plus the current _patch_tot, padding the smaller one with zeros if needed.
+        n = max(len(tot), len(self._patch_tot) if self._patch_tot is not None else 0)
+        new_tot = np.zeros((n,n), dtype=float)
+        new_tot[:len(tot),:len(tot)] += tot
+        if self._patch_tot is not None:
+            k = len(self._patch_tot)
+            new_tot[:k,:k] += self._patch_tot
+        return new_tot
+
+    def _add_patch_tot(self, cat1, cat2=None):
+        # Keep track of the contribution to tot from each pair of patches, which is needed
+        # to normalize the results when resampling the patches.
+        if cat1.patch is None: return
+        w1 = np.bincount(cat1.patch, weights=cat1.w, minlength=self.npatch)
+        if cat2 is None:
+            tot = np.triu(np.outer(w1, w1), 1) + np.diag(0.5 * w1**2)
+        else:
+            w2 = np.bincount(cat2.patch, weights=cat2.w, minlength=self.npatch)
+            tot = np.outer(w1, w2)
+        self._patch_tot = self._padded_patch_tot(tot)
+
+    def _sum_patch_tot(self, m):
+        # The equivalent of tot for the patches selected with multiplicity m.
+        # cf. BinnedCorr2._sum_patch_results
+        k = len(self._patch_tot)
+        mm = np.outer(m[:k], m[:k])
+        np.fill_diagonal(mm, m[:k])
+        return np.sum(mm * self._patch_tot)
+
+    def _get_npatch(self):
+        return max([c.npatch for c in [self, self._rr, self._dr, self._rd] if c is not None])
+
+    def _calculate_xi_from_pairs(self, m):
+        if self._rr is None:
+            raise ValueError("calculateXi must be called before estimate_cov for NNCorrelation")
+        for c in [self, self._rr, self._dr, self._rd]:
+            if c is not None and (len(c.results) == 0 or c._patch_tot is None):
+                raise ValueError("All of the NNCorrelations need patch results to estimate "
+                                 "the covariance.")
+        dd = self._sum_patch_results(m)[6]
+        ddtot = self._sum_patch_tot(m)
+
+        def scaled_weight(c):
+            # The weight of c scaled to be commensurate with dd.
+            return c._sum_patch_results(m)[6] * (ddtot / c._sum_patch_tot(m))
+
+        rr = scaled_weight(self._rr)
+        if self._dr is None:
+            if self._rd is None:
+                xi = dd - rr
+            else:
+                xi = dd - 2.*scaled_weight(self._rd) + rr
+        else:
+            if self._rd is None:
+                xi = dd - 2.*scaled_weight(self._dr) + rr
+            else:
+                xi = dd - scaled_weight(self._rd) - scaled_weight(self._dr) + rr
+        mask1 = rr != 0
+        xi[mask1] /= rr[mask1]
+        xi[~mask1] = 0.
+        return xi
+
+    def process(self, cat1, cat2=None, metric=None, num_threads=None, num_split=None, rng=None,
+                dilute_scale=None, dilute_fraction=None, dilute=True):
         """Compute the correlation function.
 
         If only 1 argument is given, then compute an auto-correlation function.
@@ -321,6 +456,24 @@ class NNCorrelation(treecorr.BinnedCorr2):
         Both arguments may be lists, in which case all items in the list are used
         for that element of the correlation.
 
+        If num_split > 1, then each catalog is randomly split into num_split sub-catalogs,
+        and only the pairs within the same sub-catalog (i.e. sub-catalog i of cat1 with
+        sub-catalog i of cat2 for cross-correlations) are accumulated.  This is intended for
+        the random-random correlation, RR, which can then use a much larger random catalog
+        than DR at only a fraction of the cost.  The total number of pairs, tot, is only
+        accumulated for the pairs that were actually used, so the normalization in
+        `calculateXi` and `write` is automatically correct.
+
+        If dilute_scale is given, then the bins whose left edge is at or above dilute_scale
+        are computed using randomly diluted versions of the catalogs, keeping only a fraction
+        dilute_fraction of the objects.  This is intended for random catalogs when the binning
+        spans a large range of scales, since the largest bins typically have many more random
+        pairs than are needed for their statistical precision.  The smaller bins still use
+        the full catalogs.  The weight and npairs in the diluted bins are scaled up by the
+        ratio of the total number of pairs in the full and diluted catalogs, so the result
+        may be used just like a normal NNCorrelation.  The fraction of the pairs actually
+        used in each bin is saved as the dilution attribute.
+
         Parameters:
             cat1 (Catalog):     A catalog or list of catalogs for the first N field.
             cat2 (Catalog):     A catalog or list of catalogs for the second N field, if any.
@@ -331,22 +484,236 @@ class NNCorrelation(treecorr.BinnedCorr2):
             num_threads (int):  How many OpenMP threads to use during the calculation.
                                 (default: use the number of cpu cores; this value can also be given
                                 in the constructor in the config dict.)
+            num_split (int):    If given, the number of random sub-catalogs into which to split
+                                the catalogs.  (default: None, which means don't split the
+                                catalogs)
+            rng (RandomState):  If desired, a numpy.random.RandomState instance to use for
+                                splitting or diluting the catalogs. (default: None)
+            dilute_scale (float): If given, the separation (in sep_units) above which to use
+                                diluted catalogs. (default: None, which means don't dilute
+                                the catalogs)
+            dilute_fraction (float): The fraction of the objects to keep in the diluted
+                                catalogs.  Required if dilute_scale is given. (default: None)
+            dilute (bool):      Which catalogs to dilute.  True means both, 1 means only cat1,
+                                and 2 means only cat2.  e.g. for a data-random cross-correlation
+                                use dilute=2. (default: True)
         """
         self.clear()
         if not isinstance(cat1,list): cat1 = [cat1]
         if cat2 is not None and not isinstance(cat2,list): cat2 = [cat2]
-
-        if cat2 is None or len(cat2) == 0:
-            self._process_all_auto(cat1,metric,num_threads)
+        if num_split is None:
+            num_split = 1
+        if num_split < 1:
+            raise ValueError("num_split must be at least 1")
+
+        if dilute_scale is not None:
+            self._process_diluted(cat1, cat2, metric, num_threads, num_split, rng,
+                                  dilute_scale, dilute_fraction, dilute)
+            return
+
+        if num_split == 1:
+            split1 = [cat1]
+            split2 = [cat2]
         else:
-            self._process_all_cross(cat1,cat2,metric,num_threads)
+            if rng is None:
+                rng = np.random.RandomState()
+            self.logger.info('Splitting catalogs into %d sub-catalogs',num_split)
+            split1 = self._split_catalogs(cat1, num_split, rng)
+            if cat2 is None or len(cat2) == 0:
+                split2 = [None] * num_split
+            else:
+                split2 = self._split_catalogs(cat2, num_split, rng)
+
+        for c1, c2 in zip(split1, split2):
+            if c2 is None or len(c2) == 0:
+                self._process_all_auto(c1,metric,num_threads)
+            else:
+                self._process_all_cross(c1,c2,metric,num_threads)
         self.finalize()
 
+    def _process_diluted(self, cat1, cat2, metric, num_threads, num_split, rng,
+                         dilute_scale, dilute_fraction, dilute):
+        if self.bin_type == 'TwoD':
+            raise ValueError("dilute_scale is not valid for bin_type = TwoD")
+        if dilute_fraction is None:
+            raise TypeError("dilute_fraction is required when using dilute_scale")
+        if not 0. < dilute_fraction <= 1.:
+            raise ValueError("dilute_fraction must be in the range (0,1]")
+        if dilute not in (True, 1, 2):
+            raise ValueError("Invalid value for dilute: %s"%dilute)
+        if any(c.npatch > 1 for c in cat1 + (cat2 or [])):
+            raise ValueError("dilute_scale cannot be used with patches")
+        if rng is None:
+            rng = np.random.RandomState()
+
+        # The first bin that is completely above dilute_scale.
+        # (Allow for a little rounding error in left_edges.)
+        k = int(np.searchsorted(self.left_edges, dilute_scale * (1.-1.e-10)))
+        self.logger.info('Using catalogs diluted by %f for bins %d..%d',
+                         dilute_fraction, k, self.nbins)
+
+        def process_all(c1, c2, max_sep=None):
+            # Use the same binning (and hence the same bin_slop and tree) as the full
+            # calculation, so the bins taken from each pass are exactly as they would be
+            # without dilution.  With max_sep, the C++ layer skips any pairs of cells that
+            # are entirely beyond max_sep, so the larger bins don't cost anything.
+            nn = NNCorrelation(self.config, self.logger)
+            if max_sep is not None:
+                treecorr._lib.DestroyCorr2(nn.corr, nn._d1, nn._d2, nn._bintype)
+                nn._build_corr(max_sep)
+            nn.process(c1, c2, metric, num_threads, num_split, rng)
+            return nn
+
+        def dilute_catalogs(cat_list):
+            new_list = []
+            for cat in cat_list:
+                use = rng.random_sample(cat.ntot) < dilute_fraction
+                if not np.any(use):
+                    raise ValueError("Diluted catalog has no objects.")
+                new_list.append(cat._subset(use))
+            return new_list
+
+        self.dilution = np.ones(self.nbins)
+        if k > 0:
+            # The full catalogs are only needed for bins < k.  Allow for a little rounding
+            # error between the edge and the bin numbers calculated from log(r), so no pairs
+            # that belong in bin k-1 are lost.
+            if k < self.nbins:
+                max_sep = self.left_edges[k] * self._sep_units * (1.+1.e-8)
+            else:
+                max_sep = None
+            full = process_all(cat1, cat2, max_sep)
+            self.tot = full.tot
+            for name in ['meanr', 'meanlogr', 'weight', 'npairs']:
+                getattr(self, name)[:k] = getattr(full, name)[:k]
+        else:
+            # No need to process the full catalogs just to get tot.
+            self.tot = self._calculate_tot(cat1, cat2, num_split, rng)
+
+        if k < self.nbins:
+            d1 = dilute_catalogs(cat1) if dilute in (True, 1) else cat1
+            if cat2 is None or len(cat2) == 0:
+                d2 = None
+            else:
+                d2 = dilute_catalogs(cat2) if dilute in (True, 2) else cat2
+            diluted = process_all(d1, d2)
+            # Scale up the diluted bins to match the number of pairs in the full catalogs.
+            scale = self.tot / diluted.tot
+            self.meanr[k:] = diluted.meanr[k:]
+            self.meanlogr[k:] = diluted.meanlogr[k:]
+            self.weight[k:] = diluted.weight[k:] * scale
+            self.npairs[k:] = diluted.npairs[k:] * scale
+            self.dilution[k:] = 1./scale
+        self.logger.info('Fraction of pairs used in each bin = %s',self.dilution)
+
+    def _calculate_tot(self, cat1, cat2, num_split, rng):
+        # The tot that process would accumulate for these catalogs, calculated from the
+        # total weights of the catalogs without processing any pairs.
+        if num_split == 1:
+            split1 = [cat1]
+            split2 = [cat2]
+        else:
+            split1 = self._split_catalogs(cat1, num_split, rng)
+            if cat2 is None or len(cat2) == 0:
+                split2 = [None] * num_split
+            else:
+                split2 = self._split_catalogs(cat2, num_split, rng)
+        pairwise = treecorr.config.get(self.config,'pairwise',bool,False)
+        tot = 0.
+        for c1, c2 in zip(split1, split2):
+            if c2 is None or len(c2) == 0:
+                # 0.5 * sumw^2 for each catalog, plus sumw1 * sumw2 for each pair of them.
+                tot += 0.5 * np.sum([c.sumw for c in c1])**2
+            elif pairwise:
+                tot += np.sum([(a.sumw + b.sumw)/2. for a, b in zip(c1, c2)])
+            else:
+                tot += np.sum([c.sumw for c in c1]) * np.sum([c.sumw for c in c2])
+        return tot
+
+    @staticmethod
+    def _split_catalogs(cat_list, num_split, rng):
+        # Randomly assign the objects in each catalog to num_split nearly equal sub-catalogs.
+        # Returns a list of num_split lists of catalogs.
+        split = [ [] for i in range(num_split) ]
+        for cat in cat_list:
+            if cat.ntot < num_split:
+                raise ValueError("Catalog has fewer than num_split=%d objects"%num_split)
+            index = rng.permutation(cat.ntot)
+            for i in range(num_split):
+                split[i].append(cat._subset(np.sort(index[i::num_split])))
+        return split
+
+    def analytic_rr(self):
+        """Calculate the expected random-random pair counts for a periodic box.
+
+        For the Periodic metric, the distribution of separations for uniformly distributed
+        points is known exactly, so there is no need to build and process a random catalog.
+        The expected number of pairs in each bin is tot times the fraction of the box volume
+        (or area for flat coordinates) within the bin's range of separations, where the
+        separations use the minimum image convention in each direction.
+
+        For bin_type = 'TwoD', the expected number of pairs in each pixel is just tot times
+        the fraction of the box area covered by the pixel (less any part with r < min_sep).
+        The pairs in an auto-correlation are counted in both directions for TwoD binning,
+        so these count double.  This requires max_sep <= period/2, so the grid of pixels
+        doesn't overlap itself when wrapped.
+
+        This may be called after processing the data catalog(s), since it needs to know the
+        coordinate system and the total number of pairs.  The returned object may be used
+        as rr in `calculateXi` or `write`.  (If rr is omitted in `calculateXi`, this is
+        done automatically.)
+
+        Returns:
+            An NNCorrelation object with the expected RR weight and npairs in each bin.
+        """
+        if self.metric != 'Periodic':
+            raise ValueError("Analytic RR requires the Periodic metric")
+        if self.tot == 0:
+            raise ValueError("Analytic RR requires tot > 0.  Process the data first.")
+
+        rr = NNCorrelation(self.config, self.logger)
+        rr.coords = self.coords
+        rr.metric = self.metric
+        rr._coords = self._coords
+        rr._metric = self._metric
+        rr.tot = self.tot
+        rr._auto_tot = self._auto_tot
+
+        if self.bin_type == 'TwoD':
+            if self.max_sep * self._sep_units > 0.5 * min(self.xperiod, self.yperiod):
+                raise ValueError("Analytic RR for bin_type = TwoD requires max_sep <= period/2")
+            s = self._sep_units
+            x0, x1 = self.left_edges * s, self.right_edges * s
+            y0, y1 = self.bottom_edges * s, self.top_edges * s
+            area = (x1-x0) * (y1-y0)
+            if self.min_sep > 0:
+                area -= _disk_rect_area(self.min_sep * s, x0, x1, y0, y1)
+            box = self.xperiod * self.yperiod
+            rr.weight[:] = (self.tot + self._auto_tot) * area / box
+            rr.npairs[:] = rr.weight
+            rr.meanr[:] = self.rnom
+            rr.meanlogr[:] = self.logr
+            return rr
+
+        edges = np.append(self.left_edges, self.right_edges[-1]) * self._sep_units
+        if self.coords == '3d':
+            a, b, c = 0.5*self.xperiod, 0.5*self.yperiod, 0.5*self.zperiod
+            vol = np.array([ _ball_box_volume(r, a, b, c) for r in edges ])
+            box = self.xperiod * self.yperiod * self.zperiod
+        else:
+            vol = _disk_box_area(edges, 0.5*self.xperiod, 0.5*self.yperiod)
+            box = self.xperiod * self.yperiod
+        rr.weight[:] = self.tot * np.diff(vol) / box
+        rr.npairs[:] = rr.weight
+        rr.meanr[:] = self.rnom
+        rr.meanlogr[:] = self.logr
+        return rr
+
     def _mean_weight(self):
         mean_np = np.mean(self.npairs)
         return 1 if mean_np == 0 else np.mean(self.weight)/mean_np
 
-    def calculateXi(self, rr, dr=None, rd=None):
+    def calculateXi(self, rr=None, dr=None, rd=None):
         """Calculate the correlation function given another correlation function of random
         points using the same mask, and possibly cross correlations of the data and random.
 
@@ -360,8 +727,13 @@ class NNCorrelation(treecorr.BinnedCorr2):
 
         where DD is the data NN correlation function, which is the current object.
 
+        For the Periodic metric, rr may be omitted, in which case the exact expected value
+        for uniform randoms in the periodic box is used.  See `analytic_rr`.
+
         Parameters:
             rr (NNCorrelation):     The auto-correlation of the random field (RR)
+                                    (default: None, which is only valid for the Periodic
+                                    metric)
             dr (NNCorrelation):     The cross-correlation of the data with randoms (DR), if
                                     desired, in which case the Landy-Szalay estimator will be
                                     calculated.  (default: None)
@@ -374,6 +746,14 @@ class NNCorrelation(treecorr.BinnedCorr2):
                 - xi = array of :math:`\\xi(r)`
                 - varxi = array of variance estimates of :math:`\\xi(r)`
         """
+        if rr is None:
+            if self.metric != 'Periodic':
+                raise TypeError("rr is required unless using the Periodic metric")
+            rr = self.analytic_rr()
+
+        # Keep these for estimate_cov.
+        self._rr, self._dr, self._rd = rr, dr, rd
+
         # Each random weight value needs to be rescaled by the ratio of total possible pairs.
         if rr.tot == 0:
             raise ValueError("rr has tot=0.")
@@ -437,7 +817,8 @@ class NNCorrelation(treecorr.BinnedCorr2):
         return xi, varxi
 
 
-    def write(self, file_name, rr=None, dr=None, rd=None, file_type=None, precision=None):
+    def write(self, file_name, rr=None, dr=None, rd=None, file_type=None, precision=None,
+              name=None):
         """Write the correlation function to the file, file_name.
 
         rr is the NNCorrelation function for random points.
@@ -476,12 +857,16 @@ class NNCorrelation(treecorr.BinnedCorr2):
                                     desired. (default: None)
             rd (NNCorrelation):     The cross-correlation of the randoms with data (RD), if
                                     desired. (default: None, which means use rd=dr)
-            file_type (str):        The type of file to write ('ASCII' or 'FITS').
+            file_type (str):        The type of file to write ('ASCII', 'FITS' or 'HDF5').
                                     (default: determine the type automatically from the extension
                                     of file_name.)
             precision (int):        For ASCII output catalogs, the desired precision. (default: 4;
                                     this value can also be given in the constructor in the config
                                     dict.)
+            name (str):             For HDF5 output, the name of the group in which to write the
+                                    results.  Results with different names can be written to the
+                                    same file.  (default: None, which writes the results at the
+                                    top level of a new file)
         """
         self.logger.info('Writing NN correlations to %s',file_name)
 
@@ -511,6 +896,17 @@ class NNCorrelation(treecorr.BinnedCorr2):
             col_names += [ 'npairs' ]
             columns += [ self.npairs ]
 
+            # If the randoms were diluted, also write the fraction of the pairs that were used.
+            if rr.dilution is not None:
+                col_names += [ 'RR_frac' ]
+                columns += [ rr.dilution ]
+            if dr is not None and dr.dilution is not None:
+                col_names += [ 'DR_frac' ]
+                columns += [ dr.dilution ]
+            if rd is not None and rd is not dr and rd.dilution is not None:
+                col_names += [ 'RD_frac' ]
+                columns += [ rd.dilution ]
+
         if precision is None:
             precision = self.config.get('precision', 4)
 
@@ -519,10 +915,10 @@ class NNCorrelation(treecorr.BinnedCorr2):
 
         treecorr.util.gen_write(
             file_name, col_names, columns, params=params,
-            precision=precision, file_type=file_type, logger=self.logger)
+            precision=precision, file_type=file_type, name=name, logger=self.logger)
 
 
-    def read(self, file_name, file_type=None):
+    def read(self, file_name, file_type=None, name=None):
         """Read in values from a file.
 
         This should be a file that was written by TreeCorr, preferably a FITS file, so there
@@ -534,12 +930,15 @@ class NNCorrelation(treecorr.BinnedCorr2):
 
         Parameters:
             file_name (str):   The name of the file to read in.
-            file_type (str):   The type of file ('ASCII' or 'FITS').  (default: determine the type
-                                automatically from the extension of file_name.)
+            file_type (str):   The type of file ('ASCII', 'FITS' or 'HDF5').  (default: determine
+                                the type automatically from the extension of file_name.)
+            name (str):        For HDF5 files, the name of the group to read, if the results
+                                were written with a name.  (default: None)
         """
         self.logger.info('Reading NN correlations from %s',file_name)
 
-        data, params = treecorr.util.gen_read(file_name, file_type=file_type, logger=self.logger)
+        data, params = treecorr.util.gen_read(file_name, file_type=file_type, name=name,
+                                              logger=self.logger)
         if 'R_nom' in data.dtype.names:  # pragma: no cover
             self.rnom = data['R_nom']
             self.meanr = data['meanR']
@@ -229,6 +229,7 @@ class NNNCorrelation(treecorr.BinnedCorr3):
         self.logger.info('Starting %d jobs.',field.nTopLevelNodes)
         treecorr._lib.ProcessAuto3(self.corr, field.data, self.output_dots,
                                    field._d, self._coords, self._bintype, self._metric)
+        self._log_thread_memory()
         self.tot += (1./6.) * cat.sumw**3
 
     def process_cross21(self, cat1, cat2, metric=None, num_threads=None):
@@ -296,6 +297,7 @@ class NNNCorrelation(treecorr.BinnedCorr3):
         self.logger.info('Starting %d jobs.',f1.nTopLevelNodes)
         treecorr._lib.ProcessCross3(self.corr, f1.data, f2.data, f3.data, self.output_dots,
                                     f1._d, f2._d, f3._d, self._coords, self._bintype, self._metric)
+        self._log_thread_memory()
         self.tot += cat1.sumw * cat2.sumw * cat3.sumw / 6.0
 
 
@@ -427,7 +429,109 @@ class NNNCorrelation(treecorr.BinnedCorr3):
             self._process_all_cross(cat1,cat2,cat3, metric, num_threads)
         self.finalize()
 
-    def calculateZeta(self, rrr, drr=None, rdr=None, rrd=None,
+    def analytic_rrr(self):
+        """Calculate the expected random-random-random triangle counts for a periodic box.
+
+        For the Periodic metric, the distribution of triangles for uniformly distributed
+        points is known exactly, so there is no need to build and process a random catalog.
+        Given the total number of triangles, tot, and the volume V of the box, the density
+        of triangles with sides d1, d2, d3 is
+
+        .. math::
+
+            6 \\frac{tot}{V^2} 8\\pi^2 d_1 d_2 d_3 \\, dd_1 dd_2 dd_3
+
+        for 3d coordinates, split equally between positive and negative v, and
+
+        .. math::
+
+            6 \\frac{tot}{V^2} \\frac{\\pi d_1 d_2 d_3}{A} \\, dd_1 dd_2 dd_3
+
+        for each sign of v for flat coordinates, where A is the area of the triangle.
+        These are integrated over each bin in r, u, v.
+
+        This is only exact if the triangles are small enough that the periodic wrapping doesn't
+        affect their shape, so max_sep must be at most 1/4 of the smallest period.  It also
+        assumes that tot counts the triangles as for an auto-correlation.
+
+        This may be called after processing the data catalog, since it needs to know the
+        coordinate system and the total number of triangles.  The returned object may be used
+        as rrr in `calculateZeta` or `write`.  (If rrr is omitted in `calculateZeta`, this is
+        done automatically.)
+
+        Returns:
+            An NNNCorrelation object with the expected RRR weight and ntri in each bin.
+        """
+        if self.metric != 'Periodic':
+            raise ValueError("Analytic RRR requires the Periodic metric")
+        if self.tot == 0:
+            raise ValueError("Analytic RRR requires tot > 0.  Process the data first.")
+        if self.coords == '3d':
+            periods = [self.xperiod, self.yperiod, self.zperiod]
+        else:
+            periods = [self.xperiod, self.yperiod]
+        if self._max_sep > 0.25 * min(periods):
+            raise ValueError("Analytic RRR requires max_sep <= period/4")
+        box = np.prod(periods)
+
+        rrr = NNNCorrelation(self.config, self.logger)
+        rrr.coords = self.coords
+        rrr.metric = self.metric
+        rrr._coords = self._coords
+        rrr._metric = self._metric
+        rrr.tot = self.tot
+        rrr.finalize()  # Sets the nominal values for the meanr, etc.
+
+        # The bin edges in r (natural units), u and |v|.
+        logr = np.log(self.rnom1d * self._sep_units)
+        r0 = np.exp(logr - 0.5*self.bin_size)
+        r1 = np.exp(logr + 0.5*self.bin_size)
+        u0 = self.u1d - 0.5*self.ubin_size
+        v0 = self.v1d[self.nvbins:] - 0.5*self.vbin_size
+        # Change variables from d1,d2,d3 to r=d2, u=d3/d2, v=(d1-d2)/d3.  The Jacobian is
+        # d2^2 u, and d1 d2 d3 = r^3 u (1+uv).
+        if self.coords == '3d':
+            # Integrate 24 pi^2 r^5 u^2 (1+uv) dr du dv analytically.
+            rint = (r1**6 - r0**6) / 6.
+            u1 = u0 + self.ubin_size
+            v1 = v0 + self.vbin_size
+            uint2 = (u1**3 - u0**3) / 3.
+            uint3 = (u1**4 - u0**4) / 4.
+            uvint = (uint2[:,None] * (v1 - v0)[None,:] +
+                     uint3[:,None] * (0.5 * (v1**2 - v0**2))[None,:])
+            norm = 24. * np.pi**2
+        else:
+            # The area is A = r^2 u/4 sqrt((1-v^2)(2+u+uv)(2-u+uv)), so we need to integrate
+            # 6 pi r^3 4u(1+uv) / sqrt((1-v^2)(2+u+uv)(2-u+uv)) dr du dv.  The integrand is
+            # singular at v=1, so substitute v = 1-s^2 to make it smooth, which gives
+            # dv / sqrt(1-v^2) = 2 ds / sqrt(2-s^2).  Then integrate numerically.
+            rint = (r1**4 - r0**4) / 4.
+            x, w = np.polynomial.legendre.leggauss(10)
+            uvint = np.zeros((self.nubins, self.nvbins))
+            for i, ua in enumerate(u0):
+                u = ua + 0.5 * self.ubin_size * (1. + x)
+                wu = 0.5 * self.ubin_size * w
+                for j, va in enumerate(v0):
+                    s0 = np.sqrt(1. - min(va + self.vbin_size, 1.))
+                    s1 = np.sqrt(1. - va)
+                    s = 0.5 * (s0 + s1) + 0.5 * (s1 - s0) * x
+                    ws = 0.5 * (s1 - s0) * w
+                    uu = u[:,None]
+                    ss = s[None,:]
+                    vv = 1. - ss**2
+                    f = (4. * uu * (1. + uu*vv) * 2. /
+                         np.sqrt((2. - ss**2) * (2. + uu + uu*vv) * (2. - uu + uu*vv)))
+                    uvint[i,j] = np.sum(wu[:,None] * ws[None,:] * f)
+            norm = 6. * np.pi
+
+        w = norm * self.tot / box**2 * rint[:,None,None] * uvint[None,:,:]
+        # Negative v bins are a mirror image of the positive v bins.
+        rrr.weight[:,:,self.nvbins:] = w
+        rrr.weight[:,:,:self.nvbins] = w[:,:,::-1]
+        rrr.ntri[:] = rrr.weight
+        return rrr
+
+    def calculateZeta(self, rrr=None, drr=None, rdr=None, rrd=None,
                       ddr=None, drd=None, rdd=None):
         """Calculate the 3pt function given another 3pt function of random
         points using the same mask, and possibly cross correlations of the data and random.
@@ -456,8 +560,13 @@ class NNNCorrelation(treecorr.BinnedCorr3):
         - If only rrr is provided, the first formula will be used.
         - If all of rrr, drr, rdr, rrd, ddr, drd, rdd are provided then the second will be used.
 
+        For the Periodic metric, rrr may be omitted, in which case the exact expected value
+        for uniform randoms in the periodic box is used.  See `analytic_rrr`.
+
         Parameters:
             rrr (NNNCorrelation):   The auto-correlation of the random field (RRR)
+                                    (default: None, which is only valid for the Periodic
+                                    metric)
             drr (NNNCorrelation):   DRR if desired. (default: None)
             rdr (NNNCorrelation):   RDR if desired. (default: None)
             rrd (NNNCorrelation):   RRD if desired. (default: None)
@@ -471,6 +580,11 @@ class NNNCorrelation(treecorr.BinnedCorr3):
                 - zeta = array of :math:`\\zeta(d_1,d_2,d_3)`
                 - varzeta = array of variance estimates of :math:`\\zeta(d_1,d_2,d_3)`
         """
+        if rrr is None:
+            if self.metric != 'Periodic':
+                raise TypeError("rrr is required unless using the Periodic metric")
+            rrr = self.analytic_rrr()
+
         # Each random ntri value needs to be rescaled by the ratio of total possible tri.
         if rrr.tot == 0:
             raise ValueError("rrr has tot=0.")
@@ -519,7 +633,7 @@ class NNNCorrelation(treecorr.BinnedCorr3):
 
 
     def write(self, file_name, rrr=None, drr=None, rdr=None, rrd=None,
-              ddr=None, drd=None, rdd=None, file_type=None, precision=None):
+              ddr=None, drd=None, rdd=None, file_type=None, precision=None, name=None):
         """Write the correlation function to the file, file_name.
 
         Normally, at least rrr should be provided, but if this is None, then only the
@@ -592,12 +706,16 @@ class NNNCorrelation(treecorr.BinnedCorr3):
             ddr (NNNCorrelation):   DDR if desired. (default: None)
             drd (NNNCorrelation):   DRD if desired. (default: None)
             rdd (NNNCorrelation):   RDD if desired. (default: None)
-            file_type (str):        The type of file to write ('ASCII' or 'FITS').
+            file_type (str):        The type of file to write ('ASCII', 'FITS' or 'HDF5').
                                     (default: determine the type automatically from the extension
                                     of file_name.)
             precision (int):        For ASCII output catalogs, the desired precision. (default: 4;
                                     this value can also be given in the constructor in the config
                                     dict.)
+            name (str):             For HDF5 output, the name of the group in which to write the
+                                    results.  Results with different names can be written to the
+                                    same file.  (default: None, which writes the results at the
+                                    top level of a new file)
         """
         self.logger.info('Writing NNN correlations to %s',file_name)
 
@@ -636,10 +754,10 @@ class NNNCorrelation(treecorr.BinnedCorr3):
 
         treecorr.util.gen_write(
             file_name, col_names, columns,
-            params=params, precision=precision, file_type=file_type, logger=self.logger)
+            params=params, precision=precision, file_type=file_type, name=name, logger=self.logger)
 
 
-    def read(self, file_name, file_type=None):
+    def read(self, file_name, file_type=None, name=None):
         """Read in values from a file.
 
         This should be a file that was written by TreeCorr, preferably a FITS file, so there
@@ -651,12 +769,15 @@ class NNNCorrelation(treecorr.BinnedCorr3):
 
         Parameters:
             file_name (str):    The name of the file to read in.
-            file_type (str):    The type of file ('ASCII' or 'FITS').  (default: determine the type
-                                automatically from the extension of file_name.)
+            file_type (str):    The type of file ('ASCII', 'FITS' or 'HDF5').  (default: determine
+                                the type automatically from the extension of file_name.)
+            name (str):         For HDF5 files, the name of the group to read, if the results
+                                were written with a name.  (default: None)
         """
         self.logger.info('Reading NNN correlations from %s',file_name)
 
-        data, params = treecorr.util.gen_read(file_name, file_type=file_type, logger=self.logger)
+        data, params = treecorr.util.gen_read(file_name, file_type=file_type, name=name,
+                                              logger=self.logger)
         s = self.logr.shape
         if 'R_nom' in data.dtype.names:  # pragma: no cover
             self.rnom = data['R_nom'].reshape(s)
@@ -0,0 +1,363 @@
+# Copyright (c) 2003-2019 by Mike Jarvis
+#
+# TreeCorr is free software: redistribution and use in source and binary forms,
+# with or without modification, are permitted provided that the following
+# conditions are met:
+#
+# 1. Redistributions of source code must retain the above copyright notice, this
+#    list of conditions, and the disclaimer given in the accompanying LICENSE
+#    file.
+# 2. Redistributions in binary form must reproduce the above copyright notice,
+#    this list of conditions, and the disclaimer given in the documentation
+#    and/or other materials provided with the distribution.
+
+"""
+.. module:: randoms
+"""
+
+import numpy as np
+import treecorr
+
+# The most points to generate in one batch, to limit the memory used for the trial points.
+_max_batch = 10000000
+
+random_valid_params = {
+    'rand_nobj' : (int, False, None, None,
+            'The number of random points to generate in memory, rather than reading '
+            'rand_file_name.'),
+    'rand_factor' : (float, False, None, None,
+            'The number of random points to generate as a multiple of the number of objects in '
+            'the corresponding data catalog(s).'),
+    'rand_seed' : (int, False, None, None,
+            'The seed to use for the generated random points.  The randoms for the second '
+            'catalog use rand_seed+1.'),
+    'rand_x_range' : (float, True, None, None,
+            'The range [min, max] of x values for generated random points.'),
+    'rand_y_range' : (float, True, None, None,
+            'The range [min, max] of y values for generated random points.'),
+    'rand_z_range' : (float, True, None, None,
+            'The range [min, max] of z values for generated random points.'),
+    'rand_ra_range' : (float, True, None, None,
+            'The range [min, max] of ra values (in ra_units) for generated random points.'),
+    'rand_dec_range' : (float, True, None, None,
+            'The range [min, max] of dec values (in dec_units) for generated random points.'),
+    'rand_cap_center' : (float, True, None, None,
+            'The center [ra, dec] (in ra_units, dec_units) of a spherical cap in which '
+            'to generate random points.'),
+    'rand_cap_radius' : (float, False, None, None,
+            'The radius (in dec_units) of a spherical cap in which to generate random points.'),
+    'rand_mask_file' : (str, False, None, None,
+            'An ASCII file with a 2-d array of 0s and 1s giving a pixelized mask covering '
+            'the x,y or ra,dec range of the generated random points.  Rows are y (or dec) '
+            'from min to max, columns are x (or ra) from min to max.'),
+    'rand_polygon_file' : (str, False, None, None,
+            'An ASCII file with columns (id, x, y) or (id, ra, dec) giving the vertices of '
+            'polygons in which to generate random points.'),
+}
+
+
+def _get_range(value, name):
+    if value is None:
+        return None
+    value = np.array(value, dtype=float).ravel()
+    if len(value) != 2:
+        raise TypeError("%s must be given as (min, max)"%name)
+    if not value[0] < value[1]:
+        raise ValueError("%s must have min < max"%name)
+    return value
+
+
+def _unit(units, name):
+    if units is None:
+        raise TypeError("%s is required when using ra, dec"%name)
+    return treecorr.config.parse_unit(units)
+
+
+def generate_randoms(nrand, x_range=None, y_range=None, z_range=None,
+                     ra_range=None, dec_range=None, cap_center=None, cap_radius=None,
+                     mask=None, polygons=None, x_units=None, y_units=None,
+                     ra_units=None, dec_units=None, seed=None, logger=None):
+    """Generate a Catalog of points uniformly distributed over some footprint.
+
+    The points are generated directly in memory by the C++ layer, using a fast, seedable
+    random number generator that runs in parallel over blocks of points.  The results only
+    depend on the seed, not on the number of threads being used.
+
+    The footprint may be any of the following:
+
+        1. A flat box, given by x_range and y_range, and optionally z_range for 3-d positions.
+        2. A rectangle in ra and dec, given by ra_range and dec_range.  The points are uniform
+           on the sphere, i.e. uniform in ra and sin(dec).  To straddle ra=0, use a range like
+           (350, 370) degrees.
+        3. A spherical cap, given by cap_center = (ra, dec) and cap_radius.
+
+    In addition, the points may be restricted further by either or both of:
+
+        - mask: a 2-d boolean array covering the x_range, y_range (or ra_range, dec_range)
+          rectangle.  ``mask[j,i]`` covers the i-th pixel in x (or ra) and the j-th pixel in
+          y (or dec), counting from the minimum value.  Only points in pixels where the mask
+          is True are kept.
+        - polygons: a list of polygons, each given as an (N,2) array of vertices in x,y (or
+          ra,dec) coordinates.  Only points inside at least one of the polygons are kept.
+          For ra,dec polygons, the edges are straight lines in ra and dec.  If no range is
+          given, the bounding box of the polygons is used.
+
+    Masked footprints are filled by rejection, so the requested number of points is always
+    returned.
+
+    Parameters:
+        nrand (int):        The number of random points to generate.
+        x_range (tuple):    The range (min, max) of x values. (default: None)
+        y_range (tuple):    The range (min, max) of y values. (default: None)
+        z_range (tuple):    The range (min, max) of z values, if desired. (default: None)
+        ra_range (tuple):   The range (min, max) of ra values in ra_units. (default: None)
+        dec_range (tuple):  The range (min, max) of dec values in dec_units. (default: None)
+        cap_center (tuple): The center (ra, dec) of a spherical cap in ra_units, dec_units.
+                            (default: None)
+        cap_radius (float): The radius of the spherical cap in dec_units. (default: None)
+        mask (array):       A 2-d boolean pixel mask. (default: None)
+        polygons (list):    A list of (N,2) arrays of polygon vertices. (default: None)
+        x_units (str):      The units of x values to use for the returned Catalog.
+                            (default: None)
+        y_units (str):      The units of y values to use for the returned Catalog.
+                            (default: None)
+        ra_units (str):     The units of ra values.  Required for spherical footprints.
+        dec_units (str):    The units of dec values.  Required for spherical footprints.
+        seed (int):         The seed for the random number generator.  (default: None, which
+                            means to pick a seed from the system entropy.)
+        logger:             If desired, a logger object for logging. (default: None)
+
+    Returns:
+        A Catalog of the random points.
+    """
+    nrand = int(nrand)
+    if nrand < 1:
+        raise ValueError("nrand must be at least 1")
+    if seed is None:
+        seed = np.random.RandomState().randint(0, 2**31)
+    seed = int(seed)
+
+    x_range = _get_range(x_range, 'x_range')
+    y_range = _get_range(y_range, 'y_range')
+    z_range = _get_range(z_range, 'z_range')
+    ra_range = _get_range(ra_range, 'ra_range')
+    dec_range = _get_range(dec_range, 'dec_range')
+
+    flat = x_range is not None or y_range is not None or z_range is not None
+    cap = cap_center is not None or cap_radius is not None
+    spher = ra_range is not None or dec_range is not None or cap
+    if flat and spher:
+        raise TypeError("Cannot mix x,y,z ranges with ra,dec or cap footprints")
+    if not flat and not spher and polygons is None:
+        raise TypeError("No footprint specified for random points")
+    if polygons is not None and not flat and not spher and (ra_units or dec_units):
+        spher = True
+    if cap and (ra_range is not None or dec_range is not None):
+        raise TypeError("Cannot give both a spherical cap and ra_range or dec_range")
+    if cap and (cap_center is None or cap_radius is None):
+        raise TypeError("cap_center and cap_radius must be given together")
+    if cap and mask is not None:
+        raise TypeError("A pixel mask requires ra_range, dec_range rather than a cap")
+
+    # Polygons are given in the input units.  Convert to radians for spherical footprints.
+    if spher:
+        ra_u = _unit(ra_units, 'ra_units')
+        dec_u = _unit(dec_units, 'dec_units')
+    else:
+        ra_u = dec_u = 1.
+    if polygons is not None:
+        polygons = [ np.array(p, dtype=float).reshape(-1,2) for p in polygons ]
+        if len(polygons) == 0 or any(len(p) < 3 for p in polygons):
+            raise ValueError("Each polygon must have at least 3 vertices")
+        px = np.ascontiguousarray(np.concatenate([p[:,0] for p in polygons])) * ra_u
+        py = np.ascontiguousarray(np.concatenate([p[:,1] for p in polygons])) * dec_u
+        pstart = np.cumsum([0] + [len(p) for p in polygons]).astype(int)
+        bounds = (np.array([px.min(), px.max()]) / ra_u, np.array([py.min(), py.max()]) / dec_u)
+        if spher and not cap:
+            if ra_range is None: ra_range = bounds[0]
+            if dec_range is None: dec_range = bounds[1]
+        elif not spher:
+            if x_range is None: x_range = bounds[0]
+            if y_range is None: y_range = bounds[1]
+            flat = True
+
+    if flat and (x_range is None or y_range is None):
+        raise TypeError("Both x_range and y_range are required")
+    if spher and not cap and (ra_range is None or dec_range is None):
+        raise TypeError("Both ra_range and dec_range are required")
+
+    if spher and not cap:
+        ra_range = ra_range * ra_u
+        dec_range = dec_range * dec_u
+        if dec_range[0] < -np.pi/2. or dec_range[1] > np.pi/2.:
+            raise ValueError("dec_range must be within [-90, 90] degrees")
+    if cap:
+        cap_center = np.array(cap_center, dtype=float).ravel()
+        if len(cap_center) != 2:
+            raise TypeError("cap_center must be given as (ra, dec)")
+        ra0 = cap_center[0] * ra_u
+        dec0 = cap_center[1] * dec_u
+        radius = float(cap_radius) * dec_u
+        if not 0. < radius <= np.pi:
+            raise ValueError("cap_radius must be between 0 and 180 degrees")
+
+    if mask is not None:
+        mask = np.array(mask, dtype=bool)
+        if mask.ndim != 2:
+            raise ValueError("mask must be a 2-d array")
+        if not np.any(mask):
+            raise ValueError("mask has no valid pixels")
+        mask_long = np.ascontiguousarray(mask, dtype=int)
+        mrange = (x_range, y_range) if flat else (ra_range, dec_range)
+
+    if logger:
+        logger.info('Generating %d random points with seed %d',nrand,seed)
+
+    lib = treecorr._lib
+    dp = treecorr.util.double_ptr
+    lp = treecorr.util.long_ptr
+    use_z = flat and z_range is not None
+
+    chunks = []
+    ngen = 0       # Total number generated so far
+    nkeep = 0      # Total number kept so far
+    stream = 0
+    while nkeep < nrand:
+        # Use the acceptance fraction so far to guess how many more we need.
+        frac = float(nkeep) / ngen if ngen > 0 else 1.
+        ntry = int((nrand - nkeep) / max(frac, 1.e-3) * 1.05) + 100
+        # The guess can be huge if few or none have been kept so far (e.g. a small footprint
+        # in a large range), so only let the batches grow gradually, and never past
+        # _max_batch points at a time.
+        if ngen > 0:
+            ntry = min(ntry, 4 * ngen)
+        ntry = min(ntry, _max_batch)
+        a = np.empty(ntry, dtype=float)
+        b = np.empty(ntry, dtype=float)
+        c = np.empty(ntry, dtype=float) if use_z else None
+        if flat:
+            zr = z_range if use_z else (0.,0.)
+            lib.GenerateFlat(dp(a), dp(b), dp(c), ntry, x_range[0], x_range[1],
+                             y_range[0], y_range[1], zr[0], zr[1], seed, stream)
+        elif cap:
+            lib.GenerateCap(dp(a), dp(b), ntry, ra0, dec0, radius, seed, stream)
+        else:
+            lib.GenerateRADec(dp(a), dp(b), ntry, ra_range[0], ra_range[1],
+                              dec_range[0], dec_range[1], seed, stream)
+        stream += 1
+        ngen += ntry
+
+        if mask is not None or polygons is not None:
+            keep = np.ones(ntry, dtype=int)
+            if mask is not None:
+                ny, nx = mask.shape
+                lib.ApplyPixelMask(dp(a), dp(b), ntry, lp(mask_long), nx, ny,
+                                   mrange[0][0], mrange[0][1], mrange[1][0], mrange[1][1],
+                                   lp(keep))
+            if polygons is not None:
+                lib.ApplyPolygonMask(dp(a), dp(b), ntry, dp(px), dp(py), lp(pstart),
+                                     len(polygons), lp(keep))
+            keep = keep.astype(bool)
+            a = a[keep]
+            b = b[keep]
+            if c is not None: c = c[keep]
+        chunks.append((a,b,c))
+        nkeep += len(a)
+        if nkeep == 0 and ngen > 1000 * nrand:
+            raise RuntimeError("Unable to generate any random points within the footprint")
+
+    a = np.concatenate([ch[0] for ch in chunks])[:nrand]
+    b = np.concatenate([ch[1] for ch in chunks])[:nrand]
+    if logger:
+        logger.debug('Generated %d points to keep %d',ngen,nkeep)
+    if flat:
+        c = np.concatenate([ch[2] for ch in chunks])[:nrand] if use_z else None
+        if x_units is not None or y_units is not None:
+            return treecorr.Catalog(x=a, y=b, z=c, x_units=x_units, y_units=y_units)
+        else:
+            return treecorr.Catalog(x=a, y=b, z=c)
+    else:
+        return treecorr.Catalog(ra=a, dec=b, ra_units='rad', dec_units='rad')
+
+
+def _read_polygons(file_name):
+    data = np.loadtxt(file_name, ndmin=2)
+    if data.shape[1] != 3:
+        raise ValueError("Polygon file %s should have 3 columns: id, x, y"%file_name)
+    ids = data[:,0]
+    # Keep the polygons in the order in which they first appear in the file.
+    _, first = np.unique(ids, return_index=True)
+    return [ data[ids == ids[i], 1:] for i in np.sort(first) ]
+
+
+def generate_random_catalogs(config, num=0, ndata=None, logger=None):
+    """Generate random catalogs according to the rand_* parameters in a config dict.
+
+    This is how corr2 and corr3 use randoms generated in memory when no rand_file_name is
+    given.  The number of points is either rand_nobj or rand_factor * ndata.
+
+    Parameters:
+        config (dict):  The configuration dict to use for the appropriate parameters
+        num (int):      Which number catalog does this correspond to.  The units are taken
+                        from the num-th item of lists like ra_units, and the seed is
+                        rand_seed + num.  (default: 0)
+        ndata (int):    The number of objects in the corresponding data catalog(s).  Required
+                        if using rand_factor.  (default: None)
+        logger:         If desired, a logger object for logging. (default: None)
+
+    Returns:
+        A list with a single random Catalog, or an empty list if no randoms are specified.
+    """
+    get = treecorr.config.get
+    if 'rand_nobj' in config:
+        if 'rand_factor' in config:
+            raise TypeError("Cannot provide both rand_nobj and rand_factor")
+        nrand = get(config,'rand_nobj',int)
+    elif 'rand_factor' in config:
+        if ndata is None:
+            raise TypeError("ndata is required when using rand_factor")
+        nrand = int(np.ceil(get(config,'rand_factor',float) * ndata))
+    else:
+        return []
+
+    seed = get(config,'rand_seed',int)
+    if seed is not None:
+        seed += num
+    mask = None
+    if 'rand_mask_file' in config:
+        mask = np.loadtxt(config['rand_mask_file'], ndmin=2) != 0
+    polygons = None
+    if 'rand_polygon_file' in config:
+        polygons = _read_polygons(config['rand_polygon_file'])
+
+    def get_list(key):
+        value = config.get(key, None)
+        if value is None:
+            return None
+        if not isinstance(value, list):
+            value = value.split()
+        return [ float(v) for v in value ]
+
+    def get_units(key):
+        # Leave these as strings, rather than letting get_from_list convert them to radians.
+        value = config.get(key, None)
+        if isinstance(value, list):
+            value = value[num]
+        return value
+
+    rand = generate_randoms(
+            nrand,
+            x_range=get_list('rand_x_range'),
+            y_range=get_list('rand_y_range'),
+            z_range=get_list('rand_z_range'),
+            ra_range=get_list('rand_ra_range'),
+            dec_range=get_list('rand_dec_range'),
+            cap_center=get_list('rand_cap_center'),
+            cap_radius=get(config,'rand_cap_radius',float),
+            mask=mask, polygons=polygons,
+            x_units=get_units('x_units'),
+            y_units=get_units('y_units'),
+            ra_units=get_units('ra_units'),
+            dec_units=get_units('dec_units'),
+            seed=seed, logger=logger)
+    return [rand]
@@ -27,7 +27,8 @@ def ensure_dir(target):
         if not os.path.exists(d):
             os.makedirs(d)
 
-def gen_write(file_name, col_names, columns, params=None, precision=4, file_type=None, logger=None):
+def gen_write(file_name, col_names, columns, params=None, precision=4, file_type=None, logger=None,
+              name=None):
     """Write some columns to an output file with the given column names.
 
     We do this basic functionality a lot, so put the code to do it in one place.
@@ -41,6 +42,9 @@ def gen_write(file_name, col_names, columns, params=None, precision=4, file_type
     :param file_type:   Which kind of file to write to. (default: determine from the file_name
                         extension)
     :param logger:      If desired, a logger object for logging. (default: None)
+    :param name:        For HDF5 output, the name of the group to write to.  Other groups already
+                        in the file are kept.  (default: None, which means to write a new file
+                        with the columns at the top level)
     """
     if len(col_names) != len(columns):
         raise ValueError("col_names and columns are not the same length.")
@@ -56,9 +60,11 @@ def gen_write(file_name, col_names, columns, params=None, precision=4, file_type
     # Figure out which file type the catalog is
     if file_type is None:
         import os
-        name, ext = os.path.splitext(file_name)
+        root, ext = os.path.splitext(file_name)
         if ext.lower().startswith('.fit'):
             file_type = 'FITS'
+        elif ext.lower() in ['.hdf5', '.hdf', '.h5']:
+            file_type = 'HDF5'
         else:
             file_type = 'ASCII'
         if logger:  # pragma: no branch  (We always provide a logger.)
@@ -71,6 +77,13 @@ def gen_write(file_name, col_names, columns, params=None, precision=4, file_type
             logger.error("Unable to import fitsio.  Cannot write to %s"%file_name)
             raise
         gen_write_fits(file_name, col_names, columns, params)
+    elif file_type.upper() == 'HDF5':
+        try:
+            import h5py
+        except ImportError:
+            logger.error("Unable to import h5py.  Cannot write to %s"%file_name)
+            raise
+        gen_write_hdf5(file_name, col_names, columns, params, name)
     elif file_type.upper() == 'ASCII':
         gen_write_ascii(file_name, col_names, columns, params, precision=precision)
     else:
@@ -126,7 +139,38 @@ def gen_write_fits(file_name, col_names, columns, params):
     fitsio.write(file_name, data, header=params, clobber=True)
 
 
-def gen_read(file_name, file_type=None, logger=None):
+def gen_write_hdf5(file_name, col_names, columns, params, name=None):
+    """Write some columns to an output HDF5 file with the given column names.
+
+    Each column is written as a separate dataset, so they can be read back without any parsing.
+    If name is given, the columns are written in a group with that name, replacing any previous
+    group of the same name, and leaving any other groups in the file unchanged.  This way many
+    results can be collected in a single file.
+
+    :param file_name:   The name of the file to write to.
+    :param col_names:   A list of columns names for the given columns.
+    :param columns:     A list of numpy arrays with the data to write.
+    :param params:      A dict of extra parameters to write, each as an attribute of the
+                        group.
+    :param name:        The name of the group to write to. (default: None)
+    """
+    import h5py
+    ensure_dir(file_name)
+    with h5py.File(file_name, 'w' if name is None else 'a') as fid:
+        if name is None:
+            group = fid
+        else:
+            if name in fid:
+                del fid[name]
+            group = fid.create_group(name)
+        for (col_name, col) in zip(col_names, columns):
+            group.create_dataset(col_name, data=col)
+        group.attrs['col_names'] = list(col_names)
+        if params is not None:
+            group.attrs.update(params)
+
+
+def gen_read(file_name, file_type=None, logger=None, name=None):
     """Read some columns from an input file.
 
     We do this basic functionality a lot, so put the code to do it in one place.
@@ -137,15 +181,19 @@ def gen_read(file_name, file_type=None, logger=None):
     :param file_type:   Which kind of file to read. (default: determine from the file_name
                         extension)
     :param logger:      If desired, a logger object for logging. (default: None)
+    :param name:        For HDF5 files, the name of the group to read.  Only this group is
+                        read from the file. (default: None)
 
     :returns: (data, params), a numpy ndarray with named columns, and a dict of extra parameters.
     """
     # Figure out which file type the catalog is
     if file_type is None:
         import os
-        name, ext = os.path.splitext(file_name)
+        root, ext = os.path.splitext(file_name)
         if ext.lower().startswith('.fit'):
             file_type = 'FITS'
+        elif ext.lower() in ['.hdf5', '.hdf', '.h5']:
+            file_type = 'HDF5'
         else:
             file_type = 'ASCII'
         if logger:  # pragma: no branch  (We always provide a logger.)
@@ -159,6 +207,25 @@ def gen_read(file_name, file_type=None, logger=None):
             raise
         data = fitsio.read(file_name)
         params = fitsio.read_header(file_name, 1)
+    elif file_type.upper() == 'HDF5':
+        try:
+            import h5py
+        except ImportError:
+            logger.error("Unable to import h5py.  Cannot read %s"%file_name)
+            raise
+        with h5py.File(file_name, 'r') as fid:
+            if name is None:
+                group = fid
+            elif name in fid:
+                group = fid[name]
+            else:
+                raise ValueError("No results named %s in %s"%(name, file_name))
+            col_names = [ str(col_name) for col_name in group.attrs['col_names'] ]
+            data = np.empty(len(group[col_names[0]]), dtype=[ (n,'f8') for n in col_names ])
+            for col_name in col_names:
+                data[col_name] = group[col_name][:]
+            params = dict(group.attrs)
+            del params['col_names']
     elif file_type.upper() == 'ASCII':
         with open(file_name) as fid:
             header = fid.readline()
@@ -245,6 +312,10 @@ class LRU_Cache:
         """Lists all items stored in the cache"""
         return list([v[3] for v in self.cache.values() if v[3] is not None])
 
+    def items(self):
+        """Lists all (key, item) pairs stored in the cache"""
+        return list([(k, v[3]) for k, v in self.cache.items() if v[3] is not None])
+
     @property
     def last_value(self):
         """Return the most recently used value"""
@@ -314,6 +385,19 @@ def double_ptr(x):
         # This works, presumably by ignoring the numpy read_only flag.  Although, I think it's ok.
         return treecorr._ffi.cast('double*', x.ctypes.data)
 
+def float_ptr(x):
+    """
+    Cast x as a float* to pass to library C functions
+
+    :param x:   A numpy array assumed to have dtype = np.float32.
+
+    :returns:   A version of the array that can be passed to cffi C functions.
+    """
+    if x is None:
+        return treecorr._ffi.cast('float*', 0)
+    else:
+        return treecorr._ffi.cast('float*', x.ctypes.data)
+
 def long_ptr(x):
     """
     Cast x as a long* to pass to library C functions
@@ -322,7 +406,7 @@ def long_ptr(x):
 
     :returns:   A version of the array that can be passed to cffi C functions.
     """
-    if x is None:  # pragma: no cover   (I don't ever have x=None for this one.)
+    if x is None:
         return treecorr._ffi.cast('long*', 0)
     else:
         return treecorr._ffi.cast('long*', x.ctypes.data)
@@ -445,8 +529,55 @@ def parse_xyzsep(args, kwargs, _coords):
     Finally, in cases where ra, dec are allowed, a coord.CelestialCoord instance may be
     provided as the first argument.
 
-    :returns: The effective (x, y, z, sep) as a tuple.
+    Any of the above values may also be arrays (with angles given as values along with the
+    corresponding units parameter), in which case they are broadcast to a common length.
+
+    :returns: The effective (x, y, z, sep) as a tuple, either of floats or of 1-d arrays.
+    """
+    x, y, z, sep = _parse_xyz_and('sep', args, kwargs, _coords)
+    if _coords == treecorr._lib.Sphere:
+        if not isinstance(sep, coord.Angle):
+            if 'sep_units' not in kwargs:
+                raise TypeError("Missing required argument sep_units")
+            sep = _apply_angle_units(sep, kwargs.pop('sep_units'))
+        # We actually want the chord distance for this angle.
+        sep = 2. * np.sin(sep/2.)
+    if len(kwargs) > 0:
+        raise TypeError("Invalid kwargs: %s"%(kwargs))
+
+    if np.ndim(x) == 0 and np.ndim(y) == 0 and np.ndim(z) == 0 and np.ndim(sep) == 0:
+        return float(x), float(y), float(z), float(sep)
+    else:
+        # Arrays of target locations and/or separations.  Broadcast them to a common length.
+        x, y, z, sep = np.broadcast_arrays(x, y, z, sep)
+        return tuple(np.ascontiguousarray(a, dtype=float).ravel() for a in (x, y, z, sep))
+
+def parse_xyzk(args, kwargs, _coords):
+    """Parse the different options for passing a coordinate and a number of neighbors, k.
+
+    The allowed parameters are the same as for `parse_xyzsep`, except that k takes the
+    place of sep.
+
+    :returns: The effective (x, y, z, k) as a tuple, where x, y, z are either floats or
+              1-d arrays, and k is an int.
     """
+    x, y, z, k = _parse_xyz_and('k', args, kwargs, _coords)
+    if len(kwargs) > 0:
+        raise TypeError("Invalid kwargs: %s"%(kwargs))
+    if np.ndim(k) != 0 or int(k) != k or k <= 0:
+        raise ValueError("k must be a positive integer")
+
+    if np.ndim(x) == 0 and np.ndim(y) == 0 and np.ndim(z) == 0:
+        return float(x), float(y), float(z), int(k)
+    else:
+        x, y, z = np.broadcast_arrays(x, y, z)
+        x, y, z = (np.ascontiguousarray(a, dtype=float).ravel() for a in (x, y, z))
+        return x, y, z, int(k)
+
+def _parse_xyz_and(name, args, kwargs, _coords):
+    # The implementation of parse_xyzsep and parse_xyzk.  The value given by name is either
+    # the last positional arg or a kwarg.  Its value is returned as is, without any units
+    # being applied.  Other kwargs that aren't used here are left in kwargs.
     radec = False
     if _coords == treecorr._lib.Flat:
         if len(args) == 0:
@@ -454,18 +585,18 @@ def parse_xyzsep(args, kwargs, _coords):
                 raise TypeError("Missing required argument x")
             if 'y' not in kwargs:
                 raise TypeError("Missing required argument y")
-            if 'sep' not in kwargs:
-                raise TypeError("Missing required argument sep")
+            if name not in kwargs:
+                raise TypeError("Missing required argument %s"%name)
             x = kwargs.pop('x')
             y = kwargs.pop('y')
-            sep = kwargs.pop('sep')
+            sep = kwargs.pop(name)
         elif len(args) == 1:
             raise TypeError("x,y should be given as either args or kwargs, not mixed.")
         elif len(args) == 2:
-            if 'sep' not in kwargs:
-                raise TypeError("Missing required argument sep")
+            if name not in kwargs:
+                raise TypeError("Missing required argument %s"%name)
             x,y = args
-            sep = kwargs.pop('sep')
+            sep = kwargs.pop(name)
         elif len(args) == 3:
             x,y,sep = args
         else:
@@ -493,9 +624,9 @@ def parse_xyzsep(args, kwargs, _coords):
                 if 'r' not in kwargs:
                     raise TypeError("Missing required argument r")
                 r = kwargs.pop('r')
-            if 'sep' not in kwargs:
-                raise TypeError("Missing required argument sep")
-            sep = kwargs.pop('sep')
+            if name not in kwargs:
+                raise TypeError("Missing required argument %s"%name)
+            sep = kwargs.pop(name)
         elif len(args) == 1:
             if not isinstance(args[0], coord.CelestialCoord):
                 raise TypeError("Invalid unnamed argument %r"%args[0])
@@ -505,9 +636,9 @@ def parse_xyzsep(args, kwargs, _coords):
             if 'r' not in kwargs:
                 raise TypeError("Missing required argument r")
             r = kwargs.pop('r')
-            if 'sep' not in kwargs:
-                raise TypeError("Missing required argument sep")
-            sep = kwargs.pop('sep')
+            if name not in kwargs:
+                raise TypeError("Missing required argument %s"%name)
+            sep = kwargs.pop(name)
         elif len(args) == 2:
             if isinstance(args[0], coord.CelestialCoord):
                 ra = args[0].ra
@@ -520,9 +651,9 @@ def parse_xyzsep(args, kwargs, _coords):
                 if 'r' not in kwargs:
                     raise TypeError("Missing required argument r")
                 r = kwargs.pop('r')
-            if 'sep' not in kwargs:
-                raise TypeError("Missing required argument sep")
-            sep = kwargs.pop('sep')
+            if name not in kwargs:
+                raise TypeError("Missing required argument %s"%name)
+            sep = kwargs.pop(name)
         elif len(args) == 3:
             if isinstance(args[0], coord.CelestialCoord):
                 ra = args[0].ra
@@ -533,20 +664,20 @@ def parse_xyzsep(args, kwargs, _coords):
             elif isinstance(args[0], coord.Angle):
                 ra, dec, r = args
                 radec = True
-                if 'sep' not in kwargs:
-                    raise TypeError("Missing required argument sep")
-                sep = kwargs.pop('sep')
+                if name not in kwargs:
+                    raise TypeError("Missing required argument %s"%name)
+                sep = kwargs.pop(name)
             elif 'ra_units' in kwargs or 'dec_units' in kwargs:
                 ra, dec, r = args
                 radec = True
-                if 'sep' not in kwargs:
-                    raise TypeError("Missing required argument sep")
-                sep = kwargs.pop('sep')
+                if name not in kwargs:
+                    raise TypeError("Missing required argument %s"%name)
+                sep = kwargs.pop(name)
             else:
                 x, y, z = args
-                if 'sep' not in kwargs:
-                    raise TypeError("Missing required argument sep")
-                sep = kwargs.pop('sep')
+                if name not in kwargs:
+                    raise TypeError("Missing required argument %s"%name)
+                sep = kwargs.pop(name)
         elif len(args) == 4:
             if isinstance(args[0], coord.Angle):
                 ra, dec, r, sep = args
@@ -568,18 +699,18 @@ def parse_xyzsep(args, kwargs, _coords):
             ra = kwargs.pop('ra')
             dec = kwargs.pop('dec')
             radec = True
-            if 'sep' not in kwargs:
-                raise TypeError("Missing required argument sep")
-            sep = kwargs.pop('sep')
+            if name not in kwargs:
+                raise TypeError("Missing required argument %s"%name)
+            sep = kwargs.pop(name)
         elif len(args) == 1:
             if not isinstance(args[0], coord.CelestialCoord):
                 raise TypeError("Invalid unnamed argument %r"%args[0])
             ra = args[0].ra
             dec = args[0].dec
             radec = True
-            if 'sep' not in kwargs:
-                raise TypeError("Missing required argument sep")
-            sep = kwargs.pop('sep')
+            if name not in kwargs:
+                raise TypeError("Missing required argument %s"%name)
+            sep = kwargs.pop(name)
         elif len(args) == 2:
             if isinstance(args[0], coord.CelestialCoord):
                 ra = args[0].ra
@@ -589,36 +720,42 @@ def parse_xyzsep(args, kwargs, _coords):
             else:
                 ra, dec = args
                 radec = True
-                if 'sep' not in kwargs:
-                    raise TypeError("Missing required argument sep")
-                sep = kwargs.pop('sep')
+                if name not in kwargs:
+                    raise TypeError("Missing required argument %s"%name)
+                sep = kwargs.pop(name)
         elif len(args) == 3:
             ra, dec, sep = args
             radec = True
         else:
             raise TypeError("Too many positional args")
-        if not isinstance(sep, coord.Angle):
-            if 'sep_units' not in kwargs:
-                raise TypeError("Missing required argument sep_units")
-            sep = sep * coord.AngleUnit.from_name(kwargs.pop('sep_units'))
-        # We actually want the chord distance for this angle.
-        sep = 2. * np.sin(sep/2.)
 
     if radec:
         if not isinstance(ra, coord.Angle):
             if 'ra_units' not in kwargs:
                 raise TypeError("Missing required argument ra_units")
-            ra = ra * coord.AngleUnit.from_name(kwargs.pop('ra_units'))
+            ra = _apply_angle_units(ra, kwargs.pop('ra_units'))
         if not isinstance(dec, coord.Angle):
             if 'dec_units' not in kwargs:
                 raise TypeError("Missing required argument dec_units")
-            dec = dec * coord.AngleUnit.from_name(kwargs.pop('dec_units'))
-        x,y,z = coord.CelestialCoord(ra, dec).get_xyz()
+            dec = _apply_angle_units(dec, kwargs.pop('dec_units'))
+        if np.ndim(ra) == 0 and np.ndim(dec) == 0:
+            x,y,z = coord.CelestialCoord(ra, dec).get_xyz()
+        else:
+            # For arrays, ra and dec are in radians.  Use the same formulae as CelestialCoord.
+            cosdec = np.cos(dec)
+            x = cosdec * np.cos(ra)
+            y = cosdec * np.sin(ra)
+            z = np.sin(dec)
         if _coords == treecorr._lib.ThreeD:
-            x *= r
-            y *= r
-            z *= r
-    if len(kwargs) > 0:
-        raise TypeError("Invalid kwargs: %s"%(kwargs))
-
-    return float(x), float(y), float(z), float(sep)
+            x = x * r
+            y = y * r
+            z = z * r
+    return x, y, z, sep
+
+def _apply_angle_units(value, units):
+    # Scalars become coord.Angle instances.  Arrays become numpy arrays in radians.
+    units = coord.AngleUnit.from_name(units)
+    if np.ndim(value) == 0:
+        return value * units
+    else:
+        return np.asarray(value, dtype=float) * units.value